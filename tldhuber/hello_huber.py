@@ -2,21 +2,33 @@
 Module for setting up a Streamlit application that searches and summarizes content
 from the Huberman Lab Podcast. Uses llama_index for data indexing and retrieval, and
 OpenAI for text embedding and generation.
+
+openai, llama_index and the modules built on them take seconds to import, so they
+are imported inside the functions that use them, and the page renders without
+them. Once it has rendered, a served app imports them in the background (see
+CHAT_MODULES), so the first chat query does not wait for them either.
 """
 
+# Heavy modules are imported where they are used, see the docstring above
+# pylint: disable=C0415
+
+import importlib
+import os
+import sys
+import threading
+import time
+
 import streamlit as st
-import openai
-from llama_index.core import (
-    StorageContext,
-    load_index_from_storage,
-    get_response_synthesizer,
-    Settings
-)
-from llama_index.core.retrievers import VectorIndexRetriever
-from llama_index.core.query_engine import RetrieverQueryEngine
-from llama_index.core.postprocessor import SimilarityPostprocessor
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding
+
+# `streamlit run tldhuber/hello_huber.py` only puts tldhuber/ on sys.path, so the
+# repository root is added for the tldhuber package to be importable
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+# pylint: disable=C0413
+from tldhuber.utils import metrics
+from tldhuber.utils.clips import extract_metadata, get_mid_video_link
 
 # Configuration of the Streamlit page
 st.set_page_config(
@@ -30,6 +42,70 @@ st.set_page_config(
 # Markdown file path
 MARKDOWN_FILE_PATH = 'docs/tldhuber_side_page.md'
 
+SYSTEM_PROMPT = """Respond as if you are Andrew Huberman. You should answer by
+                summarizing the topic from your context. Always
+                include a direct quote from your podcast related to
+                the response."""
+
+# Per-stage latency histograms, retrieved node counts and LLM token counts, see
+# tldhuber/utils/metrics.py. Both files are rewritten after every answer, and the
+# metrics are also served over HTTP when TLDHUBER_METRICS_PORT is set
+METRICS_PROM_FILE = 'data/metrics.prom'
+METRICS_JSON_FILE = 'data/metrics.json'
+
+# Index directories: the JSON index written by indexing.py, its memory-mapped
+# export written by tldhuber/utils/vector_store.py, the optional approximate
+# nearest neighbour index written by tldhuber/utils/ann_index.py, the optional
+# quantized codes written by tldhuber/utils/quantized_index.py, and the metadata
+# index used to filter searches, written by tldhuber/utils/metadata_index.py
+INDEX_DIR = 'data'
+MMAP_INDEX_DIR = 'data/mmap'
+IVF_INDEX_DIR = 'data/ivf'
+QUANTIZED_INDEX_DIR = 'data/quantized'
+METADATA_INDEX_DIR = 'data/metadata'
+
+# Query embeddings shared by every app worker, see tldhuber/utils/embedding_cache.py
+EMBEDDING_CACHE_PATH = 'data/query_embeddings.sqlite'
+
+# Prebuilt retrieval snapshot written by tldhuber/utils/snapshot.py. When present,
+# its vector, keyword, IVF, quantized and metadata indexes are used instead of the
+# directories above and below, and no JSON index is ever parsed
+SNAPSHOT_DIR = 'data/snapshot'
+
+# Local keyword index written by tldhuber/utils/bm25_index.py. Keyword search
+# needs no API key or network access, and is also the fallback when the API fails
+BM25_INDEX_DIR = 'data/bm25'
+CHAT_MODE = "Chat (OpenAI)"
+KEYWORD_MODE = "Keyword search (offline)"
+
+# Answers to the first question of a conversation are cached by query embedding
+# and served to later questions within this cosine distance, for a day, until
+# the index is rebuilt. See tldhuber/utils/response_cache.py
+RESPONSE_CACHE_MAX_DISTANCE = 0.1
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+RESPONSE_CACHE_SIZE = 512
+
+# Retrieved nodes are merged, deduplicated and packed into this many tokens before
+# they are sent to the LLM, see tldhuber/utils/context_compaction.py
+CONTEXT_TOKEN_BUDGET = 3072
+
+# The modules needed to answer chat queries, preloaded in the background
+CHAT_MODULES = (
+    "openai",
+    "llama_index.core",
+    "llama_index.llms.openai",
+    "llama_index.embeddings.openai",
+    "tldhuber.utils.ann_index",
+    "tldhuber.utils.context_compaction",
+    "tldhuber.utils.embedding_cache",
+    "tldhuber.utils.metadata_index",
+    "tldhuber.utils.quantized_index",
+    "tldhuber.utils.response_cache",
+    "tldhuber.utils.retrievers",
+    "tldhuber.utils.token_counter",
+    "tldhuber.utils.vector_store",
+)
+
 def read_markdown_file(path):
     """
     Reads the content of a markdown file and returns it.
@@ -48,9 +124,11 @@ with st.sidebar:
     openai_api_key = st.text_input("OpenAI API Key", key="chatbot_api_key", type="password")
     st.markdown("[Get an OpenAI API key](https://platform.openai.com/account/api-keys)")
     st.markdown("[View the source code](https://github.com/apeled/TLDhubeR)")
+    search_mode = st.radio("Search mode", [CHAT_MODE, KEYWORD_MODE])
+    # Filled in by metadata_filters once the indexes are found
+    filter_container = st.container()
     st.markdown(read_markdown_file(MARKDOWN_FILE_PATH), unsafe_allow_html=True)
 
-openai.api_key = openai_api_key
 st.title("TLDHubeR: Search and Summarize the Huberman Lab")
 st.info("Hint: Are you a Hubernoob? If so, try searching for sleep!")
 
@@ -66,120 +144,632 @@ def clear_session_state():
     for key in list(st.session_state.keys()):
         del st.session_state[key]
 
+def index_dirs():
+    """
+    Finds the directories of the vector, IVF, quantized, keyword and metadata
+    indexes, preferring the prebuilt snapshot in SNAPSHOT_DIR to MMAP_INDEX_DIR,
+    IVF_INDEX_DIR, QUANTIZED_INDEX_DIR, BM25_INDEX_DIR and METADATA_INDEX_DIR.
+    Only checks for the snapshot's manifest.
+    
+    Returns:
+        dict: The "vectors", "ivf", "quantized", "keyword" and "metadata" directories.
+    """
+    from tldhuber.utils.snapshot import is_snapshot, snapshot_dirs
+    if is_snapshot(SNAPSHOT_DIR):
+        return snapshot_dirs(SNAPSHOT_DIR)
+    return {"vectors": MMAP_INDEX_DIR, "ivf": IVF_INDEX_DIR,
+            "quantized": QUANTIZED_INDEX_DIR, "keyword": BM25_INDEX_DIR,
+            "metadata": METADATA_INDEX_DIR}
+
 @st.cache_resource(show_spinner=False)
 def load_data():
     """
     Loads and indexes the Huberman Lab Podcast data, initializing settings for keyword
-    extraction and text embedding.
+    extraction and text embedding. Query embeddings are cached in memory and in
+    EMBEDDING_CACHE_PATH. The memory-mapped index of the snapshot, or else the
+    memory-mapped export of the index, is used when present, falling back to the
+    JSON-persisted index otherwise.
     
     Returns:
         VectorStoreIndex: The loaded and indexed podcast data.
     """
-    with st.spinner("Loading and indexing the Huberman Lab Podcast!"):
-        Settings.llm = OpenAI(temperature=0.2, model="gpt-3.5-turbo-0125")
-        Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small")
+    from llama_index.core import (
+        StorageContext,
+        VectorStoreIndex,
+        load_index_from_storage,
+        Settings
+    )
+    from llama_index.core.callbacks import CallbackManager
+    from llama_index.embeddings.openai import OpenAIEmbedding
+    from llama_index.llms.openai import OpenAI
+    from tldhuber.utils.embedding_cache import CachedEmbedding
+    from tldhuber.utils.token_counter import LLMTokenCounter
+    from tldhuber.utils.vector_store import MmapVectorStore
+
+    with st.spinner("Loading and indexing the Huberman Lab Podcast!"), metrics.span("load_data"):
+        Settings.llm = OpenAI(
+            temperature=0.2, model="gpt-3.5-turbo-0125",
+            callback_manager=CallbackManager([LLMTokenCounter()])
+        )
+        Settings.embed_model = CachedEmbedding(
+            OpenAIEmbedding(model="text-embedding-3-small"),
+            cache_path=EMBEDDING_CACHE_PATH
+        )
 
-        storage_context_load = StorageContext.from_defaults(persist_dir="data")
+        vectors_dir = index_dirs()["vectors"]
+        if os.path.exists(os.path.join(vectors_dir, "meta.json")):
+            return VectorStoreIndex.from_vector_store(MmapVectorStore(vectors_dir))
+
+        storage_context_load = StorageContext.from_defaults(persist_dir=INDEX_DIR)
         loaded_index = load_index_from_storage(storage_context_load)
 
         return loaded_index
 
-def set_up_engine(loaded_index):
+@st.cache_resource(show_spinner=False)
+def start_metrics_server():
+    """
+    Serves the app's metrics on the port in TLDHUBER_METRICS_PORT, once per process.
+    
+    Returns:
+        ThreadingHTTPServer: The running server, or None if the variable is unset.
+    """
+    port = os.environ.get("TLDHUBER_METRICS_PORT")
+    return metrics.serve(port=int(port)) if port else None
+
+@st.cache_resource(show_spinner=False)
+def preload_chat_modules():
+    """
+    Imports CHAT_MODULES in a background thread, once per process. Only a served
+    app preloads them; imports in bare mode (e.g. in tests) stay lazy.
+    
+    Returns:
+        threading.Thread: The importing thread, or None in bare mode.
+    """
+    if not st.runtime.exists():
+        return None
+
+    def import_modules():
+        for name in CHAT_MODULES:
+            importlib.import_module(name)
+
+    thread = threading.Thread(target=import_modules, name="preload_chat_modules", daemon=True)
+    thread.start()
+    return thread
+
+@st.cache_resource(show_spinner=False)
+def load_response_cache():
+    """
+    Creates the response cache shared by every session of the process.
+    
+    Returns:
+        ResponseCache: An empty cache.
+    """
+    from tldhuber.utils.response_cache import ResponseCache
+    return ResponseCache(max_distance=RESPONSE_CACHE_MAX_DISTANCE, ttl=RESPONSE_CACHE_TTL,
+                         max_size=RESPONSE_CACHE_SIZE)
+
+def index_version():
+    """
+    Fingerprints the files that are rewritten whenever the indexes are rebuilt.
+    
+    Returns:
+        str: A fingerprint that changes when any index is rebuilt.
+    """
+    from tldhuber.utils.response_cache import index_fingerprint
+    dirs = index_dirs()
+    return index_fingerprint([
+        os.path.join(dirs[name], "meta.json")
+        for name in ("vectors", "ivf", "quantized", "keyword", "metadata")
+    ] + [os.path.join(INDEX_DIR, "docstore.json")])
+
+def export_metrics():
+    """
+    Writes the app's metrics to METRICS_PROM_FILE and METRICS_JSON_FILE.
+    """
+    metrics.REGISTRY.write(METRICS_PROM_FILE)
+    metrics.REGISTRY.write(METRICS_JSON_FILE)
+
+def default_retriever_mode():
+    """
+    Picks the approximate "ivf" retriever when its index has been built, then the
+    "quantized" retriever when its codes have been built, and "exact" search
+    otherwise.
+    
+    Returns:
+        str: The retriever mode to pass to set_up_engine.
+    """
+    dirs = index_dirs()
+    if os.path.exists(os.path.join(dirs["ivf"], "meta.json")):
+        return "ivf"
+    if os.path.exists(os.path.join(dirs["quantized"], "meta.json")):
+        return "quantized"
+    return "exact"
+
+def set_up_dense_retriever(loaded_index, retriever_mode="exact"):
+    """
+    Creates the embedding retriever of set_up_engine. An approximate index built
+    on other rows than loaded_index's, e.g. before the index was last updated, is
+    not used, and every node is scored instead.
+    
+    Parameters:
+        loaded_index (VectorStoreIndex): The loaded and indexed podcast data.
+        retriever_mode (str): See set_up_engine.
+        
+    Returns:
+        MatrixRetriever: The retriever, or one of its approximate subclasses.
+    """
+    from tldhuber.utils.ann_index import IVFIndex, IVFRetriever
+    from tldhuber.utils.quantized_index import QuantizedIndex, QuantizedRetriever
+    from tldhuber.utils.retrievers import MatrixRetriever
+    from tldhuber.utils.vector_store import index_signature
+
+    if retriever_mode not in ("exact", "ivf", "quantized"):
+        raise ValueError(f"Unknown retriever mode: {retriever_mode}")
+    approximate = {
+        "ivf": (IVFIndex, IVFRetriever, "ivf_index"),
+        "quantized": (QuantizedIndex, QuantizedRetriever, "quantized_index"),
+    }
+    if retriever_mode in approximate:
+        index_class, retriever_class, argument = approximate[retriever_mode]
+        num_rows, fingerprint = index_signature(loaded_index)
+        try:
+            approximate_index = index_class.load(index_dirs()[retriever_mode],
+                                                 num_rows=num_rows, fingerprint=fingerprint)
+        except ValueError:
+            # The approximate index is stale: search every node
+            approximate_index = None
+        if approximate_index is not None:
+            return retriever_class.from_index(
+                loaded_index, similarity_top_k=10, similarity_cutoff=0.25,
+                **{argument: approximate_index}
+            )
+    return MatrixRetriever.from_index(
+        loaded_index, similarity_top_k=10, similarity_cutoff=0.25
+    )
+
+def set_up_engine(loaded_index, retriever_mode="exact", keyword_index=None):
     """
-    Creates a retriever and query engine using the loaded index.
+    Creates a retriever and query engine using the loaded index. The retriever
+    scores nodes in one vectorized pass and applies the similarity cutoff itself.
+    When a keyword index of the same nodes is given, keyword and dense rankings
+    are fused, which finds exact names and terms with fewer nodes of context.
     
     Parameters:
         loaded_index (VectorStoreIndex): The loaded and indexed podcast data.
+        retriever_mode (str): "exact" scores every node; "ivf" only scans the
+            closest lists of the approximate index; "quantized" scores every node
+            with its int8 or binary codes and re-ranks the best candidates
+            exactly (see index_dirs).
+        keyword_index (BM25Index): The keyword index returned by load_keyword_index,
+            or None for dense retrieval only.
         
     Returns:
         RetrieverQueryEngine: The assembled query engine.
     """
-    retriever = VectorIndexRetriever(index=loaded_index, similarity_top_k=10)
+    from llama_index.core import get_response_synthesizer
+    from llama_index.core.query_engine import RetrieverQueryEngine
+    from tldhuber.utils.retrievers import HybridRetriever
+
+    retriever = set_up_dense_retriever(loaded_index, retriever_mode)
+    if keyword_index is not None:
+        try:
+            retriever = HybridRetriever(retriever, keyword_index, similarity_top_k=5)
+        except ValueError:
+            # The keyword index was built from the transcripts rather than from
+            # this index's nodes, so it can only serve the keyword search mode
+            pass
     response_synthesizer = get_response_synthesizer(response_mode="no_text")
 
     simple_hube_engine = RetrieverQueryEngine.from_args(
         retriever=retriever,
         response_synthesizer=response_synthesizer,
-        node_postprocessors=[SimilarityPostprocessor(similarity_cutoff=0.25)]
     )
     return simple_hube_engine
 
-def get_mid_video_link(link, time_stamp):
+@st.cache_resource(show_spinner=False)
+def load_engine(retriever_mode="exact", use_keyword_index=False):
+    """
+    Builds the query engine once per process, so its retriever (and, for a JSON
+    index, its embedding matrix) is shared by every session and rerun. Sessions
+    filter it through their own SessionRetriever, see set_up_session_retriever.
+    
+    Parameters:
+        retriever_mode (str): See set_up_engine.
+        use_keyword_index (bool): Whether to fuse in the keyword index.
+        
+    Returns:
+        RetrieverQueryEngine: The shared query engine.
+    """
+    return set_up_engine(
+        load_data(), retriever_mode=retriever_mode,
+        keyword_index=load_keyword_index() if use_keyword_index else None
+    )
+
+def set_up_session_retriever(query_engine):
+    """
+    Wraps the shared retriever of a query engine for one session, which keeps the
+    session's metadata filters without changing the shared retriever.
+    
+    Parameters:
+        query_engine (RetrieverQueryEngine): The engine returned by load_engine.
+        
+    Returns:
+        SessionRetriever: The session's retriever.
+    """
+    from tldhuber.utils.retrievers import SessionRetriever
+    return SessionRetriever(query_engine.retriever)
+
+def set_up_chat_engine(retriever):
+    """
+    Creates a context chat engine on the session's retriever, so the nodes
+    retrieved for the LLM context are the same nodes used for video links.
+    Retrieved nodes are compacted into CONTEXT_TOKEN_BUDGET tokens first: the
+    neighbouring chunks of an episode are merged into one clip starting at the
+    earliest timestamp, and near-duplicates are dropped.
+    
+    Parameters:
+        retriever (SessionRetriever): The retriever returned by set_up_session_retriever.
+        
+    Returns:
+        ContextChatEngine: The assembled chat engine.
+    """
+    from llama_index.core.chat_engine import ContextChatEngine
+    from tldhuber.utils.context_compaction import ContextCompactor
+    return ContextChatEngine.from_defaults(
+        retriever=retriever,
+        system_prompt=SYSTEM_PROMPT,
+        node_postprocessors=[ContextCompactor(token_budget=CONTEXT_TOKEN_BUDGET)]
+    )
+
+def keyword_index_available():
+    """
+    Checks whether the keyword index has been built, in the snapshot or in
+    BM25_INDEX_DIR.
+    
+    Returns:
+        bool: True if keyword search can be used.
+    """
+    return os.path.exists(os.path.join(index_dirs()["keyword"], "meta.json"))
+
+@st.cache_resource(show_spinner=False)
+def load_keyword_index():
+    """
+    Loads the local BM25 keyword index. No API key is needed, and neither openai
+    nor llama_index is imported.
+    
+    Returns:
+        BM25Index: The loaded keyword index.
+    """
+    from tldhuber.utils.bm25_index import BM25Index
+    return BM25Index.load(index_dirs()["keyword"])
+
+@st.cache_resource(show_spinner=False)
+def load_metadata_index():
+    """
+    Loads the metadata index of the vector index's rows, which filters chat
+    searches, from the snapshot or METADATA_INDEX_DIR.
+    
+    Returns:
+        MetadataIndex: The loaded index, or None if it has not been built or was
+            built on another export of the vector index.
+    """
+    from tldhuber.utils.metadata_index import MetadataIndex
+    from tldhuber.utils.vector_store import index_signature
+    metadata_dir = index_dirs()["metadata"]
+    if not os.path.exists(os.path.join(metadata_dir, "meta.json")):
+        return None
+    num_rows, fingerprint = index_signature(load_data())
+    try:
+        return MetadataIndex.load(metadata_dir, num_rows=num_rows, fingerprint=fingerprint)
+    except ValueError:
+        # The metadata index is stale: searches are not filtered until it is rebuilt
+        return None
+
+@st.cache_resource(show_spinner=False)
+def load_keyword_metadata_index():
+    """
+    Indexes the metadata of the keyword index's chunks, which filters keyword
+    searches. The keyword index may cover the transcripts rather than the vector
+    index's nodes, so it gets its own metadata index.
+    
+    Returns:
+        MetadataIndex: The built index.
+    """
+    from tldhuber.utils.metadata_index import MetadataIndex
+    return MetadataIndex.build(load_keyword_index().chunks)
+
+def metadata_filters(metadata_index):
+    """
+    Renders the episode, title, guest and time window filters in the sidebar.
+    
+    Parameters:
+        metadata_index (MetadataIndex): Gives the range of the sliders, or None
+            to render no filters.
+        
+    Returns:
+        dict: The filters the user changed, as keyword arguments of
+            MetadataIndex.mask.
+    """
+    if metadata_index is None:
+        return {}
+    filters = {}
+    first, last = metadata_index.episode_range()
+    longest = int(metadata_index.max_timestamp() // 60) + 1
+    with filter_container.expander("Filter episodes"):
+        if first < last:
+            episodes = st.slider("Episode numbers", first, last, (first, last))
+            if episodes != (first, last):
+                filters["episode_min"], filters["episode_max"] = episodes
+        title = st.text_input("Title contains")
+        guest = st.text_input("Guest")
+        minutes = st.slider("Minutes into the episode", 0, longest, (0, longest))
+    if title:
+        filters["title"] = title
+    if guest:
+        filters["guest"] = guest
+    if minutes != (0, longest):
+        filters["start"], filters["end"] = minutes[0] * 60, minutes[1] * 60
+    return filters
+
+def apply_filters(retriever, metadata_index, filters):
+    """
+    Restricts a retriever to the rows that pass the filters, or lifts the
+    restriction when there are none.
+    
+    Parameters:
+        retriever (SessionRetriever): The retriever of the session's chat engine.
+        metadata_index (MetadataIndex): The metadata of the retriever's rows.
+        filters (dict): The filters returned by metadata_filters.
+        
+    Returns:
+        bool: True if the retriever's searches are filtered.
+    """
+    row_mask = None
+    if filters and metadata_index is not None:
+        row_mask = metadata_index.mask(**filters)
+    try:
+        retriever.set_row_mask(row_mask)
+    except ValueError:
+        # The metadata index was built from another version of the vector index
+        retriever.set_row_mask(None)
+        row_mask = None
+    if filters and row_mask is None:
+        st.warning("Build the metadata index of the current vector index to filter "
+                   "chat answers: python -m tldhuber.utils.metadata_index")
+    return row_mask is not None
+
+def keyword_search(bm25_index, query, top_k=10, row_mask=None):
+    """
+    Finds the transcript chunks that best match a keyword query, without any
+    network access.
+    
+    Parameters:
+        bm25_index (BM25Index): The index returned by load_keyword_index.
+        query (str): The user's query.
+        top_k (int): The maximum number of results.
+        row_mask (np.ndarray): Only the chunks where it is True are returned, or
+            every chunk when it is None.
+        
+    Returns:
+        list[dict]: The metadata of the matching chunks, best first, with YouTube
+            links that start at the chunk's timestamp.
+    """
+    results = bm25_index.search_metadata(query, top_k=top_k, row_mask=row_mask)
+    for result in results:
+        result["youtube_link"] = get_mid_video_link(result["youtube_link"], result["timestamp"])
+    return results
+
+def format_keyword_results(results):
     """
-    Modifies a YouTube link to start at a specified time.
+    Formats keyword search results as a markdown list of episodes and clips.
     
     Parameters:
-        link (str): The original YouTube video link.
-        t (int): The start time in seconds.
+        results (list[dict]): The results returned by keyword_search.
         
     Returns:
-        str: The modified YouTube link with the start time parameter.
+        str: The markdown text of the results.
+    """
+    if not results:
+        return "No clips matched those keywords. Try different words."
+    return "\n".join(
+        f"- **{result['episode_title']}**: {result['youtube_link']}" for result in results
+    )
+
+def respond_with_keyword_search(query, filters=None):
+    """
+    Writes keyword search results for a query as the assistant's message, and
+    plays the best matching clip.
+    
+    Parameters:
+        query (str): The user's query.
+        filters (dict): The filters returned by metadata_filters, if any.
+    """
+    with metrics.span("keyword_search"):
+        row_mask = load_keyword_metadata_index().mask(**filters) if filters else None
+        results = keyword_search(load_keyword_index(), query, row_mask=row_mask)
+    content = format_keyword_results(results)
+    st.write(content)
+    st.session_state["messages"].append({"role": "assistant", "content": content})
+    if results:
+        with metrics.span("video_rendering"):
+            st.video(results[0]['youtube_link'], start_time=results[0]['timestamp'])
+    export_metrics()
+
+def render_messages():
+    """
+    Displays the chat history.
     """
-    base_url = link.replace("www.youtube.com/watch?v=", "youtu.be/")
-    return f"{base_url}?t={time_stamp}"
+    for i, message in enumerate(st.session_state["messages"]):
+        with st.chat_message(message["role"], avatar="docs/andrew.jpeg" if i == 0 else None):
+            st.write(message["content"])
 
-def extract_metadata(query_response):
+def cached_answer(response_cache, query):
     """
-    Extracts and transforms metadata from source nodes in a query response.
+    Looks up the answer to a query in the response cache. The query embedding
+    comes from the embedding cache, where retrieval finds it again on a miss.
     
     Parameters:
-        query_response (QueryResponse): The response from a query engine.
+        response_cache (ResponseCache): The cache returned by load_response_cache.
+        query (str): The user's query.
         
     Returns:
-        list[dict]: A list of transformed metadata dictionaries with modified YouTube links.
+        tuple[dict, list[float]]: The cached "answer" and "clips", or None, and
+            the query embedding.
     """
-    metadata_list = [node.metadata for node in query_response.source_nodes]
-    for metadata in metadata_list:
-        base_link = metadata["youtube_link"]
-        start_time = metadata["timestamp"]
-        metadata["youtube_link"] = get_mid_video_link(base_link, start_time)
-    return metadata_list
+    from llama_index.core import Settings
+    with metrics.span("response_cache"):
+        response_cache.validate(index_version())
+        query_embedding = Settings.embed_model.get_query_embedding(query)
+        return response_cache.get(query_embedding), query_embedding
+
+def stream_answer(chat_engine, query, chat_history=None):
+    """
+    Starts a streamed answer to a query. Retrieval is finished when this returns,
+    so the video metadata is available before the first token arrives. The time
+    to the first token and to the end of the answer are recorded in the metrics
+    registry as the "first_token" and "chat" stages.
+    
+    Parameters:
+        chat_engine (ContextChatEngine): The engine returned by set_up_chat_engine.
+        query (str): The user's query.
+        chat_history (list[ChatMessage]): Replaces the chat engine's history
+            before answering, or None to keep it.
+        
+    Returns:
+        tuple[Iterator[str], list[dict]]: The tokens of the answer as they arrive,
+            and the metadata of its source nodes, as returned by extract_metadata.
+    """
+    start = time.perf_counter()
+    if chat_history is None:
+        streaming_response = chat_engine.stream_chat(query)
+    else:
+        streaming_response = chat_engine.stream_chat(query, chat_history=chat_history)
+    metrics.REGISTRY.observe(metrics.RETRIEVED_NODES, len(streaming_response.source_nodes))
+    with metrics.span("extract_metadata"):
+        meta_data = extract_metadata(streaming_response)
+    tokens = metrics.timed_stream(streaming_response.response_gen, start,
+                                  first_stage="first_token", last_stage="chat")
+    return tokens, meta_data
+
+def render_clips(meta_data):
+    """
+    Plays the clip of the best source node, and lists the other clips below it.
+    
+    Parameters:
+        meta_data (list[dict]): The metadata of the source nodes, as returned by
+            extract_metadata.
+    """
+    youtube_links = [episode['youtube_link'] for episode in meta_data]
+    timestamps = [episode['timestamp'] for episode in meta_data]
+    if youtube_links:
+        with metrics.span("video_rendering"):
+            st.video(youtube_links[0], start_time=timestamps[0])
+
+            with st.expander("See additional clips"):
+                unique_youtube_links = set(youtube_links[1:])
+                for episode in unique_youtube_links:
+                    st.write(episode)
+
+def respond_with_chat(chat_engine, query, use_cache=True):
+    """
+    Streams the chat engine's answer to a query into the assistant's message. The
+    clip of the best source node, and the other clips below it, are rendered
+    before the first token so the video loads while the answer is written.
+    
+    The first question of a conversation is answered from the response cache when
+    a similar question was answered before, and its answer is cached otherwise.
+    Later questions depend on the conversation, so they always reach the LLM,
+    with any cached exchanges added to the chat engine's history.
+    
+    Parameters:
+        chat_engine (ContextChatEngine): The engine returned by set_up_chat_engine.
+        query (str): The user's query.
+        use_cache (bool): False skips the response cache, e.g. for filtered
+            searches, whose answers depend on the filters.
+    """
+    from llama_index.core.llms import ChatMessage, MessageRole
+    cached_exchanges = st.session_state.setdefault("cached_exchanges", [])
+    cached, query_embedding = None, None
+    with st.spinner("Thinking..."):
+        if use_cache and not chat_engine.chat_history and not cached_exchanges:
+            cached, query_embedding = cached_answer(load_response_cache(), query)
+        if cached is not None:
+            tokens, meta_data = iter([cached["answer"]]), cached["clips"]
+        else:
+            chat_history = chat_engine.chat_history + cached_exchanges if cached_exchanges else None
+            tokens, meta_data = stream_answer(chat_engine, query, chat_history=chat_history)
+            cached_exchanges.clear()
+    answer_container = st.container()
+    render_clips(meta_data)
+    content = answer_container.write_stream(tokens)
+    if cached is not None:
+        cached_exchanges.extend([ChatMessage(role=MessageRole.USER, content=query),
+                                 ChatMessage(role=MessageRole.ASSISTANT, content=content)])
+    elif query_embedding is not None:
+        load_response_cache().put(query_embedding, content, meta_data)
+    st.session_state["messages"].append({"role": "assistant", "content": content})
+    export_metrics()
 
 # Main application logic
+start_metrics_server()
+use_keyword_search = keyword_index_available() and (
+    search_mode == KEYWORD_MODE or not openai_api_key
+)
 try:
-    if openai.api_key:
-        index = load_data()
-        engine = set_up_engine(index)
+    if use_keyword_search:
+        search_filters = metadata_filters(load_keyword_metadata_index())
+        if prompt := st.chat_input("Keyword Search"):
+            st.session_state["messages"].append({"role": "user", "content": prompt})
+
+        render_messages()
+
+        if st.session_state["messages"][-1]["role"] != "assistant":
+            with st.chat_message("assistant", avatar="docs/andrew.jpeg"):
+                respond_with_keyword_search(prompt, search_filters)
+
+        if st.button("Clear Chat History"):
+            clear_session_state()
+
+    elif openai_api_key:
+        import openai
+        openai.api_key = openai_api_key
+        engine = load_engine(default_retriever_mode(), keyword_index_available())
         if "chat_engine" not in st.session_state:
-            st.session_state["chat_engine"] = index.as_chat_engine(
-                chat_mode="context",
-                system_prompt="""Respond as if you are Andrew Huberman. You should answer by
-                                summarizing the topic from your context. Always
-                                include a direct quote from your podcast related to
-                                the response."""
-            )
+            st.session_state["retriever"] = set_up_session_retriever(engine)
+            st.session_state["chat_engine"] = set_up_chat_engine(st.session_state["retriever"])
+        search_filters = metadata_filters(load_metadata_index())
+        filtered = apply_filters(st.session_state["retriever"], load_metadata_index(),
+                                 search_filters)
 
         if prompt := st.chat_input("Search Query"):
             st.session_state["messages"].append({"role": "user", "content": prompt})
-            vector_response = engine.query(prompt)
-            meta_data = extract_metadata(vector_response)
-            youtube_links = [episode['youtube_link'] for episode in meta_data]
-            timestamps = [episode['timestamp'] for episode in meta_data]
 
-        for i, message in enumerate(st.session_state["messages"]):
-            with st.chat_message(message["role"], avatar="docs/andrew.jpeg" if i == 0 else None):
-                st.write(message["content"])
+        render_messages()
 
         if st.session_state["messages"][-1]["role"] != "assistant":
             with st.chat_message("assistant", avatar="docs/andrew.jpeg"):
-                with st.spinner("Thinking..."):
-                    response = st.session_state["chat_engine"].chat(prompt)
-                    st.write(response.response)
-                    message = {"role": "assistant", "content": response.response}
-                    st.session_state["messages"].append(message)
-                    st.video(youtube_links[0], start_time=timestamps[0])
-
-                    with st.expander("See additional clips"):
-                        unique_youtube_links = set(youtube_links[1:])
-                        for episode in unique_youtube_links:
-                            st.write(episode)
+                try:
+                    respond_with_chat(st.session_state["chat_engine"], prompt,
+                                      use_cache=not filtered)
+                except openai.APIError as api_error:
+                    if not keyword_index_available():
+                        raise
+                    st.warning(f"The OpenAI API is unavailable ({api_error}). "
+                               "Showing keyword search results instead.")
+                    respond_with_keyword_search(prompt, search_filters)
 
         # Button to clear the session state
         if st.button("Clear Chat History"):
             clear_session_state()
 
+    elif search_mode == KEYWORD_MODE:
+        st.warning("Build the keyword index first: python -m tldhuber.utils.bm25_index")
+
 except ValueError as e:
-    if openai.api_key:
+    if openai_api_key:
         st.error(f"An error occurred: {e}. Please check your OpenAPI key and try again.")
     else:
         st.warning("Enter your OpenAPI key in the sidebar.")
+
+# Once the page has rendered, load what the first chat query needs
+preload_chat_modules()
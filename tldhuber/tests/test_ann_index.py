@@ -0,0 +1,147 @@
+"""
+Unit tests for the ann_index module. Builds IVF indexes over synthetic clustered
+embeddings and checks recall against exact search, persistence, and the
+IVFRetriever's per-query nprobe.
+"""
+
+import tempfile
+import unittest
+
+import numpy as np
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import QueryBundle, TextNode
+
+from tldhuber.utils.ann_index import IVFIndex, IVFRetriever, assign_lists
+from tldhuber.utils.vector_store import normalize_rows, top_k_rows
+
+
+def clustered_embeddings(n_rows=2000, dim=32, n_clusters=20, seed=0):
+    """Makes normalized embeddings drawn around a few random cluster centres."""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(n_clusters, dim))
+    labels = rng.integers(0, n_clusters, n_rows)
+    return normalize_rows(centres[labels] + rng.normal(0, 0.3, size=(n_rows, dim)))
+
+
+class TestIVFIndex(unittest.TestCase):
+    """Tests for building, searching and persisting IVFIndex."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.embeddings = clustered_embeddings()
+        cls.ivf_index = IVFIndex.build(cls.embeddings, n_lists=32, seed=1)
+        cls.queries = clustered_embeddings(n_rows=50, seed=0)
+
+    def recall_at_10(self, nprobe):
+        """Returns the average overlap between IVF and exact top 10 results."""
+        hits = 0
+        for query in self.queries:
+            exact = top_k_rows(self.embeddings @ query, 10)
+            approx, _ = self.ivf_index.search(self.embeddings, query, 10, nprobe)
+            hits += len(set(exact) & set(approx))
+        return hits / (10 * len(self.queries))
+
+    def test_every_row_in_one_list(self):
+        """Test that the lists partition the rows."""
+        self.assertEqual(self.ivf_index.n_lists, 32)
+        self.assertEqual(self.ivf_index.list_offsets[-1], self.embeddings.shape[0])
+        np.testing.assert_array_equal(
+            np.sort(self.ivf_index.list_rows), np.arange(self.embeddings.shape[0])
+        )
+
+    def test_rows_are_in_their_closest_list(self):
+        """Test that each row sits in the list of its closest centroid."""
+        assignments = assign_lists(self.embeddings, self.ivf_index.centroids)
+        offsets = self.ivf_index.list_offsets
+        for list_id in range(self.ivf_index.n_lists):
+            rows = self.ivf_index.list_rows[offsets[list_id] : offsets[list_id + 1]]
+            self.assertTrue(np.all(assignments[rows] == list_id))
+
+    def test_recall_grows_with_nprobe(self):
+        """Test that scanning more lists trades latency for recall."""
+        low, high = self.recall_at_10(1), self.recall_at_10(8)
+        self.assertLessEqual(low, high)
+        self.assertGreater(high, 0.9)
+        self.assertEqual(self.recall_at_10(self.ivf_index.n_lists), 1.0)
+
+    def test_save_and_load(self):
+        """Test that a saved index loads back with identical search results."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.ivf_index.save(tmp_dir)
+            loaded = IVFIndex.load(tmp_dir)
+            for query in self.queries[:5]:
+                expected, _ = self.ivf_index.search(self.embeddings, query, 10, 4)
+                actual, _ = loaded.search(self.embeddings, query, 10, 4)
+                np.testing.assert_array_equal(expected, actual)
+
+    def test_load_checks_rows(self):
+        """Test that an index refuses to load for another matrix or export."""
+        num_rows = self.embeddings.shape[0]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.ivf_index.save(tmp_dir, fingerprint="abc")
+            self.assertEqual(IVFIndex.load(tmp_dir, num_rows, "abc").n_lists, 32)
+            self.assertEqual(IVFIndex.load(tmp_dir, num_rows).n_lists, 32)
+            with self.assertRaises(ValueError):
+                IVFIndex.load(tmp_dir, num_rows + 1, "abc")
+            with self.assertRaises(ValueError):
+                IVFIndex.load(tmp_dir, num_rows, "def")
+
+    def test_more_lists_than_samples(self):
+        """Test that training keeps at most one list per sampled row."""
+        ivf_index = IVFIndex.build(self.embeddings, n_lists=64, sample_size=20)
+        self.assertEqual(ivf_index.n_lists, 20)
+        self.assertEqual(len(ivf_index.list_offsets), 21)
+        self.assertEqual(ivf_index.list_offsets[-1], self.embeddings.shape[0])
+
+
+class TestIVFRetriever(unittest.TestCase):
+    """Tests for IVFRetriever."""
+
+    def setUp(self):
+        self.embeddings = clustered_embeddings(n_rows=500, dim=16)
+        self.nodes = [TextNode(text=f"chunk {i}", id_=str(i)) for i in range(500)]
+        self.retriever = IVFRetriever(
+            self.embeddings,
+            lambda rows: [self.nodes[row] for row in rows],
+            embed_model=MockEmbedding(embed_dim=16),
+            similarity_top_k=5,
+            ivf_index=IVFIndex.build(self.embeddings, n_lists=10),
+            nprobe=1,
+        )
+
+    def test_retrieve_returns_sorted_nodes(self):
+        """Test that retrieval returns top_k nodes ordered by score."""
+        query = QueryBundle("query", embedding=self.embeddings[7].tolist())
+        results = self.retriever.retrieve(query)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0].node.node_id, "7")
+        scores = [result.score for result in results]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_per_query_nprobe_is_exact_when_scanning_all_lists(self):
+        """Test that nprobe == n_lists gives the exact top k."""
+        query = QueryBundle("query", embedding=self.embeddings[42].tolist())
+        results = self.retriever.retrieve_with_nprobe(query, nprobe=10)
+        expected = top_k_rows(self.embeddings @ self.embeddings[42], 5)
+        self.assertEqual([r.node.node_id for r in results], [str(row) for row in expected])
+
+    def test_row_mask(self):
+        """Test that filtered searches only return selected rows: exactly for a
+        selective mask, from the probed lists otherwise."""
+        query = QueryBundle("query", embedding=self.embeddings[42].tolist())
+        scores = self.embeddings @ self.embeddings[42]
+        row_mask = np.zeros(500, dtype=bool)
+        row_mask[::25] = True
+        rows, _ = self.retriever.search_rows(query, row_mask)
+        np.testing.assert_array_equal(rows, top_k_rows(np.where(row_mask, scores, -2), 5))
+
+        unfiltered, _ = self.retriever.search_rows(query, nprobe=3)
+        row_mask = np.ones(500, dtype=bool)
+        row_mask[42] = False
+        rows, _ = self.retriever.search_rows(query, row_mask, nprobe=3)
+        np.testing.assert_array_equal(rows[:4], unfiltered[1:])
+        self.assertNotIn(42, rows)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Unit tests for the bm25_index module. Builds small keyword indexes from the test
+transcript and from hand-written chunks, and checks the BM25 ranking, the
+save/load round trip and that searching needs no network access.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from llama_index.core import Document
+
+from tldhuber.utils import indexing
+from tldhuber.utils.bm25_index import BM25Index, tokenize
+
+
+def chunk(text, timestamp):
+    """Makes a Document shaped like a transcript chunk."""
+    return Document(text=text, metadata={
+        "episode_title": "Test episode", "episode_number": "1",
+        "youtube_link": "https://www.youtube.com/watch?v=abc", "timestamp": timestamp,
+        "episode_summary": "Not indexed.",
+    })
+
+
+class TestBM25Index(unittest.TestCase):
+    """Tests for tokenize and BM25Index."""
+
+    def setUp(self):
+        self.bm25_index = BM25Index.build([
+            chunk("Sleep is vital. Get morning sunlight for better sleep.", 0),
+            chunk("Caffeine late in the day delays sleep onset.", 60),
+            chunk("Cold exposure raises dopamine for hours.", 120),
+            chunk("Dopamine, motivation and cold water: how cold showers help.", 180),
+        ])
+
+    def test_tokenize(self):
+        """Test lowercasing, punctuation splitting and stopword removal."""
+        self.assertEqual(tokenize("How does SLEEP affect the brain's focus?"),
+                         ["sleep", "affect", "brain's", "focus"])
+
+    def test_ranking(self):
+        """Test that chunks with more and rarer matching terms rank first."""
+        results = self.bm25_index.search("cold dopamine")
+        self.assertEqual([chunk_id for chunk_id, _ in results], [3, 2])
+        self.assertEqual(self.bm25_index.search("sleep")[0][0], 0)
+
+    def test_no_matches(self):
+        """Test that chunks sharing no term with the query are not returned."""
+        self.assertEqual(self.bm25_index.search("bananas"), [])
+        self.assertEqual(self.bm25_index.search("the and of"), [])
+        self.assertEqual(self.bm25_index.search("sleep", top_k=0), [])
+
+    def test_top_k(self):
+        """Test that at most top_k results are returned, best first."""
+        results = self.bm25_index.search("sleep cold dopamine caffeine", top_k=2)
+        self.assertEqual(len(results), 2)
+        self.assertGreaterEqual(results[0][1], results[1][1])
+
+    def test_row_mask(self):
+        """Test that only the chunks selected by a row mask are returned."""
+        row_mask = np.array([True, True, False, True])
+        results = self.bm25_index.search("cold dopamine", row_mask=row_mask)
+        self.assertEqual([chunk_id for chunk_id, _ in results], [3])
+        self.assertEqual(self.bm25_index.search_metadata("cold", row_mask=~row_mask), [
+            {**self.bm25_index.chunks[2], "score": self.bm25_index.search("cold")[1][1]}
+        ])
+
+    def test_search_metadata(self):
+        """Test that results carry the chunk metadata needed for video links."""
+        result = self.bm25_index.search_metadata("caffeine")[0]
+        self.assertEqual(set(result), {"episode_title", "episode_number",
+                                       "youtube_link", "timestamp", "node_id", "score"})
+        self.assertEqual(result["timestamp"], 60)
+
+    def test_save_and_load(self):
+        """Test that a saved index gives the same scores after loading."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_dir = os.path.join(tmp_dir, "bm25")
+            self.bm25_index.save(out_dir)
+            loaded = BM25Index.load(out_dir)
+            np.testing.assert_allclose(loaded.scores("cold sleep"),
+                                       self.bm25_index.scores("cold sleep"))
+            self.assertEqual(loaded.chunks, self.bm25_index.chunks)
+
+    def test_build_from_transcripts(self):
+        """Test indexing the Documents parsed from the test transcript."""
+        docs = indexing.parse_into_documents(
+            indexing.load_json_transcripts("./tldhuber/tests/test_data")
+        )
+        bm25_index = BM25Index.build(docs)
+        self.assertEqual(bm25_index.num_chunks, len(docs))
+        best = bm25_index.search_metadata("bananas bendy")[0]
+        self.assertEqual(best["timestamp"], docs[3].metadata["timestamp"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+Unit tests for the checkpoint_log module and the ingestion code that uses it.
+Checks the round trip of nodes through the log, recovery from torn and corrupt
+records, automatic resumption of process_documents, and building an index by
+streaming nodes from the log.
+"""
+
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import TextNode
+
+from tldhuber.utils import indexing
+from tldhuber.utils.checkpoint_log import CheckpointLog
+
+
+class TestCheckpointLog(unittest.TestCase):
+    """Tests for CheckpointLog, process_documents resumption and build_index_from_log."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.path = os.path.join(self.tmp_dir.name, "checkpoints", "nodes.log")
+        self.nodes = indexing.unpickle_nodes("./tldhuber/tests/test_data")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        """Test that nodes, metadata and embeddings are read back after reopening."""
+        log = CheckpointLog(self.path)
+        log.append("0:4", self.nodes[:4])
+        log.append("4:8", self.nodes[4:])
+        reopened = CheckpointLog(self.path)
+        self.assertEqual(reopened.completed_keys, {"0:4", "4:8"})
+        nodes = list(reopened.iter_nodes())
+        self.assertEqual([n.node_id for n in nodes], [n.node_id for n in self.nodes])
+        self.assertEqual(nodes[3].metadata, self.nodes[3].metadata)
+        self.assertEqual(nodes[3].embedding, self.nodes[3].embedding)
+
+    def test_torn_tail_is_truncated(self):
+        """Test that a partly written record is dropped and the log stays appendable."""
+        log = CheckpointLog(self.path)
+        log.append("0:4", self.nodes[:4])
+        size = os.path.getsize(self.path)
+        log.append("4:8", self.nodes[4:])
+        with open(self.path, "r+b") as file:
+            file.truncate(size + 100)
+        reopened = CheckpointLog(self.path)
+        self.assertEqual(reopened.completed_keys, {"0:4"})
+        self.assertEqual(os.path.getsize(self.path), size)
+        reopened.append("4:8", self.nodes[4:])
+        self.assertEqual(len(list(CheckpointLog(self.path).iter_nodes())), 8)
+
+    def test_corrupt_record_is_dropped(self):
+        """Test that a record failing its checksum ends the valid part of the log."""
+        log = CheckpointLog(self.path)
+        log.append("0:4", self.nodes[:4])
+        log.append("4:8", self.nodes[4:])
+        with open(self.path, "r+b") as file:
+            file.seek(-10, os.SEEK_END)
+            file.write(b"XXXXXXXXXX")
+        self.assertEqual(CheckpointLog(self.path).completed_keys, {"0:4"})
+
+    def test_process_documents_resumes(self):
+        """Test that a rerun only processes the batches missing from the log."""
+        docs = indexing.parse_into_documents(
+            indexing.load_json_transcripts("./tldhuber/tests/test_data")
+        )
+        pipeline = Mock(indexing.IngestionPipeline)
+        pipeline.run.side_effect = lambda documents: [
+            TextNode(text=doc.text, metadata=doc.metadata) for doc in documents
+        ]
+        log = CheckpointLog(self.path)
+        log.append(indexing.batch_key(docs[:3]), pipeline.run(documents=docs[:3]))
+        pipeline.run.reset_mock()
+
+        indexing.process_documents(
+            docs, pipeline=pipeline, batch_size=3, checkpoint_log=log,
+            scheduler_kwargs={"progress_callback": None},
+        )
+        self.assertEqual(pipeline.run.call_count, 2)
+        self.assertEqual(CheckpointLog(self.path).completed_keys,
+                         set(indexing.batch_keys(docs, batch_size=3)))
+        texts = sorted(node.text for node in log.iter_nodes())
+        self.assertEqual(texts, sorted(doc.text for doc in docs))
+
+        indexing.process_documents(docs, pipeline=pipeline, batch_size=3,
+                                   checkpoint_log=log)
+        self.assertEqual(pipeline.run.call_count, 2)
+
+    def test_edited_documents_are_reprocessed(self):
+        """
+        Test that after documents are inserted or edited, only the batches whose
+        documents changed are processed again, and that the index of the current
+        batches leaves out the stale ones.
+        """
+        docs = indexing.parse_into_documents(
+            indexing.load_json_transcripts("./tldhuber/tests/test_data")
+        )
+        pipeline = Mock(indexing.IngestionPipeline)
+        pipeline.run.side_effect = lambda documents: [
+            TextNode(text=doc.text, metadata=doc.metadata, embedding=[1.0, 0.0])
+            for doc in documents
+        ]
+        log = CheckpointLog(self.path)
+        indexing.process_documents(docs, pipeline=pipeline, batch_size=3, checkpoint_log=log)
+        self.assertEqual(pipeline.run.call_count, 3)
+
+        # Swapping the last two documents changes the last batch only
+        docs[6], docs[7] = docs[7], docs[6]
+        indexing.process_documents(docs, pipeline=pipeline, batch_size=3, checkpoint_log=log)
+        self.assertEqual(pipeline.run.call_count, 4)
+        # Editing a document changes its batch, even at the same position
+        docs[1].set_content("Bananas are bendy because of negative geotropism.")
+        indexing.process_documents(docs, pipeline=pipeline, batch_size=3, checkpoint_log=log)
+        self.assertEqual(pipeline.run.call_count, 5)
+        self.assertEqual(len(CheckpointLog(self.path)), 5)
+
+        index = indexing.build_index_from_log(
+            log, embed_model=MockEmbedding(embed_dim=2),
+            keys=indexing.batch_keys(docs, batch_size=3),
+        )
+        texts = sorted(node.text for node in index.docstore.docs.values())
+        self.assertEqual(texts, sorted(doc.text for doc in docs))
+
+    def test_build_index_from_log(self):
+        """Test that the index holds every logged node with its stored embedding."""
+        log = CheckpointLog(self.path)
+        log.append("0:4", self.nodes[:4])
+        log.append("4:8", self.nodes[4:])
+        index = indexing.build_index_from_log(
+            log, embed_model=MockEmbedding(embed_dim=1536), insert_batch_size=3
+        )
+        self.assertEqual(len(index.index_struct.nodes_dict), 8)
+        node_id = self.nodes[5].node_id
+        self.assertEqual(index.vector_store.get(node_id), self.nodes[5].embedding)
+        self.assertEqual(index.docstore.get_node(node_id).text, self.nodes[5].text)
+
+
+if __name__ == "__main__":
+    unittest.main()
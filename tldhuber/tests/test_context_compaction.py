@@ -0,0 +1,111 @@
+"""
+Unit tests for the context_compaction module. Compacts small hand-made nodes,
+counting words as tokens, and checks merging, deduplication and packing.
+"""
+
+import unittest
+
+from llama_index.core.schema import NodeRelationship, NodeWithScore, RelatedNodeInfo, TextNode
+
+from tldhuber.utils.context_compaction import ContextCompactor, jaccard, shingles
+
+TRANSCRIPT = "one two three four five six seven eight nine ten"
+
+
+def make_node(text, timestamp, score, link="https://www.youtube.com/watch?v=a", **kwargs):
+    """Makes a scored node of a transcript chunk, with metadata hidden from the LLM."""
+    node = TextNode(text=text, metadata={"youtube_link": link, "timestamp": timestamp},
+                    excluded_llm_metadata_keys=["youtube_link", "timestamp"], **kwargs)
+    return NodeWithScore(node=node, score=score)
+
+
+def split_node(start, end, score):
+    """Makes a node of the characters start:end of the transcript chunk "doc"."""
+    node = make_node(TRANSCRIPT[start:end], 180, score,
+                     start_char_idx=start, end_char_idx=end)
+    node.node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id="doc")
+    return node
+
+
+class TestContextCompactor(unittest.TestCase):
+    """Tests for ContextCompactor."""
+
+    def setUp(self):
+        self.calls = []
+
+        def tokenizer(text):
+            self.calls.append(text)
+            return text.split()
+
+        self.compactor = ContextCompactor(token_budget=100, tokenizer=tokenizer)
+
+    def test_overlapping_splits_merge_once(self):
+        """Test that the text shared by two splits of a chunk is kept once."""
+        nodes = [split_node(14, 34, 0.9), split_node(0, 23, 0.5)]
+        result = self.compactor.postprocess_nodes(nodes)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].node.text, TRANSCRIPT[:34])
+        self.assertEqual(result[0].score, 0.9)
+        self.assertEqual(result[0].node.node_id, nodes[0].node.node_id)
+        self.assertEqual(result[0].node.ref_doc_id, "doc")
+
+    def test_neighbouring_chunks_merge(self):
+        """Test that nearby chunks of an episode merge, starting at the earliest."""
+        nodes = [
+            make_node("later chunk about light", 360, 0.8),
+            make_node("earlier chunk about sleep", 180, 0.6),
+            make_node("distant chunk about focus", 3600, 0.7),
+            make_node("other episode chunk", 200, 0.5, link="https://www.youtube.com/watch?v=b"),
+        ]
+        result = self.compactor.postprocess_nodes(nodes)
+        self.assertEqual([node.score for node in result], [0.8, 0.7, 0.5])
+        merged = result[0].node
+        self.assertEqual(merged.text, "earlier chunk about sleep\n\nlater chunk about light")
+        self.assertEqual(merged.metadata["timestamp"], 180)
+        self.assertEqual(merged.excluded_llm_metadata_keys, ["youtube_link", "timestamp"])
+
+    def test_near_duplicates_dropped(self):
+        """Test that a node repeating a better node's text is dropped."""
+        text = "morning sunlight sets the circadian clock and improves sleep at night"
+        nodes = [
+            make_node(text, 0, 0.9),
+            make_node(text + " too", 7200, 0.8, link="https://www.youtube.com/watch?v=b"),
+            make_node("caffeine delays the onset of sleep pressure", 3600, 0.7),
+        ]
+        result = self.compactor.postprocess_nodes(nodes)
+        self.assertEqual([node.score for node in result], [0.9, 0.7])
+
+    def test_packing_skips_nodes_that_do_not_fit(self):
+        """Test that nodes are packed best first, skipping those over the budget."""
+        compactor = ContextCompactor(token_budget=10, tokenizer=str.split)
+        nodes = [
+            make_node("a b c d e f", 0, 0.9),
+            make_node("g h i j k l", 1000, 0.8),
+            make_node("m n o", 2000, 0.7),
+        ]
+        result = compactor.postprocess_nodes(nodes)
+        self.assertEqual([node.node.text for node in result], ["a b c d e f", "m n o"])
+
+    def test_merging_respects_the_budget(self):
+        """Test that neighbours are not merged past the token budget."""
+        compactor = ContextCompactor(token_budget=8, tokenizer=str.split)
+        nodes = [make_node("a b c d e", 0, 0.9), make_node("f g h i j", 180, 0.8)]
+        result = compactor.postprocess_nodes(nodes)
+        self.assertEqual([node.node.text for node in result], ["a b c d e"])
+
+    def test_token_counts_are_cached(self):
+        """Test that each distinct text is only tokenized once."""
+        nodes = [make_node("a b c", 0, 0.9), make_node("d e f", 1000, 0.8)]
+        self.compactor.postprocess_nodes(nodes)
+        self.compactor.postprocess_nodes(nodes)
+        self.assertEqual(sorted(self.calls), ["a b c", "d e f"])
+
+    def test_shingles(self):
+        """Test word 3-gram shingles and their Jaccard similarity."""
+        self.assertEqual(shingles("A b c d"), {("a", "b", "c"), ("b", "c", "d")})
+        self.assertEqual(shingles("a b"), {("a", "b")})
+        self.assertEqual(jaccard(shingles("a b c d"), shingles("b c d e")), 1 / 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+"""
+Unit tests for the embedding_cache module. Uses a counting stand-in for the
+OpenAI embedding model to check that repeated queries skip the model, that the
+LRU stays bounded, and that the on-disk tier is shared between cache instances.
+"""
+
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+from llama_index.core.embeddings import MockEmbedding
+
+from tldhuber.utils.embedding_cache import CachedEmbedding, normalize_query
+
+
+class CountingEmbedding(MockEmbedding):  # pylint: disable=R0901
+    """Mock embedding model that counts and records query embedding calls."""
+
+    calls: int = 0
+    queries: list = []
+
+    def _get_query_embedding(self, query):
+        self.calls += 1
+        self.queries.append(query)
+        return [float(len(query)), 1.0, 0.0]
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+
+class BatchCountingEmbedding(MockEmbedding):  # pylint: disable=R0901
+    """Mock embedding model that records the texts of each batch call."""
+
+    batches: list = []
+
+    async def _aget_text_embeddings(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text)), 1.0, 0.0] for text in texts]
+
+
+class TestCachedEmbedding(unittest.TestCase):
+    """Tests for CachedEmbedding."""
+
+    def setUp(self):
+        self.inner = CountingEmbedding(embed_dim=3, queries=[])
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.cache_path = os.path.join(self.tmp_dir.name, "cache", "queries.sqlite")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_normalize_query(self):
+        """Test that case and whitespace differences map to the same key."""
+        self.assertEqual(normalize_query("  How to   SLEEP\tbetter "), "how to sleep better")
+
+    def test_repeated_query_hits_memory(self):
+        """Test that a repeated query is served from memory without a model call."""
+        cached = CachedEmbedding(self.inner)
+        first = cached.get_query_embedding("sleep")
+        second = cached.get_query_embedding("  Sleep ")
+        self.assertEqual(first, second)
+        self.assertEqual(self.inner.calls, 1)
+        self.assertEqual(cached.stats, {"memory_hits": 1, "disk_hits": 0,
+                                        "misses": 1, "hits": 1})
+
+    def test_model_embeds_original_query(self):
+        """Test that only the cache key is normalized, not the embedded text."""
+        cached = CachedEmbedding(self.inner)
+        cached.get_query_embedding("  What does Andrew Huberman say about NSDR?")
+        asyncio.run(cached.aget_query_embedding("Cold  Plunge"))
+        self.assertEqual(self.inner.queries, ["  What does Andrew Huberman say about NSDR?",
+                                              "Cold  Plunge"])
+        inner = BatchCountingEmbedding(embed_dim=3, batches=[])
+        asyncio.run(CachedEmbedding(inner).aget_query_embedding_batch(["Sleep", "sleep"]))
+        self.assertEqual(inner.batches, [["Sleep"]])
+
+    def test_query_batch(self):
+        """Test that the distinct misses of a batch are embedded in one call."""
+        inner = BatchCountingEmbedding(embed_dim=3, batches=[])
+        cached = CachedEmbedding(inner)
+        embeddings = asyncio.run(cached.aget_query_embedding_batch(["sleep", "light", "Sleep"]))
+        self.assertEqual(inner.batches, [["sleep", "light"]])
+        self.assertEqual(embeddings, [[5.0, 1.0, 0.0], [5.0, 1.0, 0.0], [5.0, 1.0, 0.0]])
+        asyncio.run(cached.aget_query_embedding_batch(["light", "focus"]))
+        self.assertEqual(inner.batches[1], ["focus"])
+
+    def test_lru_eviction(self):
+        """Test that the least recently used query is evicted first."""
+        cached = CachedEmbedding(self.inner, max_size=2)
+        for query in ["a", "b", "a", "c", "a"]:
+            cached.get_query_embedding(query)
+        self.assertEqual(self.inner.calls, 3)
+        cached.get_query_embedding("b")
+        self.assertEqual(self.inner.calls, 4)
+
+    def test_disk_tier_is_shared(self):
+        """Test that a second cache instance reads embeddings from the shared file."""
+        CachedEmbedding(self.inner, cache_path=self.cache_path).get_query_embedding("focus")
+        other = CachedEmbedding(self.inner, cache_path=self.cache_path)
+        self.assertEqual(other.get_query_embedding("Focus"), [5.0, 1.0, 0.0])
+        self.assertEqual(self.inner.calls, 1)
+        self.assertEqual(other.stats["disk_hits"], 1)
+
+    def test_async_query_uses_cache(self):
+        """Test that async query embeddings share the same cache."""
+        cached = CachedEmbedding(self.inner)
+        cached.get_query_embedding("dopamine")
+        embedding = asyncio.run(cached.aget_query_embedding("dopamine"))
+        self.assertEqual(embedding, [8.0, 1.0, 0.0])
+        self.assertEqual(self.inner.calls, 1)
+
+    def test_async_disk_access_leaves_event_loop(self):
+        """Test that async queries read and write the SQLite file in worker threads."""
+        cached = CachedEmbedding(BatchCountingEmbedding(embed_dim=3, batches=[]),
+                                 cache_path=self.cache_path)
+        threads = []
+        disk = cached._disk  # pylint: disable=W0212
+
+        def record_thread():
+            threads.append(threading.current_thread())
+            return disk()
+
+        object.__setattr__(cached, "_disk", record_thread)
+        asyncio.run(cached.aget_query_embedding_batch(["sleep", "light"]))
+        asyncio.run(cached.aget_query_embedding("focus"))
+        self.assertEqual(len(threads), 6)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_text_embeddings_pass_through(self):
+        """Test that document embeddings are delegated to the wrapped model."""
+        cached = CachedEmbedding(self.inner)
+        self.assertEqual(cached.get_text_embedding_batch(["a", "b"]),
+                         self.inner.get_text_embedding_batch(["a", "b"]))
+        self.assertEqual(cached.stats["misses"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
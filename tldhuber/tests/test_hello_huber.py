@@ -9,16 +9,26 @@ mocking to isolate tests from external dependencies, allowing for efficient
 and focused validation of the application logic.
 """
 
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 
 from tldhuber.hello_huber import (read_markdown_file,
                                   load_data,
                                   set_up_engine,
+                                  set_up_chat_engine,
+                                  set_up_session_retriever,
+                                  stream_answer,
+                                  cached_answer,
                                   get_mid_video_link,
-                                  extract_metadata, clear_session_state)
+                                  extract_metadata, clear_session_state,
+                                  keyword_search, format_keyword_results,
+                                  index_dirs, index_version, apply_filters)
 
-class TestHelloHuber(unittest.TestCase):
+class TestHelloHuber(unittest.TestCase):  # pylint: disable=R0904
     """
     A collection of unit tests designed to verify the functionality of
     the hello_huber Streamlit application.
@@ -34,8 +44,8 @@ class TestHelloHuber(unittest.TestCase):
         content = read_markdown_file('fake_path.md')
         self.assertEqual(content, 'Test Markdown Content')
 
-    @patch('tldhuber.hello_huber.load_index_from_storage')
-    @patch('tldhuber.hello_huber.StorageContext.from_defaults')
+    @patch('llama_index.core.load_index_from_storage')
+    @patch('llama_index.core.StorageContext.from_defaults')
     def test_load_data(self, mock_storage_context, mock_load_index):
         """
         Test the `load_data` function to verify that the podcast data is
@@ -46,8 +56,25 @@ class TestHelloHuber(unittest.TestCase):
         result = load_data()
         self.assertIsNotNone(result)
 
-    @patch('tldhuber.hello_huber.VectorIndexRetriever')
-    def test_set_up_engine(self, _):
+    @patch('llama_index.core.VectorStoreIndex.from_vector_store')
+    @patch('tldhuber.utils.vector_store.MmapVectorStore')
+    @patch('tldhuber.utils.snapshot.is_snapshot', return_value=False)
+    @patch('tldhuber.hello_huber.os.path.exists', return_value=True)
+    @patch('llama_index.core.load_index_from_storage')
+    def test_load_data_prefers_mmap_index(self, mock_load_index, _, __, mock_store,
+                                          mock_from_vector_store):
+        """
+        Test that `load_data` uses the memory-mapped export of the index when it
+        exists instead of parsing the JSON-persisted index.
+        """
+        result = load_data()
+        mock_store.assert_called_once_with('data/mmap')
+        mock_from_vector_store.assert_called_once_with(mock_store.return_value)
+        mock_load_index.assert_not_called()
+        self.assertIs(result, mock_from_vector_store.return_value)
+
+    @patch('tldhuber.utils.retrievers.MatrixRetriever')
+    def test_set_up_engine(self, mock_retriever):
         """
         Test the `set_up_engine` function to ensure a query engine is properly
         initialized with the loaded podcast data index.
@@ -55,6 +82,144 @@ class TestHelloHuber(unittest.TestCase):
         mock_index = MagicMock()
         engine = set_up_engine(mock_index)
         self.assertIsNotNone(engine)
+        mock_retriever.from_index.assert_called_once_with(
+            mock_index, similarity_top_k=10, similarity_cutoff=0.25)
+
+    @patch('tldhuber.utils.ann_index.IVFIndex.load')
+    @patch('tldhuber.utils.ann_index.IVFRetriever')
+    def test_set_up_engine_ivf(self, mock_retriever, mock_load):
+        """
+        Test that `set_up_engine` builds an IVF retriever over the persisted
+        approximate index when asked to, and rejects unknown modes.
+        """
+        mock_index = MagicMock()
+        engine = set_up_engine(mock_index, retriever_mode="ivf")
+        self.assertIsNotNone(engine)
+        mock_load.assert_called_once_with('data/ivf', num_rows=0, fingerprint=None)
+        mock_retriever.from_index.assert_called_once_with(
+            mock_index, similarity_top_k=10, similarity_cutoff=0.25,
+            ivf_index=mock_load.return_value)
+        with self.assertRaises(ValueError):
+            set_up_engine(mock_index, retriever_mode="unknown")
+
+    @patch('tldhuber.utils.ann_index.IVFIndex.load', side_effect=ValueError("stale"))
+    @patch('tldhuber.utils.ann_index.IVFRetriever')
+    @patch('tldhuber.utils.retrievers.MatrixRetriever')
+    def test_set_up_engine_stale_ivf(self, mock_matrix, mock_ivf, _):
+        """
+        Test that `set_up_engine` searches exactly when the IVF index was built
+        on other rows than the loaded index.
+        """
+        mock_index = MagicMock()
+        set_up_engine(mock_index, retriever_mode="ivf")
+        mock_ivf.from_index.assert_not_called()
+        mock_matrix.from_index.assert_called_once_with(
+            mock_index, similarity_top_k=10, similarity_cutoff=0.25)
+
+    @patch('tldhuber.utils.quantized_index.QuantizedIndex.load')
+    @patch('tldhuber.utils.quantized_index.QuantizedRetriever')
+    def test_set_up_engine_quantized(self, mock_retriever, mock_load):
+        """
+        Test that `set_up_engine` builds a quantized retriever over the persisted
+        codes when asked to.
+        """
+        mock_index = MagicMock()
+        engine = set_up_engine(mock_index, retriever_mode="quantized")
+        self.assertIsNotNone(engine)
+        mock_load.assert_called_once_with('data/quantized', num_rows=0, fingerprint=None)
+        mock_retriever.from_index.assert_called_once_with(
+            mock_index, similarity_top_k=10, similarity_cutoff=0.25,
+            quantized_index=mock_load.return_value)
+
+    @patch('tldhuber.utils.quantized_index.QuantizedIndex.load',
+           side_effect=ValueError("stale"))
+    @patch('tldhuber.utils.quantized_index.QuantizedRetriever')
+    @patch('tldhuber.utils.retrievers.MatrixRetriever')
+    def test_set_up_engine_stale_quantized(self, mock_matrix, mock_quantized, _):
+        """
+        Test that `set_up_engine` searches exactly when the quantized codes were
+        built on other rows than the loaded index.
+        """
+        mock_index = MagicMock()
+        set_up_engine(mock_index, retriever_mode="quantized")
+        mock_quantized.from_index.assert_not_called()
+        mock_matrix.from_index.assert_called_once_with(
+            mock_index, similarity_top_k=10, similarity_cutoff=0.25)
+
+    @patch('tldhuber.utils.retrievers.HybridRetriever')
+    @patch('tldhuber.utils.retrievers.MatrixRetriever')
+    def test_set_up_engine_hybrid(self, mock_retriever, mock_hybrid):
+        """
+        Test that `set_up_engine` fuses keyword and dense retrieval when given a
+        keyword index, and keeps dense retrieval if the index does not match.
+        """
+        mock_index, mock_keyword_index = MagicMock(), MagicMock()
+        engine = set_up_engine(mock_index, keyword_index=mock_keyword_index)
+        mock_hybrid.assert_called_once_with(
+            mock_retriever.from_index.return_value, mock_keyword_index, similarity_top_k=5)
+        self.assertIs(engine.retriever, mock_hybrid.return_value)
+        mock_hybrid.side_effect = ValueError("not built from this index")
+        engine = set_up_engine(mock_index, keyword_index=mock_keyword_index)
+        self.assertIs(engine.retriever, mock_retriever.from_index.return_value)
+
+    @patch('llama_index.core.chat_engine.ContextChatEngine.from_defaults')
+    def test_set_up_chat_engine_shares_retriever(self, mock_from_defaults):
+        """
+        Test that the chat engine is built on a session view of the shared query
+        engine's retriever, so a prompt is only embedded and retrieved once.
+        """
+        mock_query_engine = MagicMock()
+        mock_query_engine.retriever.num_rows = 3
+        retriever = set_up_session_retriever(mock_query_engine)
+        self.assertIs(retriever.retriever, mock_query_engine.retriever)
+        chat_engine = set_up_chat_engine(retriever)
+        self.assertIs(chat_engine, mock_from_defaults.return_value)
+        self.assertIs(mock_from_defaults.call_args.kwargs['retriever'], retriever)
+        postprocessors = mock_from_defaults.call_args.kwargs['node_postprocessors']
+        self.assertEqual([type(p).__name__ for p in postprocessors], ['ContextCompactor'])
+
+    def test_stream_answer_metadata_before_tokens(self):
+        """
+        Test that `stream_answer` makes one streaming chat call, returns the video
+        metadata before the answer is read, and then passes every token through.
+        """
+        mock_chat_engine = MagicMock()
+        mock_chat_engine.stream_chat.return_value = MagicMock(
+            response_gen=iter(["Sleep ", "is ", "vital."]),
+            source_nodes=[MagicMock(metadata={
+                'youtube_link': 'https://www.youtube.com/watch?v=example', 'timestamp': 42
+            })]
+        )
+        tokens, metadata = stream_answer(mock_chat_engine, "sleep")
+        mock_chat_engine.stream_chat.assert_called_once_with("sleep")
+        self.assertEqual(metadata[0]['youtube_link'], 'https://youtu.be/example?t=42')
+        self.assertEqual("".join(tokens), "Sleep is vital.")
+
+    def test_stream_answer_with_history(self):
+        """
+        Test that `stream_answer` passes a replacement chat history to the engine.
+        """
+        mock_chat_engine = MagicMock()
+        mock_chat_engine.stream_chat.return_value = MagicMock(response_gen=iter([]),
+                                                              source_nodes=[])
+        history = [MagicMock()]
+        stream_answer(mock_chat_engine, "sleep", chat_history=history)
+        mock_chat_engine.stream_chat.assert_called_once_with("sleep", chat_history=history)
+
+    @patch('tldhuber.hello_huber.index_version', return_value="v1")
+    @patch('llama_index.core.Settings')
+    def test_cached_answer(self, mock_settings, _):
+        """
+        Test that `cached_answer` looks up the query embedding in the response
+        cache, after validating the cache against the index version.
+        """
+        mock_settings.embed_model.get_query_embedding.return_value = [1.0, 0.0]
+        mock_cache = MagicMock()
+        cached, query_embedding = cached_answer(mock_cache, "sleep")
+        mock_cache.validate.assert_called_once_with("v1")
+        mock_cache.get.assert_called_once_with([1.0, 0.0])
+        self.assertIs(cached, mock_cache.get.return_value)
+        self.assertEqual(query_embedding, [1.0, 0.0])
 
     def test_get_mid_video_link(self):
         """
@@ -93,8 +258,8 @@ class TestHelloHuber(unittest.TestCase):
         self.assertEqual(len(mock_session_state), 0,
                          "Session state should be empty after clearing.")
 
-    @patch('tldhuber.hello_huber.load_index_from_storage', return_value=MagicMock())
-    @patch('tldhuber.hello_huber.StorageContext.from_defaults', return_value=MagicMock())
+    @patch('llama_index.core.load_index_from_storage', return_value=MagicMock())
+    @patch('llama_index.core.StorageContext.from_defaults', return_value=MagicMock())
     def test_load_data_failure(self, _, mock_load_index):
         """Test load_data behavior when indexing fails."""
         mock_load_index.side_effect = Exception("Indexing failed")
@@ -150,5 +315,121 @@ class TestHelloHuber(unittest.TestCase):
         self.assertTrue('' not in unique_links, "Empty links should be ignored.")
         self.assertEqual(len(unique_links), 2, "Duplicate links should be filtered out.")
 
+    def test_keyword_search_links(self):
+        """
+        Test that keyword search results get YouTube links starting at the
+        timestamp of the matching chunk, best result first.
+        """
+        mock_bm25_index = MagicMock()
+        mock_bm25_index.search_metadata.return_value = [
+            {'episode_title': 'Sleep', 'youtube_link': 'https://www.youtube.com/watch?v=abc',
+             'timestamp': 42, 'score': 3.0},
+        ]
+        results = keyword_search(mock_bm25_index, 'sleep', top_k=5)
+        mock_bm25_index.search_metadata.assert_called_once_with('sleep', top_k=5,
+                                                                 row_mask=None)
+        self.assertEqual(results[0]['youtube_link'], 'https://youtu.be/abc?t=42')
+
+    def test_format_keyword_results(self):
+        """
+        Test the markdown list of keyword search results, and the message shown
+        when nothing matched.
+        """
+        content = format_keyword_results([
+            {'episode_title': 'Sleep', 'youtube_link': 'https://youtu.be/abc?t=42'},
+            {'episode_title': 'Focus', 'youtube_link': 'https://youtu.be/def?t=7'},
+        ])
+        self.assertEqual(content.splitlines(), ['- **Sleep**: https://youtu.be/abc?t=42',
+                                                '- **Focus**: https://youtu.be/def?t=7'])
+        self.assertIn('No clips matched', format_keyword_results([]))
+
+    @patch('tldhuber.utils.snapshot.is_snapshot')
+    def test_index_dirs_prefers_snapshot(self, mock_is_snapshot):
+        """
+        Test that the indexes of a prebuilt snapshot are used when it exists, and
+        the separately built indexes otherwise.
+        """
+        mock_is_snapshot.return_value = False
+        self.assertEqual(index_dirs(), {'vectors': 'data/mmap', 'ivf': 'data/ivf',
+                                        'quantized': 'data/quantized',
+                                        'keyword': 'data/bm25',
+                                        'metadata': 'data/metadata'})
+        mock_is_snapshot.return_value = True
+        self.assertEqual(index_dirs(), {'vectors': 'data/snapshot/vectors',
+                                        'ivf': 'data/snapshot/ivf',
+                                        'quantized': 'data/snapshot/quantized',
+                                        'keyword': 'data/snapshot/bm25',
+                                        'metadata': 'data/snapshot/metadata'})
+
+    @patch('tldhuber.hello_huber.index_dirs')
+    def test_index_version_covers_every_index(self, mock_index_dirs):
+        """
+        Test that rebuilding any of the indexes, including the quantized and
+        metadata indexes, changes the version the response cache is keyed on.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mock_index_dirs.return_value = {
+                name: os.path.join(tmp_dir, name)
+                for name in ('vectors', 'ivf', 'quantized', 'keyword', 'metadata')
+            }
+            versions = [index_version()]
+            for name in ('quantized', 'metadata'):
+                os.makedirs(os.path.join(tmp_dir, name))
+                with open(os.path.join(tmp_dir, name, 'meta.json'), 'w',
+                          encoding='utf-8') as file:
+                    file.write('{}')
+                versions.append(index_version())
+        self.assertEqual(len(set(versions)), 3)
+
+    @patch('tldhuber.hello_huber.st.warning')
+    def test_apply_filters(self, mock_warning):
+        """
+        Test that filters restrict the retriever to the matching rows, and that
+        the restriction is lifted without filters or without a matching metadata
+        index.
+        """
+        mock_retriever = MagicMock()
+        mock_metadata_index = MagicMock()
+        self.assertTrue(apply_filters(mock_retriever, mock_metadata_index, {'guest': 'walker'}))
+        mock_metadata_index.mask.assert_called_once_with(guest='walker')
+        mock_retriever.set_row_mask.assert_called_with(mock_metadata_index.mask.return_value)
+
+        self.assertFalse(apply_filters(mock_retriever, mock_metadata_index, {}))
+        mock_retriever.set_row_mask.assert_called_with(None)
+        mock_warning.assert_not_called()
+
+        mock_retriever.set_row_mask.side_effect = [ValueError('misaligned'), None]
+        self.assertFalse(apply_filters(mock_retriever, mock_metadata_index, {'guest': 'walker'}))
+        mock_retriever.set_row_mask.assert_called_with(None)
+        mock_warning.assert_called_once()
+
+    def test_import_is_lazy(self):
+        """
+        Test that rendering the page without an API key imports neither openai
+        nor llama_index.
+        """
+        code = ("import sys, tldhuber.hello_huber; "
+                "print(sorted({'openai', 'llama_index.core'} & set(sys.modules)))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                                text=True, check=True).stdout
+        self.assertEqual(output.strip().splitlines()[-1], "[]")
+
+    def test_runs_as_streamlit_script(self):
+        """
+        Test that the app runs the way `streamlit run tldhuber/hello_huber.py`
+        runs it: as a script, with only tldhuber/ on sys.path.
+        """
+        app_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "hello_huber.py")
+        code = ("import runpy, sys; "
+                f"sys.path = [{os.path.dirname(app_path)!r}] + "
+                f"[path for path in sys.path[1:] if path != {os.getcwd()!r}]; "
+                f"runpy.run_path({app_path!r}, run_name='__main__'); print('started')")
+        env = {key: value for key, value in os.environ.items() if key != "PYTHONPATH"}
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                                text=True, check=False, env=env)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip().splitlines()[-1], "started")
+
 if __name__ == '__main__':
     unittest.main()
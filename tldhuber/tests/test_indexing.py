@@ -5,10 +5,19 @@ using mocking. The index generation code was only intended to be run once, but
 writing these tests was still good practice.
 """
 
+import json
+import os
+import tempfile
 import unittest
+from typing import Iterator
 from unittest.mock import Mock
 
+from llama_index.core import Document, VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import TransformComponent
+
 from tldhuber.utils import indexing
+from tldhuber.utils.content_store import ContentStore
 
 
 def is_list_of_dicts(data):
@@ -89,5 +98,154 @@ class TestIndexingFuctions(unittest.TestCase):
         self.assertEqual(written_nodes, expected_nodes)
 
 
+class TestStreamingLoader(unittest.TestCase):
+    """Tests for the parallel, per-episode transcript loader."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        with open("./tldhuber/tests/test_data/test.json", "r", encoding="utf-8") as file:
+            transcript = json.load(file)
+        for ep_num in range(5):
+            with open(os.path.join(self.tmp_dir.name, f"ep_{ep_num}.json"), "w",
+                      encoding="utf-8") as file:
+                json.dump({**transcript, "ep_num": ep_num}, file)
+        with open(os.path.join(self.tmp_dir.name, "notes.txt"), "w", encoding="utf-8") as file:
+            file.write("not a transcript")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_iter_json_transcripts_in_order(self):
+        """Test that transcripts are yielded lazily, in file name order."""
+        transcripts = indexing.iter_json_transcripts(self.tmp_dir.name, max_workers=2)
+        self.assertIsInstance(transcripts, Iterator)
+        self.assertEqual([t["ep_num"] for t in transcripts], [0, 1, 2, 3, 4])
+
+    def test_episodes_match_parse_into_documents(self):
+        """Test that streamed episodes hold the same Documents as the list API."""
+        expected = indexing.parse_into_documents(
+            indexing.load_json_transcripts(self.tmp_dir.name)
+        )
+        for use_processes in (False, True):
+            episodes = list(indexing.iter_episode_documents(
+                self.tmp_dir.name, max_workers=2, use_processes=use_processes
+            ))
+            self.assertEqual(len(episodes), 5)
+            self.assertTrue(all(
+                doc.metadata["episode_number"] == ep_num
+                for ep_num, episode in enumerate(episodes) for doc in episode
+            ))
+            streamed = [doc for episode in episodes for doc in episode]
+            self.assertEqual([(d.text, d.metadata) for d in streamed],
+                             [(d.text, d.metadata) for d in expected])
+            self.assertEqual(streamed[0].excluded_llm_metadata_keys,
+                             ["episode_summary", "timestamp", "youtube_link"])
+
+
+class CountingKeywords(TransformComponent):
+    """Stand-in for KeywordExtractor that counts the nodes it is given."""
+
+    calls: int = 0
+
+    def __call__(self, nodes, **kwargs):
+        self.calls += len(nodes)
+        for node in nodes:
+            node.metadata["excerpt_keywords"] = node.text.split()[0]
+        return nodes
+
+
+class TestIncrementalIndexing(unittest.TestCase):
+    """
+    Tests for update_index and seed_content_store, using a counting keyword
+    transformation and a mock embedding model instead of the OpenAI API.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.store = ContentStore(os.path.join(self.tmp_dir.name, "content.sqlite"))
+        self.embed_model = MockEmbedding(embed_dim=8)
+        self.keywords = CountingKeywords()
+        self.index = VectorStoreIndex([], embed_model=self.embed_model)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def load_docs(self):
+        """Parses fresh Document objects from the test transcript."""
+        return indexing.parse_into_documents(
+            indexing.load_json_transcripts("./tldhuber/tests/test_data")
+        )
+
+    def update(self, docs, **kwargs):
+        """Runs update_index with the counting transformations."""
+        return indexing.update_index(
+            docs, self.index, self.store,
+            transformations=[self.keywords, self.embed_model], **kwargs
+        )
+
+    def test_first_run_processes_everything(self):
+        """Test that an empty index gets every document and node processed."""
+        stats = self.update(self.load_docs())
+        self.assertEqual(stats["new"], 8)
+        self.assertEqual(stats["processed_nodes"], 8)
+        self.assertEqual(len(self.index.index_struct.nodes_dict), 8)
+
+    def test_unchanged_documents_are_skipped(self):
+        """Test that a second run over the same corpus does no work."""
+        self.update(self.load_docs())
+        stats = self.update(self.load_docs())
+        self.assertEqual(stats["unchanged"], 8)
+        self.assertEqual(self.keywords.calls, 8)
+        self.assertEqual(len(self.index.index_struct.nodes_dict), 8)
+
+    def test_changed_and_new_documents(self):
+        """Test that only changed and new text reaches the transformations."""
+        self.update(self.load_docs())
+        docs = self.load_docs()
+        docs[3].set_content("Bananas are bendy because of negative geotropism.")
+        extra = Document(text="A brand new chunk at the end of the episode.",
+                         metadata={**docs[0].metadata, "timestamp": 9999})
+        stats = self.update(docs + [extra])
+        self.assertEqual((stats["changed"], stats["new"], stats["unchanged"]), (1, 1, 7))
+        self.assertEqual(stats["processed_nodes"], 2)
+        self.assertEqual(self.keywords.calls, 10)
+        texts = {node.text for node in self.index.docstore.docs.values()}
+        self.assertIn("Bananas are bendy because of negative geotropism.", texts)
+        self.assertNotIn("But seriously, why are bananas so bendy?", texts)
+        self.assertEqual(len(self.index.index_struct.nodes_dict), 9)
+
+    def test_reverted_text_is_served_from_store(self):
+        """Test that text seen before is not re-processed even after a change."""
+        self.update(self.load_docs())
+        docs = self.load_docs()
+        docs[0].set_content("Temporary edit.")
+        self.update(docs)
+        stats = self.update(self.load_docs())
+        self.assertEqual((stats["changed"], stats["cached_nodes"]), (1, 1))
+        self.assertEqual(stats["processed_nodes"], 0)
+
+    def test_prune_removes_missing_documents(self):
+        """Test that pruning deletes documents no longer in the corpus."""
+        self.update(self.load_docs())
+        stats = self.update(self.load_docs()[:5], prune=True)
+        self.assertEqual(stats["removed"], 3)
+        self.assertEqual(len(self.index.index_struct.nodes_dict), 5)
+        self.assertEqual(len(self.store.manifest()), 5)
+
+    def test_seed_from_existing_index(self):
+        """
+        Test that an index built by main() can be seeded, so the first update
+        replaces its nodes without calling the transformations.
+        """
+        nodes = indexing.unpickle_nodes("./tldhuber/tests/test_data")
+        self.index = VectorStoreIndex(nodes, embed_model=MockEmbedding(embed_dim=1536))
+        self.assertEqual(indexing.seed_content_store(self.index, self.store), 8)
+        stats = self.update(self.load_docs())
+        self.assertEqual((stats["changed"], stats["cached_nodes"]), (8, 8))
+        self.assertEqual(self.keywords.calls, 0)
+        self.assertEqual(len(self.index.index_struct.nodes_dict), 8)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,206 @@
+"""
+Unit tests for the ingestion_scheduler module. Rate limiting, retries and
+bounded concurrency are tested with fake pipelines, and a full ingestion run is
+tested against a local stub of the OpenAI embeddings endpoint, so no real
+network requests are made.
+"""
+
+import asyncio
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llama_index.core import Document
+from llama_index.core.ingestion import IngestionPipeline
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.embeddings.openai import OpenAIEmbedding
+
+from tldhuber.utils import indexing
+from tldhuber.utils.ingestion_scheduler import (IngestionScheduler, TokenBucket,
+                                                estimate_requests, is_rate_limit_error,
+                                                pipeline_embed_batch_size)
+
+
+class RateLimited(Exception):
+    """Exception shaped like an API client's HTTP 429 error."""
+
+    status_code = 429
+
+
+class FakePipeline:  # pylint: disable=R0903
+    """Pipeline double that fails with 429 a few times and tracks concurrency."""
+
+    def __init__(self, failures=0, delay=0.0):
+        self.failures = failures
+        self.delay = delay
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def run(self, documents):
+        """Returns one fake node per document, after the configured failures."""
+        with self._lock:
+            self.calls += 1
+            if self.failures > 0:
+                self.failures -= 1
+                raise RateLimited()
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+        return [f"node for {doc.text}" for doc in documents]
+
+
+class StubEmbeddingHandler(BaseHTTPRequestHandler):
+    """Serves POST /v1/embeddings like the OpenAI API, with constant vectors."""
+
+    requests_served = 0
+
+    def do_POST(self):  # pylint: disable=C0103
+        """Answers an embeddings request."""
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        payload = json.dumps({
+            "object": "list",
+            "model": body["model"],
+            "data": [{"object": "embedding", "index": i, "embedding": [0.5, 0.5, 0.5]}
+                     for i in range(len(texts))],
+            "usage": {"prompt_tokens": 1, "total_tokens": 1},
+        }).encode("utf-8")
+        StubEmbeddingHandler.requests_served += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        """Keeps test output quiet."""
+
+
+def docs(*texts):
+    """Makes a batch of Documents with the given texts."""
+    return [Document(text=text) for text in texts]
+
+
+def quiet_scheduler_kwargs(**kwargs):
+    """Scheduler settings with progress printing turned off."""
+    return {"progress_callback": None, **kwargs}
+
+
+class TestIngestionScheduler(unittest.TestCase):
+    """Tests for IngestionScheduler and TokenBucket."""
+
+    def test_token_bucket_paces_requests(self):
+        """Test that an empty bucket waits for tokens at the configured rate."""
+        async def take(bucket, times):
+            for _ in range(times):
+                await bucket.acquire()
+
+        bucket = TokenBucket(rate_per_minute=1200, capacity=1)
+        started = time.monotonic()
+        asyncio.run(take(bucket, 5))
+        self.assertGreaterEqual(time.monotonic() - started, 0.18)
+
+    def test_estimate_requests(self):
+        """Test that a batch is charged one request per embedding call, and none
+        for keywords."""
+        documents = [Document(text="sleep")] * 25
+        self.assertEqual(estimate_requests(documents, embed_batch_size=10), 3)
+        self.assertEqual(estimate_requests(documents, embed_batch_size=100), 1)
+        pipeline = IngestionPipeline(transformations=[
+            SentenceSplitter(), OpenAIEmbedding(api_key="sk-test", embed_batch_size=100)
+        ])
+        self.assertEqual(pipeline_embed_batch_size(pipeline), 100)
+        self.assertEqual(pipeline_embed_batch_size(IngestionPipeline(transformations=[])), 10)
+
+    def test_is_rate_limit_error(self):
+        """Test detection of 429 errors by status code."""
+        self.assertTrue(is_rate_limit_error(RateLimited()))
+        self.assertFalse(is_rate_limit_error(ValueError()))
+
+    def test_retries_rate_limited_batches(self):
+        """Test that 429 errors are retried with backoff and then succeed."""
+        pipeline = FakePipeline(failures=2)
+        done = {}
+        scheduler = IngestionScheduler(pipeline, backoff_base=0.01,
+                                       **quiet_scheduler_kwargs())
+        progress = scheduler.run([(0, docs("a", "b"))], done.__setitem__)
+        self.assertEqual(done, {0: ["node for a", "node for b"]})
+        self.assertEqual(progress["retries"], 2)
+        self.assertEqual(pipeline.calls, 3)
+
+    def test_gives_up_after_max_retries(self):
+        """Test that a batch that keeps failing raises the last error."""
+        scheduler = IngestionScheduler(FakePipeline(failures=10), max_retries=1,
+                                       backoff_base=0.01, **quiet_scheduler_kwargs())
+        with self.assertRaises(RateLimited):
+            scheduler.run([(0, docs("a"))], lambda key, nodes: None)
+
+    def test_concurrency_is_bounded(self):
+        """Test that no more than max_concurrency batches run at once."""
+        pipeline = FakePipeline(delay=0.05)
+        scheduler = IngestionScheduler(pipeline, max_concurrency=2,
+                                       **quiet_scheduler_kwargs())
+        batches = [(i, docs(str(i))) for i in range(6)]
+        progress = scheduler.run(batches, lambda key, nodes: None)
+        self.assertEqual(pipeline.max_in_flight, 2)
+        self.assertEqual(progress["batches_done"], 6)
+        self.assertGreater(progress["documents_per_second"], 0)
+
+    def test_progress_callback(self):
+        """Test that progress is reported after every batch."""
+        reports = []
+        scheduler = IngestionScheduler(FakePipeline(), progress_callback=reports.append)
+        scheduler.run([(0, docs("a")), (1, docs("b", "c"))], lambda key, nodes: None)
+        self.assertEqual([r["batches_done"] for r in reports], [1, 2])
+        self.assertEqual(reports[-1]["documents_done"], 3)
+
+
+class TestIngestionAgainstStubServer(unittest.TestCase):
+    """Runs process_documents through OpenAIEmbedding against a local stub server."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubEmbeddingHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        StubEmbeddingHandler.requests_served = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_process_documents_with_stub_embeddings(self):
+        """Test that every batch is embedded by the stub and checkpointed."""
+        test_docs = indexing.parse_into_documents(
+            indexing.load_json_transcripts("./tldhuber/tests/test_data")
+        )
+        embed_model = OpenAIEmbedding(
+            api_key="fake",
+            api_base=f"http://127.0.0.1:{self.server.server_address[1]}/v1",
+            max_retries=0,
+        )
+        pipeline = IngestionPipeline(
+            transformations=[SentenceSplitter(chunk_size=1024), embed_model]
+        )
+        written = {}
+
+        def dump(nodes, filename):
+            written[filename] = nodes
+
+        indexing.process_documents(
+            test_docs, pipeline=pipeline, dump_object_func=dump, batch_size=3,
+            scheduler_kwargs=quiet_scheduler_kwargs(max_concurrency=3),
+        )
+        self.assertEqual(set(written), {"nodes_0.pkl", "nodes_3.pkl", "nodes_final.pkl"})
+        nodes = [node for batch in written.values() for node in batch]
+        self.assertEqual(len(nodes), len(test_docs))
+        self.assertTrue(all(node.embedding == [0.5, 0.5, 0.5] for node in nodes))
+        self.assertEqual(StubEmbeddingHandler.requests_served, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+Unit tests for the keyword_extractor module. Extracts keywords from hand-made
+texts, checks that corpus statistics, worker processes and batch statistics
+behave as expected, and runs the extractor in an ingestion pipeline in place of
+KeywordExtractor.
+"""
+
+import unittest
+
+from llama_index.core import Document
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.ingestion import IngestionPipeline
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import TextNode
+
+from tldhuber.utils import indexing, keyword_extractor
+from tldhuber.utils.keyword_extractor import TfidfKeywordExtractor, term_counts
+
+TEXTS = [
+    "Sleep sleep and the circadian rhythm. Morning sunlight helps sleep.",
+    "Dopamine drives motivation, and sunlight in the morning raises dopamine.",
+    "Cold exposure raises dopamine for hours after the cold plunge.",
+    "Morning sunlight, morning light and morning routines.",
+]
+
+
+class TestTfidfKeywordExtractor(unittest.TestCase):
+    """Tests for TfidfKeywordExtractor."""
+
+    def test_term_counts(self):
+        """Test that stopwords, numbers and short words are not candidates."""
+        self.assertEqual(term_counts(["The 10 big benefits of sleep, 10 of them"]),
+                         [{"big": 1, "benefits": 1, "sleep": 1}])
+
+    def test_corpus_statistics(self):
+        """Test that terms frequent in a text but rare in the corpus rank first."""
+        extractor = TfidfKeywordExtractor(keywords=2, num_workers=1).fit(TEXTS)
+        self.assertTrue(extractor.is_fitted)
+        self.assertEqual(extractor.extract_keywords(TEXTS),
+                         [["sleep", "circadian"], ["dopamine", "drives"],
+                          ["cold", "exposure"], ["morning", "light"]])
+
+    def test_unseen_terms(self):
+        """Test that terms missing from the fitted corpus count as the rarest."""
+        extractor = TfidfKeywordExtractor(keywords=1, num_workers=1).fit(TEXTS)
+        self.assertEqual(extractor.extract_keywords(["morning sunlight and glutamine"]),
+                         [["glutamine"]])
+        self.assertEqual(extractor.extract_keywords(["", "a 12"]), [[], []])
+
+    def test_batch_statistics(self):
+        """Test that an extractor that was not fitted uses the texts it is given."""
+        extractor = TfidfKeywordExtractor(keywords=2, num_workers=1)
+        self.assertEqual(extractor.extract_keywords(TEXTS),
+                         TfidfKeywordExtractor(keywords=2).fit(TEXTS).extract_keywords(TEXTS))
+        self.assertFalse(extractor.is_fitted)
+
+    def test_worker_processes(self):
+        """Test that worker processes extract the same keywords as this process."""
+        texts = TEXTS * 300
+        serial = TfidfKeywordExtractor(num_workers=1).fit(texts)
+        parallel = TfidfKeywordExtractor(num_workers=2, min_parallel_texts=1).fit(texts)
+        self.assertEqual(parallel.extract_keywords(texts), serial.extract_keywords(texts))
+
+    def test_in_process_extraction_keeps_worker_stats(self):
+        """Test that extracting in this process leaves the worker statistics unset."""
+        TfidfKeywordExtractor(num_workers=1).fit(TEXTS).extract_keywords(TEXTS * 300)
+        self.assertEqual(keyword_extractor._worker_stats, {})  # pylint: disable=W0212
+
+    def test_excerpt_keywords(self):
+        """Test that keywords are written to excerpt_keywords, like KeywordExtractor."""
+        nodes = [TextNode(text=text, metadata={"episode_title": "Sleep Toolkit"})
+                 for text in TEXTS]
+        extractor = TfidfKeywordExtractor(keywords=3, num_workers=1).fit(TEXTS)
+        nodes = extractor(nodes)
+        self.assertEqual(nodes[2].metadata["excerpt_keywords"], "cold, exposure, hours")
+        self.assertEqual(nodes[2].metadata["episode_title"], "Sleep Toolkit")
+
+    def test_ingestion_pipeline(self):
+        """Test that the extractor replaces KeywordExtractor in an ingestion pipeline."""
+        documents = [Document(text=text) for text in TEXTS]
+        extractor = indexing.keyword_extractor(documents)
+        self.assertTrue(extractor.is_fitted)
+        pipeline = IngestionPipeline(transformations=[
+            SentenceSplitter(chunk_size=1024), extractor, MockEmbedding(embed_dim=8)
+        ])
+        nodes = pipeline.run(documents=documents)
+        self.assertEqual(nodes[3].metadata["excerpt_keywords"],
+                         "morning, light, routines, sunlight")
+        self.assertEqual([len(node.metadata["excerpt_keywords"].split(", ")) for node in nodes],
+                         [5, 5, 5, 4])
+        self.assertTrue(all(len(node.embedding) == 8 for node in nodes))
+        self.assertIsInstance(indexing.default_pipeline(documents).transformations[1],
+                              TfidfKeywordExtractor)
+
+
+if __name__ == "__main__":
+    unittest.main()
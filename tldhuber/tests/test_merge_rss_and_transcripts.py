@@ -3,15 +3,31 @@ This module contains unit tests for the merge_rss_and_transcripts function. It t
 various scenarios including successful data merging, handling empty YouTube playlists,
 and cases where there are more RSS entries than YouTube videos. The tests ensure that
 the function behaves as expected under different conditions by mocking external dependencies
-and verifying the function's output.
+and verifying the function's output. It also tests matching videos to RSS entries by
+title and date, and re-merging into the append-only output file.
 """
 
+import os
+import tempfile
 import unittest
-from unittest.mock import patch, mock_open
+from unittest.mock import patch
 
 import pandas as pd
 
-from tldhuber.utils.merge_rss_and_transcripts import merge_rss_and_transcripts
+from tldhuber.utils.merge_rss_and_transcripts import (
+    EpisodeIndex,
+    merge_rss_and_transcripts,
+    normalize_title,
+    read_merged_entries,
+)
+
+MODULE = "tldhuber.utils.merge_rss_and_transcripts"
+
+
+def playlist_item(video_id, title, published_at=None):
+    """Makes a playlist item of the YouTube Data API."""
+    return {"contentDetails": {"videoId": video_id},
+            "snippet": {"title": title, "publishedAt": published_at}}
 
 
 class TestMergeRSSAndTranscripts(unittest.TestCase):
@@ -20,78 +36,150 @@ class TestMergeRSSAndTranscripts(unittest.TestCase):
     def setUp(self):
         """Set up mock data for testing, including mock RSS data and YouTube playlist items."""
         self.mock_rss_data = pd.DataFrame({
-            "Title": ["Episode 1", "Episode 2"],
-            "Publication Date": ["2023-01-01", "2023-01-02"],
-            "Summary": ["Summary 1", "Summary 2"],
-            "Enclosure Link": ["http://example.com/1", "http://example.com/2"],
+            "Title": ["Episode 2", "Episode 1"],
+            "Publication Date": ["2023-01-02", "2023-01-01"],
+            "Summary": ["Summary 2", "Summary 1"],
+            "Enclosure Link": ["http://example.com/2", "http://example.com/1"],
         })
 
         self.mock_playlist_items = [
-            {"contentDetails": {"videoId": "12345"}, "snippet": {"title": "Video 1"}},
-            {"contentDetails": {"videoId": "67890"}, "snippet": {"title": "Video 2"}},
+            playlist_item("67890", "Episode 2 | Huberman Lab Podcast #2", "2023-01-02T13:00:00Z"),
+            playlist_item("12345", "Episode 1 | Huberman Lab Podcast #1", "2023-01-01T13:00:00Z"),
         ]
-
-    @patch("tldhuber.utils.merge_rss_and_transcripts.get_playlist_items")
-    @patch("tldhuber.utils.merge_rss_and_transcripts.get_channel_upload_playlist_id_by_channelid",
-           return_value="some_playlist_id")
-    @patch("tldhuber.utils.merge_rss_and_transcripts.scrape_rss_data")
-    def test_merge_success(self, mock_scrape_rss_data, _, mock_get_playlist_items):
-        """Test successful merging of RSS and YouTube data."""
-        mock_scrape_rss_data.return_value = self.mock_rss_data
-        mock_get_playlist_items.return_value = self.mock_playlist_items
-
-        with patch("builtins.open",
-                   new_callable=mock_open) as mocked_open, patch("json.dump")as mocked_json_dump:
-            merge_rss_and_transcripts("fake_api_key", "fake_channel_id", "fake_rss_feed_url")
-
-            self.assertEqual(mocked_open.call_count, len(self.mock_playlist_items))
-            mocked_json_dump.assert_called()
-
-    @patch("tldhuber.utils.merge_rss_and_transcripts.scrape_rss_data")
-    @patch("tldhuber.utils.merge_rss_and_transcripts.get_playlist_items")
-    @patch("tldhuber.utils.merge_rss_and_transcripts.get_channel_upload_playlist_id_by_channelid",
-           return_value="some_playlist_id")
-    def test_more_rss_entries_than_youtube_videos(self, _, mock_get_playlist_items,
-                                                  mock_scrape_rss_data):
+        self.transcripts = {"12345": [{"text": "hi", "start": 0.0, "duration": 1.5}]}
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.output_path = os.path.join(self.tmp_dir.name, "merged", "episodes.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def merge(self, rss_data, playlist_items):
+        """Runs merge_rss_and_transcripts on mock data, returning the appended entries."""
+        with patch(f"{MODULE}.scrape_rss_data", return_value=rss_data), \
+                patch(f"{MODULE}.get_channel_upload_playlist_id_by_channelid",
+                      return_value="some_playlist_id"), \
+                patch(f"{MODULE}.refresh_playlist_items", return_value=playlist_items), \
+                patch(f"{MODULE}.fetch_transcripts", return_value=self.transcripts) as fetch:
+            changed = merge_rss_and_transcripts("fake_api_key", "fake_channel_id",
+                                                "fake_rss_feed_url",
+                                                output_path=self.output_path)
+        self.assertEqual(fetch.call_args.args[1],
+                         [item["contentDetails"]["videoId"] for item in playlist_items])
+        return changed
+
+    def test_merge_success(self):
+        """Test successful merging of RSS and YouTube data, with the fetched transcripts."""
+        self.merge(self.mock_rss_data, self.mock_playlist_items)
+
+        entries, _ = read_merged_entries(self.output_path)
+        self.assertEqual(list(entries), ["67890", "12345"])
+        self.assertEqual(entries["12345"]["podcast_title"], "Episode 1")
+        self.assertEqual(entries["12345"]["summary"], "Summary 1")
+        self.assertEqual(entries["12345"]["transcript"][0]["text"], "hi")
+        self.assertEqual(entries["67890"]["enclosure_link"], "http://example.com/2")
+        self.assertIsNone(entries["67890"]["transcript"])
+
+    def test_more_rss_entries_than_youtube_videos(self):
         """Test processing when there are more RSS entries than YouTube videos."""
         mock_rss_data_extended = pd.DataFrame({
-            'Title': ['Episode 1', 'Episode 2', 'Episode 3'],
-            'Publication Date': ['2023-01-01', '2023-01-02', '2023-01-03'],
-            'Summary': ['Summary 1', 'Summary 2', 'Summary 3'],
-            'Enclosure Link': ['http://example.com/1', 'http://example.com/2',
-                               'http://example.com/3']
+            'Title': ['Episode 3', 'Episode 2', 'Episode 1'],
+            'Publication Date': ['2023-01-03', '2023-01-02', '2023-01-01'],
+            'Summary': ['Summary 3', 'Summary 2', 'Summary 1'],
+            'Enclosure Link': ['http://example.com/3', 'http://example.com/2',
+                               'http://example.com/1']
         })
-        mock_scrape_rss_data.return_value = mock_rss_data_extended
-        mock_get_playlist_items.return_value = self.mock_playlist_items
-
-        with patch("builtins.open", mock_open()) as mock_file_open, patch("json.dump"):
-            merge_rss_and_transcripts("fake_api_key", "fake_channel_id", "fake_rss_feed_url")
-
-            self.assertEqual(mock_file_open.call_count, len(self.mock_playlist_items))
-
-    @patch('tldhuber.utils.merge_rss_and_transcripts.get_channel_upload_playlist_id_by_channelid',
-           return_value="some_playlist_id")
-    @patch('tldhuber.utils.merge_rss_and_transcripts.get_playlist_items')
-    @patch('tldhuber.utils.merge_rss_and_transcripts.scrape_rss_data')
-    def test_more_youtube_videos_than_rss_entries(self, mock_scrape_rss_data,
-                                                  mock_get_playlist_items, _):
-        """Test processing when there are more YouTube video entries than RSS feed entries."""
-        mock_rss_data = pd.DataFrame({
-            'Title': ['Episode 1'],
-            'Publication Date': ['2023-01-01'],
-            'Summary': ['Summary 1'],
-            'Enclosure Link': ['http://example.com/1']
-        })
-        mock_scrape_rss_data.return_value = mock_rss_data
-        mock_get_playlist_items.return_value = [
-            {"contentDetails": {"videoId": "12345"}, "snippet": {"title": "Video 1"}},
-            {"contentDetails": {"videoId": "67890"}, "snippet": {"title": "Video 2"}}
-        ]
+        changed = self.merge(mock_rss_data_extended, self.mock_playlist_items)
+
+        self.assertEqual([entry["podcast_title"] for entry in changed],
+                         ["Episode 2", "Episode 1"])
+
+    def test_more_youtube_videos_than_rss_entries(self):
+        """Test processing when there are more YouTube video entries than RSS feed entries,
+        such as a trailer inserted before the episodes."""
+        playlist_items = [playlist_item("00000", "Trailer: Season 2", "2023-01-03T13:00:00Z")]
+        changed = self.merge(self.mock_rss_data, playlist_items + self.mock_playlist_items)
+
+        self.assertEqual(len(changed), 3)
+        self.assertEqual(changed[0]["podcast_title"], "Trailer: Season 2")
+        self.assertIsNone(changed[0]["publication_date"])
+        self.assertEqual([entry["podcast_title"] for entry in changed[1:]],
+                         ["Episode 2", "Episode 1"])
+
+    def test_remerge_appends_only_changes(self):
+        """Test that a re-merge only appends the entries that are new or changed."""
+        self.merge(self.mock_rss_data, self.mock_playlist_items)
+        self.assertEqual(self.merge(self.mock_rss_data, self.mock_playlist_items), [])
+
+        self.transcripts["67890"] = [{"text": "new", "start": 0.0, "duration": 1.0}]
+        changed = self.merge(self.mock_rss_data, self.mock_playlist_items)
+        self.assertEqual([entry["video_id"] for entry in changed], ["67890"])
+        with open(self.output_path, "r", encoding="utf-8") as file:
+            self.assertEqual(len(file.readlines()), 3)
+        entries, _ = read_merged_entries(self.output_path)
+        self.assertEqual(entries["67890"]["transcript"][0]["text"], "new")
+
+    def test_failed_fetch_keeps_transcript(self):
+        """Test that a transcript that failed to fetch does not replace the merged one."""
+        self.merge(self.mock_rss_data, self.mock_playlist_items)
+        del self.transcripts["12345"]
+        self.assertEqual(self.merge(self.mock_rss_data, self.mock_playlist_items), [])
+        entries, _ = read_merged_entries(self.output_path)
+        self.assertEqual(entries["12345"]["transcript"][0]["text"], "hi")
+
+    def test_torn_last_line_is_dropped(self):
+        """Test that a line torn by an interrupted write is dropped before appending."""
+        self.merge(self.mock_rss_data, self.mock_playlist_items[:1])
+        with open(self.output_path, "a", encoding="utf-8") as file:
+            file.write('{"video_id": "12345", "podc')
+
+        self.assertEqual(list(read_merged_entries(self.output_path)[0]), ["67890"])
+        self.merge(self.mock_rss_data, self.mock_playlist_items)
+        entries, valid_length = read_merged_entries(self.output_path)
+        self.assertEqual(list(entries), ["67890", "12345"])
+        self.assertEqual(valid_length, os.path.getsize(self.output_path))
+
+
+class TestEpisodeIndex(unittest.TestCase):
+    """Test cases for matching videos to RSS entries."""
 
-        with patch("builtins.open", mock_open()) as mock_file_open, patch("json.dump"):
-            merge_rss_and_transcripts("fake_api_key", "fake_channel_id", "fake_rss_feed_url")
+    def setUp(self):
+        self.episode_index = EpisodeIndex([
+            {"Title": "Dr. Andy Galpin: How to Build Strength, Muscle Size & Endurance",
+             "Publication Date": "Mon, 16 Jan 2023 08:00:00 GMT"},
+            {"Title": "Ask Me Anything", "Publication Date": "Mon, 02 Jan 2023 08:00:00 GMT"},
+            {"Title": "Ask Me Anything", "Publication Date": "Mon, 09 Jan 2023 08:00:00 GMT"},
+            {"Title": "Tools for Managing Stress & Anxiety",
+             "Publication Date": "Mon, 07 Mar 2022 08:00:00 GMT"},
+        ])
+
+    def test_normalize_title(self):
+        """Test that titles are normalized without suffix, case and punctuation."""
+        self.assertEqual(normalize_title("Dr. Andy Galpin: Strength & Endurance | "
+                                         "Huberman Lab Podcast #65"),
+                         "dr andy galpin strength and endurance")
+
+    def test_exact_title_match_closest_date(self):
+        """Test that entries with the same title are matched closest in date first, once."""
+        self.assertEqual(self.episode_index.match("Ask Me Anything | Huberman Lab",
+                                                  "2023-01-09T12:00:00Z")["Publication Date"],
+                         "Mon, 09 Jan 2023 08:00:00 GMT")
+        self.assertEqual(self.episode_index.match("Ask Me Anything",
+                                                  "2023-01-09T12:00:00Z")["Publication Date"],
+                         "Mon, 02 Jan 2023 08:00:00 GMT")
+        self.assertIsNone(self.episode_index.match("Ask Me Anything", "2023-01-09T12:00:00Z"))
+
+    def test_fuzzy_match_within_date_window(self):
+        """Test that slightly different titles are matched near the entry's date only."""
+        title = "Andy Galpin - How To Build Strength, Muscle Size & Stamina"
+        self.assertIsNone(self.episode_index.match(title, "2023-03-01T12:00:00Z"))
+        self.assertEqual(self.episode_index.match(title, "2023-01-17T12:00:00Z")["Title"],
+                         "Dr. Andy Galpin: How to Build Strength, Muscle Size & Endurance")
+
+    def test_no_match(self):
+        """Test that unrelated videos, such as clips, are not matched."""
+        self.assertIsNone(self.episode_index.match("How to Reduce Stress", "2022-03-07"))
+        self.assertIsNone(self.episode_index.match(""))
 
-            self.assertEqual(mock_file_open.call_count, len(self.mock_rss_data))
 
 if __name__ == "__main__":
     unittest.main()
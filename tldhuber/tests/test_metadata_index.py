@@ -0,0 +1,130 @@
+"""
+Unit tests for the metadata_index module. Indexes hand-made node metadata and
+checks every filter, their combination, and persistence.
+"""
+
+import tempfile
+import unittest
+
+import numpy as np
+
+from tldhuber.utils.metadata_index import MetadataIndex, guest_from_title
+
+TITLES = {
+    "1": "Dr. Matthew Walker: The Science & Practice of Perfecting Your Sleep",
+    "2": "How to Focus to Change Your Brain | Huberman Lab Podcast #6",
+    "3": "Dr. Andy Galpin: How to Build Strength, Muscle Size & Endurance",
+}
+
+
+def metadata(episode_number, timestamp):
+    """Makes the metadata of a transcript chunk of one of the TITLES."""
+    return {"episode_title": TITLES[episode_number], "episode_number": episode_number,
+            "youtube_link": f"https://www.youtube.com/watch?v={episode_number}",
+            "timestamp": timestamp}
+
+
+class TestMetadataIndex(unittest.TestCase):
+    """Tests for MetadataIndex and guest_from_title."""
+
+    def setUp(self):
+        self.metadata_index = MetadataIndex.build([
+            metadata("1", 0), metadata("1", 180), metadata("1", 3600),
+            metadata("2", 0), metadata("2", 180),
+            metadata("3", 0), metadata("3", 5400),
+            {"episode_title": "Unnumbered", "episode_number": "bonus", "timestamp": None},
+        ])
+
+    def assert_rows(self, row_mask, rows):
+        """Asserts that a row mask selects exactly the given rows."""
+        np.testing.assert_array_equal(np.flatnonzero(row_mask), rows)
+
+    def test_guest_from_title(self):
+        """Test that guests are read before the colon of a title, if any."""
+        self.assertEqual(guest_from_title(TITLES["1"]), "Dr. Matthew Walker")
+        self.assertEqual(guest_from_title(TITLES["2"]), "")
+        self.assertEqual(guest_from_title("Using Science to Optimize Sleep, Learning & "
+                                          "Metabolism: Part 2"), "")
+
+    def test_guest_from_series_titles(self):
+        """Test that series and topic titles with a colon have no guest."""
+        for title in ("AMA #10: Benefits of Nature & \u201cGrounding,\u201d",
+                      "Sleep Toolkit: Tools for Optimizing Sleep & Sleep-Wake Timing",
+                      "Mental Health Toolkit: Tools to Bolster Your Mood & Mental Health",
+                      "Ketamine: Benefits and Risks for Depression, PTSD & Neuroplasticity",
+                      "LIVE EVENT Q&A: Dr. Andrew Huberman Question & Answer in Seattle, WA",
+                      "Huberman Lab Essentials: Tools for Focus",
+                      "The Science of MDMA & Its Therapeutic Uses: Benefits & Risks",
+                      "Adderall, Stimulants & Modafinil for ADHD: Short- & Long-Term Effects"):
+            self.assertEqual(guest_from_title(title), "", title)
+        self.assertEqual(guest_from_title("Chris Voss: How to Succeed at Hard Conversations"),
+                         "Chris Voss")
+        self.assertEqual(guest_from_title("Dr. Immordino-Yang: How Emotions & Social Factors "
+                                          "Impact Learning"), "Dr. Immordino-Yang")
+        self.assertEqual(guest_from_title("GUEST SERIES | Dr. Paul Conti: How to Improve Your "
+                                          "Mental Health"), "Dr. Paul Conti")
+        self.assertEqual(guest_from_title("Mark Zuckerberg & Dr. Priscilla Chan: Curing All "
+                                          "Human Diseases"), "Mark Zuckerberg & Dr. Priscilla Chan")
+
+    def test_columns(self):
+        """Test that every row gets its episode, episode number and timestamp."""
+        self.assertEqual(self.metadata_index.num_rows, 8)
+        self.assertEqual(len(self.metadata_index.titles), 4)
+        np.testing.assert_array_equal(self.metadata_index.episode_ids,
+                                      [0, 0, 0, 1, 1, 2, 2, 3])
+        self.assertEqual(self.metadata_index.episode_numbers[-1], -1)
+        self.assertTrue(np.isnan(self.metadata_index.timestamps[-1]))
+        self.assertEqual(self.metadata_index.episode_range(), (1, 3))
+        self.assertEqual(self.metadata_index.max_timestamp(), 5400)
+
+    def test_no_filters(self):
+        """Test that no mask is built without filters."""
+        self.assertIsNone(self.metadata_index.mask())
+        self.assertIsNone(self.metadata_index.mask(title="", guest=None))
+
+    def test_episode_range(self):
+        """Test that episode ranges are inclusive and skip unnumbered episodes."""
+        self.assert_rows(self.metadata_index.mask(episode_min=2), [3, 4, 5, 6])
+        self.assert_rows(self.metadata_index.mask(episode_max=2), [0, 1, 2, 3, 4])
+        self.assert_rows(self.metadata_index.mask(episode_min=2, episode_max=2), [3, 4])
+
+    def test_title_and_guest(self):
+        """Test that titles and guests match substrings, ignoring case."""
+        self.assert_rows(self.metadata_index.mask(title="how to"), [3, 4, 5, 6])
+        self.assert_rows(self.metadata_index.mask(guest="walker"), [0, 1, 2])
+        self.assert_rows(self.metadata_index.mask(guest="focus"), [])
+        self.assert_rows(self.metadata_index.mask(title="no such episode"), [])
+
+    def test_time_window(self):
+        """Test that time windows select moments within every episode."""
+        self.assert_rows(self.metadata_index.mask(start=60, end=3600), [1, 2, 4])
+        self.assert_rows(self.metadata_index.mask(start=3600), [2, 6])
+
+    def test_combined_filters(self):
+        """Test that combined filters select the rows passing all of them."""
+        self.assert_rows(self.metadata_index.mask(title="how to", guest="dr.", end=60), [5])
+
+    def test_save_and_load(self):
+        """Test that a saved index gives the same masks after loading."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.metadata_index.save(tmp_dir)
+            loaded = MetadataIndex.load(tmp_dir)
+        self.assertEqual(loaded.titles, self.metadata_index.titles)
+        self.assertEqual(loaded.guests, self.metadata_index.guests)
+        np.testing.assert_array_equal(loaded.mask(guest="galpin", start=0),
+                                      self.metadata_index.mask(guest="galpin", start=0))
+
+    def test_load_checks_rows(self):
+        """Test that an index refuses to load for another vector index or export."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.metadata_index.save(tmp_dir, fingerprint="abc")
+            self.assertEqual(MetadataIndex.load(tmp_dir, 8, "abc").num_rows, 8)
+            self.assertEqual(MetadataIndex.load(tmp_dir, 8).num_rows, 8)
+            with self.assertRaises(ValueError):
+                MetadataIndex.load(tmp_dir, 9, "abc")
+            with self.assertRaises(ValueError):
+                MetadataIndex.load(tmp_dir, 8, "def")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+Unit tests for the metrics and token_counter modules. Checks the histograms and
+their quantiles, the stage spans, the Prometheus and JSON exports, the token
+counting callback and the local HTTP endpoint.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+import urllib.request
+
+import numpy as np
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import QueryBundle, TextNode
+
+from tldhuber.utils import metrics
+from tldhuber.utils.retrievers import MatrixRetriever
+from tldhuber.utils.token_counter import LLMTokenCounter
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for Histogram, MetricsRegistry, LLMTokenCounter and serve."""
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_histogram(self):
+        """Test the bucket counts, sum and quantiles of a histogram."""
+        histogram = metrics.Histogram((1, 5, 10))
+        for value in [0.5, 1, 3, 7, 100]:
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative_counts(),
+                         [("1", 2), ("5", 3), ("10", 4), ("+Inf", 5)])
+        self.assertEqual(histogram.sum, 111.5)
+        self.assertEqual(histogram.quantile(0.5), 3)
+        self.assertIsNone(metrics.Histogram((1,)).quantile(0.5))
+
+    def test_span(self):
+        """Test that spans record a duration per stage, also when the block raises."""
+        with self.registry.span("retrieval"):
+            pass
+        with self.assertRaises(KeyError):
+            with self.registry.span("chat"):
+                raise KeyError("failed")
+        self.assertEqual(self.registry.get(metrics.STAGE_SECONDS, stage="retrieval").count, 1)
+        self.assertEqual(self.registry.get(metrics.STAGE_SECONDS, stage="chat").count, 1)
+        self.assertIsNone(self.registry.get(metrics.STAGE_SECONDS, stage="load_data"))
+
+    def test_prometheus_format(self):
+        """Test the histogram series of the Prometheus text format."""
+        self.registry.observe(metrics.RETRIEVED_NODES, 4)
+        self.registry.observe(metrics.STAGE_SECONDS, 0.02, stage='say "hi"')
+        text = self.registry.to_prometheus()
+        self.assertIn("# TYPE tldhuber_retrieved_nodes histogram", text)
+        self.assertIn('tldhuber_retrieved_nodes_bucket{le="3"} 0', text)
+        self.assertIn('tldhuber_retrieved_nodes_bucket{le="5"} 1', text)
+        self.assertIn('tldhuber_retrieved_nodes_bucket{le="+Inf"} 1', text)
+        self.assertIn("tldhuber_retrieved_nodes_count 1", text)
+        self.assertIn('tldhuber_stage_seconds_sum{stage="say \\"hi\\""} 0.02', text)
+
+    def test_write_json_and_summary(self):
+        """Test the JSON export, its percentiles and the summary table."""
+        for value in np.linspace(0.001, 0.1, 100):
+            self.registry.observe(metrics.STAGE_SECONDS, value, stage="retrieval")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "metrics", "metrics.json")
+            self.registry.write(path)
+            self.registry.write(path.replace(".json", ".prom"))
+            with open(path, "r", encoding="utf-8") as file:
+                summary = json.load(file)
+            self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                             ["metrics.json", "metrics.prom"])
+        series = summary["metrics"][metrics.STAGE_SECONDS][0]
+        self.assertEqual(series["labels"], {"stage": "retrieval"})
+        self.assertAlmostEqual(series["p50"], 0.0505)
+        self.assertAlmostEqual(series["p99"], 0.09901)
+        self.assertIn("retrieval", metrics.format_summary(summary))
+
+    def test_llm_token_counter(self):
+        """Test that every LLM call records its prompt and completion tokens."""
+        llm = MockLLM(max_tokens=8,
+                      callback_manager=CallbackManager([LLMTokenCounter(self.registry)]))
+        llm.complete("How does light affect sleep?")
+        prompt = self.registry.get(metrics.LLM_TOKENS, kind="prompt")
+        completion = self.registry.get(metrics.LLM_TOKENS, kind="completion")
+        self.assertEqual(prompt.count, 1)
+        self.assertGreater(prompt.sum, 0)
+        self.assertEqual(completion.sum, 8)
+
+    def test_retriever_stages(self):
+        """Test that the retriever records its embedding, retrieval and node loading."""
+        metrics.REGISTRY.reset()
+        embeddings = np.eye(3, dtype=np.float32)
+        nodes = [TextNode(text=str(row)) for row in range(3)]
+        retriever = MatrixRetriever(embeddings, lambda rows: [nodes[row] for row in rows],
+                                    embed_model=object(), similarity_top_k=2)
+        retriever.retrieve(QueryBundle("q", embedding=[1.0, 0.0, 0.0]))
+        for stage in ["query_embedding", "retrieval", "node_loading"]:
+            self.assertEqual(metrics.REGISTRY.get(metrics.STAGE_SECONDS, stage=stage).count, 1)
+
+    def test_serve(self):
+        """Test the Prometheus and JSON endpoints."""
+        self.registry.observe(metrics.RETRIEVED_NODES, 2)
+        server = metrics.serve(self.registry, port=0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(f"{url}/metrics") as response:
+                self.assertIn("tldhuber_retrieved_nodes_count 1", response.read().decode())
+            with urllib.request.urlopen(f"{url}/metrics.json") as response:
+                self.assertIn(metrics.RETRIEVED_NODES, json.load(response)["metrics"])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Unit tests for the packed_corpus module. Packs a few copies of the test
+transcript with small compression blocks, and checks random access, lookups and
+that the round trip reproduces the JSON transcripts exactly.
+"""
+
+import os
+import tempfile
+import unittest
+
+from tldhuber.utils import indexing
+from tldhuber.utils.packed_corpus import PackedCorpus, is_packed_corpus, pack_corpus
+
+
+class TestPackedCorpus(unittest.TestCase):
+    """Tests for pack_corpus and PackedCorpus."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.path = os.path.join(self.tmp_dir.name, "corpus.bin")
+        transcript = indexing.load_json_transcripts("./tldhuber/tests/test_data")[0]
+        self.transcripts = [
+            {**transcript, "ep_num": str(ep_num), "link": f"{transcript['link']}{ep_num}"}
+            for ep_num in range(3)
+        ]
+        self.transcripts.append({**transcript, "ep_num": "3", "link": "empty",
+                                 "chunks": []})
+        self.stats = pack_corpus(self.transcripts, self.path, chunks_per_block=3)
+        self.corpus = PackedCorpus(self.path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        """Test that every transcript is read back exactly as it was packed."""
+        self.assertEqual(list(self.corpus.iter_transcripts()), self.transcripts)
+        self.assertEqual((self.stats["episodes"], self.stats["chunks"]), (4, 24))
+        self.assertEqual(self.corpus.num_chunks, 24)
+
+    def test_random_access(self):
+        """Test that any chunk can be read by id, across block boundaries."""
+        chunks = [chunk for transcript in self.transcripts for chunk in transcript["chunks"]]
+        for chunk_id in [23, 0, 8, 9, 14]:
+            chunk = self.corpus.chunk(chunk_id)
+            self.assertEqual(chunk["text"], chunks[chunk_id]["text"])
+            self.assertEqual(chunk["timestamp"], chunks[chunk_id]["timestamp"])
+            self.assertEqual(chunk["episode_id"], chunk_id // 8)
+
+    def test_episode_metadata_and_chunks(self):
+        """Test the episode columns and the chunk ranges of episodes."""
+        self.assertEqual(self.corpus.episode(1)["ep_num"], "1")
+        self.assertEqual(self.corpus.episode_chunk_ids(1), range(8, 16))
+        self.assertEqual(len(self.corpus.episode_chunk_ids(3)), 0)
+
+    def test_find_chunk(self):
+        """Test looking up a chunk by video link and timestamp."""
+        first = self.transcripts[2]["chunks"][1]
+        chunk_id = self.corpus.find_chunk(self.transcripts[2]["link"], first["timestamp"])
+        self.assertEqual(self.corpus.text(chunk_id), first["text"])
+        self.assertIsNone(self.corpus.find_chunk("missing", 0))
+
+    def test_episode_documents_from_packed_file(self):
+        """Test that indexing reads Documents from a packed file like from JSON."""
+        self.assertTrue(is_packed_corpus(self.path))
+        self.assertFalse(is_packed_corpus(self.tmp_dir.name))
+        episodes = list(indexing.iter_episode_documents(self.path))
+        expected = indexing.parse_into_documents(self.transcripts)
+        self.assertEqual(len(episodes), 4)
+        self.assertEqual([(doc.text, doc.metadata) for ep in episodes for doc in ep],
+                         [(doc.text, doc.metadata) for doc in expected])
+
+    def test_rejects_other_files(self):
+        """Test that a file that is not a packed corpus raises ValueError."""
+        with self.assertRaises(ValueError):
+            PackedCorpus("./tldhuber/tests/test_data/test.json")
+
+
+if __name__ == "__main__":
+    unittest.main()
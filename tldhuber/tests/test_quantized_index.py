@@ -0,0 +1,144 @@
+"""
+Unit tests for the quantized_index module. Quantizes synthetic clustered
+embeddings and checks the codes, recall against exact search after re-ranking,
+persistence, and the QuantizedRetriever.
+"""
+
+import tempfile
+import unittest
+
+import numpy as np
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import QueryBundle, TextNode
+
+from tldhuber.utils.quantized_index import (POPCOUNT, QuantizedIndex, QuantizedRetriever,
+                                            hamming_distances, quantize_binary, recall_at_k)
+from tldhuber.utils.vector_store import normalize_rows, top_k_rows
+
+
+def clustered_embeddings(n_rows=2000, dim=64, n_clusters=20, seed=0):
+    """Makes normalized embeddings drawn around a few random cluster centres."""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(n_clusters, dim))
+    labels = rng.integers(0, n_clusters, n_rows)
+    return normalize_rows(centres[labels] + rng.normal(0, 0.5, size=(n_rows, dim)))
+
+
+class TestQuantizedIndex(unittest.TestCase):
+    """Tests for building, searching and persisting QuantizedIndex."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.embeddings = clustered_embeddings()
+        cls.indexes = {mode: QuantizedIndex.build(cls.embeddings, mode, chunk_size=512)
+                       for mode in ("int8", "binary")}
+
+    def test_memory_reduction(self):
+        """Test that int8 codes are 4 times and binary codes 32 times smaller."""
+        self.assertEqual(self.embeddings.nbytes / self.indexes["int8"].nbytes, 4)
+        self.assertEqual(self.embeddings.nbytes / self.indexes["binary"].nbytes, 32)
+
+    def test_int8_codes_round_trip(self):
+        """Test that int8 codes scaled back are within half a step of the values."""
+        index = self.indexes["int8"]
+        restored = index.codes.astype(np.float32) * index.scales
+        self.assertTrue(np.all(np.abs(restored - self.embeddings) <= index.scales / 2 + 1e-7))
+
+    def test_hamming_distances(self):
+        """Test both popcounts against a bit-by-bit count, for any code width."""
+        for dim in (64, 20):
+            embeddings = clustered_embeddings(n_rows=50, dim=dim)
+            codes, query_code = quantize_binary(embeddings), quantize_binary(embeddings[0])
+            expected = (np.unpackbits(codes ^ query_code, axis=1)).sum(axis=1)
+            np.testing.assert_array_equal(hamming_distances(codes, query_code), expected)
+            np.testing.assert_array_equal(POPCOUNT[codes ^ query_code].sum(axis=1), expected)
+
+    def test_recall_after_reranking(self):
+        """Test that re-ranking the candidates finds nearly all exact top 10 rows."""
+        # The signs of only 64 dimensions are coarse; real embeddings have 1536
+        minimum_recall = {"int8": 0.99, "binary": 0.9}
+        for mode, index in self.indexes.items():
+            with self.subTest(mode=mode):
+                self.assertGreater(recall_at_k(self.embeddings, index, rerank_k=100),
+                                   minimum_recall[mode])
+
+    def test_reranking_every_row_is_exact(self):
+        """Test that exact scores are returned, and rerank_k == n_rows is exact."""
+        query = self.embeddings[11]
+        expected = top_k_rows(self.embeddings @ query, 10)
+        for index in self.indexes.values():
+            rows, scores = index.search(self.embeddings, query, 10, rerank_k=2000)
+            np.testing.assert_array_equal(rows, expected)
+            np.testing.assert_allclose(scores, self.embeddings[rows] @ query, rtol=1e-6)
+
+    def test_save_and_load(self):
+        """Test that saved codes load back with identical search results."""
+        for mode, index in self.indexes.items():
+            with self.subTest(mode=mode), tempfile.TemporaryDirectory() as tmp_dir:
+                index.save(tmp_dir)
+                loaded = QuantizedIndex.load(tmp_dir)
+                self.assertEqual((loaded.mode, loaded.dim), (mode, 64))
+                for query in self.embeddings[:5]:
+                    expected, _ = index.search(self.embeddings, query, 10, 50)
+                    actual, _ = loaded.search(self.embeddings, query, 10, 50)
+                    np.testing.assert_array_equal(expected, actual)
+
+    def test_load_checks_rows(self):
+        """Test that codes refuse to load for another matrix or export."""
+        num_rows = self.embeddings.shape[0]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.indexes["binary"].save(tmp_dir, fingerprint="abc")
+            self.assertEqual(QuantizedIndex.load(tmp_dir, num_rows, "abc").num_rows, num_rows)
+            self.assertEqual(QuantizedIndex.load(tmp_dir, num_rows).num_rows, num_rows)
+            with self.assertRaises(ValueError):
+                QuantizedIndex.load(tmp_dir, num_rows + 1, "abc")
+            with self.assertRaises(ValueError):
+                QuantizedIndex.load(tmp_dir, num_rows, "def")
+
+    def test_unknown_mode(self):
+        """Test that unknown quantization modes are rejected."""
+        with self.assertRaises(ValueError):
+            QuantizedIndex.build(self.embeddings, "int4")
+
+
+class TestQuantizedRetriever(unittest.TestCase):
+    """Tests for QuantizedRetriever."""
+
+    def setUp(self):
+        self.embeddings = clustered_embeddings(n_rows=500, dim=16)
+        self.nodes = [TextNode(text=f"chunk {i}", id_=str(i)) for i in range(500)]
+        self.retriever = QuantizedRetriever(
+            self.embeddings,
+            lambda rows: [self.nodes[row] for row in rows],
+            embed_model=MockEmbedding(embed_dim=16),
+            similarity_top_k=5,
+            similarity_cutoff=0.5,
+            quantized_index=QuantizedIndex.build(self.embeddings, "binary"),
+            rerank_k=50,
+        )
+
+    def test_retrieve_returns_sorted_nodes(self):
+        """Test that retrieval returns top_k nodes ordered by exact score."""
+        query = QueryBundle("query", embedding=self.embeddings[7].tolist())
+        results = self.retriever.retrieve(query)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0].node.node_id, "7")
+        self.assertAlmostEqual(results[0].score, 1.0, places=5)
+        scores = [result.score for result in results]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertTrue(all(score >= 0.5 for score in scores))
+
+    def test_row_mask(self):
+        """Test that filtered searches only score and return selected rows."""
+        query = QueryBundle("query", embedding=self.embeddings[7].tolist())
+        scores = self.embeddings @ self.embeddings[7]
+        for step in (20, 2):
+            row_mask = np.zeros(500, dtype=bool)
+            row_mask[1::step] = True
+            rows, _ = self.retriever.search_rows(query, row_mask)
+            self.assertTrue(row_mask[rows].all())
+            self.assertEqual(rows[0], top_k_rows(np.where(row_mask, scores, -2), 1)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+Unit tests for the refresh_index module. Persists a small JSON index built from
+the pickled test nodes with every derived index next to it, adds a transcript
+chunk with update_index and checks that every derived index is rebuilt on the
+new rows.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from llama_index.core import Document, VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+
+from tldhuber.utils import indexing, refresh_index, snapshot
+from tldhuber.utils.ann_index import IVFIndex
+from tldhuber.utils.bm25_index import BM25Index
+from tldhuber.utils.metadata_index import MetadataIndex
+from tldhuber.utils.quantized_index import QuantizedIndex
+from tldhuber.utils.vector_store import MmapVectorStore, export_persisted_index
+
+
+class TestRefreshIndex(unittest.TestCase):
+    """Tests for update_json_index and rebuild_derived_indexes."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.data_dir = self.tmp_dir.name
+        self.dirs = {name: os.path.join(self.data_dir, subdir)
+                     for name, subdir in refresh_index.DERIVED_DIRS.items()}
+        nodes = indexing.unpickle_nodes("./tldhuber/tests/test_data")
+        index = VectorStoreIndex(nodes, embed_model=MockEmbedding(embed_dim=1536))
+        index.storage_context.persist(persist_dir=self.data_dir)
+        export_persisted_index(self.data_dir, self.dirs["vectors"])
+        store = MmapVectorStore(self.dirs["vectors"])
+        IVFIndex.build(store.embeddings, n_lists=2).save(self.dirs["ivf"], store.fingerprint)
+        QuantizedIndex.build(store.embeddings, "binary").save(self.dirs["quantized"])
+        MetadataIndex.build(node.metadata for node in nodes).save(self.dirs["metadata"])
+        BM25Index.build(nodes).save(self.dirs["keyword"])
+        snapshot.build_snapshot(self.dirs["vectors"], self.dirs["snapshot"], ivf=True,
+                                n_lists=3, quantize="int8")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read_meta(self, name, key):
+        """Reads a value of the meta.json of a derived index."""
+        with open(os.path.join(self.dirs[name], "meta.json"), "r", encoding="utf-8") as file:
+            return json.load(file)[key]
+
+    def test_update_and_rebuild(self):
+        """Test that a new chunk reaches the JSON index and every derived index."""
+        docs = indexing.parse_into_documents(
+            indexing.load_json_transcripts("./tldhuber/tests/test_data")
+        )
+        docs.append(Document(text="A brand new chunk about morning sunlight.",
+                             metadata={**docs[0].metadata, "timestamp": 9999}))
+        stats = refresh_index.update_json_index(
+            self.data_dir, docs,
+            transformations=[indexing.keyword_extractor(docs), MockEmbedding(embed_dim=1536)],
+        )
+        self.assertEqual((stats["new"], stats["cached_nodes"], stats["processed_nodes"]),
+                         (1, 8, 1))
+
+        rebuilt = refresh_index.rebuild_derived_indexes(self.data_dir, docs)
+        self.assertEqual(rebuilt, ["vectors", "ivf", "quantized", "metadata", "keyword",
+                                   "snapshot"])
+        store = MmapVectorStore(self.dirs["vectors"])
+        self.assertEqual(store.num_nodes, 9)
+        self.assertEqual(IVFIndex.load(self.dirs["ivf"], 9, store.fingerprint).list_rows.shape,
+                         (9,))
+        self.assertEqual(self.read_meta("quantized", "mode"), "binary")
+        self.assertEqual(self.read_meta("quantized", "num_rows"), 9)
+        self.assertEqual(self.read_meta("quantized", "fingerprint"), store.fingerprint)
+        self.assertEqual(MetadataIndex.load(self.dirs["metadata"], 9, store.fingerprint).num_rows,
+                         9)
+        self.assertEqual(BM25Index.load(self.dirs["keyword"]).chunks[8]["node_id"],
+                         store.get_node(8).node_id)
+        manifest = snapshot.read_manifest(self.dirs["snapshot"])
+        self.assertEqual(manifest["num_nodes"], 9)
+        self.assertEqual(manifest["components"],
+                         ["vectors", "keyword", "metadata", "ivf", "quantized"])
+        self.assertEqual(manifest["options"], {"n_lists": 3, "quantize": "int8"})
+        snapshot_dirs = snapshot.snapshot_dirs(self.dirs["snapshot"])
+        self.assertEqual(IVFIndex.load(snapshot_dirs["ivf"], 9, store.fingerprint).n_lists, 3)
+        self.assertFalse([name for name in os.listdir(self.data_dir)
+                          if name.endswith((".new", ".old"))])
+
+    def test_snapshot_options_without_manifest_options(self):
+        """Test that a snapshot whose manifest has no options keeps its IVF lists
+        and quantization mode."""
+        manifest_path = os.path.join(self.dirs["snapshot"], snapshot.MANIFEST_FILE)
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+        del manifest["options"]
+        with open(manifest_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file)
+        refresh_index.rebuild_derived_indexes(self.data_dir)
+        manifest = snapshot.read_manifest(self.dirs["snapshot"])
+        self.assertEqual(manifest["options"], {"n_lists": 3, "quantize": "int8"})
+
+    def test_missing_indexes_are_not_built(self):
+        """Test that only the derived indexes that exist are rebuilt."""
+        for name in ("ivf", "quantized", "snapshot"):
+            refresh_index.replace_dir(os.makedirs, self.dirs[name])
+        self.assertEqual(refresh_index.rebuild_derived_indexes(self.data_dir),
+                         ["vectors", "metadata", "keyword"])
+        self.assertEqual(os.listdir(self.dirs["ivf"]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Unit tests for the response_cache module. Uses small hand-made embeddings and a
+fake clock to check similarity matching, expiry, eviction and invalidation.
+"""
+
+import os
+import tempfile
+import unittest
+
+from tldhuber.utils.response_cache import ResponseCache, index_fingerprint
+
+CLIPS = [{"youtube_link": "https://youtu.be/example?t=42", "timestamp": 42}]
+
+
+class FakeClock:  # pylint: disable=R0903
+    """A clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResponseCache(unittest.TestCase):
+    """Tests for ResponseCache."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResponseCache(max_distance=0.1, ttl=60, max_size=2, clock=self.clock)
+
+    def test_similar_query_hits(self):
+        """Test that queries within max_distance get the cached answer and clips."""
+        self.assertIsNone(self.cache.get([1.0, 0.0, 0.0]))
+        self.cache.put([1.0, 0.0, 0.0], "Get morning sunlight.", CLIPS)
+        self.assertEqual(self.cache.get([2.0, 0.3, 0.0]),
+                         {"answer": "Get morning sunlight.", "clips": CLIPS})
+        self.assertIsNone(self.cache.get([1.0, 1.0, 0.0]))
+        self.assertEqual(self.cache.stats["hits"], 1)
+        self.assertEqual(self.cache.stats["misses"], 2)
+
+    def test_clips_are_copied(self):
+        """Test that changing served clips does not change the cached ones."""
+        self.cache.put([1.0, 0.0], "answer", CLIPS)
+        self.cache.get([1.0, 0.0])["clips"][0]["timestamp"] = 0
+        self.assertEqual(self.cache.get([1.0, 0.0])["clips"], CLIPS)
+
+    def test_expiry(self):
+        """Test that answers are not served after their time to live."""
+        self.cache.put([1.0, 0.0], "answer", CLIPS)
+        self.clock.now += 59
+        self.assertIsNotNone(self.cache.get([1.0, 0.0]))
+        self.clock.now += 2
+        self.assertIsNone(self.cache.get([1.0, 0.0]))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used answer is evicted when full."""
+        self.cache.put([1.0, 0.0, 0.0], "a", CLIPS)
+        self.cache.put([0.0, 1.0, 0.0], "b", CLIPS)
+        self.cache.get([1.0, 0.0, 0.0])
+        self.cache.put([0.0, 0.0, 1.0], "c", CLIPS)
+        self.assertEqual(self.cache.get([1.0, 0.0, 0.0])["answer"], "a")
+        self.assertIsNone(self.cache.get([0.0, 1.0, 0.0]))
+        self.assertEqual(self.cache.get([0.0, 0.0, 1.0])["answer"], "c")
+        self.assertEqual(self.cache.stats["evictions"], 1)
+
+    def test_near_duplicates_share_a_slot(self):
+        """Test that caching a near-duplicate query replaces the earlier answer."""
+        self.cache.put([1.0, 0.0, 0.0], "first", CLIPS)
+        self.cache.put([1.0, 0.1, 0.0], "second", CLIPS)
+        self.cache.put([0.0, 1.0, 0.0], "other", CLIPS)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get([1.0, 0.0, 0.0])["answer"], "second")
+        self.assertEqual(self.cache.stats["evictions"], 0)
+
+    def test_validate(self):
+        """Test that a new index version drops every answer."""
+        self.assertFalse(self.cache.validate("v1"))
+        self.cache.put([1.0, 0.0], "answer", CLIPS)
+        self.assertTrue(self.cache.validate("v1"))
+        self.assertIsNotNone(self.cache.get([1.0, 0.0]))
+        self.assertFalse(self.cache.validate("v2"))
+        self.assertIsNone(self.cache.get([1.0, 0.0]))
+        self.assertEqual(self.cache.stats["invalidations"], 1)
+
+    def test_index_fingerprint(self):
+        """Test that the fingerprint changes when an index file is rewritten."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "meta.json")
+            missing = os.path.join(tmp_dir, "missing.json")
+            with open(path, "w", encoding="utf-8") as file:
+                file.write("{}")
+            before = index_fingerprint([path, missing])
+            self.assertEqual(index_fingerprint([path, missing]), before)
+            with open(path, "w", encoding="utf-8") as file:
+                file.write('{"num_nodes": 1}')
+            self.assertNotEqual(index_fingerprint([path, missing]), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Unit tests for the retrieval_benchmark module. Runs the benchmark on tiny
+synthetic corpora and checks the shape of the synthetic data, the report and
+the regression comparison.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from llama_index.core.postprocessor import SimilarityPostprocessor
+
+from tldhuber.utils import retrieval_benchmark
+from tldhuber.utils.vector_store import MmapVectorStore, export_rows
+
+
+class TestRetrievalBenchmark(unittest.TestCase):
+    """Tests for the synthetic corpus, run_benchmark and compare_results."""
+
+    def test_synthetic_corpus_shape(self):
+        """Test that synthetic nodes look like parse_into_documents output."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            retrieval_benchmark.write_synthetic_index(tmp_dir, 30, dim=8)
+            store = MmapVectorStore(tmp_dir)
+            self.assertEqual(store.num_nodes, 30)
+            node = store.get_node(27)
+            self.assertEqual(set(node.metadata), {"episode_title", "episode_number",
+                                                  "episode_summary", "youtube_link",
+                                                  "timestamp"})
+            self.assertEqual(node.metadata["episode_number"], "1")
+            self.assertIn("timestamp", node.excluded_llm_metadata_keys)
+
+    def test_synthetic_corpus_is_deterministic(self):
+        """Test that the same seed gives the same embeddings."""
+        first = [e for e, _ in retrieval_benchmark.synthetic_rows(5, dim=4, seed=3)]
+        second = [e for e, _ in retrieval_benchmark.synthetic_rows(5, dim=4, seed=3)]
+        self.assertTrue(all((a == b).all() for a, b in zip(first, second)))
+
+    def test_run_benchmark_report(self):
+        """Test that every stage is timed at every scale and the report is JSON."""
+        report = retrieval_benchmark.run_benchmark(
+            [1, 2], dim=16, num_queries=5, base_chunks=60
+        )
+        self.assertEqual([r["num_nodes"] for r in report["results"]], [60, 120])
+        stages = report["results"][0]["stages"]
+        for stage in ["index_load", "retrieval", "similarity_cutoff", "extract_metadata"]:
+            self.assertGreater(stages[stage]["p50_ms"], 0)
+        self.assertEqual(stages["retrieval"]["n"], 5)
+        self.assertGreater(stages["nodes_per_query"], 1)
+        json.dumps(report)
+
+    def test_cutoff_stage_filters_unfiltered_nodes(self):
+        """Test that the similarity_cutoff stage postprocesses the full top k, not
+        the nodes the retriever already filtered."""
+        postprocess = SimilarityPostprocessor.postprocess_nodes
+        with tempfile.TemporaryDirectory() as tmp_dir, patch.object(
+            SimilarityPostprocessor, "postprocess_nodes", autospec=True,
+            side_effect=postprocess,
+        ) as mock_postprocess:
+            # Unrelated random embeddings: only each query's own row passes the cutoff
+            rng = np.random.default_rng(0)
+            rows = [(rng.standard_normal(64), node)
+                    for _, node in retrieval_benchmark.synthetic_rows(200, dim=2)]
+            export_rows(rows, 200, 64, tmp_dir)
+            stages = retrieval_benchmark.benchmark_index(tmp_dir, num_queries=5,
+                                                         load_repeats=1)
+        self.assertEqual([len(call.args[1]) for call in mock_postprocess.call_args_list],
+                         [10] * 5)
+        self.assertLess(stages["nodes_per_query"], 10)
+
+    def test_compare_results(self):
+        """Test that only stages slower than the tolerance are reported."""
+        def report(retrieval_ms, load_ms):
+            return {"results": [{"num_nodes": 100, "stages": {
+                "retrieval": {"p50_ms": retrieval_ms},
+                "index_load": {"p50_ms": load_ms},
+                "nodes_per_query": 10.0,
+            }}]}
+
+        regressions = retrieval_benchmark.compare_results(report(1.0, 5.0), report(1.5, 5.5))
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("retrieval", regressions[0])
+        self.assertEqual(retrieval_benchmark.compare_results(report(1.0, 5.0),
+                                                             {"results": []}), [])
+
+    def test_main_writes_results(self):
+        """Test the command line entry point and its exit code on regressions."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out = os.path.join(tmp_dir, "results.json")
+            args = ["--scales", "0.01", "--dim", "8", "--queries", "3", "--out", out]
+            self.assertEqual(retrieval_benchmark.main(args), 0)
+            with open(out, "r", encoding="utf-8") as file:
+                baseline = json.load(file)
+            for stage in baseline["results"][0]["stages"].values():
+                if isinstance(stage, dict):
+                    stage["p50_ms"] = 1e-9
+            with open(out, "w", encoding="utf-8") as file:
+                json.dump(baseline, file)
+            self.assertEqual(retrieval_benchmark.main(args + ["--compare", out]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
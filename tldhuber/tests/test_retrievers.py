@@ -0,0 +1,238 @@
+"""
+Unit tests for the retrievers module. Checks that MatrixRetriever returns the
+same nodes and scores as llama_index's VectorIndexRetriever followed by a
+SimilarityPostprocessor, using the pickled test nodes and their real embeddings,
+and that HybridRetriever fuses keyword and dense rankings.
+"""
+
+import asyncio
+import tempfile
+import unittest
+
+import numpy as np
+from llama_index.core import VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.postprocessor import SimilarityPostprocessor
+from llama_index.core.retrievers import VectorIndexRetriever
+from llama_index.core.schema import QueryBundle
+
+from tldhuber.utils import indexing
+from tldhuber.utils.bm25_index import BM25Index
+from tldhuber.utils.retrievers import (HybridRetriever, MatrixRetriever, SessionRetriever,
+                                       reciprocal_rank_fusion)
+from tldhuber.utils.vector_store import MmapVectorStore, export_index, top_k_rows
+
+EMBED_MODEL = MockEmbedding(embed_dim=1536)
+
+
+def query_bundle_near(node, seed=0):
+    """Makes a query bundle whose embedding is a noisy copy of a node's embedding."""
+    rng = np.random.default_rng(seed)
+    embedding = np.asarray(node.embedding) + rng.normal(0, 0.01, len(node.embedding))
+    return QueryBundle(query_str="test query", embedding=embedding.tolist())
+
+
+class TestMatrixRetriever(unittest.TestCase):
+    """Tests for MatrixRetriever and the top_k_rows selection helper."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nodes = indexing.unpickle_nodes("./tldhuber/tests/test_data")
+        cls.index = VectorStoreIndex(cls.nodes, embed_model=EMBED_MODEL)
+
+    def reference_retrieve(self, query_bundle, top_k, cutoff):
+        """Runs the llama_index retriever and postprocessor the app used to use."""
+        retriever = VectorIndexRetriever(
+            index=self.index, similarity_top_k=top_k, embed_model=EMBED_MODEL
+        )
+        nodes = retriever.retrieve(query_bundle)
+        return SimilarityPostprocessor(similarity_cutoff=cutoff).postprocess_nodes(nodes)
+
+    def assert_same_results(self, expected, actual):
+        """Asserts that two lists of NodeWithScore have the same ids and scores."""
+        self.assertEqual([n.node.node_id for n in expected], [n.node.node_id for n in actual])
+        np.testing.assert_allclose(
+            [n.score for n in expected], [n.score for n in actual], rtol=1e-5
+        )
+
+    def test_matches_vector_index_retriever(self):
+        """Test that results match VectorIndexRetriever plus SimilarityPostprocessor."""
+        retriever = MatrixRetriever.from_index(
+            self.index, embed_model=EMBED_MODEL, similarity_top_k=5, similarity_cutoff=0.25
+        )
+        for seed, node in enumerate(self.nodes):
+            query_bundle = query_bundle_near(node, seed)
+            expected = self.reference_retrieve(query_bundle, 5, 0.25)
+            self.assert_same_results(expected, retriever.retrieve(query_bundle))
+
+    def test_from_mmap_store(self):
+        """Test that a retriever over the memory-mapped export gives the same results."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            export_index(self.index, tmp_dir)
+            mmap_index = VectorStoreIndex.from_vector_store(
+                MmapVectorStore(tmp_dir), embed_model=EMBED_MODEL
+            )
+            retriever = MatrixRetriever.from_index(
+                mmap_index, embed_model=EMBED_MODEL, similarity_top_k=3
+            )
+            self.assertIsInstance(retriever.embeddings, np.memmap)
+            query_bundle = query_bundle_near(self.nodes[5])
+            expected = self.reference_retrieve(query_bundle, 3, 0.0)
+            self.assert_same_results(expected, retriever.retrieve(query_bundle))
+
+    def test_cutoff_drops_all_nodes(self):
+        """Test that a cutoff above every score returns no nodes."""
+        retriever = MatrixRetriever.from_index(
+            self.index, embed_model=EMBED_MODEL, similarity_cutoff=1.01
+        )
+        self.assertEqual(retriever.retrieve(query_bundle_near(self.nodes[0])), [])
+
+    def test_embeds_query_text(self):
+        """Test that the embed model is used when the query has no embedding."""
+        retriever = MatrixRetriever.from_index(
+            self.index, embed_model=EMBED_MODEL, similarity_top_k=2
+        )
+        self.assertEqual(len(retriever.retrieve("sleep")), 2)
+
+    def test_row_mask(self):
+        """Test that a row mask restricts results to its rows, scored as before."""
+        retriever = MatrixRetriever.from_index(self.index, embed_model=EMBED_MODEL,
+                                               similarity_top_k=3)
+        query_bundle = query_bundle_near(self.nodes[0])
+        unfiltered = retriever.retrieve(query_bundle)
+        row_mask = np.ones(len(self.nodes), dtype=bool)
+        row_mask[0] = False
+        retriever.set_row_mask(row_mask)
+        self.assertNotIn(self.nodes[0].node_id,
+                         [result.node.node_id for result in retriever.retrieve(query_bundle)])
+        rows, scores = retriever.search_rows(query_bundle, row_mask)
+        self.assertNotIn(0, rows)
+        expected = top_k_rows(np.where(row_mask, retriever.score(retriever.embed_query(
+            query_bundle)), -np.inf), 3)
+        np.testing.assert_array_equal(rows, expected)
+        self.assertEqual(len(scores), 3)
+        retriever.set_row_mask(None)
+        self.assert_same_results(unfiltered, retriever.retrieve(query_bundle))
+        with self.assertRaises(ValueError):
+            retriever.set_row_mask(np.ones(len(self.nodes) + 1, dtype=bool))
+
+    def test_session_retriever(self):
+        """Test that sessions filter a shared retriever without changing it."""
+        shared = MatrixRetriever.from_index(self.index, embed_model=EMBED_MODEL,
+                                            similarity_top_k=3)
+        query_bundle = query_bundle_near(self.nodes[0])
+        unfiltered = shared.retrieve(query_bundle)
+        row_mask = np.ones(len(self.nodes), dtype=bool)
+        row_mask[0] = False
+        filtered_session, other_session = SessionRetriever(shared), SessionRetriever(shared)
+        filtered_session.set_row_mask(row_mask)
+        self.assertNotIn(self.nodes[0].node_id, [result.node.node_id for result
+                                                 in filtered_session.retrieve(query_bundle)])
+        self.assert_same_results(unfiltered, other_session.retrieve(query_bundle))
+        self.assertIsNone(shared.row_mask)
+        with self.assertRaises(ValueError):
+            filtered_session.set_row_mask(np.ones(len(self.nodes) + 1, dtype=bool))
+
+    def test_search_rows_batch_with_row_masks(self):
+        """Test that filtered and unfiltered queries of a batch get their own results."""
+        retriever = MatrixRetriever.from_index(self.index, embed_model=EMBED_MODEL,
+                                               similarity_top_k=4)
+        query_embeddings = np.array([query_bundle_near(self.nodes[i], i).embedding
+                                     for i in range(3)])
+        row_mask = np.zeros(len(self.nodes), dtype=bool)
+        row_mask[5:9] = True
+        batch = retriever.search_rows_batch(query_embeddings, row_masks=[None, row_mask, None])
+        for i, (rows, _) in enumerate(batch):
+            expected, _ = retriever.search_rows(QueryBundle("", embedding=query_embeddings[i]),
+                                                row_mask if i == 1 else None)
+            np.testing.assert_array_equal(rows, expected)
+        self.assertTrue(set(batch[1][0]) <= set(range(5, 9)))
+
+    def test_top_k_rows(self):
+        """Test row selection order, truncation and cutoff."""
+        scores = np.array([0.1, 0.9, 0.5, 0.7, 0.3])
+        np.testing.assert_array_equal(top_k_rows(scores, 3), [1, 3, 2])
+        np.testing.assert_array_equal(top_k_rows(scores, 10, 0.6), [1, 3])
+        self.assertEqual(len(top_k_rows(scores, 0)), 0)
+
+
+class TestHybridRetriever(unittest.TestCase):
+    """Tests for HybridRetriever and reciprocal_rank_fusion."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nodes = indexing.unpickle_nodes("./tldhuber/tests/test_data")
+        cls.index = VectorStoreIndex(cls.nodes, embed_model=EMBED_MODEL)
+        cls.keyword_index = BM25Index.build(
+            cls.index.docstore.get_nodes(list(cls.index.index_struct.nodes_dict.values()))
+        )
+
+    def make_retriever(self, **kwargs):
+        """Builds a hybrid retriever over the test index."""
+        dense = MatrixRetriever.from_index(self.index, embed_model=EMBED_MODEL,
+                                           similarity_top_k=3)
+        return HybridRetriever(dense, self.keyword_index, **kwargs)
+
+    def test_reciprocal_rank_fusion(self):
+        """Test that items ranked well in both lists come first."""
+        fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a", "d"]], k=1)
+        self.assertEqual([item for item, _ in fused], ["a", "c", "b", "d"])
+        self.assertAlmostEqual(fused[0][1], 1 / 2 + 1 / 3)
+
+    def test_keyword_match_is_fused_with_dense_results(self):
+        """Test that an exact-term match the embedding misses is still returned."""
+        banana = next(node for node in self.nodes if "bananas" in node.text)
+        far_node = next(node for node in self.nodes if "bananas" not in node.text)
+        query_bundle = query_bundle_near(far_node)
+        query_bundle.query_str = "bananas"
+        results = self.make_retriever(similarity_top_k=4).retrieve(query_bundle)
+        ids = [result.node.node_id for result in results]
+        self.assertEqual(ids[0], far_node.node_id)
+        self.assertIn(banana.node_id, ids)
+        self.assertEqual(len(ids), 4)
+        self.assertEqual([r.score for r in results], sorted((r.score for r in results),
+                                                            reverse=True))
+
+    def test_async_retrieve_matches_sync(self):
+        """Test that async retrieval fuses the same rankings."""
+        retriever = self.make_retriever()
+        query_bundle = query_bundle_near(self.nodes[2])
+        query_bundle.query_str = "bananas science"
+        sync_ids = [r.node.node_id for r in retriever.retrieve(query_bundle)]
+        async_ids = [r.node.node_id for r in asyncio.run(retriever.aretrieve(query_bundle))]
+        self.assertEqual(sync_ids, async_ids)
+
+    def test_row_mask_filters_both_rankings(self):
+        """Test that the row mask applies to the keyword search too."""
+        banana_row = next(row for row, chunk in enumerate(self.keyword_index.chunks)
+                          if "bananas" in self.index.docstore.get_node(chunk["node_id"]).text)
+        retriever = self.make_retriever(similarity_top_k=4)
+        row_mask = np.ones(self.keyword_index.num_chunks, dtype=bool)
+        row_mask[banana_row] = False
+        self.assertIn(banana_row, retriever.keyword_rows("bananas"))
+        self.assertNotIn(banana_row, retriever.keyword_rows("bananas", row_mask))
+        retriever.set_row_mask(row_mask)
+        query_bundle = query_bundle_near(self.nodes[2])
+        query_bundle.query_str = "bananas"
+        banana_id = self.keyword_index.chunks[banana_row]["node_id"]
+        self.assertNotIn(banana_id, [r.node.node_id for r in retriever.retrieve(query_bundle)])
+
+    def test_rejects_keyword_index_of_other_nodes(self):
+        """Test that a keyword index of different nodes is refused."""
+        dense = MatrixRetriever.from_index(self.index, embed_model=EMBED_MODEL)
+        docs = indexing.parse_into_documents(
+            indexing.load_json_transcripts("./tldhuber/tests/test_data")
+        )
+        with self.assertRaises(ValueError):
+            HybridRetriever(dense, BM25Index.build(docs))
+        with self.assertRaises(ValueError):
+            HybridRetriever(dense, BM25Index.build(docs[:3]))
+        # Same nodes and same first and last rows, two middle rows swapped
+        nodes = self.index.docstore.get_nodes(list(self.index.index_struct.nodes_dict.values()))
+        nodes[2], nodes[3] = nodes[3], nodes[2]
+        with self.assertRaises(ValueError):
+            HybridRetriever(dense, BM25Index.build(nodes))
+
+
+if __name__ == "__main__":
+    unittest.main()
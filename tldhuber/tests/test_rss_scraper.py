@@ -4,13 +4,77 @@ Unit tests for the RSS Scraper module.
 This test suite provides a series of unit tests for the rss_scraper module.
 It tests fetching the RSS feed from the Huberman Lab podcast, whether the
 columns are named as expected, and tests if expected episode titles are
-included in the scrape.
+included in the scrape. The incremental mode is tested against a local stub
+server, without network access.
 """
 
+import io
+import os
+import tempfile
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pandas as pd
 
-from tldhuber.utils.rss_scraper import scrape_rss_data
+from tldhuber.utils.rss_scraper import (
+    fetch_new_rss_entries,
+    iter_rss_entries,
+    load_feed_state,
+    scrape_rss_data,
+)
+
+
+def make_feed(numbers):
+    """Makes an RSS feed with one episode for each number, in the given order."""
+    items = "".join(
+        f"<item><title>Episode {number}</title><guid>episode-{number}</guid>"
+        f"<pubDate>Mon, {number:02d} Jan 2024 08:00:00 GMT</pubDate>"
+        f"<itunes:summary>Summary {number}</itunes:summary>"
+        f'<enclosure url="https://example.com/{number}.mp3" type="audio/mpeg"/></item>'
+        for number in numbers
+    )
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">'
+            f"<channel><title>Stub feed</title>{items}</channel></rss>").encode("utf-8")
+
+
+class StubFeedServer:  # pylint: disable=R0903
+    """A local server of an RSS feed answering conditional requests by ETag."""
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.etag = '"1"'
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Serves the feed, or a 304 when the client has its ETag."""
+
+            def do_GET(self):  # pylint: disable=C0103
+                """Answers a request for the feed."""
+                stub.requests.append(self.headers.get("If-None-Match"))
+                if self.headers.get("If-None-Match") == stub.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", stub.etag)
+                self.send_header("Content-Length", str(len(stub.feed)))
+                self.end_headers()
+                self.wfile.write(stub.feed)
+
+            def log_message(self, *args):  # pylint: disable=W0221
+                """Keeps the test output quiet."""
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/feed"
+
+    def close(self):
+        """Stops the server."""
+        self.server.shutdown()
+        self.server.server_close()
 
 
 class TestRSSDataScraper(unittest.TestCase):
@@ -69,5 +133,68 @@ class TestRSSDataScraper(unittest.TestCase):
         result = scrape_rss_data(invalid_feed_url)
         self.assertIsNone(result)
 
+class TestIncrementalRSS(unittest.TestCase):
+    """
+    Unit tests for the incremental, streaming RSS download.
+    """
+
+    def setUp(self):
+        self.stub = StubFeedServer(make_feed([3, 2, 1]))
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.state_file = os.path.join(self.tmp_dir.name, "rss_state.json")
+
+    def tearDown(self):
+        self.stub.close()
+        self.tmp_dir.cleanup()
+
+    def fetch(self):
+        """Returns the new entries of the stub feed."""
+        return list(fetch_new_rss_entries(self.stub.url, state_file=self.state_file))
+
+    def test_iter_rss_entries(self):
+        """
+        Test that entries are parsed into plain records while the feed is read.
+        """
+        feed = io.BytesIO(make_feed(range(1, 2000)))
+        entries = iter_rss_entries(feed)
+        self.assertEqual(next(entries), {
+            "Id": "episode-1",
+            "Title": "Episode 1",
+            "Publication Date": "Mon, 01 Jan 2024 08:00:00 GMT",
+            "Summary": "Summary 1",
+            "Enclosure Link": "https://example.com/1.mp3",
+        })
+        self.assertLess(feed.tell(), len(feed.getvalue()) / 2)
+
+    def test_first_fetch(self):
+        """
+        Test that the first download yields every entry and saves the state.
+        """
+        self.assertEqual([entry["Title"] for entry in self.fetch()],
+                         ["Episode 3", "Episode 2", "Episode 1"])
+        self.assertEqual(load_feed_state(self.state_file),
+                         {"etag": '"1"', "last_modified": None, "last_entry_id": "episode-3"})
+
+    def test_unchanged_feed(self):
+        """
+        Test that an unchanged feed is requested conditionally and yields nothing.
+        """
+        self.fetch()
+        self.assertEqual(self.fetch(), [])
+        self.assertEqual(self.stub.requests, [None, '"1"'])
+
+    def test_new_entries(self):
+        """
+        Test that only the entries published since the last download are yielded,
+        and that entries a caller did not consume are yielded again.
+        """
+        self.fetch()
+        self.stub.feed, self.stub.etag = make_feed([5, 4, 3, 2, 1]), '"2"'
+        next(fetch_new_rss_entries(self.stub.url, state_file=self.state_file))
+        self.assertEqual([entry["Id"] for entry in self.fetch()], ["episode-5", "episode-4"])
+        self.assertEqual(self.fetch(), [])
+        self.assertEqual(load_feed_state(self.state_file)["last_entry_id"], "episode-5")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,188 @@
+"""
+Unit tests for the search_api module. Serves a small synthetic index with a
+counting embedding model and checks the micro-batching, the JSON of the
+endpoints and the handling of bad requests.
+"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from aiohttp.test_utils import TestClient, TestServer
+from llama_index.core import VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from tldhuber.utils.embedding_cache import CachedEmbedding
+from tldhuber.utils.metadata_index import MetadataIndex
+from tldhuber.utils.retrieval_benchmark import write_synthetic_index
+from tldhuber.utils.retrievers import MatrixRetriever
+from tldhuber.utils.search_api import (
+    MicroBatcher, SearchService, create_app, load_metadata_index,
+)
+from tldhuber.utils.vector_store import MmapVectorStore
+
+
+class BatchCountingEmbedding(MockEmbedding):  # pylint: disable=R0901
+    """Mock embedding model that records the texts of each batch call."""
+
+    batches: list = []
+
+    async def _aget_text_embeddings(self, texts):
+        self.batches.append(list(texts))
+        return [[1.0] + [0.0] * (self.embed_dim - 1) for _ in texts]
+
+
+class TestMicroBatcher(unittest.IsolatedAsyncioTestCase):
+    """Tests for MicroBatcher."""
+
+    async def test_concurrent_items_share_a_batch(self):
+        """Test that concurrent items are processed together, in order."""
+        batches = []
+
+        async def process(items):
+            batches.append(items)
+            return [item * 2 for item in items]
+
+        batcher = MicroBatcher(process, max_batch=4, max_wait=0.01)
+        results = await asyncio.gather(*(batcher.submit(item) for item in range(6)))
+        self.assertEqual(results, [0, 2, 4, 6, 8, 10])
+        self.assertEqual(batches, [[0, 1, 2, 3], [4, 5]])
+
+    async def test_errors_reach_every_item(self):
+        """Test that a failed batch raises in every waiting caller."""
+        async def process(_):
+            raise RuntimeError("embedding failed")
+
+        batcher = MicroBatcher(process, max_wait=0.001)
+        results = await asyncio.gather(batcher.submit(1), batcher.submit(2),
+                                       return_exceptions=True)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+
+
+class TestSearchAPI(unittest.IsolatedAsyncioTestCase):
+    """Tests for SearchService and the HTTP endpoints."""
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        write_synthetic_index(self.tmp_dir.name, 50, dim=8)
+        store = MmapVectorStore(self.tmp_dir.name)
+        self.inner = BatchCountingEmbedding(embed_dim=8, batches=[])
+        embed_model = CachedEmbedding(self.inner)
+        retriever = MatrixRetriever(store.embeddings, store.get_nodes_by_rows,
+                                    embed_model=embed_model, similarity_top_k=5)
+        metadata_index = MetadataIndex.build(store.get_node(row).metadata for row in range(50))
+        self.service = SearchService(retriever, embed_model, max_wait=0.01,
+                                     metadata_index=metadata_index)
+        self.client = TestClient(TestServer(create_app(self.service)))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.tmp_dir.cleanup()
+
+    async def test_query(self):
+        """Test that a query returns scored clips with timestamped links."""
+        response = await self.client.get("/query", params={"q": "sleep", "top_k": "3"})
+        self.assertEqual(response.status, 200)
+        result = await response.json()
+        self.assertEqual(result["query"], "sleep")
+        self.assertEqual(len(result["clips"]), 3)
+        clip = result["clips"][0]
+        self.assertIn("youtu.be/", clip["youtube_link"])
+        self.assertTrue(clip["youtube_link"].endswith(f"?t={clip['timestamp']}"))
+        scores = [clip["score"] for clip in result["clips"]]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    async def test_concurrent_queries_are_batched(self):
+        """Test that concurrent requests make a single embedding call."""
+        queries = [f"question {number}" for number in range(8)]
+        responses = await asyncio.gather(*(
+            self.client.post("/query", json={"query": query}) for query in queries
+        ))
+        results = [await response.json() for response in responses]
+        self.assertEqual([result["query"] for result in results], queries)
+        self.assertTrue(all(len(result["clips"]) == 5 for result in results))
+        self.assertEqual(len(self.inner.batches), 1)
+        self.assertEqual(sorted(self.inner.batches[0]), queries)
+
+    async def test_same_results_as_retriever(self):
+        """Test that batched search returns the nodes the retriever returns."""
+        result = await self.service.search("sleep")
+        nodes = self.service.retriever.retrieve("sleep")
+        self.assertEqual([clip["score"] for clip in result["clips"]],
+                         [node.score for node in nodes])
+
+    async def test_bad_requests(self):
+        """Test that missing queries and bad top_k values are rejected."""
+        for params in [{}, {"q": " "}, {"q": "sleep", "top_k": "0"},
+                       {"q": "sleep", "top_k": "many"}]:
+            response = await self.client.get("/query", params=params)
+            self.assertEqual(response.status, 400)
+        response = await self.client.post("/query", data="not json")
+        self.assertEqual(response.status, 400)
+
+    async def test_filters(self):
+        """Test that filtered queries only return clips passing the filters, in the
+        same batch as unfiltered ones."""
+        responses = await asyncio.gather(
+            self.client.get("/query", params={"q": "sleep", "start": "360", "end": "540"}),
+            self.client.post("/query", json={"query": "sleep", "title": "episode",
+                                             "episode_min": 0, "end": 0}),
+            self.client.post("/query", json={"query": "focus"}),
+        )
+        results = [await response.json() for response in responses]
+        self.assertTrue(results[0]["clips"])
+        self.assertTrue(all(360 <= clip["timestamp"] <= 540 for clip in results[0]["clips"]))
+        self.assertTrue(all(clip["timestamp"] == 0 for clip in results[1]["clips"]))
+        self.assertEqual(len(results[2]["clips"]), 5)
+        self.assertEqual(len(self.inner.batches), 1)
+
+    async def test_bad_filters(self):
+        """Test that badly typed filters, and filters without a metadata index, are
+        rejected."""
+        for body in [{"query": "sleep", "episode_min": "first"},
+                     {"query": "sleep", "guest": 3}]:
+            response = await self.client.post("/query", json=body)
+            self.assertEqual(response.status, 400)
+        self.service.metadata_index = None
+        response = await self.client.get("/query", params={"q": "sleep", "guest": "walker"})
+        self.assertEqual(response.status, 400)
+        self.assertIn("metadata index", (await response.json())["error"])
+
+    def test_load_metadata_index(self):
+        """Test that a metadata index built on another export is not loaded."""
+        store = MmapVectorStore(self.tmp_dir.name)
+        index = VectorStoreIndex.from_vector_store(store, embed_model=MockEmbedding(embed_dim=8))
+        metadata_dir = os.path.join(self.tmp_dir.name, "metadata")
+        self.assertIsNone(load_metadata_index(metadata_dir, index))
+        self.service.metadata_index.save(metadata_dir, store.fingerprint)
+        self.assertEqual(load_metadata_index(metadata_dir, index).num_rows, 50)
+        self.service.metadata_index.save(metadata_dir, "another export")
+        self.assertIsNone(load_metadata_index(metadata_dir, index))
+
+    async def test_health_and_metrics(self):
+        """Test the health and metrics endpoints."""
+        response = await self.client.get("/health")
+        self.assertEqual(await response.json(), {"status": "ok", "num_nodes": 50})
+        await self.client.get("/query", params={"q": "sleep"})
+        response = await self.client.get("/metrics")
+        self.assertIn("tldhuber_search_batch_size_count", await response.text())
+
+
+class TestFormatResult(unittest.TestCase):
+    """Tests for SearchService.format_result."""
+
+    def test_format_result(self):
+        """Test that clips carry the node metadata and score."""
+        node = TextNode(text="t", metadata={"youtube_link": "https://www.youtube.com/watch?v=a",
+                                            "timestamp": 7})
+        result = SearchService.format_result("q", [NodeWithScore(node=node, score=0.5)])
+        self.assertEqual(result, {"query": "q", "clips": [
+            {"youtube_link": "https://youtu.be/a?t=7", "timestamp": 7, "score": 0.5}
+        ]})
+
+
+if __name__ == "__main__":
+    unittest.main()
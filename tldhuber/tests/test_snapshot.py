@@ -0,0 +1,115 @@
+"""
+Unit tests for the snapshot and startup_benchmark modules. Builds snapshots of
+small synthetic corpora, checks their components and manifest, and runs the
+startup benchmark on one.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+
+from tldhuber.utils import snapshot, startup_benchmark
+from tldhuber.utils.bm25_index import BM25Index
+from tldhuber.utils.metadata_index import MetadataIndex
+from tldhuber.utils.quantized_index import QuantizedIndex
+from tldhuber.utils.retrieval_benchmark import write_synthetic_index
+from tldhuber.utils.retrievers import SessionRetriever
+from tldhuber.utils.vector_store import MmapVectorStore
+
+
+class TestSnapshot(unittest.TestCase):
+    """Tests for build_snapshot, read_manifest and the startup benchmark."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.export_dir = os.path.join(self.tmp_dir.name, "mmap")
+        self.out_dir = os.path.join(self.tmp_dir.name, "snapshot")
+        write_synthetic_index(self.export_dir, 40, dim=8)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_build_snapshot(self):
+        """Test that the snapshot holds the vectors and aligned keyword and metadata
+        indexes."""
+        self.assertFalse(snapshot.is_snapshot(self.out_dir))
+        manifest = snapshot.build_snapshot(self.export_dir, self.out_dir)
+        self.assertTrue(snapshot.is_snapshot(self.out_dir))
+        self.assertEqual(snapshot.read_manifest(self.out_dir), manifest)
+        self.assertEqual((manifest["num_nodes"], manifest["dim"]), (40, 8))
+        self.assertEqual(manifest["components"], ["vectors", "keyword", "metadata"])
+
+        dirs = snapshot.snapshot_dirs(self.out_dir)
+        store = MmapVectorStore(dirs["vectors"])
+        keyword_index = BM25Index.load(dirs["keyword"])
+        self.assertEqual(keyword_index.num_chunks, store.num_nodes)
+        self.assertEqual(keyword_index.chunks[17]["node_id"], store.get_node(17).node_id)
+        metadata_index = MetadataIndex.load(dirs["metadata"])
+        self.assertEqual(metadata_index.num_rows, store.num_nodes)
+        self.assertEqual(metadata_index.titles[metadata_index.episode_ids[17]],
+                         store.get_node(17).metadata["episode_title"])
+        self.assertFalse(os.path.exists(dirs["ivf"]))
+
+    def test_rebuild_with_ivf(self):
+        """Test that rebuilding replaces the components and can add the IVF index or
+        the quantized codes."""
+        snapshot.build_snapshot(self.export_dir, self.out_dir)
+        manifest = snapshot.build_snapshot(self.export_dir, self.out_dir, ivf=True, n_lists=4)
+        self.assertEqual(manifest["components"], ["vectors", "keyword", "metadata", "ivf"])
+        self.assertTrue(os.path.exists(
+            os.path.join(snapshot.snapshot_dirs(self.out_dir)["ivf"], "meta.json")
+        ))
+        manifest = snapshot.build_snapshot(self.export_dir, self.out_dir)
+        self.assertFalse(os.path.exists(snapshot.snapshot_dirs(self.out_dir)["ivf"]))
+        manifest = snapshot.build_snapshot(self.export_dir, self.out_dir, quantize="binary")
+        self.assertEqual(manifest["components"], ["vectors", "keyword", "metadata", "quantized"])
+        self.assertEqual(QuantizedIndex.load(snapshot.snapshot_dirs(self.out_dir)["quantized"])
+                         .codes.shape, (40, 1))
+
+    def test_unsupported_version(self):
+        """Test that a snapshot of another format version is rejected."""
+        snapshot.build_snapshot(self.export_dir, self.out_dir)
+        path = os.path.join(self.out_dir, snapshot.MANIFEST_FILE)
+        with open(path, "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+        manifest["format_version"] = snapshot.FORMAT_VERSION + 1
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file)
+        with self.assertRaises(ValueError):
+            snapshot.read_manifest(self.out_dir)
+
+    def test_startup_benchmark(self):
+        """Test that every startup stage is timed in a fresh interpreter."""
+        report = startup_benchmark.run_benchmark(40, dim=8, repeats=1,
+                                                 work_dir=self.tmp_dir.name)
+        stages = report["results"][0]["stages"]
+        self.assertEqual(list(stages), ["import_streamlit", "import_app", "import_chat_stack",
+                                        "load_snapshot", "first_query"])
+        self.assertTrue(all(summary["p50_ms"] > 0 for summary in stages.values()))
+
+    def test_startup_benchmark_builds_session_engine(self):
+        """Test that the benchmark builds the chat engine on a session retriever, as
+        the app does."""
+        from tldhuber import hello_huber  # pylint: disable=C0415
+
+        snapshot.build_snapshot(self.export_dir,
+                                os.path.join(self.tmp_dir.name, hello_huber.SNAPSHOT_DIR))
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        self.addCleanup(os.chdir, cwd)
+        self.addCleanup(hello_huber.load_keyword_index.clear)
+        index = VectorStoreIndex.from_vector_store(
+            MmapVectorStore(hello_huber.index_dirs()["vectors"]),
+            embed_model=MockEmbedding(embed_dim=8),
+        )
+        retriever, chat_engine = startup_benchmark.set_up_app_engines(hello_huber, index)
+        self.assertIsInstance(retriever, SessionRetriever)
+        self.assertIs(chat_engine._retriever, retriever)  # pylint: disable=W0212
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,100 +2,304 @@
 Unit tests for the YouTube video transcript extraction module.
 
 This test suite provides a series of unit tests for the transcript_scraper module.
-It tests fetching the upload playlist ID, retrieving playlist items, and saving video information
-to a JSON file. The tests use mocking to simulate API responses, so that that no actual network
-requests are made.
+It tests fetching the upload playlist ID, retrieving playlist items, fetching
+transcripts concurrently, and saving video information to a JSON file. The tests
+run against a local stub of the YouTube Data API and of a transcript endpoint,
+so that no requests leave the machine, and check connection reuse, retries,
+conditional requests and resuming from the on-disk state.
 """
 
-import unittest
-from unittest.mock import patch
-import os
+import hashlib
 import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
 import pandas as pd
+import requests
 
 from tldhuber.utils.transcripts_scraper import (
+    ScrapeState,
+    YouTubeClient,
+    fetch_transcripts,
     get_channel_upload_playlist_id_by_username,
     get_channel_upload_playlist_id_by_channelid,
     get_playlist_items,
+    refresh_playlist_items,
     save_video_information_to_json,
 )
 
 
+class StubYouTube:  # pylint: disable=R0902
+    """
+    A local HTTP server answering like the YouTube Data API (/channels and
+    /playlistItems, with ETags) plus /transcripts/<video id>, which answers 404
+    for videos named "missing-..." and 500 for videos named "broken-...".
+    """
+
+    def __init__(self, videos, page_size=2):
+        self.videos = list(videos)
+        self.page_size = page_size
+        self.requests = []
+        self.failures = {}
+        self.in_flight = self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        """The root URL of the stub."""
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def paths(self, prefix):
+        """Returns the requests whose path starts with prefix."""
+        return [request for request in self.requests if request["path"].startswith(prefix)]
+
+    def playlist_page(self, page_token):
+        """Returns the JSON of a page of the uploads playlist."""
+        page = int(page_token.split("-")[1]) if page_token else 0
+        start = page * self.page_size
+        body = {"items": [{"contentDetails": {"videoId": video_id},
+                           "snippet": {"title": f"Video {video_id}"}}
+                          for video_id in self.videos[start:start + self.page_size]]}
+        if start + self.page_size < len(self.videos):
+            body["nextPageToken"] = f"page-{page + 1}"
+        return body
+
+    def respond(self, path, query):
+        """Returns the status and JSON body of a request."""
+        if path == "/channels":
+            if query.get("forUsername") == "nobody":
+                return 200, {"items": []}
+            return 200, {"items": [{"contentDetails": {"relatedPlaylists": {
+                "uploads": "UPLOAD_PLAYLIST_ID"}}}]}
+        if path == "/playlistItems":
+            return 200, self.playlist_page(query.get("pageToken"))
+        video_id = path.rsplit("/", 1)[-1]
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        if video_id.startswith("missing"):
+            return 404, {"error": "no transcript"}
+        if video_id.startswith("broken"):
+            return 500, {"error": "broken"}
+        return 200, [{"text": f"Transcript of {video_id}", "start": 0.0, "duration": 2.0}]
+
+    def handler_class(self):
+        """Makes the request handler class bound to this stub."""
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Handles the requests of the client under test."""
+
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):  # pylint: disable=C0103
+                """Answers like the stubbed services, failing as configured."""
+                parsed = urlparse(self.path)
+                query = dict(parse_qsl(parsed.query))
+                with stub.lock:
+                    stub.requests.append({"path": parsed.path, "query": query,
+                                          "port": self.client_address[1],
+                                          "if_none_match": self.headers.get("If-None-Match")})
+                    failing = stub.failures.get(parsed.path, 0)
+                    if failing:
+                        stub.failures[parsed.path] = failing - 1
+                if failing:
+                    self.send(503, {"error": "unavailable"}, {"Retry-After": "0"})
+                    return
+                status, body = stub.respond(parsed.path, query)
+                etag = '"' + hashlib.sha1(json.dumps(body).encode()).hexdigest() + '"'
+                if status == 200 and self.headers.get("If-None-Match") == etag:
+                    self.send(304, None, {"ETag": etag})
+                else:
+                    self.send(status, body, {"ETag": etag})
+
+            def send(self, status, body, headers):
+                """Writes a response with a JSON body, if any."""
+                data = b"" if body is None else json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):  # pylint: disable=W0221
+                """Keeps the test output quiet."""
+
+        return Handler
+
+    def close(self):
+        """Stops the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def stub_fetcher(client, video_id):
+    """Fetches a transcript from the stub, returning None for videos without one."""
+    try:
+        return client.get_json(f"{client.base_url}/transcripts/{video_id}")
+    except requests.HTTPError as error:
+        if error.response.status_code == 404:
+            return None
+        raise
+
+
 class TestTranscriptsScraper(unittest.TestCase):
     """
     Test suite for the transcripts_scraper module that extracts YouTube video transcripts.
 
     This class tests all the functions defined in transcripts_scraper module,
-    including fetching upload playlist IDs, retrieving playlist items, and saving video
-    information to JSON.
+    including fetching upload playlist IDs, retrieving playlist items, fetching
+    transcripts, and saving video information to JSON.
     """
 
-    @patch("requests.get")
-    def test_get_channel_upload_playlist_id_by_username(self, mock_get):
+    def setUp(self):
+        self.stub = StubYouTube([f"video-{number}" for number in range(5)])
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.state_dir = os.path.join(self.tmp_dir.name, "state")
+
+    def tearDown(self):
+        self.stub.close()
+        self.tmp_dir.cleanup()
+
+    def make_client(self, state=None, retries=2):
+        """Makes a client of the stub that retries without waiting."""
+        return YouTubeClient("dummy_api_key", base_url=self.stub.url, state=state,
+                             retries=retries, backoff_factor=0, pool_size=4)
+
+    def test_get_channel_upload_playlist_id_by_username(self):
         """
         Test fetching the upload playlist ID using a YouTube channel username.
         """
-        mock_get.return_value.json.return_value = {
-            "items": [
-                {
-                    "contentDetails": {
-                        "relatedPlaylists": {"uploads": "UPLOAD_PLAYLIST_ID"}
-                    }
-                }
-            ]
-        }
-        api_key = "dummy_api_key"
-        username = "dummy_username"
-        result = get_channel_upload_playlist_id_by_username(api_key, username)
+        result = get_channel_upload_playlist_id_by_username(
+            "dummy_api_key", "dummy_username", client=self.make_client()
+        )
         self.assertEqual(result, "UPLOAD_PLAYLIST_ID")
+        self.assertEqual(self.stub.requests[0]["query"], {
+            "part": "contentDetails", "forUsername": "dummy_username", "key": "dummy_api_key"
+        })
 
-    @patch("requests.get")
-    def test_get_channel_upload_playlist_id_by_channelid(self, mock_get):
+    def test_get_channel_upload_playlist_id_by_channelid(self):
         """
         Test fetching the upload playlist ID using a YouTube channel ID.
         """
-        mock_get.return_value.json.return_value = {
-            "items": [
-                {
-                    "contentDetails": {
-                        "relatedPlaylists": {"uploads": "UPLOAD_PLAYLIST_ID"}
-                    }
-                }
-            ]
-        }
-        api_key = "dummy_api_key"
-        channel_id = "dummy_channel_id"
-        result = get_channel_upload_playlist_id_by_channelid(api_key, channel_id)
+        result = get_channel_upload_playlist_id_by_channelid(
+            "dummy_api_key", "dummy_channel_id", client=self.make_client()
+        )
         self.assertEqual(result, "UPLOAD_PLAYLIST_ID")
+        self.assertEqual(self.stub.requests[0]["query"]["id"], "dummy_channel_id")
 
-    @patch("requests.get")
-    def test_get_playlist_items(self, mock_get):
-        """
-        Test retrieving all items from a YouTube playlist.
-        """
-        mock_get.return_value.json.side_effect = [
-            {"items": ["video1", "video2"], "nextPageToken": "token"},
-            {"items": ["video3"]},
-        ]
-        api_key = "dummy_api_key"
-        playlist_id = "dummy_playlist_id"
-        result = get_playlist_items(api_key, playlist_id)
-        self.assertEqual(result, ["video1", "video2", "video3"])
-
-    @patch('requests.get')
-    def test_get_channel_upload_playlist_id_by_username_no_items(self, mock_get):
+    def test_get_channel_upload_playlist_id_by_username_no_items(self):
         """
         Test upload playlist ID using a YouTube channel username when no items are returned.
         This is an edge case where the given username does not exist or there is an API issue.
         """
-        mock_get.return_value.json.return_value = {
-            "items": []
-        }
-        api_key = "dummy_api_key"
-        username = "dummy_username"
-        result = get_channel_upload_playlist_id_by_username(api_key, username)
+        result = get_channel_upload_playlist_id_by_username(
+            "dummy_api_key", "nobody", client=self.make_client()
+        )
         self.assertIsNone(result)
 
+    def test_get_playlist_items(self):
+        """
+        Test retrieving all items from a YouTube playlist over one pooled connection.
+        """
+        result = get_playlist_items("dummy_api_key", "dummy_playlist_id",
+                                    client=self.make_client())
+        self.assertEqual([item["contentDetails"]["videoId"] for item in result],
+                         self.stub.videos)
+        pages = self.stub.paths("/playlistItems")
+        self.assertEqual([page["query"].get("pageToken") for page in pages],
+                         [None, "page-1", "page-2"])
+        self.assertEqual(len({page["port"] for page in pages}), 1)
+
+    def test_retry_with_backoff(self):
+        """
+        Test that requests failing with HTTP 503 are retried, and give up after
+        the configured number of retries.
+        """
+        self.stub.failures["/playlistItems"] = 2
+        result = get_playlist_items("dummy_api_key", "dummy_playlist_id",
+                                    client=self.make_client(retries=2))
+        self.assertEqual(len(result), 5)
+        self.assertEqual(len(self.stub.paths("/playlistItems")), 5)
+        self.stub.failures["/channels"] = 3
+        with self.assertRaises(requests.RequestException):
+            get_channel_upload_playlist_id_by_channelid("dummy_api_key", "dummy_channel_id",
+                                                        client=self.make_client(retries=2))
+
+    def test_conditional_requests(self):
+        """
+        Test that pages seen before are requested conditionally and reused when
+        the server answers 304 Not Modified, also after reloading the state.
+        """
+        refresh_playlist_items(self.make_client(ScrapeState(self.state_dir)), "UPLOADS")
+        client = self.make_client(ScrapeState(self.state_dir))
+        result = get_playlist_items("dummy_api_key", "UPLOADS", client=client)
+        self.assertEqual(len(result), 5)
+        self.assertEqual(client.stats, {"requests": 3, "not_modified": 3})
+        self.assertTrue(all(page["if_none_match"]
+                            for page in self.stub.paths("/playlistItems")[3:]))
+
+    def test_refresh_playlist_items_is_incremental(self):
+        """
+        Test that a refresh stops paging at the first page of known videos and
+        keeps the known videos after the new ones.
+        """
+        refresh_playlist_items(self.make_client(ScrapeState(self.state_dir)), "UPLOADS")
+        self.stub.videos.insert(0, "video-new")
+        self.stub.requests.clear()
+        result = refresh_playlist_items(self.make_client(ScrapeState(self.state_dir)), "UPLOADS")
+        self.assertEqual([item["contentDetails"]["videoId"] for item in result],
+                         ["video-new"] + [f"video-{number}" for number in range(5)])
+        self.assertEqual(len(self.stub.paths("/playlistItems")), 2)
+
+    def test_fetch_transcripts_concurrently(self):
+        """
+        Test that transcripts are fetched by at most max_workers threads at once,
+        over the client's connection pool.
+        """
+        video_ids = [f"video-{number}" for number in range(12)]
+        result = fetch_transcripts(self.make_client(), video_ids, stub_fetcher, max_workers=4)
+        self.assertEqual(set(result), set(video_ids))
+        self.assertEqual(result["video-3"][0]["text"], "Transcript of video-3")
+        self.assertGreater(self.stub.max_in_flight, 1)
+        self.assertLessEqual(self.stub.max_in_flight, 4)
+        self.assertLessEqual(len({request["port"] for request in self.stub.requests}), 4)
+
+    def test_fetch_transcripts_resumes(self):
+        """
+        Test that fetched transcripts, and videos without one, are not fetched
+        again, that failed fetches are retried later, and that a torn record in
+        the state is ignored.
+        """
+        video_ids = ["video-0", "missing-1", "broken-2", "video-3"]
+        result = fetch_transcripts(self.make_client(ScrapeState(self.state_dir)), video_ids,
+                                   stub_fetcher)
+        self.assertEqual(set(result), {"video-0", "missing-1", "video-3"})
+        self.assertIsNone(result["missing-1"])
+        with open(os.path.join(self.state_dir, "transcripts.jsonl"), "a",
+                  encoding="utf-8") as file:
+            file.write('{"video_id": "video-4", "transc')
+
+        self.stub.requests.clear()
+        state = ScrapeState(self.state_dir)
+        self.assertNotIn("video-4", state.transcripts)
+        result = fetch_transcripts(self.make_client(state), video_ids, stub_fetcher)
+        self.assertEqual({request["path"] for request in self.stub.requests},
+                         {"/transcripts/broken-2"})
+        self.assertEqual(result["video-0"][0]["text"], "Transcript of video-0")
+
     def test_save_video_information_to_json(self):
         """
         Test saving video information to a JSON file.
@@ -0,0 +1,123 @@
+"""
+Unit tests for the vector_store module. Exports a small index built from the
+pickled test nodes (which carry real embeddings) to the memory-mapped layout and
+checks that the loaded store returns the same nodes and similarities.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from llama_index.core import VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from tldhuber.utils import indexing
+from tldhuber.utils.vector_store import (
+    MmapVectorStore,
+    check_built_on,
+    export_index,
+    index_signature,
+    node_ids_fingerprint,
+    normalize_rows,
+    read_fingerprint,
+)
+
+
+def build_test_index():
+    """Builds an in-memory VectorStoreIndex from the pickled test nodes."""
+    nodes = indexing.unpickle_nodes("./tldhuber/tests/test_data")
+    return nodes, VectorStoreIndex(nodes, embed_model=MockEmbedding(embed_dim=1536))
+
+
+class TestMmapVectorStore(unittest.TestCase):
+    """Round-trip tests for export_index and MmapVectorStore."""
+
+    def setUp(self):
+        self.nodes, self.index = build_test_index()
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.num_exported = export_index(self.index, self.tmp_dir.name)
+        self.store = MmapVectorStore(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_export_layout(self):
+        """Test that every node is exported and the metadata file marks completion."""
+        self.assertEqual(self.num_exported, len(self.nodes))
+        self.assertEqual(self.store.num_nodes, len(self.nodes))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, "meta.json")))
+
+    def test_fingerprint(self):
+        """Test that the fingerprint only changes when the exported rows do."""
+        fingerprint = read_fingerprint(self.tmp_dir.name)
+        self.assertEqual(self.store.fingerprint, fingerprint)
+        self.assertEqual(self.store.node_ids_fingerprint, node_ids_fingerprint(
+            self.store.get_node(row).node_id for row in range(self.store.num_nodes)))
+        index = VectorStoreIndex.from_vector_store(self.store)
+        self.assertEqual(index_signature(index), (len(self.nodes), fingerprint))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            export_index(self.index, tmp_dir)
+            self.assertEqual(read_fingerprint(tmp_dir), fingerprint)
+            reordered = VectorStoreIndex(self.nodes[::-1],
+                                         embed_model=MockEmbedding(embed_dim=1536))
+            export_index(reordered, tmp_dir)
+            self.assertNotEqual(read_fingerprint(tmp_dir), fingerprint)
+
+        check_built_on({"num_rows": 3, "fingerprint": "abc"}, 3, "abc", "ivf")
+        check_built_on({"num_rows": 3}, 3, "abc", "ivf")
+        with self.assertRaises(ValueError):
+            check_built_on({"num_rows": 3, "fingerprint": "abc"}, 3, "def", "ivf")
+        with self.assertRaises(ValueError):
+            check_built_on({"num_rows": 3}, 4, None, "ivf")
+
+    def test_embeddings_are_memory_mapped_and_normalized(self):
+        """Test that the matrix is a float32 memmap with unit-norm rows."""
+        embeddings = self.store.embeddings
+        self.assertIsInstance(embeddings, np.memmap)
+        self.assertEqual(embeddings.dtype, np.float32)
+        np.testing.assert_allclose(np.linalg.norm(embeddings, axis=1), 1.0, rtol=1e-5)
+
+    def test_node_round_trip(self):
+        """Test that decoded nodes keep their text and metadata but drop embeddings."""
+        by_id = {node.node_id: node for node in self.nodes}
+        for row in range(self.store.num_nodes):
+            node = self.store.get_node(row)
+            self.assertEqual(node.text, by_id[node.node_id].text)
+            self.assertEqual(node.metadata, by_id[node.node_id].metadata)
+            self.assertIsNone(node.embedding)
+
+    def test_query_matches_cosine_similarity(self):
+        """Test that querying with a node's own embedding ranks that node first."""
+        target = self.nodes[3]
+        result = self.store.query(
+            VectorStoreQuery(query_embedding=target.embedding, similarity_top_k=3)
+        )
+        self.assertEqual(result.ids[0], target.node_id)
+        self.assertAlmostEqual(result.similarities[0], 1.0, places=5)
+        self.assertEqual(result.similarities, sorted(result.similarities, reverse=True))
+
+    def test_index_from_store_retrieves(self):
+        """Test that a VectorStoreIndex built on the store can retrieve nodes."""
+        index = VectorStoreIndex.from_vector_store(
+            self.store, embed_model=MockEmbedding(embed_dim=1536)
+        )
+        retrieved = index.as_retriever(similarity_top_k=2).retrieve("anything")
+        self.assertEqual(len(retrieved), 2)
+
+    def test_store_is_read_only(self):
+        """Test that the store refuses writes."""
+        with self.assertRaises(NotImplementedError):
+            self.store.add(self.nodes)
+        with self.assertRaises(NotImplementedError):
+            self.store.delete("ref_doc_id")
+
+    def test_normalize_rows_keeps_zero_rows(self):
+        """Test that all-zero rows do not produce NaNs."""
+        normalized = normalize_rows(np.array([[0.0, 0.0], [3.0, 4.0]]))
+        np.testing.assert_allclose(normalized, [[0.0, 0.0], [0.6, 0.8]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file builds an inverted-file (IVF) approximate nearest neighbour index over
+the normalized embedding matrix exported by vector_store.py, and provides a
+retriever that searches it.
+
+Exact search scores every node for every query, which stops being viable once
+the corpus grows to millions of chunks. The IVF index clusters the embeddings
+with spherical k-means and keeps, for each cluster ("list"), the rows assigned
+to it. A query is only scored against the rows of its `nprobe` closest lists,
+so `nprobe` trades recall for latency and can be changed for every query.
+
+File contents:
+1. Train the list centroids on a sample of the embeddings.
+2. Assign every row to its closest centroid and group the rows by list.
+3. Persist the index next to data/, and load it back memory-mapped, after
+   checking that it was built on the export being searched.
+4. IVFRetriever, a drop-in alternative to MatrixRetriever in set_up_engine.
+
+Modules: os, json, numpy, llama_index.
+"""
+
+import json
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.schema import NodeWithScore, QueryBundle, QueryType
+
+from tldhuber.utils.metrics import span
+from tldhuber.utils.retrievers import MatrixRetriever
+from tldhuber.utils.vector_store import (
+    EMBEDDINGS_FILE,
+    check_built_on,
+    normalize_rows,
+    read_fingerprint,
+    top_k_rows,
+)
+
+CENTROIDS_FILE = "centroids.npy"
+LIST_OFFSETS_FILE = "list_offsets.npy"
+LIST_ROWS_FILE = "list_rows.npy"
+META_FILE = "meta.json"
+
+
+def assign_lists(embeddings: np.ndarray, centroids: np.ndarray,
+                 chunk_size: int = 65536) -> np.ndarray:
+    """Finds the closest centroid of every row, working in chunks to bound memory.
+
+    Args:
+        embeddings (np.ndarray): The (n_rows, dim) matrix of normalized embeddings.
+        centroids (np.ndarray): The (n_lists, dim) matrix of normalized centroids.
+        chunk_size (int, optional): The number of rows scored at once. Defaults to 65536.
+
+    Returns:
+        np.ndarray: The list number of every row.
+    """
+    assignments = np.empty(embeddings.shape[0], dtype=np.int64)
+    for start in range(0, embeddings.shape[0], chunk_size):
+        chunk = np.asarray(embeddings[start : start + chunk_size], dtype=np.float32)
+        assignments[start : start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(embeddings: np.ndarray, n_lists: int, n_iter: int = 10,
+                    sample_size: Optional[int] = None, seed: int = 0) -> np.ndarray:
+    """Trains list centroids with spherical k-means on a sample of the rows.
+
+    Args:
+        embeddings (np.ndarray): The (n_rows, dim) matrix of normalized embeddings.
+        n_lists (int): The number of centroids to train, at most the number of
+            sampled rows.
+        n_iter (int, optional): The number of k-means iterations. Defaults to 10.
+        sample_size (int, optional): The number of rows to train on. Defaults to
+            256 rows per list, capped at the number of rows.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        np.ndarray: The (n_lists, dim) matrix of normalized centroids.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = embeddings.shape[0]
+    sample_size = min(sample_size or 256 * n_lists, n_rows)
+    n_lists = min(n_lists, sample_size)
+    sample_rows = np.sort(rng.choice(n_rows, sample_size, replace=False))
+    sample = normalize_rows(embeddings[sample_rows])
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+
+    for _ in range(n_iter):
+        assignments = assign_lists(sample, centroids)
+        counts = np.bincount(assignments, minlength=n_lists)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        filled = counts > 0
+        sums = np.zeros_like(centroids)
+        sums[filled] = np.add.reduceat(sample[np.argsort(assignments)], starts[filled])
+        # Re-seed empty lists with random rows so that every list stays in use
+        sums[~filled] = sample[rng.choice(sample_size, int((~filled).sum()))]
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    """Inverted-file index over the rows of a normalized embedding matrix.
+
+    Args:
+        centroids (np.ndarray): The (n_lists, dim) matrix of list centroids.
+        list_offsets (np.ndarray): The (n_lists + 1) start of each list in list_rows.
+        list_rows (np.ndarray): The embedding rows, grouped by list.
+    """
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray,
+                 list_rows: np.ndarray) -> None:
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+
+    @property
+    def n_lists(self) -> int:
+        """The number of inverted lists."""
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, n_lists: Optional[int] = None,
+              **train_kwargs) -> "IVFIndex":
+        """Trains the centroids and assigns every row of the matrix to a list.
+
+        Args:
+            embeddings (np.ndarray): The (n_rows, dim) matrix of normalized embeddings.
+            n_lists (int, optional): The number of lists. Defaults to 4 * sqrt(n_rows).
+            **train_kwargs: Passed on to `train_centroids`.
+
+        Returns:
+            IVFIndex: The built index.
+        """
+        n_rows = embeddings.shape[0]
+        n_lists = min(n_lists or int(4 * np.sqrt(n_rows)) or 1, n_rows)
+        centroids = train_centroids(embeddings, n_lists, **train_kwargs)
+        assignments = assign_lists(embeddings, centroids)
+        counts = np.bincount(assignments, minlength=centroids.shape[0])
+        list_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        list_rows = np.argsort(assignments, kind="stable").astype(np.int64)
+        return cls(centroids, list_offsets, list_rows)
+
+    def save(self, out_dir: str, fingerprint: Optional[str] = None) -> None:
+        """Writes the index to out_dir, with meta.json written last.
+
+        Args:
+            out_dir (str): The directory to write the index to.
+            fingerprint (str, optional): The fingerprint of the export the index
+                was built on (see vector_store.read_fingerprint).
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        np.save(os.path.join(out_dir, CENTROIDS_FILE), self.centroids)
+        np.save(os.path.join(out_dir, LIST_OFFSETS_FILE), self.list_offsets)
+        np.save(os.path.join(out_dir, LIST_ROWS_FILE), self.list_rows)
+        meta = {"n_lists": self.n_lists, "num_rows": int(self.list_rows.shape[0]),
+                "fingerprint": fingerprint}
+        with open(os.path.join(out_dir, META_FILE), "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+
+    @classmethod
+    def load(cls, persist_dir: str, num_rows: Optional[int] = None,
+             fingerprint: Optional[str] = None) -> "IVFIndex":
+        """Loads an index written by `save`, memory-mapping the row lists.
+
+        Args:
+            persist_dir (str): The directory the index was saved to.
+            num_rows (int, optional): The number of rows of the embedding matrix
+                to be searched. Not checked if None.
+            fingerprint (str, optional): The fingerprint of that matrix's export.
+                Not checked if None.
+
+        Raises:
+            ValueError: If the index was built on another matrix; search it
+                exactly instead.
+        """
+        if num_rows is not None:
+            with open(os.path.join(persist_dir, META_FILE), "r", encoding="utf-8") as file:
+                check_built_on(json.load(file), num_rows, fingerprint, persist_dir)
+        return cls(
+            np.load(os.path.join(persist_dir, CENTROIDS_FILE)),
+            np.load(os.path.join(persist_dir, LIST_OFFSETS_FILE)),
+            np.load(os.path.join(persist_dir, LIST_ROWS_FILE), mmap_mode="r"),
+        )
+
+    def candidate_rows(self, query_embedding: np.ndarray, nprobe: int) -> np.ndarray:
+        """Returns the sorted rows of the nprobe lists closest to the query."""
+        lists = top_k_rows(self.centroids @ query_embedding, nprobe)
+        rows = [self.list_rows[self.list_offsets[i] : self.list_offsets[i + 1]] for i in lists]
+        # Sorted rows read the memory-mapped embedding matrix front to back
+        return np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+
+    def search(self, embeddings: np.ndarray, query_embedding: np.ndarray,  # pylint: disable=R0913
+               top_k: int, nprobe: int, *, similarity_cutoff: Optional[float] = None,
+               row_mask: Optional[np.ndarray] = None):
+        """Finds the approximate top k rows for a normalized query embedding.
+
+        Args:
+            embeddings (np.ndarray): The matrix the index was built on.
+            query_embedding (np.ndarray): The normalized query embedding.
+            top_k (int): The number of rows to return.
+            nprobe (int): The number of lists to scan. Higher is slower but closer
+                to exact search; nprobe == n_lists is exact.
+            similarity_cutoff (float, optional): Drops rows scoring below it.
+            row_mask (np.ndarray, optional): A boolean array with one entry per row;
+                only the candidates where it is True are scored.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The selected rows, best first, and their scores.
+        """
+        rows = self.candidate_rows(query_embedding, nprobe)
+        if row_mask is not None:
+            rows = rows[row_mask[rows]]
+        scores = embeddings[rows] @ query_embedding
+        selected = top_k_rows(scores, top_k, similarity_cutoff)
+        return rows[selected], scores[selected]
+
+
+class IVFRetriever(MatrixRetriever):
+    """Approximate top-k retriever that only scans the lists closest to the query.
+
+    Takes the same arguments as MatrixRetriever, plus:
+
+    Args:
+        ivf_index (IVFIndex): An index built on the retriever's embedding matrix.
+        nprobe (int, optional): The default number of lists to scan. Defaults to 8.
+    """
+
+    def __init__(self, *args, ivf_index: IVFIndex, nprobe: int = 8, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.ivf_index = ivf_index
+        self.nprobe = nprobe
+
+    def search_rows(self, query_bundle: QueryBundle, row_mask: Optional[np.ndarray] = None,
+                    nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the best rows for a query by scanning `nprobe` lists.
+
+        With a row mask, the candidates of the lists are filtered by it. When the
+        mask selects no more rows than the lists hold on average, those rows are
+        scored exactly instead, which is faster and finds every match.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The selected rows, best first, and their scores.
+        """
+        nprobe = nprobe or self.nprobe
+        with span("query_embedding"):
+            query_embedding = self.embed_query(query_bundle)
+        with span("retrieval"):
+            rows = None if row_mask is None else np.flatnonzero(row_mask)
+            expected_candidates = self.embeddings.shape[0] * nprobe / self.ivf_index.n_lists
+            if rows is not None and len(rows) <= expected_candidates:
+                return self.search_subset(query_embedding, rows)
+            return self.ivf_index.search(
+                self.embeddings,
+                query_embedding,
+                self.similarity_top_k,
+                nprobe,
+                similarity_cutoff=self.similarity_cutoff,
+                row_mask=row_mask,
+            )
+
+    def retrieve_with_nprobe(self, str_or_query_bundle: QueryType,
+                             nprobe: int) -> List[NodeWithScore]:
+        """Retrieves with a per-query nprobe instead of the retriever's default."""
+        if isinstance(str_or_query_bundle, str):
+            str_or_query_bundle = QueryBundle(str_or_query_bundle)
+        return self.nodes_with_scores(
+            *self.search_rows(str_or_query_bundle, self.row_mask, nprobe)
+        )
+
+
+def main():
+    """
+    Builds the IVF index for the memory-mapped export in ./data/mmap (see
+    vector_store.py) and saves it to ./data/ivf, where the app picks it up.
+    """
+    embeddings = np.load(os.path.join("./data/mmap", EMBEDDINGS_FILE), mmap_mode="r")
+    ivf_index = IVFIndex.build(embeddings)
+    ivf_index.save("./data/ivf", fingerprint=read_fingerprint("./data/mmap"))
+    print(f"Saved an IVF index with {ivf_index.n_lists} lists to ./data/ivf")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains a local inverted index with BM25 scoring over the transcript
+chunks, used for keyword search without an OpenAI API key or any network access.
+
+Every posting stores its precomputed BM25 term weight (impact), so a query only
+adds up the impact slices of its terms into one score per chunk and selects the
+best chunks; there is no per-query length normalization or IDF computation.
+
+Layout of an index directory (data/bm25 by default):
+1. vocabulary.json - the sorted indexed terms; a term's position is its id.
+2. term_offsets.npy - (n_terms + 1) uint64 offsets of each term's postings.
+3. posting_chunks.npy - uint32 chunk ids of the postings, grouped by term.
+4. posting_impacts.npy - float32 BM25 weights of the postings.
+5. chunks.json - the metadata of every chunk (episode title and number,
+   YouTube link, timestamp) and its node id.
+6. meta.json - chunk count, BM25 parameters and format version. Written last,
+   so its presence marks a complete index.
+
+Modules: os, re, json, collections, numpy.
+"""
+
+import json
+import os
+import re
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+FORMAT_VERSION = 1
+BM25_INDEX_DIR = "./data/bm25"
+META_FILE = "meta.json"
+CHUNK_METADATA_KEYS = ("episode_title", "episode_number", "youtube_link", "timestamp")
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset("""
+a about after all also am an and any are as at be because been but by can could
+did do does doing don't for from get got had has have having he her here him his
+how i i'm if in into is it it's its just like me more my no not now of on one or
+our out really so some than that that's the their them then there these they
+this to too up us very was we what when where which who why will with would you
+your
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercases text and splits it into word tokens, dropping common stopwords."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def invert(term_counts: List[Counter]) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+    """Turns per-chunk term counts into postings grouped by term.
+
+    Args:
+        term_counts (list[Counter]): The term frequencies of each chunk.
+
+    Returns:
+        tuple: The sorted terms, the (n_terms + 1) offsets of each term's postings,
+            and the chunk id and term frequency of every posting.
+    """
+    postings = {}
+    for chunk_id, counts in enumerate(term_counts):
+        for term, count in counts.items():
+            postings.setdefault(term, []).append((chunk_id, count))
+    terms = sorted(postings)
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    term_offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+    flat = np.array([posting for term in terms for posting in postings[term]],
+                    dtype=np.int64).reshape(-1, 2)
+    return terms, term_offsets, flat[:, 0].astype(np.uint32), flat[:, 1].astype(np.float32)
+
+
+class BM25Index:
+    """Inverted index of transcript chunks with precomputed BM25 weights.
+
+    Use BM25Index.build to index chunks and BM25Index.load to open a saved index.
+
+    Args:
+        vocabulary (dict): Maps each term to its id.
+        term_offsets (np.ndarray): The offsets of each term's postings.
+        posting_chunks (np.ndarray): The chunk id of every posting.
+        posting_impacts (np.ndarray): The BM25 weight of every posting.
+        chunks (list[dict]): The metadata of every chunk.
+    """
+
+    def __init__(self, vocabulary: dict, term_offsets: np.ndarray,
+                 posting_chunks: np.ndarray, posting_impacts: np.ndarray,
+                 chunks: List[dict]) -> None:
+        self.vocabulary = vocabulary
+        self.term_offsets = term_offsets
+        self.posting_chunks = posting_chunks
+        self.posting_impacts = posting_impacts
+        self.chunks = chunks
+
+    @property
+    def num_chunks(self) -> int:
+        """The number of indexed chunks."""
+        return len(self.chunks)
+
+    # pylint: disable=R0914
+    @classmethod
+    def build(cls, documents: Iterable, k1: float = 1.2, b: float = 0.75) -> "BM25Index":
+        """Indexes the text of Documents (or nodes) and keeps their chunk metadata.
+
+        Args:
+            documents (Iterable): Objects with `text` and `metadata`, e.g. the
+                Documents of indexing.parse_into_documents.
+            k1 (float, optional): BM25 term frequency saturation. Defaults to 1.2.
+            b (float, optional): BM25 length normalization. Defaults to 0.75.
+
+        Returns:
+            BM25Index: The built index.
+        """
+        chunks = []
+        term_counts = []
+        for doc in documents:
+            chunk = {key: doc.metadata.get(key) for key in CHUNK_METADATA_KEYS}
+            chunk["node_id"] = doc.node_id
+            chunks.append(chunk)
+            term_counts.append(Counter(tokenize(doc.text)))
+
+        terms, term_offsets, posting_chunks, posting_counts = invert(term_counts)
+
+        # Precompute every posting's weight: idf * tf * (k1 + 1) / (tf + k1 * norm)
+        lengths = np.array([sum(counts.values()) for counts in term_counts], dtype=np.float32)
+        average_length = max(float(lengths.mean()), 1.0) if len(lengths) else 1.0
+        length_norms = k1 * (1.0 - b + b * lengths / average_length)
+        document_frequencies = np.diff(term_offsets).astype(np.float32)
+        idf = np.log(1.0 + (len(chunks) - document_frequencies + 0.5)
+                     / (document_frequencies + 0.5))
+        posting_impacts = (
+            np.repeat(idf, np.diff(term_offsets).astype(np.int64)) * posting_counts * (k1 + 1.0)
+            / (posting_counts + length_norms[posting_chunks])
+        ).astype(np.float32)
+
+        vocabulary = {term: term_id for term_id, term in enumerate(terms)}
+        return cls(vocabulary, term_offsets, posting_chunks, posting_impacts, chunks)
+
+    def save(self, out_dir: str = BM25_INDEX_DIR) -> None:
+        """Writes the index to out_dir, finishing with meta.json."""
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, "vocabulary.json"), "w", encoding="utf-8") as file:
+            json.dump(sorted(self.vocabulary, key=self.vocabulary.get), file)
+        np.save(os.path.join(out_dir, "term_offsets.npy"), self.term_offsets)
+        np.save(os.path.join(out_dir, "posting_chunks.npy"), self.posting_chunks)
+        np.save(os.path.join(out_dir, "posting_impacts.npy"), self.posting_impacts)
+        with open(os.path.join(out_dir, "chunks.json"), "w", encoding="utf-8") as file:
+            json.dump(self.chunks, file)
+        with open(os.path.join(out_dir, META_FILE), "w", encoding="utf-8") as file:
+            json.dump({"format_version": FORMAT_VERSION, "num_chunks": self.num_chunks,
+                       "num_terms": len(self.vocabulary)}, file)
+
+    @classmethod
+    def load(cls, index_dir: str = BM25_INDEX_DIR) -> "BM25Index":
+        """Opens a saved index, memory-mapping the postings.
+
+        Raises:
+            ValueError: If the index was written by an unsupported format version.
+        """
+        with open(os.path.join(index_dir, META_FILE), "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported BM25 index version {meta['format_version']}")
+        with open(os.path.join(index_dir, "vocabulary.json"), "r", encoding="utf-8") as file:
+            vocabulary = {term: term_id for term_id, term in enumerate(json.load(file))}
+        with open(os.path.join(index_dir, "chunks.json"), "r", encoding="utf-8") as file:
+            chunks = json.load(file)
+        return cls(
+            vocabulary,
+            np.load(os.path.join(index_dir, "term_offsets.npy")),
+            np.load(os.path.join(index_dir, "posting_chunks.npy"), mmap_mode="r"),
+            np.load(os.path.join(index_dir, "posting_impacts.npy"), mmap_mode="r"),
+            chunks,
+        )
+
+    def scores(self, query: str) -> np.ndarray:
+        """Returns the BM25 score of every chunk for a query."""
+        scores = np.zeros(self.num_chunks, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is not None:
+                start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+                scores[self.posting_chunks[start:end]] += self.posting_impacts[start:end]
+        return scores
+
+    def search(self, query: str, top_k: int = 10,
+               row_mask: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Finds the chunks that best match a query.
+
+        Args:
+            query (str): The keyword query.
+            top_k (int, optional): The maximum number of chunks. Defaults to 10.
+            row_mask (np.ndarray, optional): A boolean array with one entry per
+                chunk; only the chunks where it is True are returned.
+
+        Returns:
+            list[tuple[int, float]]: (chunk id, score) pairs, best first. Chunks
+                sharing no term with the query are never returned.
+        """
+        if top_k <= 0:
+            return []
+        scores = self.scores(query)
+        if row_mask is not None:
+            scores[~row_mask] = 0.0
+        matches = np.flatnonzero(scores)
+        if len(matches) > top_k:
+            matches = matches[np.argpartition(-scores[matches], top_k - 1)[:top_k]]
+        matches = matches[np.argsort(-scores[matches], kind="stable")]
+        return [(int(chunk_id), float(scores[chunk_id])) for chunk_id in matches]
+
+    def search_metadata(self, query: str, top_k: int = 10,
+                        row_mask: Optional[np.ndarray] = None) -> List[dict]:
+        """Like search, but returns copies of the chunk metadata with a "score" key."""
+        return [{**self.chunks[chunk_id], "score": score}
+                for chunk_id, score in self.search(query, top_k, row_mask)]
+
+
+def main():
+    """
+    Builds the BM25 index and saves it to ./data/bm25, where the app picks it up.
+
+    When the memory-mapped export of the vector index exists (see vector_store.py),
+    its nodes are indexed in row order, so the app can also fuse keyword and dense
+    results (see retrievers.HybridRetriever). Otherwise every transcript chunk is
+    indexed, read from the packed corpus when it has been written (see
+    packed_corpus.py) and from ./transcript_data otherwise.
+    """
+    # Imported here so searching does not depend on the indexing module
+    # pylint: disable=C0415
+    from tldhuber.utils.indexing import iter_episode_documents
+    from tldhuber.utils.packed_corpus import PACKED_CORPUS_FILE
+    from tldhuber.utils.vector_store import MmapVectorStore
+
+    if os.path.exists(os.path.join("./data/mmap", META_FILE)):
+        store = MmapVectorStore("./data/mmap")
+        documents = (store.get_node(row) for row in range(store.num_nodes))
+    else:
+        source = PACKED_CORPUS_FILE if os.path.exists(PACKED_CORPUS_FILE) else "./transcript_data"
+        documents = (doc for episode in iter_episode_documents(source) for doc in episode)
+    bm25_index = BM25Index.build(documents)
+    bm25_index.save(BM25_INDEX_DIR)
+    print(f"Saved a BM25 index of {bm25_index.num_chunks} chunks and "
+          f"{len(bm25_index.vocabulary)} terms to {BM25_INDEX_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains the append-only checkpoint log written during ingestion.
+
+process_documents used to write every finished batch to its own pickle file,
+and a crash meant restarting by hand from a chosen start_index. Instead, every
+finished batch is appended to a single log file as one record:
+
+    MAGIC (4 bytes) | payload length (uint32) | CRC-32 of the payload (uint32) | payload
+
+The payload is the JSON of the batch key and its serialized nodes (including
+their embeddings). Records are flushed and fsynced as they are written. When a
+log is opened, every record is checked against its length and checksum, and a
+torn or corrupt tail (e.g. from a crash mid-write) is cut off, so the log always
+holds exactly the completed batches. Ingestion skips batches whose key is
+already in the log, and iter_nodes streams the nodes back one record at a time.
+
+Modules: os, json, struct, zlib, llama_index.
+"""
+
+import json
+import os
+import struct
+import zlib
+from typing import Iterator, List, Set, Tuple
+
+from llama_index.core.schema import BaseNode
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+
+MAGIC = b"TLDC"
+HEADER = struct.Struct("<4sII")
+
+
+class CheckpointLog:
+    """Append-only, checksummed log of ingested batches of nodes.
+
+    Args:
+        path (str): The log file. It is created if it does not exist, and
+            truncated to its last complete record if its tail is damaged.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._keys = []
+        end = 0
+        for key, _, record_end in self._scan():
+            self._keys.append(key)
+            end = record_end
+        with open(path, "ab") as file:
+            if file.tell() != end:
+                # Drop the incomplete record left by an interrupted write
+                file.truncate(end)
+
+    def _scan(self) -> Iterator[Tuple[str, bytes, int]]:
+        """Yields (key, payload, end offset) of each valid record, stopping at damage."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            while True:
+                header = file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                magic, length, checksum = HEADER.unpack(header)
+                payload = file.read(length)
+                if magic != MAGIC or len(payload) < length or zlib.crc32(payload) != checksum:
+                    return
+                yield json.loads(payload)["key"], payload, file.tell()
+
+    @property
+    def completed_keys(self) -> Set[str]:
+        """The keys of the batches stored in the log."""
+        return set(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def append(self, key: str, nodes: List[BaseNode]) -> None:
+        """Appends a finished batch and waits until it is on disk."""
+        payload = json.dumps(
+            {"key": key, "nodes": [doc_to_json(node) for node in nodes]}
+        ).encode("utf-8")
+        with open(self.path, "ab") as file:
+            file.write(HEADER.pack(MAGIC, len(payload), zlib.crc32(payload)))
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        self._keys.append(key)
+
+    def iter_batches(self) -> Iterator[Tuple[str, List[BaseNode]]]:
+        """Yields the (key, nodes) of each stored batch, in the order they were written."""
+        for key, payload, _ in self._scan():
+            yield key, [json_to_doc(node) for node in json.loads(payload)["nodes"]]
+
+    def iter_nodes(self) -> Iterator[BaseNode]:
+        """Yields every stored node, holding only one batch in memory at a time."""
+        for _, nodes in self.iter_batches():
+            yield from nodes
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file turns the source nodes of a query response into the video clips the
+app and the search API show: the metadata of each node, with a YouTube link
+starting at the node's timestamp.
+
+It imports nothing, so the search API and the benchmarks can use it without
+importing indexing.py or the Streamlit app.
+
+Modules: none.
+"""
+
+
+def get_mid_video_link(link, time_stamp):
+    """
+    Modifies a YouTube link to start at a specified time.
+
+    Parameters:
+        link (str): The original YouTube video link.
+        time_stamp (int): The start time in seconds.
+
+    Returns:
+        str: The modified YouTube link with the start time parameter.
+    """
+    base_url = link.replace("www.youtube.com/watch?v=", "youtu.be/")
+    return f"{base_url}?t={time_stamp}"
+
+
+def extract_metadata(query_response):
+    """
+    Extracts and transforms metadata from source nodes in a query response.
+
+    Parameters:
+        query_response (QueryResponse): The response from a query engine.
+
+    Returns:
+        list[dict]: A list of transformed metadata dictionaries with modified YouTube links.
+    """
+    metadata_list = [node.metadata for node in query_response.source_nodes]
+    for metadata in metadata_list:
+        base_link = metadata["youtube_link"]
+        start_time = metadata["timestamp"]
+        metadata["youtube_link"] = get_mid_video_link(base_link, start_time)
+    return metadata_list
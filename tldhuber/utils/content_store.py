@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains the content-addressed store used for incremental indexing.
+
+The store is a single SQLite file with two tables:
+1. nodes - the output of the expensive ingestion steps (keyword extraction and
+   embedding), keyed by a hash of the node's input text and metadata. Any node
+   whose content was processed before is looked up here instead of being sent
+   to the OpenAI API again.
+2. manifest - one row per source Document (a transcript chunk), with the hash of
+   its content, the ref_doc_id its nodes have in the index, and the hashes of
+   those nodes. Documents whose hash is unchanged are skipped entirely.
+
+Modules: os, json, hashlib, sqlite3, numpy.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+def content_hash(text: str, metadata: dict) -> str:
+    """Returns the SHA-256 hex digest of a text and its JSON-encoded metadata."""
+    digest = hashlib.sha256(text.encode("utf-8"))
+    digest.update(json.dumps(metadata, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ContentStore:
+    """SQLite-backed store of processed nodes and of the indexed documents.
+
+    Args:
+        path (str): The SQLite file to use. It is created if it does not exist.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS nodes ("
+            "hash TEXT PRIMARY KEY, metadata TEXT, embedding BLOB)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            "doc_key TEXT PRIMARY KEY, ref_doc_id TEXT, doc_hash TEXT, node_hashes TEXT)"
+        )
+        self._connection.commit()
+
+    def close(self) -> None:
+        """Closes the underlying SQLite connection."""
+        self._connection.close()
+
+    def get_node(self, node_hash: str) -> Optional[Tuple[dict, Optional[List[float]]]]:
+        """Looks up the metadata added to, and the embedding of, a processed node.
+
+        Returns:
+            tuple[dict, list[float]] or None: The added metadata and the embedding,
+                or None if no node with this content was processed before.
+        """
+        row = self._connection.execute(
+            "SELECT metadata, embedding FROM nodes WHERE hash = ?", (node_hash,)
+        ).fetchone()
+        if row is None:
+            return None
+        embedding = None
+        if row[1] is not None:
+            embedding = np.frombuffer(row[1], dtype=np.float32).tolist()
+        return json.loads(row[0]), embedding
+
+    def put_nodes(self, records: Iterable[Tuple[str, dict, Optional[List[float]]]]) -> None:
+        """Stores (hash, added metadata, embedding) records of processed nodes."""
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)",
+            [
+                (
+                    node_hash,
+                    json.dumps(metadata, default=str),
+                    None if embedding is None
+                    else np.asarray(embedding, dtype=np.float32).tobytes(),
+                )
+                for node_hash, metadata, embedding in records
+            ],
+        )
+        self._connection.commit()
+
+    def manifest(self) -> Dict[str, dict]:
+        """Returns the manifest as {doc_key: {ref_doc_id, doc_hash, node_hashes}}."""
+        rows = self._connection.execute(
+            "SELECT doc_key, ref_doc_id, doc_hash, node_hashes FROM manifest"
+        ).fetchall()
+        return {
+            doc_key: {
+                "ref_doc_id": ref_doc_id,
+                "doc_hash": doc_hash,
+                "node_hashes": json.loads(node_hashes),
+            }
+            for doc_key, ref_doc_id, doc_hash, node_hashes in rows
+        }
+
+    def put_manifest(self, entries: Dict[str, dict]) -> None:
+        """Adds or replaces manifest entries, in the format returned by `manifest`."""
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)",
+            [
+                (doc_key, entry["ref_doc_id"], entry["doc_hash"],
+                 json.dumps(entry["node_hashes"]))
+                for doc_key, entry in entries.items()
+            ],
+        )
+        self._connection.commit()
+
+    def delete_manifest(self, doc_keys: Iterable[str]) -> None:
+        """Removes the manifest entries of the given documents."""
+        self._connection.executemany(
+            "DELETE FROM manifest WHERE doc_key = ?", [(doc_key,) for doc_key in doc_keys]
+        )
+        self._connection.commit()
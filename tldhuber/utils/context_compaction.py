@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains a node postprocessor that compacts the retrieved context
+before it is sent to the LLM.
+
+Retrieved nodes often come from the same stretch of an episode: the splits of
+one transcript chunk overlap, since SentenceSplitter repeats chunk_overlap
+tokens at each boundary, and consecutive transcript chunks are often retrieved
+together. ContextCompactor:
+1. Merges the nodes of each episode whose timestamps are at most max_gap
+   seconds apart into one node, in transcript order, starting at the earliest
+   timestamp. Text shared by overlapping splits is kept once, and the episode's
+   metadata is sent once instead of once per node.
+2. Drops nodes whose text mostly repeats that of a better scoring node (word
+   3-gram Jaccard similarity of at least duplicate_threshold).
+3. Packs the nodes, best first, into token_budget tokens, skipping the nodes
+   that no longer fit.
+Token counts are cached by text, so the nodes of popular queries are only
+tokenized once.
+
+Modules: hashlib, threading, collections, llama_index.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Callable, List, Optional
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import (MetadataMode, NodeRelationship, NodeWithScore,
+                                     QueryBundle, TextNode)
+from llama_index.core.utils import get_tokenizer
+
+from tldhuber.utils.metrics import CONTEXT_TOKENS, REGISTRY, span
+
+
+def shingles(text: str, size: int = 3) -> set:
+    """Returns the set of lowercased word n-grams of a text."""
+    words = text.lower().split()
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def jaccard(first: set, second: set) -> float:
+    """Returns the Jaccard similarity of two sets."""
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+def overlap_length(previous, node) -> int:
+    """Returns how many leading characters of a node repeat the end of the
+    previous split of the same transcript chunk, or 0 for other nodes."""
+    if previous.ref_doc_id is None or previous.ref_doc_id != node.ref_doc_id:
+        return 0
+    if previous.end_char_idx is None or node.start_char_idx is None:
+        return 0
+    return max(0, previous.end_char_idx - node.start_char_idx)
+
+
+def merge_nodes(nodes: List[NodeWithScore]) -> NodeWithScore:
+    """Merges nodes of one episode, given in transcript order, into one node.
+
+    The merged node has the metadata of the first node, so it starts at the
+    earliest timestamp, and the id and score of the best scoring node.
+    """
+    if len(nodes) == 1:
+        return nodes[0]
+    first = nodes[0].node
+    parts, previous = [first.text], first
+    for node_with_score in nodes[1:]:
+        node = node_with_score.node
+        overlap = overlap_length(previous, node)
+        if overlap:
+            parts.append(node.text[overlap:])
+        else:
+            parts.append("\n\n" + node.text)
+        if overlap == 0 or (node.end_char_idx or 0) > (previous.end_char_idx or 0):
+            previous = node
+    best = max(nodes, key=lambda node_with_score: node_with_score.score or 0.0)
+    merged = TextNode(
+        id_=best.node.node_id,
+        text="".join(parts),
+        metadata=dict(first.metadata),
+        excluded_embed_metadata_keys=list(first.excluded_embed_metadata_keys),
+        excluded_llm_metadata_keys=list(first.excluded_llm_metadata_keys),
+    )
+    if NodeRelationship.SOURCE in first.relationships:
+        merged.relationships[NodeRelationship.SOURCE] = first.relationships[
+            NodeRelationship.SOURCE
+        ]
+    return NodeWithScore(node=merged, score=best.score)
+
+
+class ContextCompactor(BaseNodePostprocessor):  # pylint: disable=R0901
+    """Node postprocessor that merges, deduplicates and packs retrieved nodes.
+
+    Args:
+        token_budget (int, optional): The most tokens of context, counting the
+            metadata the LLM sees. Defaults to 3072.
+        max_gap (float, optional): The most seconds between the timestamps of
+            nodes of one episode that are merged. Transcript chunks are about three
+            minutes long. Defaults to 300.
+        duplicate_threshold (float, optional): The word 3-gram Jaccard similarity
+            from which a node is a near-duplicate. Defaults to 0.8.
+        tokenizer (Callable, optional): Defaults to llama_index's tokenizer.
+        cache_size (int, optional): The number of token counts cached. Defaults
+            to 4096.
+    """
+
+    token_budget: int = Field(default=3072, description="Most tokens of context.")
+    max_gap: float = Field(default=300.0, description="Most seconds between merged nodes.")
+    duplicate_threshold: float = Field(default=0.8, description="Near-duplicate similarity.")
+    cache_size: int = Field(default=4096, description="Number of cached token counts.")
+
+    _tokenizer: Callable = PrivateAttr()
+    _token_counts: OrderedDict = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+
+    def __init__(self, token_budget: int = 3072, max_gap: float = 300.0,
+                 duplicate_threshold: float = 0.8, tokenizer: Optional[Callable] = None,
+                 cache_size: int = 4096, **kwargs) -> None:
+        super().__init__(token_budget=token_budget, max_gap=max_gap,
+                         duplicate_threshold=duplicate_threshold, cache_size=cache_size,
+                         **kwargs)
+        self._tokenizer = tokenizer or get_tokenizer()
+        self._token_counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextCompactor"
+
+    def count_tokens(self, node) -> int:
+        """Counts the tokens of a node as the LLM sees it, with its metadata."""
+        text = node.get_content(metadata_mode=MetadataMode.LLM)
+        key = hashlib.sha1(text.encode("utf-8")).digest()
+        with self._lock:
+            if key in self._token_counts:
+                self._token_counts.move_to_end(key)
+                return self._token_counts[key]
+        count = len(self._tokenizer(text))
+        with self._lock:
+            self._token_counts[key] = count
+            while len(self._token_counts) > self.cache_size:
+                self._token_counts.popitem(last=False)
+        return count
+
+    def merge_neighbours(self, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """Merges the nodes of each episode that are at most max_gap seconds apart,
+        as long as the merged node fits in the token budget."""
+        episodes, merged = defaultdict(list), []
+        for node in nodes:
+            if node.node.metadata.get("timestamp") is None:
+                merged.append(node)
+            else:
+                episodes[node.node.metadata.get("youtube_link")].append(node)
+
+        for episode_nodes in episodes.values():
+            episode_nodes.sort(key=lambda node: (float(node.node.metadata["timestamp"]),
+                                                 node.node.start_char_idx or 0))
+            group = [episode_nodes[0]]
+            for node in episode_nodes[1:]:
+                gap = (float(node.node.metadata["timestamp"])
+                       - float(group[-1].node.metadata["timestamp"]))
+                if gap <= self.max_gap and (
+                        self.count_tokens(merge_nodes(group + [node]).node) <= self.token_budget):
+                    group.append(node)
+                else:
+                    merged.append(merge_nodes(group))
+                    group = [node]
+            merged.append(merge_nodes(group))
+        return merged
+
+    def drop_duplicates(self, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """Drops the nodes, given best first, that repeat the text of a kept node."""
+        kept, kept_shingles = [], []
+        for node in nodes:
+            node_shingles = shingles(node.node.get_content())
+            if all(jaccard(node_shingles, other) < self.duplicate_threshold
+                   for other in kept_shingles):
+                kept.append(node)
+                kept_shingles.append(node_shingles)
+        return kept
+
+    def pack(self, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """Keeps the nodes, given best first, that fit in the token budget."""
+        packed, total = [], 0
+        for node in nodes:
+            tokens = self.count_tokens(node.node)
+            if total + tokens <= self.token_budget:
+                packed.append(node)
+                total += tokens
+        REGISTRY.observe(CONTEXT_TOKENS, total)
+        return packed
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        with span("context_compaction"):
+            merged = self.merge_neighbours(nodes)
+            merged.sort(key=lambda node: node.score or 0.0, reverse=True)
+            return self.pack(self.drop_duplicates(merged))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file provides a caching layer in front of the query embedding model.
+
+Every search embeds the user's query with a network call to OpenAI, even for
+common repeated queries such as "sleep". CachedEmbedding wraps any llama_index
+embedding model and keys query embeddings by their normalized text, so that
+queries differing only in case or whitespace share one embedding (the model
+still embeds the query as it was typed):
+1. A bounded in-memory LRU, private to the process.
+2. An optional SQLite file, shared by every app worker on the machine.
+Only misses in both tiers reach the wrapped model, and the misses of a batch of
+queries reach it in one call. The async methods read and write the SQLite file
+in a worker thread, so a slow disk does not block the event loop. Document
+(text) embeddings, which are only computed during ingestion, are passed through
+uncached.
+
+Modules: os, asyncio, sqlite3, threading, collections, numpy, llama_index.
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+
+
+def normalize_query(query: str) -> str:
+    """Lowercases a query and collapses its whitespace, for use as a cache key."""
+    return " ".join(query.lower().split())
+
+
+class CachedEmbedding(BaseEmbedding):  # pylint: disable=R0901
+    """Embedding model that caches the query embeddings of a wrapped model.
+
+    Args:
+        embed_model (BaseEmbedding): The model used on cache misses.
+        max_size (int, optional): The number of query embeddings kept in memory.
+            Defaults to 1024.
+        cache_path (str, optional): The SQLite file of the shared on-disk tier.
+            Defaults to None, which disables the on-disk tier.
+    """
+
+    max_size: int = Field(default=1024, description="Size of the in-memory LRU.")
+    cache_path: Optional[str] = Field(default=None, description="SQLite cache file.")
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _lru: OrderedDict = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+    _connection: Optional[sqlite3.Connection] = PrivateAttr()
+    _counters: dict = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, max_size: int = 1024,
+                 cache_path: Optional[str] = None, **kwargs) -> None:
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            max_size=max_size,
+            cache_path=cache_path,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def stats(self) -> dict:
+        """Hit and miss counts of each cache tier since the model was created."""
+        with self._lock:
+            stats = dict(self._counters)
+        stats["hits"] = stats["memory_hits"] + stats["disk_hits"]
+        return stats
+
+    def _disk(self) -> Optional[sqlite3.Connection]:
+        """Opens the on-disk tier on first use. Must be called with the lock held."""
+        if self.cache_path is None:
+            return None
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            self._connection = sqlite3.connect(
+                self.cache_path, timeout=30, check_same_thread=False
+            )
+            # Write-ahead logging lets readers in other workers proceed during writes
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "model TEXT, query TEXT, embedding BLOB, PRIMARY KEY (model, query))"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def _lookup(self, key: str) -> Optional[Embedding]:
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return self._lru[key]
+
+            connection = self._disk()
+            if connection is not None:
+                row = connection.execute(
+                    "SELECT embedding FROM query_embeddings WHERE model = ? AND query = ?",
+                    (self.model_name, key),
+                ).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype=np.float32).tolist()
+                    self._remember(key, embedding)
+                    self._counters["disk_hits"] += 1
+                    return embedding
+
+            self._counters["misses"] += 1
+            return None
+
+    def _remember(self, key: str, embedding: Embedding) -> None:
+        """Adds an embedding to the LRU. Must be called with the lock held."""
+        self._lru[key] = embedding
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+    def _store(self, key: str, embedding: Embedding) -> None:
+        with self._lock:
+            self._remember(key, embedding)
+            connection = self._disk()
+            if connection is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)",
+                    (self.model_name, key,
+                     np.asarray(embedding, dtype=np.float32).tobytes()),
+                )
+                connection.commit()
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        key = normalize_query(query)
+        embedding = self._lookup(key)
+        if embedding is None:
+            embedding = self._embed_model.get_query_embedding(query)
+            self._store(key, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        key = normalize_query(query)
+        embedding = await asyncio.to_thread(self._lookup, key)
+        if embedding is None:
+            embedding = await self._embed_model.aget_query_embedding(query)
+            await asyncio.to_thread(self._store, key, embedding)
+        return embedding
+
+    async def aget_query_embedding_batch(self, queries: List[str]) -> List[Embedding]:
+        """Embeds several queries, with a single call to the wrapped model for all
+        the distinct cache misses.
+
+        The misses are embedded as texts, since embedding models only batch texts.
+        OpenAI's embedding models embed queries and texts alike.
+        """
+        keys = [normalize_query(query) for query in queries]
+        embeddings = await asyncio.to_thread(lambda: [self._lookup(key) for key in keys])
+        # The first query of each missed key is embedded as it was typed
+        misses = {}
+        for query, key, found in zip(queries, keys, embeddings):
+            if found is None:
+                misses.setdefault(key, query)
+        if misses:
+            computed = dict(zip(
+                misses, await self._embed_model.aget_text_embedding_batch(list(misses.values()))
+            ))
+            await asyncio.to_thread(
+                lambda: [self._store(key, embedding) for key, embedding in computed.items()]
+            )
+            embeddings = [computed[key] if found is None else found
+                          for key, found in zip(keys, embeddings)]
+        return embeddings
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed_model.get_text_embedding(text)
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return await self._embed_model.aget_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._embed_model.get_text_embedding_batch(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self._embed_model.aget_text_embedding_batch(texts)
@@ -14,7 +14,23 @@ File contents:
 5. Test reloading the index.
 6. Create and test a simple retrieval engine using embeddings.
 
-Modules: os, json, time, nest_asyncio, pickle, llama_index.
+Later additions:
+- Transcripts are read and parsed in a worker pool (with orjson when it is
+  installed), and iter_episode_documents streams them one episode at a time,
+  from transcript_data/ or from a packed corpus file (see packed_corpus.py).
+- Ingestion checkpoints finished batches to an append-only log (see
+  checkpoint_log.py) and resumes from it automatically; build_index_from_log
+  streams the logged nodes into the index.
+- update_index merges new and changed transcript chunks into an existing index,
+  reusing the keywords and embeddings of already processed text from a
+  content-addressed store (see content_store.py). refresh_index.py runs it on
+  data/ and rebuilds the indexes derived from it.
+- Keywords are extracted locally by TF-IDF over the whole corpus (see
+  keyword_extractor.py) instead of with one LLM call per node, so only the
+  embeddings use the OpenAI API.
+
+Modules: os, json, concurrent.futures, nest_asyncio, pickle, llama_index,
+orjson (optional).
 
 Author: Edouard Seryozhenkov
 Date: 2024-02-29
@@ -22,26 +38,99 @@ Date: 2024-02-29
 
 import json
 import os
-import time
 import pickle as pkl
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator
 
 import nest_asyncio
 from llama_index.core import Document, VectorStoreIndex, get_response_synthesizer
 from llama_index.core.retrievers import VectorIndexRetriever
 from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.core.postprocessor import SimilarityPostprocessor
-from llama_index.core.extractors import KeywordExtractor
 from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core.ingestion import IngestionPipeline
+from llama_index.core.ingestion import IngestionPipeline, run_transformations
 from llama_index.core import StorageContext, load_index_from_storage
 from llama_index.core.schema import MetadataMode
 from llama_index.core import Settings
 from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.llms.openai import OpenAI
+
+from tldhuber.utils.checkpoint_log import CheckpointLog
+# Re-exported, the clip helpers moved to clips.py
+from tldhuber.utils.clips import extract_metadata, get_mid_video_link  # pylint: disable=W0611
+from tldhuber.utils.content_store import ContentStore, content_hash
+from tldhuber.utils.ingestion_scheduler import IngestionScheduler
+from tldhuber.utils.keyword_extractor import TfidfKeywordExtractor
+from tldhuber.utils.packed_corpus import PackedCorpus, is_packed_corpus
+
+try:
+    import orjson
+
+    json_loads = orjson.loads  # pylint: disable=E1101
+except ImportError:  # orjson is optional and only speeds up loading
+    json_loads = json.loads
 
 
 nest_asyncio.apply()
 
+# Metadata shown to neither the keyword extractor nor the embedding model
+EXCLUDED_METADATA_KEYS = ("episode_summary", "timestamp", "youtube_link")
+
+
+def read_json_transcript(path: str) -> dict:
+    """Reads and decodes one JSON transcript file, with orjson when it is installed."""
+    with open(path, "rb") as file:
+        return json_loads(file.read())
+
+
+def iter_transcript_paths(base_path: str) -> list[str]:
+    """Returns the paths of the JSON files in base_path, in sorted order."""
+    return [
+        os.path.join(base_path, filename)
+        for filename in sorted(os.listdir(base_path))
+        if filename.endswith(".json")
+    ]
+
+
+def _parallel_map(func, items: list, max_workers: int = None, use_processes: bool = False):
+    """Lazily yields func(item) for each item, in order, computed in a worker pool.
+
+    At most 2 * max_workers results are in flight at once, so memory stays bounded
+    by the pool size rather than by the number of items.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=max_workers) as executor:
+        pending = deque()
+        items = iter(items)
+        for item in islice(items, 2 * max_workers):
+            pending.append(executor.submit(func, item))
+        while pending:
+            result = pending.popleft().result()
+            for item in islice(items, 1):
+                pending.append(executor.submit(func, item))
+            yield result
+
+
+def iter_json_transcripts(base_path: str, max_workers: int = None,
+                          use_processes: bool = False) -> Iterator[dict]:
+    """Yields the JSON transcripts in base_path one at a time, parsed in parallel.
+
+    Args:
+        base_path (str): The path to the directory containing the transcript files.
+        max_workers (int, optional): The size of the worker pool. Defaults to the
+            number of CPUs.
+        use_processes (bool, optional): Parse in worker processes instead of
+            threads, which sidesteps the GIL for the pure-Python json decoder.
+            Defaults to False.
+
+    Yields:
+        dict: Each parsed transcript, in file name order.
+    """
+    yield from _parallel_map(read_json_transcript, iter_transcript_paths(base_path),
+                             max_workers, use_processes)
+
 
 def load_json_transcripts(base_path: str) -> list:
     """Loads all JSON transcript files from the specified base path.
@@ -53,32 +142,48 @@ def load_json_transcripts(base_path: str) -> list:
         list: A list containing all parsed transcript data as JSON objects.
             An empty list is returned if no valid transcripts are found.
     """
-    podcasts_as_json = []
-    for filename in os.listdir(base_path):
-        if filename.endswith(".json"):
-            path = base_path + "/" + filename
-            with open(path, "r", encoding="utf-8") as file:
-                podcasts_as_json.append(json.load(file))
-
-    return podcasts_as_json
+    return list(iter_json_transcripts(base_path))
 
 
-def parse_into_documents(podcast_jsons: list) -> list[Document]:
-    """Parses a list of JSON transcripts into a list of Document objects.
-
-    For each transcript:
+def episode_documents(pc_json: dict) -> list[Document]:
+    """Parses one JSON transcript into one Document per transcript chunk.
 
     1. Extracts essential metadata like episode title, number, summary, and YouTube link.
-    2. Creates a list of document subsections ("chunks") from the transcript's "chunks" key.
-    3. For each chunk:
+    2. For each chunk in the transcript's "chunks" key:
         - Creates a copy of the transcript metadata to avoid modifying the original.
         - Adds the chunk's timestamp to the metadata.
         - Initializes a Document object with the chunk's text and the modified metadata.
         - Excludes specified metadata keys (episode_summary, timestamp, youtube_link) from
             both LLM and embed processing within the Document object.
-        - Appends the created Document object to a list.
 
-    Finally, the function returns the constructed list of Document objects.
+    Args:
+        pc_json (dict): A JSON object representing a podcast transcript.
+
+    Returns:
+        list[Document]: The episode's Documents, in transcript order.
+    """
+    podcast_metadata = {
+        "episode_title": pc_json["title"],
+        "episode_number": pc_json["ep_num"],
+        "episode_summary": pc_json["episode_summary"],
+        "youtube_link": pc_json["link"],
+    }
+    doc_list = []
+    for chunk in pc_json["chunks"]:
+        chunk_metadata = podcast_metadata.copy()
+        chunk_metadata["timestamp"] = chunk["timestamp"]
+        doc = Document(text=chunk["text"], metadata=chunk_metadata)
+        doc.excluded_embed_metadata_keys = list(EXCLUDED_METADATA_KEYS)
+        doc.excluded_llm_metadata_keys = list(EXCLUDED_METADATA_KEYS)
+        doc_list.append(doc)
+    return doc_list
+
+
+def parse_into_documents(podcast_jsons: list) -> list[Document]:
+    """Parses a list of JSON transcripts into a list of Document objects.
+
+    Each transcript is parsed by episode_documents, and the Documents of all
+    transcripts are concatenated.
 
     Args:
         podcast_jsons (list): A list of JSON objects, each representing a podcast transcript.
@@ -88,32 +193,39 @@ def parse_into_documents(podcast_jsons: list) -> list[Document]:
                             metadata from each input JSON. An empty list is returned if no valid
                             transcripts are provided.
     """
-    doc_list = []
-    for pc_json in podcast_jsons:
-        podcast_metadata = {
-            "episode_title": pc_json["title"],
-            "episode_number": pc_json["ep_num"],
-            "episode_summary": pc_json["episode_summary"],
-            "youtube_link": pc_json["link"],
-        }
-        chunk_list = list(pc_json["chunks"])
-        for chunk in chunk_list:
-            chunk_metadata = podcast_metadata.copy()
-            chunk_metadata["timestamp"] = chunk["timestamp"]
-            chunk_text = chunk["text"]
-            doc = Document(text=chunk_text, metadata=chunk_metadata)
-            doc.excluded_embed_metadata_keys = [
-                "episode_summary",
-                "timestamp",
-                "youtube_link",
-            ]
-            doc.excluded_llm_metadata_keys = [
-                "episode_summary",
-                "timestamp",
-                "youtube_link",
-            ]
-            doc_list.append(doc)
-    return doc_list
+    return [doc for pc_json in podcast_jsons for doc in episode_documents(pc_json)]
+
+
+def _load_episode_documents(path: str) -> list[Document]:
+    return episode_documents(read_json_transcript(path))
+
+
+def iter_episode_documents(base_path: str, max_workers: int = None,
+                           use_processes: bool = False) -> Iterator[list[Document]]:
+    """Streams the transcripts in base_path as Documents, one episode at a time.
+
+    Reading, decoding and Document construction all happen in the worker pool, so
+    loading scales with the number of cores, and only a few episodes are held in
+    memory at once however large the corpus grows. base_path may also be a packed
+    corpus file (see packed_corpus.py), which is read sequentially instead.
+
+    Args:
+        base_path (str): The path to the directory containing the transcript files,
+            or to a packed corpus file.
+        max_workers (int, optional): The size of the worker pool. Defaults to the
+            number of CPUs.
+        use_processes (bool, optional): Use worker processes instead of threads.
+            Defaults to False.
+
+    Yields:
+        list[Document]: The Documents of each episode, in file name order.
+    """
+    if is_packed_corpus(base_path):
+        for pc_json in PackedCorpus(base_path).iter_transcripts():
+            yield episode_documents(pc_json)
+        return
+    yield from _parallel_map(_load_episode_documents, iter_transcript_paths(base_path),
+                             max_workers, use_processes)
 
 
 def get_simple_hube_engine(documents):
@@ -174,71 +286,344 @@ def unpickle_nodes(base_path):
     return unpickled_nodes
 
 
-def process_documents(
-    documents: list[Document],
-    pipeline = IngestionPipeline(transformations=[
+def keyword_extractor(documents: list = None) -> TfidfKeywordExtractor:
+    """Builds the local keyword extractor, with the term statistics of the given
+    documents if any (otherwise, each batch of nodes is its own corpus)."""
+    extractor = TfidfKeywordExtractor(keywords=5)
+    if documents:
+        extractor.fit(doc.text for doc in documents)
+    return extractor
+
+
+def default_pipeline(documents: list = None) -> IngestionPipeline:
+    """Builds the splitting, keyword extraction and OpenAI embedding pipeline.
+
+    Args:
+        documents (list[Document], optional): The whole corpus, whose term
+            statistics the keyword extractor uses. Defaults to None.
+    """
+    return IngestionPipeline(transformations=[
         SentenceSplitter(chunk_size=1024),
-        KeywordExtractor(keywords=5),
+        keyword_extractor(documents),
         OpenAIEmbedding(model="text-embedding-3-small"),
-    ]),
+    ])
+
+
+def batch_key(batch: list) -> str:
+    """Names a batch by the content hashes of its documents, in order, so that a
+    logged batch is only skipped on a later run if it holds the same documents."""
+    return content_hash("\n".join(content_hash(doc.text, doc.metadata) for doc in batch), {})
+
+
+def batch_keys(documents: list[Document], batch_size: int = 15,
+               start_index: int = 0) -> list[str]:
+    """Returns the batch_key of every batch process_documents makes of documents."""
+    return [batch_key(documents[i : i + batch_size])
+            for i in range(start_index, len(documents), batch_size)]
+
+
+def build_index_from_log(checkpoint_log: CheckpointLog, storage_context=None,
+                         embed_model=None, insert_batch_size: int = 1024,
+                         keys: Iterable[str] = None) -> VectorStoreIndex:
+    """Builds a VectorStoreIndex from the nodes of a checkpoint log.
+
+    Nodes are streamed from the log and inserted a slice at a time, so the full
+    list of nodes is never materialized next to the index. The nodes keep their
+    stored embeddings, so no embedding calls are made.
+
+    Args:
+        checkpoint_log (CheckpointLog): The log written by process_documents.
+        storage_context (StorageContext, optional): Where to store the index.
+            Defaults to a new in-memory StorageContext.
+        embed_model (BaseEmbedding, optional): The index's embedding model.
+            Defaults to Settings.embed_model.
+        insert_batch_size (int, optional): The number of nodes inserted at once.
+            Defaults to 1024.
+        keys (Iterable[str], optional): The keys of the batches to index, e.g. the
+            batch_keys of the current documents. The log keeps the batches of
+            documents that were edited or regrouped since they were logged, and
+            those are left out. Defaults to None, which indexes every batch.
+
+    Returns:
+        VectorStoreIndex: The index of the nodes of the selected batches.
+    """
+    index = VectorStoreIndex(
+        nodes=[],
+        storage_context=storage_context or StorageContext.from_defaults(),
+        embed_model=embed_model or Settings.embed_model,
+    )
+    keys = None if keys is None else set(keys)
+    nodes = (node for key, batch in checkpoint_log.iter_batches()
+             if keys is None or key in keys for node in batch)
+    while batch := list(islice(nodes, insert_batch_size)):
+        index.insert_nodes(batch)
+    return index
+
+
+# The scheduler settings are passed through as a single keyword-only argument
+# pylint: disable=R0913
+def process_documents(
+    documents: list[Document],
+    pipeline: IngestionPipeline = None,
     dump_object_func = dump_object,
     start_index: int = 0,
     batch_size: int = 15,
+    *,
+    scheduler_kwargs: dict = None,
+    checkpoint_log: CheckpointLog = None,
 ) -> int:
     """Processes a list of Document objects using a ingestion pipeline, including:
 
     1. Sentence splitting: Splits documents into smaller sentences for easier processing.
-    2. Keyword extraction: Extracts the top keywords from each document.
+    2. Keyword extraction: Extracts the top keywords from each document by TF-IDF,
+       with the term statistics of all the documents.
     3. OpenAI embedding: Generates embeddings for each document using the specified OpenAI model.
 
-    Batches processed using the `IngestionPipeline`, and the resulting data is serialized.
+    Batches are processed concurrently by an IngestionScheduler, which paces them to
+    stay under the OpenAI rate limits and retries rate-limited batches, and the
+    resulting data is serialized as each batch finishes.
+
+    With a checkpoint_log, finished batches are appended to the log instead of
+    being pickled, and batches already in the log are skipped, so an interrupted
+    run resumes where it stopped when called again with the same batch_size.
+    Batches are keyed by the content of their documents (see batch_key), so a
+    batch whose documents were edited, reordered or shifted is processed again.
 
     Args:
         documents (list[Document]): A list of documents to be processed.
+        pipeline (IngestionPipeline, optional): The pipeline to run. Defaults to
+                                    default_pipeline(documents), which is only built when needed
+                                    so that importing this module needs no API key.
         start_index (int, optional): The index at which to start processing. Defaults to 0.
         batch_size (int, optional): The number of documents to process in each batch.
                                     Defaults to 15.
+        scheduler_kwargs (dict, optional): Concurrency, rate limit and retry settings
+                                    passed to IngestionScheduler. Defaults to None.
+        checkpoint_log (CheckpointLog, optional): The log to resume from and append
+                                    finished batches to. Defaults to None, which
+                                    writes nodes_{i}.pkl files with dump_object_func.
 
     Returns:
         int: Returns 0 to indicate successful completion.
     """
-    # my_transformations = [
-    #     SentenceSplitter(chunk_size=1024),
-    #     KeywordExtractor(keywords=5),
-    #     OpenAIEmbedding(model="text-embedding-3-small"),
-    # ]
-    # pipeline = IngestionPipeline(transformations=my_transformations)
-    for i in range(start_index, len(documents), batch_size):
-        if i + batch_size < len(documents):
-            batch = documents[i : i + batch_size]
-            nodes = pipeline.run(documents=batch)
+    batches = [
+        (i, documents[i : i + batch_size])
+        for i in range(start_index, len(documents), batch_size)
+    ]
+    if checkpoint_log is not None:
+        completed = checkpoint_log.completed_keys
+        batches = [(i, batch) for i, batch in batches if batch_key(batch) not in completed]
+    if not batches:
+        return 0
+    if pipeline is None:
+        pipeline = default_pipeline(documents)
+
+    def save_batch(i, nodes):
+        if checkpoint_log is not None:
+            checkpoint_log.append(batch_key(documents[i : i + batch_size]), nodes)
+        elif i + batch_size < len(documents):
             dump_object_func(nodes, filename=f"nodes_{i}.pkl")
-            # Wait to avoid exceeding OpenAI rate limits
-            time.sleep(60)
         else:
             # Last batch
-            batch = documents[i:]
-            nodes = pipeline.run(documents=batch)
             dump_object_func(nodes, filename="nodes_final.pkl")
 
+    IngestionScheduler(pipeline, **(scheduler_kwargs or {})).run(batches, save_batch)
     return 0
 
 
-def get_mid_video_link(link, start_t):
-    """Modifies a YouTube link to start at the specified time (seconds)."""
-    base_url = link.replace("www.youtube.com/watch?v=", "youtu.be/")
-    return base_url + "?t=" + str(start_t)
+def document_key(doc) -> str:
+    """Returns a stable key for a transcript chunk: its video link and timestamp.
 
+    Works for Documents from parse_into_documents and for the nodes split from
+    them, since nodes inherit their Document's metadata.
+    """
+    return f"{doc.metadata['youtube_link']}#{doc.metadata['timestamp']}"
+
+
+def seed_content_store(
+    index: VectorStoreIndex,
+    content_store: ContentStore,
+    added_metadata_keys: tuple = ("excerpt_keywords",),
+) -> int:
+    """Records the nodes of an index built without update_index in a content store.
 
-def extract_metadata(response):
-    """Extracts and transforms metadata from source nodes in a query response."""
-    # pylint: disable=R0801
-    metadata_list = [node.metadata for node in response.source_nodes]
-    for metadata in metadata_list:
-        base_link = metadata["youtube_link"]
-        start_time = metadata["timestamp"]
-        metadata["youtube_link"] = get_mid_video_link(base_link, start_time)
-    return metadata_list
+    The keywords and embeddings of every node are stored under the hash of the
+    node's content before ingestion, so that re-splitting the same transcripts
+    finds them instead of calling the API. Document hashes are unknown, so each
+    document is re-split (but not re-embedded) on its first update_index run.
+
+    Args:
+        index (VectorStoreIndex): An index persisted by main().
+        content_store (ContentStore): The store to seed.
+        added_metadata_keys (tuple, optional): The metadata keys added by the
+            ingestion transformations. Defaults to ("excerpt_keywords",).
+
+    Returns:
+        int: The number of recorded nodes.
+    """
+    manifest = {}
+    records = []
+    for node_id in index.index_struct.nodes_dict.values():
+        node = index.docstore.get_node(node_id)
+        base_metadata = {
+            key: value for key, value in node.metadata.items()
+            if key not in added_metadata_keys
+        }
+        added_metadata = {
+            key: node.metadata[key] for key in added_metadata_keys if key in node.metadata
+        }
+        node_hash = content_hash(node.text, base_metadata)
+        records.append((node_hash, added_metadata, index.vector_store.get(node_id)))
+        entry = manifest.setdefault(
+            document_key(node),
+            {"ref_doc_id": node.ref_doc_id, "doc_hash": None, "node_hashes": []},
+        )
+        entry["node_hashes"].append(node_hash)
+
+    content_store.put_nodes(records)
+    content_store.put_manifest(manifest)
+    return len(records)
+
+
+def enrich_nodes(nodes: list, content_store: ContentStore, transformations: list):
+    """Adds keywords and embeddings to nodes, calling the transformations only on
+    nodes whose content is not in the content store yet.
+
+    Args:
+        nodes (list): Nodes straight out of the node parser.
+        content_store (ContentStore): The store of processed nodes.
+        transformations (list): The keyword extraction and embedding transformations.
+
+    Returns:
+        tuple[list, int, int]: The enriched nodes, the number served from the
+            store and the number sent through the transformations.
+    """
+    ready = []
+    pending = []
+    pending_info = {}
+    for node in nodes:
+        node_hash = content_hash(node.text, node.metadata)
+        cached = content_store.get_node(node_hash)
+        if cached is not None:
+            node.metadata.update(cached[0])
+            node.embedding = cached[1]
+            ready.append(node)
+        else:
+            pending_info[node.node_id] = (node_hash, set(node.metadata))
+            pending.append(node)
+
+    num_cached = len(ready)
+    if pending:
+        processed = run_transformations(pending, transformations)
+        content_store.put_nodes(
+            (
+                pending_info[node.node_id][0],
+                {
+                    key: value for key, value in node.metadata.items()
+                    if key not in pending_info[node.node_id][1]
+                },
+                node.embedding,
+            )
+            for node in processed
+        )
+        ready.extend(processed)
+    return ready, num_cached, len(ready) - num_cached
+
+
+# Keyword-only options and per-step bookkeeping are necessary for merging in place
+# pylint: disable=R0913,R0914
+def update_index(
+    documents: list[Document],
+    index: VectorStoreIndex,
+    content_store: ContentStore,
+    *,
+    splitter=None,
+    transformations=None,
+    persist_dir=None,
+    prune: bool = False,
+) -> dict:
+    """Merges new and changed transcript chunks into an existing index in place.
+
+    1. Documents whose content hash matches the manifest are skipped.
+    2. Changed documents have their old nodes deleted from the index.
+    3. New and changed documents are split into nodes locally.
+    4. Nodes whose content was processed before get their keywords and embedding
+        from the content store. Only the remaining nodes are sent through the
+        keyword extraction and embedding transformations, and their output is
+        added to the store.
+    5. The nodes are inserted into the index, the index is persisted if a
+        persist_dir is given, and only then is the manifest updated.
+
+    Documents are given their document_key as id, so their nodes can be found
+    and replaced on later runs.
+
+    Args:
+        documents (list[Document]): The full list of transcript chunk Documents.
+        index (VectorStoreIndex): The index to update.
+        content_store (ContentStore): The manifest and processed-node store.
+        splitter (optional): The node parser. Defaults to SentenceSplitter(chunk_size=1024).
+        transformations (list, optional): The transformations applied to new nodes.
+            Defaults to the keyword extractor with the term statistics of
+            `documents`, and text-embedding-3-small.
+        persist_dir (str, optional): Where to persist the updated index. Defaults to None.
+        prune (bool, optional): Whether to delete indexed documents that are no
+            longer in `documents`. Defaults to False.
+
+    Returns:
+        dict: Counts of unchanged, changed, new and removed documents, and of
+            nodes served from the store versus processed.
+    """
+    splitter = splitter or SentenceSplitter(chunk_size=1024)
+    if transformations is None:
+        transformations = [
+            keyword_extractor(documents),
+            OpenAIEmbedding(model="text-embedding-3-small"),
+        ]
+    manifest = content_store.manifest()
+    stats = dict.fromkeys(
+        ["unchanged", "changed", "new", "removed", "cached_nodes", "processed_nodes"], 0
+    )
+
+    to_index = []
+    new_entries = {}
+    for doc in documents:
+        key = document_key(doc)
+        doc_hash = content_hash(doc.text, doc.metadata)
+        entry = manifest.pop(key, None)
+        if entry is not None and entry["doc_hash"] == doc_hash:
+            stats["unchanged"] += 1
+            continue
+        if entry is not None:
+            index.delete_ref_doc(entry["ref_doc_id"], delete_from_docstore=True)
+            stats["changed"] += 1
+        else:
+            stats["new"] += 1
+        doc.id_ = key
+        to_index.append(doc)
+        new_entries[key] = {"ref_doc_id": key, "doc_hash": doc_hash, "node_hashes": []}
+
+    nodes = splitter(to_index)
+    for node in nodes:
+        new_entries[document_key(node)]["node_hashes"].append(
+            content_hash(node.text, node.metadata)
+        )
+    ready, stats["cached_nodes"], stats["processed_nodes"] = enrich_nodes(
+        nodes, content_store, transformations
+    )
+
+    if prune:
+        for entry in manifest.values():
+            index.delete_ref_doc(entry["ref_doc_id"], delete_from_docstore=True)
+        stats["removed"] = len(manifest)
+
+    if ready:
+        index.insert_nodes(ready)
+    if persist_dir is not None:
+        index.storage_context.persist(persist_dir=persist_dir)
+    content_store.put_manifest(new_entries)
+    if prune:
+        content_store.delete_manifest(manifest.keys())
+    return stats
 
 
 def main():
@@ -247,34 +632,29 @@ def main():
     and creates and saves a VectorStoreIndex with extracted metadata using LlamaIndex. 
     See indexing notebook for more details.
     """
-    # Using GPT-3.5 for keyword extraction because it is cheaper
-    Settings.llm = OpenAI(temperature=0.2, model="gpt-3.5-turbo-0125")
     Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small")
 
     # Parse the output of merge_rss_and_transcripts into Document objects
-    jsons = load_json_transcripts("/home/edouas/DATA-515/TLDhubeR/transcript_data")
-    docs = parse_into_documents(jsons)
-
-    # Process the documents into lists of nodes and serialize.
-    # This takes a few hours to avoid exceeding API rate limits
-    process_documents(docs, batch_size=10)
-
-    # Load the nodes into a single list and save for later
-    nodes_full = unpickle_nodes("/home/edouas/DATA-515/TLDhubeR/pickled_nodes/")
-    dump_object(nodes_full, "nodes_full.pkl")
+    docs = [
+        doc
+        for episode in iter_episode_documents("/home/edouas/DATA-515/TLDhubeR/transcript_data")
+        for doc in episode
+    ]
+
+    # Process the documents into lists of nodes, appending each finished batch to
+    # the checkpoint log. Batches run concurrently, paced to stay under the API
+    # rate limits, and rerunning after a crash skips the batches already logged
+    checkpoint_log = CheckpointLog("/home/edouas/DATA-515/TLDhubeR/checkpoints/nodes.log")
+    process_documents(docs, batch_size=10, checkpoint_log=checkpoint_log)
 
     # Make sure the correct metadata was exposed to the LLM and the embedding model
-    print(nodes_full[0].get_content(metadata_mode=MetadataMode.LLM))
-    print(nodes_full[0].get_content(metadata_mode=MetadataMode.EMBED))
-
-    # Construct the vector store and customize storage
-    storage_context = StorageContext.from_defaults()
-    storage_context.docstore.add_documents(nodes_full)
+    first_node = next(checkpoint_log.iter_nodes())
+    print(first_node.get_content(metadata_mode=MetadataMode.LLM))
+    print(first_node.get_content(metadata_mode=MetadataMode.EMBED))
 
-    # Create and save the index
-    test_index = VectorStoreIndex(
-        nodes_full, embed_model=Settings.embed_model, storage_context=storage_context
-    )
+    # Create the index by streaming the logged nodes into it, and save it
+    test_index = build_index_from_log(checkpoint_log, embed_model=Settings.embed_model,
+                                      keys=batch_keys(docs, batch_size=10))
     test_index.storage_context.persist(persist_dir="./data")
 
     # Test rebuilding the index from storage
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains a local replacement for llama_index's KeywordExtractor, which
+makes one LLM completion per node. TfidfKeywordExtractor picks the keywords of a
+node by TF-IDF instead, without any network access, and writes them to the same
+`excerpt_keywords` metadata field, as a comma-separated string.
+
+1. fit() counts the document frequency of every term over the whole corpus, in a
+   pool of worker processes, and keeps the inverse document frequencies as one
+   array indexed by term id.
+2. Extraction splits the nodes into chunks, which worker processes tokenize and
+   score (for large inputs). Each chunk looks up the IDF of all its terms at
+   once, scores every (node, term) pair as (1 + log tf) * idf and keeps the best
+   `keywords` terms of each node with a single sort, so only the keywords are
+   sent back.
+An extractor that was not fitted uses the statistics of the nodes it is given.
+
+Terms are the tokens of bm25_index.tokenize, without stopwords, numbers and
+words shorter than MIN_TERM_LENGTH characters, so keywords match the terms of
+the keyword index.
+
+Modules: os, collections, concurrent.futures, numpy, llama_index.
+"""
+
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.extractors import BaseExtractor
+from llama_index.core.schema import BaseNode, MetadataMode, TextNode
+
+from tldhuber.utils.bm25_index import tokenize
+
+MIN_TERM_LENGTH = 3
+TEXTS_PER_TASK = 512
+
+
+def term_counts(texts: List[str]) -> List[Counter]:
+    """Counts the keyword candidate terms of each text."""
+    return [
+        Counter(token for token in tokenize(text)
+                if len(token) >= MIN_TERM_LENGTH and not token.isdigit())
+        for text in texts
+    ]
+
+
+def _document_frequencies(texts: List[str]) -> Counter:
+    """Counts the texts each term appears in."""
+    frequencies = Counter()
+    for counts in term_counts(texts):
+        frequencies.update(counts.keys())
+    return frequencies
+
+
+def inverse_document_frequencies(frequencies: Counter,
+                                 num_texts: int) -> Tuple[Dict[str, int], np.ndarray]:
+    """Computes the smoothed IDF of every term from its document frequency.
+
+    Args:
+        frequencies (Counter): The number of texts each term appears in.
+        num_texts (int): The number of texts counted.
+
+    Returns:
+        tuple[dict, np.ndarray]: The position of each term in the IDF array, and
+            the array.
+    """
+    terms = sorted(frequencies)
+    document_frequency = np.array([frequencies[term] for term in terms], dtype=np.float64)
+    vocabulary = {term: term_id for term_id, term in enumerate(terms)}
+    return vocabulary, np.log((1 + num_texts) / (1 + document_frequency)) + 1
+
+
+def _best_terms(scores: np.ndarray, text_ids: np.ndarray, terms: List[str], num_texts: int,
+                keywords: int) -> List[List[str]]:
+    """Keeps the `keywords` best scored terms of each text, with a single sort."""
+    # Best terms first within each text, ties in order of appearance
+    order = np.lexsort((-scores, text_ids))
+    starts = np.searchsorted(text_ids[order], np.arange(num_texts))
+    rank = np.arange(len(order)) - starts[text_ids[order]]
+    best = [[] for _ in range(num_texts)]
+    for position in order[rank < keywords]:
+        best[text_ids[position]].append(terms[position])
+    return best
+
+
+def score_keywords(counts: List[Counter], vocabulary: Dict[str, int], idf: np.ndarray,
+                   num_texts: int, keywords: int) -> List[List[str]]:
+    """Picks the best terms of each text by TF-IDF.
+
+    Args:
+        counts (list[Counter]): The term counts of each text.
+        vocabulary (dict): Maps each term of the corpus to its position in idf.
+        idf (np.ndarray): The inverse document frequency of each term.
+        num_texts (int): The number of texts in the corpus.
+        keywords (int): The number of terms to pick per text.
+
+    Returns:
+        list[list[str]]: The `keywords` best terms of each text, best first.
+    """
+    terms = [term for text_counts in counts for term in text_counts]
+    if not terms:
+        return [[] for _ in counts]
+    text_ids = np.repeat(np.arange(len(counts)), [len(text_counts) for text_counts in counts])
+    term_frequency = np.fromiter((count for text_counts in counts
+                                  for count in text_counts.values()),
+                                 dtype=np.float64, count=len(terms))
+    term_ids = np.fromiter((vocabulary.get(term, -1) for term in terms),
+                           dtype=np.int64, count=len(terms))
+    # Terms missing from the corpus are as rare as possible
+    unseen_idf = np.log(1 + num_texts) + 1
+    scores = (1 + np.log(term_frequency)) * np.where(term_ids >= 0,
+                                                     idf[np.maximum(term_ids, 0)], unseen_idf)
+    return _best_terms(scores, text_ids, terms, len(counts), keywords)
+
+
+# The corpus statistics of a worker process, set once by _init_worker. Never set
+# in the main process
+_worker_stats = {}
+
+
+def _init_worker(stats: dict) -> None:
+    _worker_stats.update(stats)
+
+
+def _with_worker_stats(func, chunk: List[str]):
+    return func(chunk, **_worker_stats)
+
+
+def _extract_chunk(texts: List[str], **stats) -> List[List[str]]:
+    return score_keywords(term_counts(texts), **stats)
+
+
+def _map_chunks(func, texts: List[str], num_workers: int, stats: Optional[dict] = None) -> list:
+    """Applies func to chunks of texts, in worker processes if num_workers > 1.
+
+    func is called with a chunk and the keyword arguments stats. Worker processes
+    receive stats once, when they start, rather than with every chunk.
+    """
+    stats = stats or {}
+    chunks = [texts[start:start + TEXTS_PER_TASK]
+              for start in range(0, len(texts), TEXTS_PER_TASK)]
+    if num_workers <= 1 or len(chunks) <= 1:
+        return [func(chunk, **stats) for chunk in chunks]
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(chunks)),
+                             initializer=_init_worker, initargs=(stats,)) as executor:
+        return list(executor.map(partial(_with_worker_stats, func), chunks))
+
+
+class TfidfKeywordExtractor(BaseExtractor):  # pylint: disable=R0901
+    """Keyword extractor scoring the terms of each node by TF-IDF. Node-level
+    extractor. Extracts `excerpt_keywords` metadata field.
+
+    Args:
+        keywords (int): The number of keywords to extract. Defaults to 5.
+        num_workers (int): The number of worker processes. Defaults to the
+            number of CPUs.
+        min_parallel_texts (int): The fewest texts that are tokenized in worker
+            processes rather than in this one. Defaults to 4096.
+    """
+
+    keywords: int = Field(default=5, description="The number of keywords to extract.", gt=0)
+    num_workers: int = Field(
+        default_factory=lambda: os.cpu_count() or 1,
+        description="The number of worker processes.",
+    )
+    min_parallel_texts: int = Field(
+        default=4096, description="The fewest texts tokenized in worker processes."
+    )
+    _vocabulary: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _idf: Optional[np.ndarray] = PrivateAttr(default=None)
+    _num_texts: int = PrivateAttr(default=0)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TfidfKeywordExtractor"
+
+    @property
+    def is_fitted(self) -> bool:
+        """Whether corpus statistics were computed by fit()."""
+        return self._idf is not None
+
+    def _workers_for(self, num_texts: int) -> int:
+        return self.num_workers if num_texts >= self.min_parallel_texts else 1
+
+    def fit(self, texts: Iterable[str]) -> "TfidfKeywordExtractor":
+        """Computes the inverse document frequency of every term of a corpus.
+
+        Args:
+            texts (Iterable[str]): The texts of the corpus, e.g. the text of
+                every Document to be ingested.
+
+        Returns:
+            TfidfKeywordExtractor: This extractor.
+        """
+        texts = list(texts)
+        frequencies = Counter()
+        for chunk_frequencies in _map_chunks(_document_frequencies, texts,
+                                             self._workers_for(len(texts))):
+            frequencies.update(chunk_frequencies)
+        self._vocabulary, self._idf = inverse_document_frequencies(frequencies, len(texts))
+        self._num_texts = len(texts)
+        return self
+
+    def extract_keywords(self, texts: List[str]) -> List[List[str]]:
+        """Extracts the keywords of texts.
+
+        Args:
+            texts (list[str]): The texts.
+
+        Returns:
+            list[list[str]]: The keywords of each text, best first.
+        """
+        if not self.is_fitted:
+            counts = term_counts(texts)
+            vocabulary, idf = inverse_document_frequencies(
+                Counter(term for text_counts in counts for term in text_counts), len(texts)
+            )
+            return score_keywords(counts, vocabulary, idf, len(texts), self.keywords)
+        stats = {"vocabulary": self._vocabulary, "idf": self._idf,
+                 "num_texts": self._num_texts, "keywords": self.keywords}
+        return [
+            keywords
+            for chunk_keywords in _map_chunks(_extract_chunk, texts,
+                                              self._workers_for(len(texts)), stats)
+            for keywords in chunk_keywords
+        ]
+
+    async def aextract(self, nodes: Sequence[BaseNode]) -> List[Dict]:
+        texts = [
+            node.get_content(metadata_mode=MetadataMode.NONE)
+            if isinstance(node, TextNode) or not self.is_text_node_only else ""
+            for node in nodes
+        ]
+        return [
+            {"excerpt_keywords": ", ".join(keywords)} if text else {}
+            for text, keywords in zip(texts, self.extract_keywords(texts))
+        ]
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains a columnar index of node metadata, used to restrict searches
+to some episodes, guests or moments before any similarity is computed.
+
+Every node carries the metadata of indexing.parse_into_documents. MetadataIndex
+keeps, for each row of the embedding matrix (or chunk of the keyword index):
+1. episode_numbers - the episode number, or -1 when it is not a number.
+2. episode_ids - the position of the row's episode in `titles` and `guests`.
+3. timestamps - the start of the row's transcript chunk, in seconds.
+Title and guest matches are evaluated once per episode rather than once per row,
+and every filter is a boolean bitmap over the rows, so combining filters is a
+few vectorized comparisons. The retrievers then score only the rows the bitmap
+selects (see retrievers.MatrixRetriever.set_row_mask).
+
+Guests are read from episode titles of the form "Dr. Guest Name: Topic | ...",
+skipping series such as the AMAs, toolkits and live events, whose titles start
+with a name-like label instead.
+
+Layout of an index directory (data/metadata by default):
+1. episode_numbers.npy, episode_ids.npy, timestamps.npy - the columns.
+2. episodes.json - the title and guest of every episode.
+3. meta.json - row and episode counts, and the fingerprint of the export the
+   index was built on. Written last, so its presence marks a complete index.
+
+Usage:
+    python -m tldhuber.utils.metadata_index
+
+Modules: os, re, json, numpy.
+"""
+
+import json
+import os
+import re
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+METADATA_INDEX_DIR = "./data/metadata"
+META_FILE = "meta.json"
+FILTER_KEYS = ("episode_min", "episode_max", "title", "guest", "start", "end")
+# "Dr. Name ..." or "Firstname Lastname ...", with up to four capitalized words,
+# and co-hosted episodes joined by "&"
+_NAME = r"(?:Dr\. [A-Z][\w'.-]*(?: [A-Z][\w'.-]*){0,3}|[A-Z][\w'.-]*(?: [A-Z][\w'.-]*){1,3})"
+GUEST_PATTERN = re.compile(rf"{_NAME}(?: & {_NAME})*")
+# Words of the name-like labels of episode series that have no guest
+NON_GUEST_WORDS = {"AMA", "LIVE", "Toolkit", "Essentials"}
+
+
+def guest_from_title(title: str) -> str:
+    """Returns the guest named before the colon of an episode title (after any
+    "GUEST SERIES |" prefix), or "" for titles without one (e.g. solo episodes,
+    AMAs and toolkits)."""
+    head, colon, _ = (title or "").partition(":")
+    head = head.rpartition("|")[2].strip()
+    if (not colon or not GUEST_PATTERN.fullmatch(head)
+            or NON_GUEST_WORDS.intersection(head.split())):
+        return ""
+    return head
+
+
+def _to_number(value, default: float) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class MetadataIndex:
+    """Columns of episode numbers, episodes and timestamps, one entry per row.
+
+    Use MetadataIndex.build to index metadata and MetadataIndex.load to open a
+    saved index.
+
+    Args:
+        episode_numbers (np.ndarray): The episode number of every row.
+        episode_ids (np.ndarray): The episode of every row, as a position in titles.
+        timestamps (np.ndarray): The timestamp of every row, in seconds.
+        titles (list[str]): The title of every episode.
+        guests (list[str]): The guest of every episode, or "".
+    """
+
+    def __init__(self, episode_numbers: np.ndarray, episode_ids: np.ndarray,  # pylint: disable=R0913
+                 timestamps: np.ndarray, titles: list, guests: list) -> None:
+        self.episode_numbers = episode_numbers
+        self.episode_ids = episode_ids
+        self.timestamps = timestamps
+        self.titles = titles
+        self.guests = guests
+        self._lower_titles = [title.lower() for title in titles]
+        self._lower_guests = [guest.lower() for guest in guests]
+
+    @property
+    def num_rows(self) -> int:
+        """The number of indexed rows."""
+        return int(self.episode_ids.shape[0])
+
+    @classmethod
+    def build(cls, metadatas: Iterable[Dict]) -> "MetadataIndex":
+        """Indexes the metadata of every row, in row order.
+
+        Args:
+            metadatas (Iterable[dict]): The metadata of every node, e.g.
+                `node.metadata`, or the chunks of a BM25Index.
+
+        Returns:
+            MetadataIndex: The built index.
+        """
+        episodes: Dict[str, int] = {}
+        episode_numbers, episode_ids, timestamps = [], [], []
+        for metadata in metadatas:
+            title = str(metadata.get("episode_title") or "")
+            episode_ids.append(episodes.setdefault(title, len(episodes)))
+            episode_numbers.append(int(_to_number(metadata.get("episode_number"), -1)))
+            timestamps.append(_to_number(metadata.get("timestamp"), np.nan))
+        titles = list(episodes)
+        return cls(
+            np.array(episode_numbers, dtype=np.int32),
+            np.array(episode_ids, dtype=np.int32),
+            np.array(timestamps, dtype=np.float32),
+            titles,
+            [guest_from_title(title) for title in titles],
+        )
+
+    def save(self, out_dir: str = METADATA_INDEX_DIR, fingerprint: Optional[str] = None) -> None:
+        """Writes the index to out_dir, finishing with meta.json.
+
+        Args:
+            out_dir (str, optional): Defaults to METADATA_INDEX_DIR.
+            fingerprint (str, optional): The fingerprint of the export whose rows
+                were indexed (see vector_store.read_fingerprint).
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        np.save(os.path.join(out_dir, "episode_numbers.npy"), self.episode_numbers)
+        np.save(os.path.join(out_dir, "episode_ids.npy"), self.episode_ids)
+        np.save(os.path.join(out_dir, "timestamps.npy"), self.timestamps)
+        with open(os.path.join(out_dir, "episodes.json"), "w", encoding="utf-8") as file:
+            json.dump({"titles": self.titles, "guests": self.guests}, file)
+        with open(os.path.join(out_dir, META_FILE), "w", encoding="utf-8") as file:
+            json.dump({"num_rows": self.num_rows, "num_episodes": len(self.titles),
+                       "fingerprint": fingerprint}, file)
+
+    @classmethod
+    def load(cls, index_dir: str = METADATA_INDEX_DIR, num_rows: Optional[int] = None,
+             fingerprint: Optional[str] = None) -> "MetadataIndex":
+        """Opens a saved index.
+
+        Args:
+            index_dir (str, optional): Defaults to METADATA_INDEX_DIR.
+            num_rows (int, optional): The number of rows of the vector index to be
+                filtered. Not checked if None.
+            fingerprint (str, optional): The fingerprint of that index's export.
+                Not checked if None.
+
+        Raises:
+            ValueError: If the index was built on another export; rebuild it.
+        """
+        if num_rows is not None:
+            # Imported here so that filtering keyword searches does not import llama_index
+            # pylint: disable=C0415
+            from tldhuber.utils.vector_store import check_built_on
+
+            with open(os.path.join(index_dir, META_FILE), "r", encoding="utf-8") as file:
+                check_built_on(json.load(file), num_rows, fingerprint, index_dir)
+        with open(os.path.join(index_dir, "episodes.json"), "r", encoding="utf-8") as file:
+            episodes = json.load(file)
+        return cls(
+            np.load(os.path.join(index_dir, "episode_numbers.npy")),
+            np.load(os.path.join(index_dir, "episode_ids.npy")),
+            np.load(os.path.join(index_dir, "timestamps.npy")),
+            episodes["titles"],
+            episodes["guests"],
+        )
+
+    def episode_range(self):
+        """Returns the lowest and highest episode numbers, or (0, 0) if none is known."""
+        known = self.episode_numbers[self.episode_numbers >= 0]
+        return (int(known.min()), int(known.max())) if known.size else (0, 0)
+
+    def max_timestamp(self) -> float:
+        """Returns the latest timestamp of any row, in seconds."""
+        return float(np.nanmax(self.timestamps)) if self.num_rows else 0.0
+
+    def _episode_mask(self, text: str, lower_values: list) -> np.ndarray:
+        """Selects the rows whose episode's value contains the text, ignoring case."""
+        text = text.lower()
+        matches = np.array([text in value for value in lower_values], dtype=bool)
+        return matches[self.episode_ids] if matches.size else np.zeros(self.num_rows, bool)
+
+    def mask(self, *, episode_min: Optional[int] = None,  # pylint: disable=R0913
+             episode_max: Optional[int] = None, title: Optional[str] = None,
+             guest: Optional[str] = None, start: Optional[float] = None,
+             end: Optional[float] = None) -> Optional[np.ndarray]:
+        """Builds the bitmap of the rows that pass every given filter.
+
+        Args:
+            episode_min (int, optional): The lowest episode number.
+            episode_max (int, optional): The highest episode number.
+            title (str, optional): Text the episode title must contain, ignoring case.
+            guest (str, optional): Text the episode's guest must contain, ignoring case.
+            start (float, optional): The earliest timestamp within an episode, in seconds.
+            end (float, optional): The latest timestamp within an episode, in seconds.
+
+        Returns:
+            np.ndarray: A boolean array with one entry per row, or None when no
+                filter is given.
+        """
+        masks = []
+        if episode_min is not None:
+            masks.append(self.episode_numbers >= episode_min)
+        if episode_max is not None:
+            masks.append((self.episode_numbers <= episode_max) & (self.episode_numbers >= 0))
+        if title:
+            masks.append(self._episode_mask(title, self._lower_titles))
+        if guest:
+            masks.append(self._episode_mask(guest, self._lower_guests))
+        if start is not None:
+            masks.append(self.timestamps >= start)
+        if end is not None:
+            masks.append(self.timestamps <= end)
+        if not masks:
+            return None
+        return np.logical_and.reduce(masks)
+
+
+def main():
+    """
+    Builds the metadata index of the memory-mapped export in ./data/mmap (see
+    vector_store.py), in row order, and saves it to ./data/metadata, where the app
+    picks it up.
+    """
+    # pylint: disable=C0415
+    from tldhuber.utils.vector_store import MmapVectorStore
+
+    store = MmapVectorStore("./data/mmap")
+    metadata_index = MetadataIndex.build(
+        store.get_node(row).metadata for row in range(store.num_nodes)
+    )
+    metadata_index.save(METADATA_INDEX_DIR, store.fingerprint)
+    print(f"Saved a metadata index of {metadata_index.num_rows} rows and "
+          f"{len(metadata_index.titles)} episodes to {METADATA_INDEX_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains the latency and usage metrics recorded on the app's chat path.
+
+Each stage of answering a query (loading the index, embedding the query,
+retrieval, loading the retrieved nodes, context compaction, the LLM chat call,
+extract_metadata and rendering the video) is wrapped in a span that records its
+duration in a histogram labelled with the stage name, and streamed answers also
+record their time to first token.
+The number of nodes retrieved, the tokens of context left after compaction (see
+context_compaction.py) and the prompt and completion tokens of every LLM call
+(see token_counter.py) are recorded in histograms of their own.
+
+Histograms keep cumulative counts over fixed buckets, as Prometheus expects, and
+the most recent observations, from which exact p50, p90 and p99 are reported in
+the JSON export. A MetricsRegistry can be:
+1. Rendered in the Prometheus text exposition format, or as JSON.
+2. Written atomically to a file, e.g. for the node_exporter textfile collector.
+3. Served from a local HTTP endpoint (/metrics and /metrics.json).
+
+The process-wide REGISTRY is shared by every Streamlit session of the app. This
+file only depends on numpy, so the app can record metrics before it has
+imported llama_index.
+Run this file on a JSON export to print the per-stage percentiles.
+
+Modules: os, sys, json, time, bisect, threading, http.server, numpy.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import accumulate
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+STAGE_SECONDS = "tldhuber_stage_seconds"
+RETRIEVED_NODES = "tldhuber_retrieved_nodes"
+LLM_TOKENS = "tldhuber_llm_tokens"
+SEARCH_BATCH_SIZE = "tldhuber_search_batch_size"
+CONTEXT_TOKENS = "tldhuber_context_tokens"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+METRICS = {
+    STAGE_SECONDS: ("Duration of each stage of answering a query, in seconds.",
+                    LATENCY_BUCKETS),
+    RETRIEVED_NODES: ("Number of nodes retrieved for each query.", COUNT_BUCKETS),
+    LLM_TOKENS: ("Prompt and completion tokens of each LLM call.", TOKEN_BUCKETS),
+    SEARCH_BATCH_SIZE: ("Number of queries answered together by the search API.",
+                        COUNT_BUCKETS),
+    CONTEXT_TOKENS: ("Tokens of retrieved context sent to the LLM, after compaction.",
+                     TOKEN_BUCKETS),
+}
+QUANTILES = (0.5, 0.9, 0.99)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Bucketed counts of observations, plus a window of the most recent ones.
+
+    Args:
+        buckets (Sequence[float]): The sorted upper bounds of the buckets. An
+            implicit +Inf bucket follows the last one.
+        window (int, optional): The number of recent observations kept for
+            quantiles. Defaults to 1024.
+    """
+
+    def __init__(self, buckets: Sequence[float], window: int = 1024) -> None:
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        """Records one observation."""
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        """Returns (upper bound, observations at or below it) for every bucket."""
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        return list(zip(bounds, accumulate(self.bucket_counts)))
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Returns the q-quantile of the recent observations, or None if there are none."""
+        if not self.recent:
+            return None
+        return float(np.quantile(np.fromiter(self.recent, dtype=float), q))
+
+
+def format_labels(labels: Labels, **extra: str) -> str:
+    """Formats labels as a Prometheus label set, e.g. {stage="retrieval"}."""
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class MetricsRegistry:
+    """Thread-safe collection of labelled histograms.
+
+    Args:
+        window (int, optional): The number of recent observations each histogram
+            keeps for quantiles. Defaults to 1024.
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        self.window = window
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Records a value in the histogram of a metric and label set.
+
+        Args:
+            name (str): The metric, e.g. STAGE_SECONDS. Metrics missing from METRICS
+                use LATENCY_BUCKETS.
+            value (float): The observed value.
+            **labels: The labels of the series, e.g. stage="retrieval".
+        """
+        key = tuple(sorted(labels.items()))
+        buckets = METRICS.get(name, ("", LATENCY_BUCKETS))[1]
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets, self.window)
+            series[key].observe(value)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """Records the duration of the enclosed block as a stage, even if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(STAGE_SECONDS, time.perf_counter() - start, stage=stage)
+
+    def get(self, name: str, **labels: str) -> Optional[Histogram]:
+        """Returns the histogram of a metric and label set, if anything was recorded."""
+        return self._histograms.get(name, {}).get(tuple(sorted(labels.items())))
+
+    def reset(self) -> None:
+        """Drops every recorded observation."""
+        with self._lock:
+            self._histograms.clear()
+
+    def to_prometheus(self) -> str:
+        """Renders every histogram in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {METRICS.get(name, (name, None))[0]}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    for bound, count in histogram.cumulative_counts():
+                        lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum:.6g}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Summarizes every histogram, with the quantiles of its recent observations."""
+        metrics = {}
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                metrics[name] = [
+                    {
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        **{f"p{round(q * 100)}": histogram.quantile(q) for q in QUANTILES},
+                        "buckets": histogram.cumulative_counts(),
+                    }
+                    for labels, histogram in sorted(series.items())
+                ]
+        return {"generated_at": time.time(), "metrics": metrics}
+
+    def to_json(self) -> str:
+        """Renders to_dict as JSON."""
+        return json.dumps(self.to_dict(), indent=2)
+
+    def write(self, path: str) -> None:
+        """Atomically writes the metrics to a file, as JSON if the path ends in .json
+        and in the Prometheus text format otherwise."""
+        text = self.to_json() if path.endswith(".json") else self.to_prometheus()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
+
+
+def span(stage: str):
+    """Times a stage in the process-wide REGISTRY. Use as `with span("retrieval"):`."""
+    return REGISTRY.span(stage)
+
+
+def timed_stream(items: Iterator[Any], start: float, *, first_stage: str, last_stage: str,
+                 registry: Optional[MetricsRegistry] = None) -> Iterator[Any]:
+    """Passes a stream through, recording how long after `start` (a time.perf_counter
+    value) its first and its last item arrived, e.g. the tokens of a streamed answer.
+
+    Args:
+        items (Iterator): The stream.
+        start (float): When the request for the stream was made.
+        first_stage (str): The stage recorded at the first item.
+        last_stage (str): The stage recorded when the stream ends.
+        registry (MetricsRegistry, optional): Defaults to REGISTRY.
+    """
+    registry = registry or REGISTRY
+    first = True
+    for item in items:
+        if first:
+            registry.observe(STAGE_SECONDS, time.perf_counter() - start, stage=first_stage)
+            first = False
+        yield item
+    registry.observe(STAGE_SECONDS, time.perf_counter() - start, stage=last_stage)
+
+
+def serve(registry: Optional[MetricsRegistry] = None, port: int = 9464,
+          host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serves a registry over HTTP from a daemon thread.
+
+    GET /metrics returns the Prometheus text format and GET /metrics.json the JSON
+    summary.
+
+    Args:
+        registry (MetricsRegistry, optional): Defaults to REGISTRY.
+        port (int, optional): Defaults to 9464; 0 picks a free port.
+        host (str, optional): Defaults to localhost only.
+
+    Returns:
+        ThreadingHTTPServer: The running server; call shutdown() to stop it.
+    """
+    registry = registry or REGISTRY
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Handles scrapes of the metrics endpoint."""
+
+        def do_GET(self):  # pylint: disable=C0103
+            """Writes the metrics in the format matching the path."""
+            if self.path == "/metrics":
+                body, content_type = registry.to_prometheus(), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, content_type = registry.to_json(), "application/json"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):  # pylint: disable=W0622
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    """Formats the stage latencies of a to_dict summary as a table in milliseconds."""
+    rows = [f"{'stage':<18}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"]
+    for series in summary["metrics"].get(STAGE_SECONDS, []):
+        quantiles = (
+            "-" if series[key] is None else f"{series[key] * 1000:.1f}"
+            for key in ("p50", "p90", "p99")
+        )
+        rows.append(f"{series['labels']['stage']:<18}{series['count']:>8}"
+                    + "".join(f"{value:>10}" for value in quantiles))
+    return "\n".join(rows)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Prints the stage latencies of a JSON export, data/metrics.json by default."""
+    argv = sys.argv[1:] if argv is None else argv
+    path = argv[0] if argv else "./data/metrics.json"
+    with open(path, "r", encoding="utf-8") as file:
+        print(format_summary(json.load(file)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file converts the transcript corpus into a single packed file, and reads it.
+
+transcript_data/ holds one pretty-printed JSON file per episode, so every consumer
+opens and fully parses all of them. The packed file holds the same data in
+columns, and is read with one sequential read:
+1. A JSON header with the per-episode metadata columns (title, ep_num, link,
+   episode_summary).
+2. A chunk table with one row per transcript chunk: the episode id, the
+   timestamp, and the offset and length of the chunk's text.
+3. The chunk texts, zlib-compressed in blocks of consecutive chunks. Any chunk is
+   read by decompressing only its block.
+
+File layout: MAGIC, the header length (uint64), the header, the chunk table,
+the compressed block offsets (uint64) and the compressed blocks.
+
+Modules: os, json, zlib, functools, numpy.
+"""
+
+import json
+import os
+import zlib
+from functools import lru_cache
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+MAGIC = b"TLDCORP\x00"
+FORMAT_VERSION = 1
+PACKED_CORPUS_FILE = "./data/corpus.bin"
+EPISODE_COLUMNS = ("title", "ep_num", "link", "episode_summary")
+CHUNK_DTYPE = np.dtype([
+    ("episode_id", "<u4"),
+    ("timestamp", "<i8"),
+    ("text_offset", "<u8"),
+    ("text_length", "<u4"),
+])
+
+
+def compress_blocks(texts: list, chunks_per_block: int) -> tuple:
+    """Compresses consecutive chunk texts in blocks.
+
+    Returns:
+        tuple[list[bytes], np.ndarray]: The compressed blocks, and the offsets at
+            which each block starts and the last one ends once concatenated.
+    """
+    blocks = [
+        zlib.compress(b"".join(texts[start:start + chunks_per_block]), 9)
+        for start in range(0, len(texts), chunks_per_block)
+    ]
+    block_offsets = np.zeros(len(blocks) + 1, dtype="<u8")
+    block_offsets[1:] = np.cumsum([len(block) for block in blocks])
+    return blocks, block_offsets
+
+
+# pylint: disable=R0914
+def pack_corpus(transcripts: Iterable[dict], out_path: str,
+                chunks_per_block: int = 64) -> dict:
+    """Writes transcripts in the JSON format of merge_rss_and_transcripts to a packed file.
+
+    Args:
+        transcripts (Iterable[dict]): The transcripts, e.g. from iter_json_transcripts.
+        out_path (str): The packed file to write.
+        chunks_per_block (int, optional): The number of chunks compressed together.
+            Larger blocks compress better, smaller ones make random access cheaper.
+            Defaults to 64.
+
+    Returns:
+        dict: The number of episodes and chunks, and the raw and packed text sizes.
+    """
+    columns = {column: [] for column in EPISODE_COLUMNS}
+    rows = []
+    texts = []
+    text_offset = 0
+    for episode_id, transcript in enumerate(transcripts):
+        for column in EPISODE_COLUMNS:
+            columns[column].append(transcript[column])
+        for chunk in transcript["chunks"]:
+            text = chunk["text"].encode("utf-8")
+            rows.append((episode_id, chunk["timestamp"], text_offset, len(text)))
+            texts.append(text)
+            text_offset += len(text)
+
+    blocks, block_offsets = compress_blocks(texts, chunks_per_block)
+    header = json.dumps({
+        "format_version": FORMAT_VERSION,
+        "compression": "zlib",
+        "chunks_per_block": chunks_per_block,
+        "num_chunks": len(rows),
+        "episodes": columns,
+    }).encode("utf-8")
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.array([len(header)], dtype="<u8").tobytes())
+        file.write(header)
+        file.write(np.array(rows, dtype=CHUNK_DTYPE).tobytes())
+        file.write(block_offsets.tobytes())
+        for block in blocks:
+            file.write(block)
+    os.replace(tmp_path, out_path)
+    return {
+        "episodes": len(columns["title"]),
+        "chunks": len(rows),
+        "text_bytes": text_offset,
+        "packed_bytes": int(block_offsets[-1]),
+    }
+
+
+class PackedCorpus:  # pylint: disable=R0902
+    """Random-access reader of a packed corpus file.
+
+    The whole file is read at once; chunk texts are decompressed per block on
+    demand, and the most recently used blocks are kept decompressed.
+
+    Args:
+        path (str): The packed file written by pack_corpus.
+        cached_blocks (int, optional): The number of decompressed blocks kept in
+            memory. Defaults to 8.
+
+    Raises:
+        ValueError: If the file is not a packed corpus of a supported version.
+    """
+
+    def __init__(self, path: str = PACKED_CORPUS_FILE, cached_blocks: int = 8) -> None:
+        with open(path, "rb") as file:
+            data = file.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a packed corpus file")
+        position = len(MAGIC) + 8
+        header_length = int(np.frombuffer(data, dtype="<u8", count=1, offset=len(MAGIC))[0])
+        header = json.loads(data[position:position + header_length])
+        if header["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported packed corpus version {header['format_version']}")
+        position += header_length
+
+        self.path = path
+        self.chunks_per_block = header["chunks_per_block"]
+        self.episodes = header["episodes"]
+        self.chunks = np.frombuffer(data, dtype=CHUNK_DTYPE,
+                                    count=header["num_chunks"], offset=position)
+        position += self.chunks.nbytes
+        num_blocks = -(-len(self.chunks) // self.chunks_per_block)
+        self._block_offsets = np.frombuffer(data, dtype="<u8", count=num_blocks + 1,
+                                            offset=position)
+        position += self._block_offsets.nbytes
+        self._blocks = memoryview(data)[position:]
+        self._block = lru_cache(maxsize=cached_blocks)(self._decompress_block)
+        self._chunk_ids = None
+
+    @property
+    def num_episodes(self) -> int:
+        """The number of episodes in the corpus."""
+        return len(self.episodes["title"])
+
+    @property
+    def num_chunks(self) -> int:
+        """The number of transcript chunks in the corpus."""
+        return len(self.chunks)
+
+    def _decompress_block(self, block_id: int) -> bytes:
+        start, end = self._block_offsets[block_id], self._block_offsets[block_id + 1]
+        return zlib.decompress(self._blocks[start:end])
+
+    def text(self, chunk_id: int) -> str:
+        """Returns the text of a chunk, decompressing only the block that holds it."""
+        block_id = chunk_id // self.chunks_per_block
+        block_start = self.chunks["text_offset"][block_id * self.chunks_per_block]
+        row = self.chunks[chunk_id]
+        start = int(row["text_offset"] - block_start)
+        return self._block(block_id)[start:start + int(row["text_length"])].decode("utf-8")
+
+    def episode(self, episode_id: int) -> dict:
+        """Returns the metadata columns of an episode as a dict."""
+        return {column: self.episodes[column][episode_id] for column in EPISODE_COLUMNS}
+
+    def chunk(self, chunk_id: int) -> dict:
+        """Returns a chunk as {episode_id, timestamp, text}."""
+        row = self.chunks[chunk_id]
+        return {
+            "episode_id": int(row["episode_id"]),
+            "timestamp": int(row["timestamp"]),
+            "text": self.text(chunk_id),
+        }
+
+    def episode_chunk_ids(self, episode_id: int) -> range:
+        """Returns the ids of an episode's chunks, which are stored contiguously."""
+        episode_ids = self.chunks["episode_id"]
+        return range(int(np.searchsorted(episode_ids, episode_id, side="left")),
+                     int(np.searchsorted(episode_ids, episode_id, side="right")))
+
+    def find_chunk(self, youtube_link: str, timestamp: int) -> Optional[int]:
+        """Looks up the id of the chunk at a timestamp of an episode's video.
+
+        Returns:
+            int or None: The chunk id, or None if there is no such chunk.
+        """
+        if self._chunk_ids is None:
+            links = self.episodes["link"]
+            self._chunk_ids = {
+                (links[episode_id], int(timestamp)): chunk_id
+                for chunk_id, (episode_id, timestamp) in enumerate(
+                    zip(self.chunks["episode_id"], self.chunks["timestamp"])
+                )
+            }
+        return self._chunk_ids.get((youtube_link, int(timestamp)))
+
+    def iter_transcripts(self) -> Iterator[dict]:
+        """Yields the episodes in the JSON format of merge_rss_and_transcripts.
+
+        Every block is decompressed once, in order.
+        """
+        for episode_id in range(self.num_episodes):
+            transcript = self.episode(episode_id)
+            transcript["chunks"] = [
+                {"timestamp": int(self.chunks["timestamp"][chunk_id]),
+                 "text": self.text(chunk_id)}
+                for chunk_id in self.episode_chunk_ids(episode_id)
+            ]
+            yield transcript
+
+
+def is_packed_corpus(path: str) -> bool:
+    """Checks whether a path is a packed corpus file (rather than a directory)."""
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def main():
+    """Packs ./transcript_data into ./data/corpus.bin."""
+    # Imported here so the reader does not depend on the indexing module
+    from tldhuber.utils.indexing import iter_json_transcripts  # pylint: disable=C0415
+
+    stats = pack_corpus(iter_json_transcripts("./transcript_data"), PACKED_CORPUS_FILE)
+    print(
+        f"Packed {stats['episodes']} episodes and {stats['chunks']} chunks: "
+        f"{stats['text_bytes']} bytes of text in {stats['packed_bytes']} bytes"
+    )
+
+
+if __name__ == "__main__":
+    main()
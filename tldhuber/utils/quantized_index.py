@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file builds quantized codes of the normalized embedding matrix exported by
+vector_store.py, and provides a retriever that pre-scores every node with the
+codes and re-ranks a small candidate set exactly.
+
+Exact search reads the whole float32 matrix for every query, so every app
+worker keeps all of it in memory. The codes are 4 to 32 times smaller:
+1. "int8" - each value scaled by its dimension's largest magnitude to an int8
+   (1 byte per dimension). Scores are the dot product of the codes with the
+   query, scaled back.
+2. "binary" - the sign of each value as one bit (1 bit per dimension). Scores
+   are the negated Hamming distance between the codes of a row and the query.
+Queries are pre-scored against the codes of every row, and only the best
+rerank_k candidates are scored against the full-precision rows, which stay on
+disk in the memory-mapped export and are only paged in for those candidates.
+
+Usage:
+    python -m tldhuber.utils.quantized_index --mode binary
+
+Modules: os, json, argparse, numpy, llama_index.
+"""
+
+import argparse
+import json
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.schema import QueryBundle
+
+from tldhuber.utils.metrics import span
+from tldhuber.utils.retrievers import MatrixRetriever
+from tldhuber.utils.vector_store import (
+    EMBEDDINGS_FILE, check_built_on, normalize_rows, read_fingerprint, top_k_rows,
+)
+
+MODES = ("int8", "binary")
+CODES_FILE = "codes.npy"
+SCALES_FILE = "scales.npy"
+META_FILE = "meta.json"
+
+# The number of set bits of every byte value
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(codes: np.ndarray, query_code: np.ndarray) -> np.ndarray:
+    """Counts the bits that differ between each row of packed codes and a query.
+
+    Rows a multiple of 8 bytes wide are compared 64 bits at a time, with a
+    branch-free popcount; other widths use a table of byte popcounts.
+    """
+    if codes.shape[1] % 8 or not codes.flags.c_contiguous:
+        return POPCOUNT[np.bitwise_xor(codes, query_code)].sum(axis=1, dtype=np.int32)
+    bits = np.bitwise_xor(codes.view(np.uint64), query_code.view(np.uint64))
+    bits -= (bits >> np.uint64(1)) & np.uint64(0x5555555555555555)
+    bits = (bits & np.uint64(0x3333333333333333)) + (
+        (bits >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    bits = (bits + (bits >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    bits = (bits * np.uint64(0x0101010101010101)) >> np.uint64(56)
+    return bits.sum(axis=1, dtype=np.int32)
+
+
+def int8_scales(embeddings: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """Returns the scale of each dimension: its largest magnitude over 127."""
+    largest = np.zeros(embeddings.shape[1], dtype=np.float32)
+    for start in range(0, embeddings.shape[0], chunk_size):
+        chunk = np.abs(np.asarray(embeddings[start : start + chunk_size], dtype=np.float32))
+        np.maximum(largest, chunk.max(axis=0), out=largest)
+    largest[largest == 0] = 1.0
+    return largest / 127.0
+
+
+def quantize_int8(embeddings: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """Scales and rounds embeddings to int8 codes."""
+    codes = np.rint(np.asarray(embeddings, dtype=np.float32) / scales)
+    return np.clip(codes, -127, 127).astype(np.int8)
+
+
+def quantize_binary(embeddings: np.ndarray) -> np.ndarray:
+    """Packs the signs of embeddings into bits, 8 dimensions per byte."""
+    return np.packbits(np.asarray(embeddings) > 0, axis=-1)
+
+
+class QuantizedIndex:
+    """Quantized codes of the rows of a normalized embedding matrix.
+
+    Args:
+        mode (str): "int8" or "binary".
+        codes (np.ndarray): The (n_rows, dim) int8 codes, or the (n_rows, dim / 8)
+            packed sign bits.
+        dim (int): The embedding dimension.
+        scales (np.ndarray, optional): The scale of each dimension, for "int8".
+    """
+
+    def __init__(self, mode: str, codes: np.ndarray, dim: int,
+                 scales: Optional[np.ndarray] = None) -> None:
+        if mode not in MODES:
+            raise ValueError(f"Unknown quantization mode: {mode}")
+        self.mode = mode
+        self.codes = codes
+        self.dim = dim
+        self.scales = scales
+
+    @property
+    def num_rows(self) -> int:
+        """The number of rows with codes."""
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the codes, in bytes."""
+        return int(self.codes.nbytes)
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, mode: str = "int8",
+              chunk_size: int = 65536) -> "QuantizedIndex":
+        """Quantizes every row of the matrix, working in chunks to bound memory.
+
+        Args:
+            embeddings (np.ndarray): The (n_rows, dim) matrix of normalized embeddings.
+            mode (str, optional): "int8" or "binary". Defaults to "int8".
+            chunk_size (int, optional): The number of rows quantized at once.
+                Defaults to 65536.
+
+        Returns:
+            QuantizedIndex: The built index.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown quantization mode: {mode}")
+        n_rows, dim = embeddings.shape
+        scales = int8_scales(embeddings, chunk_size) if mode == "int8" else None
+        width = dim if mode == "int8" else -(-dim // 8)
+        codes = np.empty((n_rows, width), dtype=np.int8 if mode == "int8" else np.uint8)
+        for start in range(0, n_rows, chunk_size):
+            chunk = embeddings[start : start + chunk_size]
+            if mode == "int8":
+                codes[start : start + chunk_size] = quantize_int8(chunk, scales)
+            else:
+                codes[start : start + chunk_size] = quantize_binary(chunk)
+        return cls(mode, codes, dim, scales)
+
+    def save(self, out_dir: str, fingerprint: Optional[str] = None) -> None:
+        """Writes the index to out_dir, with meta.json written last.
+
+        Args:
+            out_dir (str): The directory to write the index to.
+            fingerprint (str, optional): The fingerprint of the export the codes
+                were built on (see vector_store.read_fingerprint).
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        np.save(os.path.join(out_dir, CODES_FILE), self.codes)
+        if self.scales is not None:
+            np.save(os.path.join(out_dir, SCALES_FILE), self.scales)
+        meta = {"mode": self.mode, "num_rows": self.num_rows, "dim": self.dim,
+                "fingerprint": fingerprint}
+        with open(os.path.join(out_dir, META_FILE), "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+
+    @classmethod
+    def load(cls, persist_dir: str, num_rows: Optional[int] = None,
+             fingerprint: Optional[str] = None) -> "QuantizedIndex":
+        """Loads an index written by `save`, memory-mapping the codes so that app
+        workers share them through the page cache.
+
+        Args:
+            persist_dir (str): The directory the index was saved to.
+            num_rows (int, optional): The number of rows of the embedding matrix
+                to be searched. Not checked if None.
+            fingerprint (str, optional): The fingerprint of that matrix's export.
+                Not checked if None.
+
+        Raises:
+            ValueError: If the codes were built on another matrix; search it
+                exactly instead.
+        """
+        with open(os.path.join(persist_dir, META_FILE), "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        if num_rows is not None:
+            check_built_on(meta, num_rows, fingerprint, persist_dir)
+        scales = None
+        if meta["mode"] == "int8":
+            scales = np.load(os.path.join(persist_dir, SCALES_FILE))
+        codes = np.load(os.path.join(persist_dir, CODES_FILE), mmap_mode="r")
+        return cls(meta["mode"], codes, meta["dim"], scales)
+
+    def score(self, query_embedding: np.ndarray, rows: Optional[np.ndarray] = None,
+              chunk_size: int = 4096) -> np.ndarray:
+        """Pre-scores every row, or the given rows, against a normalized query
+        embedding with the codes. Higher is closer, but only the order of the
+        scores is meaningful. Small chunks keep the unpacked codes in the CPU cache."""
+        num_rows = self.num_rows if rows is None else len(rows)
+        scores = np.empty(num_rows, dtype=np.float32)
+        if self.mode == "int8":
+            scaled_query = (query_embedding * self.scales).astype(np.float32)
+        else:
+            query_code = quantize_binary(query_embedding)
+        for start in range(0, num_rows, chunk_size):
+            if rows is None:
+                chunk = self.codes[start : start + chunk_size]
+            else:
+                chunk = self.codes[rows[start : start + chunk_size]]
+            if self.mode == "int8":
+                scores[start : start + chunk_size] = chunk.astype(np.float32) @ scaled_query
+            else:
+                scores[start : start + chunk_size] = -hamming_distances(chunk, query_code)
+        return scores
+
+    def search(self, embeddings: np.ndarray, query_embedding: np.ndarray,  # pylint: disable=R0913
+               top_k: int, rerank_k: int, *, similarity_cutoff: Optional[float] = None,
+               rows: Optional[np.ndarray] = None):
+        """Finds the top k rows for a normalized query embedding.
+
+        Args:
+            embeddings (np.ndarray): The full-precision matrix the codes were built on.
+            query_embedding (np.ndarray): The normalized query embedding.
+            top_k (int): The number of rows to return.
+            rerank_k (int): The number of candidates scored exactly. Higher is
+                slower but closer to exact search.
+            similarity_cutoff (float, optional): Drops rows scoring below it.
+            rows (np.ndarray, optional): The sorted rows to search. Defaults to every row.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The selected rows, best first, and their
+                exact scores.
+        """
+        candidates = top_k_rows(self.score(query_embedding, rows), max(rerank_k, top_k))
+        if rows is not None:
+            candidates = rows[candidates]
+        # Sorted rows read the memory-mapped embedding matrix front to back
+        candidates = np.sort(candidates)
+        scores = embeddings[candidates] @ query_embedding
+        selected = top_k_rows(scores, top_k, similarity_cutoff)
+        return candidates[selected], scores[selected]
+
+
+class QuantizedRetriever(MatrixRetriever):
+    """Top-k retriever that pre-scores nodes with quantized codes and re-ranks the
+    best candidates against the full-precision embeddings.
+
+    Takes the same arguments as MatrixRetriever, plus:
+
+    Args:
+        quantized_index (QuantizedIndex): Codes of the retriever's embedding matrix.
+        rerank_k (int, optional): The number of candidates scored exactly.
+            Defaults to 100.
+    """
+
+    def __init__(self, *args, quantized_index: QuantizedIndex, rerank_k: int = 100,
+                 **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.quantized_index = quantized_index
+        self.rerank_k = rerank_k
+
+    def search_rows(self, query_bundle: QueryBundle,
+                    row_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the best rows for a query from its rerank_k best candidates.
+
+        With a row mask, only the codes of the selected rows are scored; when it
+        selects no more than rerank_k rows, they are all scored exactly instead.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The selected rows, best first, and their scores.
+        """
+        with span("query_embedding"):
+            query_embedding = self.embed_query(query_bundle)
+        with span("retrieval"):
+            rows = None if row_mask is None else np.flatnonzero(row_mask)
+            if rows is not None and len(rows) <= self.rerank_k:
+                return self.search_subset(query_embedding, rows)
+            return self.quantized_index.search(
+                self.embeddings,
+                query_embedding,
+                self.similarity_top_k,
+                self.rerank_k,
+                similarity_cutoff=self.similarity_cutoff,
+                rows=rows,
+            )
+
+
+def recall_at_k(embeddings: np.ndarray, quantized_index: QuantizedIndex, *,  # pylint: disable=R0913
+                num_queries: int = 100, top_k: int = 10, rerank_k: int = 100,
+                seed: int = 0) -> float:
+    """Estimates the share of the exact top k rows that the quantized search finds,
+    with noisy copies of random rows as queries."""
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, embeddings.shape[0], num_queries)
+    noise = rng.standard_normal((num_queries, embeddings.shape[1]), dtype=np.float32)
+    queries = normalize_rows(embeddings[np.sort(rows)] + noise / np.sqrt(embeddings.shape[1]))
+    hits = 0
+    for query in queries:
+        exact = top_k_rows(embeddings @ query, top_k)
+        found, _ = quantized_index.search(embeddings, query, top_k, rerank_k)
+        hits += len(np.intersect1d(exact, found))
+    return hits / (num_queries * top_k)
+
+
+def main(argv: List[str] = None) -> None:
+    """
+    Builds the quantized codes of the memory-mapped export in ./data/mmap (see
+    vector_store.py) and saves them to ./data/quantized, where the app picks them
+    up. Prints their size and their estimated recall.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--mode", choices=MODES, default="int8")
+    parser.add_argument("--index-dir", default="./data/mmap")
+    parser.add_argument("--out", default="./data/quantized")
+    args = parser.parse_args(argv)
+    embeddings = np.load(os.path.join(args.index_dir, EMBEDDINGS_FILE), mmap_mode="r")
+    quantized_index = QuantizedIndex.build(embeddings, args.mode)
+    quantized_index.save(args.out, read_fingerprint(args.index_dir))
+    print(f"Saved {args.mode} codes of {quantized_index.num_rows} rows to {args.out}: "
+          f"{quantized_index.nbytes / 2**20:.1f} MB instead of "
+          f"{embeddings.nbytes / 2**20:.1f} MB, recall@10 "
+          f"{recall_at_k(embeddings, quantized_index):.3f}")
+
+
+if __name__ == "__main__":
+    main()
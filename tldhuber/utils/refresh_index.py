@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file updates the app's index with new and changed transcripts, then
+rebuilds every index derived from it, so the app never searches a memory-mapped
+export or an approximate index older than the JSON index.
+
+1. indexing.update_index merges the transcripts into the JSON index in data/,
+   reusing the keywords and embeddings of text it processed before from the
+   content store (data/content_store.sqlite). The first run seeds the store
+   from the existing index, so unchanged text is never embedded again.
+2. The memory-mapped export in data/mmap is rewritten, if it exists.
+3. Every derived index that exists is rebuilt on the new export: data/ivf,
+   data/quantized (in the same mode), data/metadata and data/bm25.
+4. The snapshot in data/snapshot is rebuilt with the same components and
+   options (IVF lists and quantization mode), if it exists.
+Each directory is written next to the old one and swapped in once complete, so
+running app processes keep reading the old files. Restart the app to load the
+updated index.
+
+Usage:
+    python -m tldhuber.utils.refresh_index --transcripts ./transcript_data
+
+Modules: os, json, shutil, argparse, numpy, llama_index.
+"""
+
+import argparse
+import json
+import os
+import shutil
+from typing import Callable, Iterable, List, Optional
+
+from tldhuber.utils.ann_index import IVFIndex
+from tldhuber.utils.bm25_index import BM25Index
+from tldhuber.utils.metadata_index import MetadataIndex
+from tldhuber.utils.quantized_index import QuantizedIndex
+from tldhuber.utils.snapshot import build_snapshot, is_snapshot, read_manifest, snapshot_dirs
+from tldhuber.utils.vector_store import META_FILE, MmapVectorStore, export_persisted_index
+
+CONTENT_STORE_FILE = "content_store.sqlite"
+DERIVED_DIRS = {"vectors": "mmap", "ivf": "ivf", "quantized": "quantized",
+                "metadata": "metadata", "keyword": "bm25", "snapshot": "snapshot"}
+
+
+def replace_dir(build: Callable[[str], None], out_dir: str) -> None:
+    """Builds a directory next to out_dir and swaps it in once build returns.
+
+    The old directory is renamed before it is deleted, so files that other
+    processes have memory-mapped stay valid until they close them.
+
+    Args:
+        build (Callable): Writes the new directory to the path it is given.
+        out_dir (str): The directory to replace.
+    """
+    new_dir, old_dir = f"{out_dir}.new", f"{out_dir}.old"
+    for directory in (new_dir, old_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+    build(new_dir)
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old_dir)
+    os.replace(new_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _read_meta(index_dir: str) -> Optional[dict]:
+    """Reads the meta.json of an index directory, or returns None if it is absent."""
+    path = os.path.join(index_dir, META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _snapshot_options(snapshot_dir: str) -> dict:
+    """Reads the build options of a snapshot whose manifest predates recording
+    them from the meta.json of its components."""
+    dirs = snapshot_dirs(snapshot_dir)
+    ivf_meta, quantized_meta = _read_meta(dirs["ivf"]), _read_meta(dirs["quantized"])
+    return {"n_lists": ivf_meta["n_lists"] if ivf_meta else None,
+            "quantize": quantized_meta["mode"] if quantized_meta else None}
+
+
+def update_json_index(data_dir: str, documents: list, transformations: list = None,
+                      prune: bool = False) -> dict:
+    """Runs indexing.update_index on the JSON index in data_dir and persists it.
+
+    Args:
+        data_dir (str): The directory of the JSON index, e.g. "./data".
+        documents (list[Document]): Every transcript chunk, see
+            indexing.iter_episode_documents.
+        transformations (list, optional): Passed to update_index. Defaults to
+            local keyword extraction and text-embedding-3-small.
+        prune (bool, optional): Whether to delete documents no longer in
+            `documents`. Defaults to False.
+
+    Returns:
+        dict: The counts returned by update_index.
+    """
+    # pylint: disable=C0415
+    from llama_index.core import StorageContext, load_index_from_storage
+    from tldhuber.utils.content_store import ContentStore
+    from tldhuber.utils.indexing import seed_content_store, update_index
+
+    index = load_index_from_storage(StorageContext.from_defaults(persist_dir=data_dir))
+    content_store = ContentStore(os.path.join(data_dir, CONTENT_STORE_FILE))
+    try:
+        if not content_store.manifest():
+            seed_content_store(index, content_store)
+        return update_index(documents, index, content_store, transformations=transformations,
+                            persist_dir=data_dir, prune=prune)
+    finally:
+        content_store.close()
+
+
+def rebuild_derived_indexes(data_dir: str = "./data",
+                            documents: Optional[Iterable] = None) -> List[str]:
+    """Rebuilds the indexes derived from the JSON index in data_dir that exist.
+
+    Args:
+        data_dir (str, optional): The directory of the JSON index. Defaults to "./data".
+        documents (Iterable, optional): The transcript chunks to rebuild a keyword
+            index from when there is no memory-mapped export to index instead.
+
+    Returns:
+        list[str]: The rebuilt components, of "vectors", "ivf", "quantized",
+            "metadata", "keyword" and "snapshot".
+    """
+    dirs = {name: os.path.join(data_dir, subdir) for name, subdir in DERIVED_DIRS.items()}
+    metas = {name: _read_meta(directory) for name, directory in dirs.items()}
+    rebuilt = []
+    if metas["vectors"] is not None:
+        replace_dir(lambda out_dir: export_persisted_index(data_dir, out_dir), dirs["vectors"])
+        rebuilt.append("vectors")
+        store = MmapVectorStore(dirs["vectors"])
+        if metas["ivf"] is not None:
+            replace_dir(lambda out_dir: IVFIndex.build(store.embeddings).save(
+                out_dir, store.fingerprint), dirs["ivf"])
+            rebuilt.append("ivf")
+        if metas["quantized"] is not None:
+            replace_dir(lambda out_dir: QuantizedIndex.build(
+                store.embeddings, metas["quantized"]["mode"]).save(out_dir, store.fingerprint),
+                dirs["quantized"])
+            rebuilt.append("quantized")
+        if metas["metadata"] is not None:
+            replace_dir(lambda out_dir: MetadataIndex.build(
+                store.get_node(row).metadata for row in range(store.num_nodes)
+            ).save(out_dir, store.fingerprint), dirs["metadata"])
+            rebuilt.append("metadata")
+        documents = (store.get_node(row) for row in range(store.num_nodes))
+    if metas["keyword"] is not None and documents is not None:
+        replace_dir(lambda out_dir: BM25Index.build(documents).save(out_dir), dirs["keyword"])
+        rebuilt.append("keyword")
+
+    if is_snapshot(dirs["snapshot"]):
+        manifest = read_manifest(dirs["snapshot"])
+        options = manifest.get("options") or _snapshot_options(dirs["snapshot"])
+        replace_dir(lambda out_dir: build_snapshot(
+            dirs["vectors"] if "vectors" in rebuilt else data_dir, out_dir,
+            ivf="ivf" in manifest["components"], n_lists=options["n_lists"],
+            quantize=options["quantize"] if "quantized" in manifest["components"] else None,
+        ), dirs["snapshot"])
+        rebuilt.append("snapshot")
+    return rebuilt
+
+
+def main(argv: List[str] = None) -> None:
+    """
+    Updates the JSON index in ./data with the transcripts, read from the packed
+    corpus when it has been written (see packed_corpus.py) and from
+    ./transcript_data otherwise, and rebuilds the indexes derived from it.
+    """
+    # pylint: disable=C0415
+    from tldhuber.utils.indexing import iter_episode_documents
+    from tldhuber.utils.packed_corpus import PACKED_CORPUS_FILE
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--transcripts",
+                        help="the transcript folder or packed corpus to index")
+    parser.add_argument("--prune", action="store_true",
+                        help="delete indexed transcripts that are no longer in the source")
+    args = parser.parse_args(argv)
+    source = args.transcripts or (
+        PACKED_CORPUS_FILE if os.path.exists(PACKED_CORPUS_FILE) else "./transcript_data"
+    )
+    documents = [doc for episode in iter_episode_documents(source) for doc in episode]
+    stats = update_json_index(args.data_dir, documents, prune=args.prune)
+    print(", ".join(f"{count} {name.replace('_', ' ')}" for name, count in stats.items()))
+    rebuilt = rebuild_derived_indexes(args.data_dir, documents)
+    print(f"Rebuilt {', '.join(rebuilt) or 'no derived indexes'} in {args.data_dir}")
+
+
+if __name__ == "__main__":
+    main()
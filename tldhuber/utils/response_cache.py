@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file provides a semantic cache of chat answers, keyed by query embedding.
+
+Many users ask the same question in different words ("how to sleep better",
+"improve sleep"), and each one costs a full LLM completion. ResponseCache keeps
+the answer and the clips (as returned by extract_metadata) of recent queries,
+and serves them to any new query whose embedding is within a cosine distance of
+a cached query's. Looking up a query is one matrix-vector product over the
+cached embeddings, and needs no network call when the query embedding is itself
+cached (see embedding_cache.py).
+
+Answers expire after a time to live, the least recently used answer is evicted
+when the cache is full, and every answer is dropped when the index it was
+retrieved from changes (see index_fingerprint and ResponseCache.validate).
+
+Modules: os, time, hashlib, threading, numpy.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+from tldhuber.utils.vector_store import normalize_rows
+
+
+def index_fingerprint(paths: Sequence[str]) -> str:
+    """Identifies the version of an index by the size and modification time of
+    its files. Rebuilding or re-exporting the index rewrites them, which changes
+    the fingerprint. Missing files are skipped.
+
+    Args:
+        paths (Sequence[str]): Files that are rewritten whenever the index is.
+
+    Returns:
+        str: A short hex digest.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        if os.path.exists(path):
+            status = os.stat(path)
+            digest.update(f"{path}:{status.st_size}:{status.st_mtime_ns};".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class ResponseCache:  # pylint: disable=R0902
+    """Thread-safe cache of answers, served to queries with similar embeddings.
+
+    Args:
+        max_distance (float, optional): The largest cosine distance (1 - cosine
+            similarity) between a new query and a cached one for the cached
+            answer to be served. Defaults to 0.1.
+        ttl (float, optional): The seconds an answer is served for. Defaults to
+            86400 (a day).
+        max_size (int, optional): The number of answers kept. Defaults to 512.
+        version (str, optional): The fingerprint of the index the answers are
+            retrieved from. Defaults to None.
+        clock (Callable, optional): Returns the current time in seconds. Defaults
+            to time.time.
+    """
+
+    def __init__(self, max_distance: float = 0.1, ttl: float = 86400.0,  # pylint: disable=R0913
+                 max_size: int = 512, version: Optional[str] = None,
+                 clock: Callable[[], float] = time.time) -> None:
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_size = max_size
+        self.version = version
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        self._clear()
+
+    def _clear(self) -> None:
+        """Drops every answer. Must be called with the lock held, or from __init__."""
+        # The embeddings of the cached queries are rows of one matrix, allocated
+        # once the dimension is known. Empty and expired slots expire at -inf or
+        # in the past, and last_used orders the slots for LRU eviction
+        self._embeddings = None
+        self._entries = [None] * self.max_size
+        self._expires = np.full(self.max_size, -np.inf)
+        self._last_used = np.zeros(self.max_size, dtype=np.int64)
+        self._tick = 0
+
+    @property
+    def stats(self) -> dict:
+        """Hit, miss, eviction and invalidation counts since the cache was created."""
+        with self._lock:
+            return dict(self._counters)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return int(np.count_nonzero(self._expires > self.clock()))
+
+    def clear(self) -> None:
+        """Drops every answer."""
+        with self._lock:
+            self._clear()
+
+    def validate(self, version: str) -> bool:
+        """Drops every answer if the index has changed since they were cached.
+
+        Args:
+            version (str): The current fingerprint of the index.
+
+        Returns:
+            bool: True if the cached answers were kept.
+        """
+        with self._lock:
+            if version == self.version:
+                return True
+            if self.version is not None:
+                self._counters["invalidations"] += 1
+            self.version = version
+            self._clear()
+            return False
+
+    def _closest(self, query_embedding: np.ndarray, now: float):
+        """Finds the live slot closest to a normalized query embedding. Must be
+        called with the lock held.
+
+        Returns:
+            tuple[int, float]: The slot and its cosine similarity, or (-1, -inf)
+                if no answer is live.
+        """
+        if self._embeddings is None or self._embeddings.shape[1] != query_embedding.shape[0]:
+            return -1, -np.inf
+        scores = self._embeddings @ query_embedding
+        scores[self._expires <= now] = -np.inf
+        slot = int(np.argmax(scores))
+        return slot, float(scores[slot])
+
+    def get(self, query_embedding: Sequence[float]) -> Optional[dict]:
+        """Looks up the answer to a query.
+
+        Args:
+            query_embedding (Sequence[float]): The embedding of the query.
+
+        Returns:
+            dict: The cached "answer" (str) and "clips" (list[dict]) of the
+                closest cached query within max_distance, or None.
+        """
+        query_embedding = normalize_rows(query_embedding)
+        with self._lock:
+            slot, similarity = self._closest(query_embedding, self.clock())
+            if slot < 0 or 1.0 - similarity > self.max_distance:
+                self._counters["misses"] += 1
+                return None
+            self._tick += 1
+            self._last_used[slot] = self._tick
+            self._counters["hits"] += 1
+            entry = self._entries[slot]
+            return {"answer": entry["answer"], "clips": [dict(clip) for clip in entry["clips"]]}
+
+    def put(self, query_embedding: Sequence[float], answer: str, clips: List[dict]) -> None:
+        """Caches the answer to a query. An answer cached for a query within
+        max_distance is replaced, so near-duplicates take a single slot.
+
+        Args:
+            query_embedding (Sequence[float]): The embedding of the query.
+            answer (str): The answer to serve.
+            clips (list[dict]): The clips to serve, as returned by extract_metadata.
+        """
+        query_embedding = normalize_rows(query_embedding)
+        with self._lock:
+            now = self.clock()
+            if self._embeddings is None or self._embeddings.shape[1] != query_embedding.shape[0]:
+                self._clear()
+                self._embeddings = np.zeros((self.max_size, query_embedding.shape[0]),
+                                            dtype=np.float32)
+            slot, similarity = self._closest(query_embedding, now)
+            if slot < 0 or 1.0 - similarity > self.max_distance:
+                free = np.flatnonzero(self._expires <= now)
+                if free.size:
+                    slot = int(free[0])
+                else:
+                    slot = int(np.argmin(self._last_used))
+                    self._counters["evictions"] += 1
+            self._tick += 1
+            self._embeddings[slot] = query_embedding
+            self._entries[slot] = {"answer": answer, "clips": [dict(clip) for clip in clips]}
+            self._expires[slot] = now + self.ttl
+            self._last_used[slot] = self._tick
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains a micro-benchmark of the app's retrieval path on synthetic
+corpora, so that speed can be measured at any corpus size without the real
+data, an API key or network access.
+
+For each corpus size, the benchmark:
+1. Generates synthetic transcript chunks shaped like the output of
+   indexing.parse_into_documents, with deterministic fake embeddings. Chunks of
+   the same episode have correlated embeddings, so queries have several hits
+   above the similarity cutoff, as with real data.
+2. Writes them in the memory-mapped layout of vector_store.py.
+3. Times each stage separately: loading the index and building the retriever
+   of hello_huber.set_up_engine, retrieval through that retriever, the
+   similarity cutoff of SimilarityPostprocessor, and clips.extract_metadata.
+   The app's retriever applies the cutoff itself, so the similarity_cutoff stage
+   runs the postprocessor on the top k nodes of a retriever without a cutoff,
+   which is what the cutoff costs as a separate postprocessing step.
+
+Results are written as JSON, with the commit they were measured on, so runs can
+be compared across commits; compare_results flags stages that got slower.
+
+Usage:
+    python -m tldhuber.utils.retrieval_benchmark --scales 1 10 100 --out results.json
+    python -m tldhuber.utils.retrieval_benchmark --compare baseline.json
+
+Corpus sizes are multiples of the real corpus (4308 chunks). At 1536 dimensions
+the embeddings alone take 26 MB per multiple, so the largest scales need a
+smaller --dim.
+
+Modules: os, sys, json, time, argparse, platform, subprocess, tempfile, numpy,
+llama_index.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+from llama_index.core.postprocessor import SimilarityPostprocessor
+from llama_index.core.schema import QueryBundle, TextNode
+
+from tldhuber.utils.retrievers import MatrixRetriever
+from tldhuber.utils.vector_store import MmapVectorStore, export_rows, normalize_rows
+
+BASE_CORPUS_CHUNKS = 4308
+CHUNKS_PER_EPISODE = 25
+WORDS = (
+    "sleep light dopamine focus cortisol morning sunlight caffeine adenosine "
+    "circadian rhythm protocol neuroscience motivation stress breathing cold heat "
+    "exercise muscle hormone testosterone estrogen nutrition fasting memory learning "
+    "neuroplasticity vision attention anxiety mood serotonin supplements zinc "
+    "magnesium omega fatty acids gut microbiome inflammation recovery sauna"
+).split()
+TEXT_VARIANTS = 64
+WORDS_PER_CHUNK = 900
+
+
+def chunk_texts(seed: int = 0) -> List[str]:
+    """Returns a pool of random transcript-like texts of realistic length (~5 KB)."""
+    rng = np.random.default_rng(seed)
+    return [
+        " ".join(WORDS[i] for i in rng.integers(0, len(WORDS), WORDS_PER_CHUNK))
+        for _ in range(TEXT_VARIANTS)
+    ]
+
+
+def synthetic_rows(num_nodes: int, dim: int,
+                   seed: int = 0) -> Iterator[Tuple[np.ndarray, TextNode]]:
+    """Yields the (embedding, node) of each synthetic chunk, one episode at a time.
+
+    Nodes carry the metadata of indexing.parse_into_documents. Each episode's
+    embeddings are its own random center plus independent noise of the same
+    scale, which gives a cosine similarity of about 0.5 within an episode and
+    about 0 across episodes.
+    """
+    texts = chunk_texts(seed)
+    for episode in range(-(-num_nodes // CHUNKS_PER_EPISODE)):
+        rng = np.random.default_rng([seed, episode])
+        size = min(CHUNKS_PER_EPISODE, num_nodes - episode * CHUNKS_PER_EPISODE)
+        center = rng.standard_normal(dim, dtype=np.float32)
+        embeddings = center + rng.standard_normal((size, dim), dtype=np.float32)
+        for i, embedding in enumerate(embeddings):
+            row = episode * CHUNKS_PER_EPISODE + i
+            node = TextNode(
+                text=f"{texts[row % TEXT_VARIANTS]} chunk {row}",
+                metadata={
+                    "episode_title": f"Synthetic Episode {episode}",
+                    "episode_number": str(episode),
+                    "episode_summary": "A synthetic episode used for benchmarking.",
+                    "youtube_link": f"https://www.youtube.com/watch?v=synthetic{episode}",
+                    "timestamp": i * 180,
+                },
+                excluded_embed_metadata_keys=["episode_summary", "timestamp", "youtube_link"],
+                excluded_llm_metadata_keys=["episode_summary", "timestamp", "youtube_link"],
+            )
+            yield embedding, node
+
+
+def write_synthetic_index(out_dir: str, num_nodes: int, dim: int, seed: int = 0) -> int:
+    """Writes a synthetic corpus in the memory-mapped layout of vector_store.py."""
+    return export_rows(synthetic_rows(num_nodes, dim, seed), num_nodes, dim, out_dir)
+
+
+def query_bundles(embeddings: np.ndarray, num_queries: int, seed: int = 0) -> List[QueryBundle]:
+    """Makes queries whose embeddings are noisy copies of random corpus rows."""
+    # A three-word seed never collides with the [seed, episode] corpus seeds
+    rng = np.random.default_rng([seed, 0, 1])
+    rows = rng.integers(0, embeddings.shape[0], num_queries)
+    noise = rng.standard_normal((num_queries, embeddings.shape[1]), dtype=np.float32)
+    queries = normalize_rows(embeddings[rows] + 0.5 * noise / np.sqrt(embeddings.shape[1]))
+    return [QueryBundle(query_str=f"query {i}", embedding=query.tolist())
+            for i, query in enumerate(queries)]
+
+
+def summarize(seconds: List[float]) -> Dict[str, float]:
+    """Summarizes stage timings in milliseconds."""
+    millis = np.asarray(seconds) * 1000.0
+    return {
+        "n": int(len(millis)),
+        "mean_ms": float(millis.mean()),
+        "p50_ms": float(np.percentile(millis, 50)),
+        "p90_ms": float(np.percentile(millis, 90)),
+        "p99_ms": float(np.percentile(millis, 99)),
+        "min_ms": float(millis.min()),
+        "max_ms": float(millis.max()),
+    }
+
+
+def timed(func: Callable, *args):
+    """Calls func(*args) and returns (result, elapsed seconds)."""
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+# pylint: disable=R0914
+def benchmark_index(index_dir: str, num_queries: int = 100, load_repeats: int = 3,
+                    seed: int = 0) -> Dict[str, dict]:
+    """Times each retrieval stage on the index in index_dir.
+
+    Args:
+        index_dir (str): A directory in the memory-mapped layout.
+        num_queries (int, optional): The number of queries timed. Defaults to 100.
+        load_repeats (int, optional): The number of index loads timed. Defaults to 3.
+        seed (int, optional): Seeds the query embeddings. Defaults to 0.
+
+    Returns:
+        dict: Timing summaries keyed by stage: index_load, retrieval,
+            similarity_cutoff and extract_metadata, plus the mean number of
+            nodes per query under "nodes_per_query".
+    """
+    # Imported here because importing the app runs the Streamlit page in bare mode
+    # pylint: disable=C0415
+    from tldhuber.hello_huber import set_up_engine
+    from tldhuber.utils.clips import extract_metadata
+
+    def load():
+        index = VectorStoreIndex.from_vector_store(MmapVectorStore(index_dir))
+        return index, set_up_engine(index).retriever
+
+    load_seconds = []
+    for _ in range(load_repeats):
+        (index, retriever), elapsed = timed(load)
+        load_seconds.append(elapsed)
+
+    # The app's retriever has already dropped the nodes below the cutoff
+    unfiltered = MatrixRetriever.from_index(index, similarity_top_k=retriever.similarity_top_k,
+                                            similarity_cutoff=None)
+    postprocessor = SimilarityPostprocessor(similarity_cutoff=retriever.similarity_cutoff)
+    timings = {"retrieval": [], "similarity_cutoff": [], "extract_metadata": []}
+    node_counts = []
+    for query_bundle in query_bundles(retriever.embeddings, num_queries, seed):
+        nodes, elapsed = timed(retriever.retrieve, query_bundle)
+        timings["retrieval"].append(elapsed)
+        _, elapsed = timed(postprocessor.postprocess_nodes, unfiltered.retrieve(query_bundle))
+        timings["similarity_cutoff"].append(elapsed)
+        response = SimpleNamespace(source_nodes=nodes)
+        _, elapsed = timed(extract_metadata, response)
+        timings["extract_metadata"].append(elapsed)
+        node_counts.append(len(nodes))
+
+    results = {"index_load": summarize(load_seconds)}
+    results.update({stage: summarize(seconds) for stage, seconds in timings.items()})
+    results["nodes_per_query"] = float(np.mean(node_counts))
+    return results
+
+
+def current_commit() -> str:
+    """Returns the current git commit hash, or None outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# pylint: disable=R0913
+def run_benchmark(scales: List[float], dim: int = 1536, num_queries: int = 100, *,
+                  base_chunks: int = BASE_CORPUS_CHUNKS, seed: int = 0,
+                  work_dir: str = None) -> dict:
+    """Benchmarks synthetic corpora of several sizes.
+
+    Args:
+        scales (list[float]): Corpus sizes, as multiples of base_chunks.
+        dim (int, optional): The embedding dimension. Defaults to 1536, the
+            dimension of text-embedding-3-small.
+        num_queries (int, optional): The number of queries per corpus. Defaults to 100.
+        base_chunks (int, optional): The size of scale 1. Defaults to the size of
+            the real corpus.
+        seed (int, optional): Seeds the corpus and the queries. Defaults to 0.
+        work_dir (str, optional): Where the synthetic indexes are written. Defaults
+            to a temporary directory that is removed afterwards.
+
+    Returns:
+        dict: The environment, configuration and per-scale stage timings.
+    """
+    # Nothing is embedded or generated: queries come with embeddings, and the
+    # engine's "no_text" synthesizer never calls the LLM
+    Settings.embed_model = MockEmbedding(embed_dim=dim)
+    Settings.llm = MockLLM()
+    results = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        for scale in scales:
+            num_nodes = max(1, int(round(scale * base_chunks)))
+            index_dir = os.path.join(tmp_dir, f"scale_{scale}")
+            _, build_seconds = timed(write_synthetic_index, index_dir, num_nodes, dim, seed)
+            stages = benchmark_index(index_dir, num_queries, seed=seed)
+            results.append({"scale": scale, "num_nodes": num_nodes,
+                            "build_seconds": build_seconds, "stages": stages})
+    return {
+        "commit": current_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "config": {"dim": dim, "num_queries": num_queries, "base_chunks": base_chunks,
+                   "seed": seed},
+        "results": results,
+    }
+
+
+def compare_results(baseline: dict, current: dict, tolerance: float = 0.2,
+                    statistic: str = "p50_ms") -> List[str]:
+    """Lists the stages that got slower than the baseline by more than tolerance.
+
+    Runs are matched by corpus size (num_nodes); sizes missing from either run
+    are ignored.
+
+    Returns:
+        list[str]: One line per regression, empty if there are none.
+    """
+    baseline_by_size = {result["num_nodes"]: result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        before = baseline_by_size.get(result["num_nodes"])
+        if before is None:
+            continue
+        for stage, summary in result["stages"].items():
+            if not isinstance(summary, dict) or stage not in before["stages"]:
+                continue
+            old, new = before["stages"][stage][statistic], summary[statistic]
+            if old > 0 and new > old * (1.0 + tolerance):
+                regressions.append(
+                    f"{result['num_nodes']} nodes, {stage}: {statistic} "
+                    f"{old:.3f} -> {new:.3f} ({new / old - 1.0:+.0%})"
+                )
+    return regressions
+
+
+def read_baseline(path: Optional[str]) -> Optional[dict]:
+    """Reads a previous results file, or returns None when no path is given.
+
+    Call it before running the benchmark, since the baseline may be the file
+    the new run overwrites.
+    """
+    if not path:
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def report_and_compare(report: dict, out_path: str, baseline: Optional[dict] = None,
+                       tolerance: float = 0.2, precision: int = 3) -> int:
+    """Writes a report, prints the p50 of each stage and any regressions against
+    the baseline.
+
+    Args:
+        report (dict): The results of run_benchmark.
+        out_path (str): The JSON file to write the report to.
+        baseline (dict, optional): Earlier results, see read_baseline.
+        tolerance (float, optional): See compare_results. Defaults to 0.2.
+        precision (int, optional): The decimals printed. Defaults to 3.
+
+    Returns:
+        int: 1 if a stage regressed, 0 otherwise, as the command's exit code.
+    """
+    with open(out_path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    for result in report["results"]:
+        stages = ", ".join(
+            f"{stage} {summary['p50_ms']:.{precision}f} ms"
+            for stage, summary in result["stages"].items() if isinstance(summary, dict)
+        )
+        print(f"{result['num_nodes']} nodes (p50): {stages}")
+    print(f"Wrote {out_path}")
+
+    if baseline is None:
+        return 0
+    regressions = compare_results(baseline, report, tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+
+def main(argv: List[str] = None) -> int:
+    """Runs the benchmark from the command line. Returns 1 if a stage regressed."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="retrieval_benchmark.json")
+    parser.add_argument("--compare", help="a previous results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    baseline = read_baseline(args.compare)
+    report = run_benchmark(args.scales, args.dim, args.queries, seed=args.seed)
+    return report_and_compare(report, args.out, baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains the retrievers used by the app's query and chat engines.
+
+VectorIndexRetriever over llama_index's SimpleVectorStore scores nodes one at a
+time in pure Python. MatrixRetriever instead keeps every embedding in a single
+normalized float32 matrix, so a query is one matrix-vector product followed by
+an argpartition, with the similarity cutoff applied in the same pass.
+
+Searches can be restricted to a subset of the rows, e.g. the rows of some
+episodes selected by a metadata_index.MetadataIndex filter. Only those rows are
+scored, so a selective filter also makes the search faster.
+
+A cached retriever can be shared by every session of the app; SessionRetriever
+gives each session its own row mask on top of it, passed along with every
+search instead of being stored in the shared retriever.
+
+HybridRetriever runs the local BM25 keyword index (see bm25_index.py) next to a
+dense retriever and merges both rankings with reciprocal-rank fusion, so exact
+names and terms that embeddings miss still reach the top of the results. The
+keyword searches of every hybrid retriever share one thread pool.
+
+Modules: asyncio, concurrent.futures, numpy, llama_index.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import BaseNode, NodeWithScore, QueryBundle
+
+from tldhuber.utils.bm25_index import BM25Index
+from tldhuber.utils.metrics import span
+from tldhuber.utils.vector_store import (
+    MmapVectorStore,
+    node_ids_fingerprint,
+    normalize_rows,
+    top_k_rows,
+)
+
+# Runs the keyword searches of every HybridRetriever next to their dense searches
+_KEYWORD_EXECUTOR = ThreadPoolExecutor(thread_name_prefix="keyword_search")
+
+
+def check_row_mask(row_mask: Optional[np.ndarray], num_rows: int) -> None:
+    """Checks that a row mask, if any, has one entry per row.
+
+    Raises:
+        ValueError: If it does not.
+    """
+    if row_mask is not None and len(row_mask) != num_rows:
+        raise ValueError(f"The row mask has {len(row_mask)} entries but the index "
+                         f"has {num_rows} rows.")
+
+
+def index_embedding_matrix(index):
+    """Collects the embeddings of a VectorStoreIndex into one normalized matrix.
+
+    Args:
+        index (VectorStoreIndex): An index whose vector store keeps embeddings.
+
+    Returns:
+        tuple[np.ndarray, list[str]]: The (n_nodes, dim) float32 matrix and the
+            node id stored at each row.
+    """
+    node_ids = list(index.index_struct.nodes_dict.values())
+    matrix = normalize_rows([index.vector_store.get(node_id) for node_id in node_ids])
+    return matrix, node_ids
+
+
+class MatrixRetriever(BaseRetriever):  # pylint: disable=R0902
+    """Exact top-k retriever that scores all nodes with one matrix-vector product.
+
+    Args:
+        embeddings (np.ndarray): The (n_nodes, dim) matrix of row-normalized embeddings.
+        get_nodes (Callable): Maps a sequence of row numbers to their nodes.
+        embed_model (BaseEmbedding, optional): The model used to embed queries.
+            Defaults to Settings.embed_model.
+        similarity_top_k (int, optional): The number of nodes to return. Defaults to 10.
+        similarity_cutoff (float, optional): Nodes scoring below the cutoff are
+            dropped, as with SimilarityPostprocessor. Defaults to None.
+        row_mask (np.ndarray, optional): A boolean array with one entry per row;
+            only the rows where it is True are searched. Defaults to None, which
+            searches every row.
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        embeddings: np.ndarray,
+        get_nodes: Callable[[np.ndarray], List[BaseNode]],
+        *,
+        embed_model=None,
+        similarity_top_k: int = 10,
+        similarity_cutoff: Optional[float] = None,
+        row_mask: Optional[np.ndarray] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(**kwargs)
+        self._embeddings = embeddings
+        self._get_nodes = get_nodes
+        self._embed_model = embed_model or Settings.embed_model
+        self.similarity_top_k = similarity_top_k
+        self.similarity_cutoff = similarity_cutoff
+        self._row_mask = None
+        self._filter_rows = None
+        self._fingerprint_node_ids = None
+        self.set_row_mask(row_mask)
+
+    @classmethod
+    def from_index(cls, index, **kwargs) -> "MatrixRetriever":
+        """Builds a retriever over the nodes of a VectorStoreIndex.
+
+        The memory-mapped matrix of an MmapVectorStore is used directly. For any
+        other store the embeddings are gathered into a new matrix and nodes are
+        read back from the index's docstore.
+        """
+        store = index.vector_store
+        if isinstance(store, MmapVectorStore):
+            retriever = cls(store.embeddings, store.get_nodes_by_rows, **kwargs)
+            retriever._fingerprint_node_ids = lambda: store.node_ids_fingerprint
+            return retriever
+
+        matrix, node_ids = index_embedding_matrix(index)
+
+        def get_nodes(rows):
+            return index.docstore.get_nodes([node_ids[row] for row in rows])
+
+        retriever = cls(matrix, get_nodes, **kwargs)
+        retriever._fingerprint_node_ids = lambda: node_ids_fingerprint(node_ids)
+        return retriever
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """The normalized embedding matrix searched by this retriever."""
+        return self._embeddings
+
+    @property
+    def num_rows(self) -> int:
+        """The number of rows of the embedding matrix."""
+        return self._embeddings.shape[0]
+
+    @property
+    def row_mask(self) -> Optional[np.ndarray]:
+        """The boolean array of the rows searched, or None when all rows are."""
+        return self._row_mask
+
+    def node_ids_fingerprint(self) -> str:
+        """Returns the fingerprint of the node ids of every row, in row order (see
+        vector_store.node_ids_fingerprint). Retrievers built with from_index get it
+        without decoding any node."""
+        if self._fingerprint_node_ids is not None:
+            return self._fingerprint_node_ids()
+        return node_ids_fingerprint(node.node_id for node in self.get_nodes(range(self.num_rows)))
+
+    @property
+    def filter_rows(self) -> Optional[np.ndarray]:
+        """The sorted rows searched, or None when all rows are."""
+        return self._filter_rows
+
+    def set_row_mask(self, row_mask: Optional[np.ndarray]) -> None:
+        """Restricts later searches to the rows where row_mask is True, or lifts
+        the restriction when it is None.
+
+        Raises:
+            ValueError: If row_mask does not have one entry per row.
+        """
+        check_row_mask(row_mask, self.num_rows)
+        self._row_mask = row_mask
+        self._filter_rows = None if row_mask is None else np.flatnonzero(row_mask)
+
+    def get_nodes(self, rows) -> List[BaseNode]:
+        """Returns the nodes stored at the given rows of the embedding matrix."""
+        return self._get_nodes(rows)
+
+    def embed_query(self, query_bundle: QueryBundle) -> np.ndarray:
+        """Returns the normalized query embedding, computing it if needed."""
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        return normalize_rows(query_bundle.embedding)
+
+    def score(self, query_embedding: np.ndarray) -> np.ndarray:
+        """Returns the cosine similarity of every node to a normalized query embedding."""
+        return self._embeddings @ query_embedding
+
+    def search_subset(self, query_embedding: np.ndarray, rows: Optional[np.ndarray] = None,
+                      top_k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Scores only the given rows, or every row when rows is None, against a
+        normalized query embedding.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The selected rows, best first, and their scores.
+        """
+        top_k = top_k or self.similarity_top_k
+        if rows is None:
+            scores = self.score(query_embedding)
+            selected = top_k_rows(scores, top_k, self.similarity_cutoff)
+            return selected, scores[selected]
+        scores = self._embeddings[rows] @ query_embedding
+        selected = top_k_rows(scores, top_k, self.similarity_cutoff)
+        return rows[selected], scores[selected]
+
+    def search_rows(self, query_bundle: QueryBundle,
+                    row_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the best rows for a query without loading their nodes.
+
+        Args:
+            query_bundle (QueryBundle): The query.
+            row_mask (np.ndarray, optional): Only the rows where it is True are
+                searched. Defaults to None, which searches every row.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The selected rows, best first, and their scores.
+        """
+        with span("query_embedding"):
+            query_embedding = self.embed_query(query_bundle)
+        with span("retrieval"):
+            rows = None if row_mask is None else np.flatnonzero(row_mask)
+            return self.search_subset(query_embedding, rows)
+
+    def search_rows_batch(
+        self, query_embeddings: np.ndarray, top_k: Optional[int] = None,
+        row_masks: Optional[Sequence[Optional[np.ndarray]]] = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Finds the best rows for several queries in one pass over the matrix.
+
+        Args:
+            query_embeddings (np.ndarray): The (n_queries, dim) query embeddings.
+            top_k (int, optional): Defaults to similarity_top_k.
+            row_masks (Sequence[np.ndarray], optional): The row mask of each query,
+                or None for queries searching every row. Unfiltered queries share
+                one pass over the matrix; filtered ones only score their rows.
+                The retriever's own row_mask is not applied.
+
+        Returns:
+            list[tuple[np.ndarray, np.ndarray]]: The selected rows of each query, best
+                first, and their scores.
+        """
+        with span("retrieval"):
+            query_embeddings = normalize_rows(query_embeddings)
+            row_masks = row_masks or [None] * len(query_embeddings)
+            results = [None] * len(query_embeddings)
+            unfiltered = [i for i, row_mask in enumerate(row_masks) if row_mask is None]
+            if unfiltered:
+                scores = query_embeddings[unfiltered] @ self._embeddings.T
+                for i, query_scores in zip(unfiltered, scores):
+                    rows = top_k_rows(query_scores, top_k or self.similarity_top_k,
+                                      self.similarity_cutoff)
+                    results[i] = (rows, query_scores[rows])
+            for i, row_mask in enumerate(row_masks):
+                if row_mask is not None:
+                    results[i] = self.search_subset(query_embeddings[i],
+                                                    np.flatnonzero(row_mask), top_k)
+        return results
+
+    def nodes_with_scores(self, rows, scores) -> List[NodeWithScore]:
+        """Loads the nodes at the given rows, with their scores."""
+        with span("node_loading"):
+            nodes = self.get_nodes(rows)
+            return [NodeWithScore(node=node, score=float(score))
+                    for node, score in zip(nodes, scores)]
+
+    def retrieve_with_mask(self, query_bundle: QueryBundle,
+                           row_mask: Optional[np.ndarray]) -> List[NodeWithScore]:
+        """Retrieves nodes among the rows where row_mask is True, or among all
+        rows when it is None, ignoring the retriever's own row mask."""
+        return self.nodes_with_scores(*self.search_rows(query_bundle, row_mask=row_mask))
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self.retrieve_with_mask(query_bundle, self._row_mask)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Hashable]],
+                           k: float = 60.0) -> List[Tuple[Hashable, float]]:
+    """Merges rankings by rank position: each item scores the sum of 1 / (k + rank).
+
+    Args:
+        rankings (Sequence[Sequence]): Lists of items (e.g. row numbers), best first.
+        k (float, optional): Damps the weight of the top ranks. Defaults to 60, the
+            value from the original paper.
+
+    Returns:
+        list[tuple]: (item, fused score) pairs, best first. Ties keep the order in
+            which items were first seen.
+    """
+    fused: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            fused[item] = fused.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda pair: pair[1], reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    """Retriever that fuses keyword (BM25) and dense rankings.
+
+    The keyword index must have been built over the dense retriever's nodes in row
+    order (see bm25_index.main), so that a keyword chunk id is a row number.
+    Keyword search runs in a worker thread while the dense retriever embeds the
+    query, on a thread pool shared by every hybrid retriever, and the two rankings
+    are merged with reciprocal_rank_fusion. Returned
+    nodes carry their fused score. The dense retriever's row mask also restricts
+    the keyword search (see set_row_mask).
+
+    Args:
+        dense_retriever (MatrixRetriever): The dense retriever, e.g. an IVFRetriever.
+            Its similarity_top_k and similarity_cutoff shape the dense ranking.
+        keyword_index (BM25Index): The keyword index of the same nodes.
+        similarity_top_k (int, optional): The number of fused nodes to return.
+            Defaults to 5.
+        keyword_top_k (int, optional): The depth of the keyword ranking. Defaults to
+            the dense retriever's similarity_top_k.
+        rrf_k (float, optional): The reciprocal-rank fusion constant. Defaults to 60.
+
+    Raises:
+        ValueError: If the keyword index does not cover the dense retriever's rows.
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        dense_retriever: MatrixRetriever,
+        keyword_index: BM25Index,
+        similarity_top_k: int = 5,
+        keyword_top_k: Optional[int] = None,
+        rrf_k: float = 60.0,
+        **kwargs,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.dense_retriever = dense_retriever
+        self.keyword_index = keyword_index
+        self.similarity_top_k = similarity_top_k
+        self.keyword_top_k = keyword_top_k or dense_retriever.similarity_top_k
+        self.rrf_k = rrf_k
+        self._check_alignment()
+
+    def _check_alignment(self) -> None:
+        """Checks that chunk i of the keyword index is the node of dense row i."""
+        num_rows = self.dense_retriever.num_rows
+        if self.keyword_index.num_chunks != num_rows:
+            raise ValueError(
+                f"The keyword index has {self.keyword_index.num_chunks} chunks but the "
+                f"dense index has {num_rows} rows; rebuild it with bm25_index.main()."
+            )
+        chunk_ids = node_ids_fingerprint(chunk.get("node_id", "")
+                                         for chunk in self.keyword_index.chunks)
+        if chunk_ids != self.dense_retriever.node_ids_fingerprint():
+            raise ValueError("The keyword index was not built from this dense index; "
+                             "rebuild it with bm25_index.main().")
+
+    @property
+    def num_rows(self) -> int:
+        """The number of rows of the dense retriever."""
+        return self.dense_retriever.num_rows
+
+    @property
+    def row_mask(self) -> Optional[np.ndarray]:
+        """The boolean array of the rows searched, or None when all rows are."""
+        return self.dense_retriever.row_mask
+
+    def set_row_mask(self, row_mask: Optional[np.ndarray]) -> None:
+        """Restricts both searches to the rows where row_mask is True, or lifts the
+        restriction when it is None."""
+        self.dense_retriever.set_row_mask(row_mask)
+
+    def keyword_rows(self, query_str: str, row_mask: Optional[np.ndarray] = None) -> List[int]:
+        """Returns the rows of the best keyword matches, best first."""
+        with span("keyword_retrieval"):
+            matches = self.keyword_index.search(query_str, self.keyword_top_k,
+                                                row_mask=row_mask)
+            return [row for row, _ in matches]
+
+    def _fuse(self, dense_rows, keyword_rows) -> List[NodeWithScore]:
+        with span("fusion"):
+            fused = reciprocal_rank_fusion(
+                [[int(row) for row in dense_rows], keyword_rows], k=self.rrf_k
+            )[:self.similarity_top_k]
+        with span("node_loading"):
+            nodes = self.dense_retriever.get_nodes([row for row, _ in fused])
+            return [NodeWithScore(node=node, score=score)
+                    for node, (_, score) in zip(nodes, fused)]
+
+    def retrieve_with_mask(self, query_bundle: QueryBundle,
+                           row_mask: Optional[np.ndarray]) -> List[NodeWithScore]:
+        """Retrieves nodes among the rows where row_mask is True, or among all
+        rows when it is None, ignoring the retriever's own row mask."""
+        keyword_future = _KEYWORD_EXECUTOR.submit(self.keyword_rows, query_bundle.query_str,
+                                                  row_mask)
+        dense_rows, _ = self.dense_retriever.search_rows(query_bundle, row_mask=row_mask)
+        return self._fuse(dense_rows, keyword_future.result())
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self.retrieve_with_mask(query_bundle, self.row_mask)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        row_mask = self.row_mask
+        (dense_rows, _), keyword_rows = await asyncio.gather(
+            asyncio.to_thread(self.dense_retriever.search_rows, query_bundle, row_mask=row_mask),
+            asyncio.to_thread(self.keyword_rows, query_bundle.query_str, row_mask),
+        )
+        return self._fuse(dense_rows, keyword_rows)
+
+
+class SessionRetriever(BaseRetriever):
+    """A session's view of a shared retriever, with the session's own row mask.
+
+    The shared retriever (e.g. one cached by the app for every session) is never
+    modified: the row mask is passed along with each search.
+
+    Args:
+        retriever (MatrixRetriever or HybridRetriever): The shared retriever.
+        row_mask (np.ndarray, optional): See set_row_mask. Defaults to None.
+    """
+
+    def __init__(self, retriever, row_mask: Optional[np.ndarray] = None, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.retriever = retriever
+        self._row_mask = None
+        self.set_row_mask(row_mask)
+
+    @property
+    def row_mask(self) -> Optional[np.ndarray]:
+        """The boolean array of the rows searched, or None when all rows are."""
+        return self._row_mask
+
+    def set_row_mask(self, row_mask: Optional[np.ndarray]) -> None:
+        """Restricts this session's searches to the rows where row_mask is True,
+        or lifts the restriction when it is None.
+
+        Raises:
+            ValueError: If row_mask does not have one entry per row.
+        """
+        check_row_mask(row_mask, self.retriever.num_rows)
+        self._row_mask = row_mask
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self.retriever.retrieve_with_mask(query_bundle, self._row_mask)
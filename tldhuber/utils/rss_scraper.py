@@ -6,12 +6,31 @@ This module provides functionality to scrape data from RSS feeds and return it
 as a pandas DataFrame. It relies on the feedparser and pandas libraries to parse
 the feed and manage the data, respectively.
 
+For frequent polling, fetch_new_rss_entries downloads the feed incrementally. It
+remembers the ETag and Last-Modified headers of the last download and the id of
+the newest entry in a small JSON state file (data/rss_state.json by default):
+1. The feed is requested conditionally, so an unchanged feed costs a 304 and no
+   parsing at all.
+2. A changed feed is parsed while it streams in, one <item> at a time, and the
+   download stops at the first entry already seen. New episodes are at the top
+   of the feed, so only they are read.
+3. New entries are yielded as plain dicts with the same keys as the columns of
+   scrape_rss_data, plus 'Id'.
+
 Author: Jake Flynn
 Date: 2024-02-20
 """
 #pylint: disable=E0401
+import json
+import os
+import xml.etree.ElementTree as ET
+
 import feedparser
 import pandas as pd
+import requests
+
+RSS_STATE_FILE = "./data/rss_state.json"
+ITUNES_NAMESPACE = "{http://www.itunes.com/dtds/podcast-1.0.dtd}"
 
 def scrape_rss_data(feed_url):
     """
@@ -46,3 +65,130 @@ def scrape_rss_data(feed_url):
 
     print(f"Error parsing feed: {feed.bozo_exception}")
     return None
+
+
+def load_feed_state(state_file=RSS_STATE_FILE):
+    """
+    Load the state of the last incremental download of a feed.
+
+    Parameters:
+    state_file (str): The path of the JSON state file.
+
+    Returns:
+    dict: The 'etag', 'last_modified' and 'last_entry_id' of the last download,
+          or an empty dict if the feed was never downloaded.
+    """
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_feed_state(state, state_file=RSS_STATE_FILE):
+    """
+    Atomically write the state of an incremental download of a feed.
+
+    Parameters:
+    state (dict): The state, as returned by load_feed_state.
+    state_file (str): The path of the JSON state file.
+    """
+    os.makedirs(os.path.dirname(state_file) or ".", exist_ok=True)
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        json.dump(state, file)
+    os.replace(tmp_file, state_file)
+
+
+def entry_record(item):
+    """
+    Convert an RSS <item> element into a plain record.
+
+    Parameters:
+    item (xml.etree.ElementTree.Element): The <item> element.
+
+    Returns:
+    dict: The 'Id', 'Title', 'Publication Date', 'Summary' and 'Enclosure Link'
+          of the entry. The id is the entry's guid, or its enclosure link or
+          title when it has none.
+    """
+    enclosure = item.find("enclosure")
+    enclosure_link = enclosure.get("url") if enclosure is not None else None
+    title = item.findtext("title", "").strip()
+    summary = item.findtext("description") or item.findtext(f"{ITUNES_NAMESPACE}summary", "")
+    return {
+        'Id': (item.findtext("guid") or "").strip() or enclosure_link or title,
+        'Title': title,
+        'Publication Date': item.findtext("pubDate", "").strip(),
+        'Summary': summary.strip(),
+        'Enclosure Link': enclosure_link
+    }
+
+
+def iter_rss_entries(source):
+    """
+    Parse the entries of an RSS feed one at a time while it is read.
+
+    Every <item> is released once it has been converted, so memory use does not
+    grow with the size of the feed, and a caller that stops iterating stops the
+    reading of the feed.
+
+    Parameters:
+    source (file-like or str): The feed, as a binary file object or a path.
+
+    Yields:
+    dict: The record of each entry (see entry_record), in feed order.
+
+    Raises:
+    xml.etree.ElementTree.ParseError: If the feed is not well-formed XML.
+    """
+    channel = None
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if event == "start" and element.tag == "channel":
+            channel = element
+        elif event == "end" and element.tag == "item":
+            yield entry_record(element)
+            if channel is not None:
+                channel.remove(element)
+
+
+def fetch_new_rss_entries(feed_url, state_file=RSS_STATE_FILE, session=None, timeout=30):
+    """
+    Yield the entries of an RSS feed published since the last call.
+
+    The feed is requested with the ETag and Last-Modified of the last download,
+    and parsing stops at the first entry already seen (see the module
+    docstring). The state is only updated once every new entry has been
+    yielded, so entries a caller did not get to are yielded again next time.
+
+    Parameters:
+    feed_url (str): The URL of the RSS feed.
+    state_file (str): The path of the JSON state file.
+    session (requests.Session): The session to download with, if any.
+    timeout (float): The timeout of the request, in seconds.
+
+    Yields:
+    dict: The record of each new entry (see entry_record), newest first.
+    """
+    state = load_feed_state(state_file)
+    headers = {}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+    http = session or requests
+    with http.get(feed_url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            return
+        response.raise_for_status()
+        response.raw.decode_content = True
+        newest_id = None
+        for entry in iter_rss_entries(response.raw):
+            if entry["Id"] == state.get("last_entry_id"):
+                break
+            newest_id = newest_id or entry["Id"]
+            yield entry
+        save_feed_state({
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "last_entry_id": newest_id or state.get("last_entry_id"),
+        }, state_file)
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains a standalone asyncio HTTP service for searching the podcast
+index, without the Streamlit UI.
+
+The app answers one query per script rerun. This service returns, as JSON, what
+the app's query engine retrieves for a query and the clips that extract_metadata
+makes from it. Concurrent requests are micro-batched: requests arriving within
+a short window (max_wait) are answered together, with one embedding call for
+all their queries and one matrix product against every node.
+
+Endpoints:
+1. GET /query?q=...&top_k=... or POST /query with {"query": ..., "top_k": ...}
+   returns {"query": ..., "clips": [...]}. Each clip has the metadata of a
+   retrieved node, a YouTube link starting at its timestamp, and its score.
+   Searches can be filtered with the parameters (or keys) episode_min,
+   episode_max, title, guest, start and end (seconds into the episode), which
+   need the metadata index (see metadata_index.py).
+2. GET /health returns {"status": "ok", "num_nodes": ...}.
+3. GET /metrics returns the service's metrics (see metrics.py).
+
+The index is loaded from the snapshot in ./data/snapshot (see snapshot.py), the
+memory-mapped export in ./data/mmap or the JSON index in ./data, in that order,
+and the metadata index from the snapshot or ./data/metadata.
+Query embeddings are cached in ./data/query_embeddings.sqlite, shared with the
+app.
+
+Usage:
+    python -m tldhuber.utils.search_api --port 8080
+
+Modules: os, asyncio, argparse, numpy, aiohttp, llama_index.
+"""
+
+import argparse
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+from aiohttp import web
+from llama_index.core.base.response.schema import Response
+
+from tldhuber.utils import metrics
+from tldhuber.utils.clips import extract_metadata
+from tldhuber.utils.metadata_index import FILTER_KEYS, MetadataIndex
+from tldhuber.utils.retrievers import MatrixRetriever
+
+MAX_TOP_K = 50
+EMBEDDING_CACHE_PATH = "./data/query_embeddings.sqlite"
+SERVICE_KEY = web.AppKey("service", "SearchService")
+
+
+class MicroBatcher:  # pylint: disable=R0903
+    """Groups concurrent calls into batches processed by a single call.
+
+    The first item of a batch waits at most max_wait seconds for others to
+    join; a batch that reaches max_batch items is processed right away.
+
+    Args:
+        process_batch (Callable): An async function mapping a list of items to the
+            list of their results, in the same order.
+        max_batch (int, optional): The largest batch. Defaults to 32.
+        max_wait (float, optional): The longest wait for a batch to fill, in
+            seconds. Defaults to 0.005.
+    """
+
+    def __init__(self, process_batch: Callable[[List[Any]], Awaitable[List[Any]]], *,
+                 max_batch: int = 32, max_wait: float = 0.005) -> None:
+        self.process_batch = process_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._running = set()
+
+    async def submit(self, item: Any) -> Any:
+        """Adds an item to the next batch and waits for its result.
+
+        Raises:
+            Exception: Whatever process_batch raised for the item's batch.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            # Keep a reference, since the event loop only holds tasks weakly
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch) -> None:
+        items = [item for item, _ in batch]
+        try:
+            results = await self.process_batch(items)
+        except Exception as error:  # pylint: disable=W0718
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class SearchService:
+    """Answers search queries in micro-batches.
+
+    Args:
+        retriever (MatrixRetriever): Scores the nodes; its similarity_top_k and
+            similarity_cutoff are the defaults of every query.
+        embed_model (BaseEmbedding): Embeds the queries. A CachedEmbedding embeds
+            the cache misses of a batch in one call.
+        max_batch (int, optional): See MicroBatcher. Defaults to 32.
+        max_wait (float, optional): See MicroBatcher. Defaults to 0.005.
+        metadata_index (MetadataIndex, optional): The metadata of the retriever's
+            rows, for filtered searches. Defaults to None.
+    """
+
+    def __init__(self, retriever: MatrixRetriever, embed_model, *,
+                 max_batch: int = 32, max_wait: float = 0.005,
+                 metadata_index: Optional[MetadataIndex] = None) -> None:
+        self.retriever = retriever
+        self.embed_model = embed_model
+        self.metadata_index = metadata_index
+        self.batcher = MicroBatcher(self.search_batch, max_batch=max_batch, max_wait=max_wait)
+
+    async def search(self, query: str, top_k: Optional[int] = None,
+                     filters: Optional[Dict[str, Any]] = None) -> dict:
+        """Retrieves the clips for one query, batched with concurrent queries.
+
+        Raises:
+            ValueError: If filters are given but the service has no metadata index.
+        """
+        row_mask = None
+        if filters:
+            if self.metadata_index is None:
+                raise ValueError("Filters need the metadata index; build it with "
+                                 "python -m tldhuber.utils.metadata_index.")
+            row_mask = self.metadata_index.mask(**filters)
+        return await self.batcher.submit(
+            (query, top_k or self.retriever.similarity_top_k, row_mask)
+        )
+
+    async def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Embeds a batch of queries with one call to the embedding model.
+
+        A CachedEmbedding looks the queries up in its SQLite tier in a worker
+        thread, so the event loop keeps receiving requests meanwhile.
+        """
+        with metrics.span("query_embedding"):
+            if hasattr(self.embed_model, "aget_query_embedding_batch"):
+                embeddings = await self.embed_model.aget_query_embedding_batch(queries)
+            else:
+                embeddings = await self.embed_model.aget_text_embedding_batch(queries)
+        return np.asarray(embeddings, dtype=np.float32)
+
+    async def search_batch(self, requests: List[tuple]) -> List[dict]:
+        """Answers a batch of (query, top_k, row_mask) requests, in order."""
+        metrics.REGISTRY.observe(metrics.SEARCH_BATCH_SIZE, len(requests))
+        embeddings = await self.embed_queries([query for query, _, _ in requests])
+        # Scoring and decoding run in a worker thread, leaving the event loop to
+        # receive the next batch
+        return await asyncio.to_thread(self.rank, requests, embeddings)
+
+    def rank(self, requests: List[tuple], embeddings: np.ndarray) -> List[dict]:
+        """Scores every node against the unfiltered queries of a batch in one pass,
+        and only the selected rows for filtered queries."""
+        ranked = self.retriever.search_rows_batch(
+            embeddings, max(k for _, k, _ in requests),
+            [row_mask for _, _, row_mask in requests],
+        )
+        return [
+            self.format_result(query, self.retriever.nodes_with_scores(rows[:k], scores[:k]))
+            for (query, k, _), (rows, scores) in zip(requests, ranked)
+        ]
+
+    @staticmethod
+    def format_result(query: str, source_nodes) -> dict:
+        """Makes the JSON of a query from the nodes the query engine would return."""
+        with metrics.span("extract_metadata"):
+            clips = extract_metadata(Response(response=None, source_nodes=source_nodes))
+        for clip, node in zip(clips, source_nodes):
+            clip["score"] = node.score
+        return {"query": query, "clips": clips}
+
+
+def parse_filters(params) -> Dict[str, Any]:
+    """Reads the metadata filters of a request from its query parameters or JSON body.
+
+    Raises:
+        ValueError: If a filter has the wrong type.
+    """
+    filters = {}
+    for key in FILTER_KEYS:
+        value = params.get(key)
+        if value is None or value == "":
+            continue
+        if key in ("title", "guest"):
+            if not isinstance(value, str):
+                raise ValueError(f"{key} must be a string.")
+            filters[key] = value
+            continue
+        try:
+            filters[key] = int(value) if key.startswith("episode") else float(value)
+        except (TypeError, ValueError) as error:
+            raise ValueError(f"{key} must be a number.") from error
+    return filters
+
+
+async def handle_query(request: web.Request) -> web.Response:
+    """Handles GET and POST /query."""
+    if request.method == "POST":
+        try:
+            body = await request.json()
+        except ValueError:
+            return web.json_response({"error": "The body must be JSON."}, status=400)
+        if not isinstance(body, dict):
+            body = {}
+        query, top_k, params = body.get("query"), body.get("top_k"), body
+    else:
+        query, top_k = request.query.get("q"), request.query.get("top_k")
+        params = request.query
+    if not isinstance(query, str) or not query.strip():
+        return web.json_response({"error": "A non-empty query is required."}, status=400)
+    try:
+        top_k = None if top_k is None else int(top_k)
+        if top_k is not None and not 0 < top_k <= MAX_TOP_K:
+            raise ValueError(top_k)
+    except (TypeError, ValueError):
+        return web.json_response(
+            {"error": f"top_k must be an integer from 1 to {MAX_TOP_K}."}, status=400
+        )
+    try:
+        filters = parse_filters(params)
+        with metrics.span("search_api"):
+            result = await request.app[SERVICE_KEY].search(query, top_k, filters)
+    except ValueError as error:
+        return web.json_response({"error": str(error)}, status=400)
+    return web.json_response(result)
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    """Handles GET /health."""
+    num_nodes = request.app[SERVICE_KEY].retriever.embeddings.shape[0]
+    return web.json_response({"status": "ok", "num_nodes": num_nodes})
+
+
+async def handle_metrics(_: web.Request) -> web.Response:
+    """Handles GET /metrics."""
+    return web.Response(text=metrics.REGISTRY.to_prometheus(),
+                        content_type="text/plain", charset="utf-8")
+
+
+def create_app(service: SearchService) -> web.Application:
+    """Creates the aiohttp application of a search service."""
+    app = web.Application()
+    app[SERVICE_KEY] = service
+    app.router.add_get("/query", handle_query)
+    app.router.add_post("/query", handle_query)
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+def load_index(data_dir: str = "./data"):
+    """Loads the vector index the app would load from data_dir.
+
+    Returns:
+        tuple[VectorStoreIndex, str]: The index, and the directory of the
+            metadata index of its rows.
+    """
+    # pylint: disable=C0415
+    from llama_index.core import StorageContext, VectorStoreIndex, load_index_from_storage
+    from tldhuber.utils.snapshot import is_snapshot, snapshot_dirs
+    from tldhuber.utils.vector_store import META_FILE, MmapVectorStore
+
+    snapshot_dir = os.path.join(data_dir, "snapshot")
+    dirs = snapshot_dirs(snapshot_dir) if is_snapshot(snapshot_dir) else {
+        "vectors": os.path.join(data_dir, "mmap"),
+        "metadata": os.path.join(data_dir, "metadata"),
+    }
+    if os.path.exists(os.path.join(dirs["vectors"], META_FILE)):
+        index = VectorStoreIndex.from_vector_store(MmapVectorStore(dirs["vectors"]))
+    else:
+        index = load_index_from_storage(StorageContext.from_defaults(persist_dir=data_dir))
+    return index, dirs["metadata"]
+
+
+def load_metadata_index(metadata_dir: str, index) -> Optional[MetadataIndex]:
+    """Loads the metadata index in metadata_dir if it was built on the rows of
+    index, and returns None otherwise."""
+    # pylint: disable=C0415
+    from tldhuber.utils.vector_store import META_FILE, index_signature
+
+    if not os.path.exists(os.path.join(metadata_dir, META_FILE)):
+        return None
+    num_rows, fingerprint = index_signature(index)
+    try:
+        return MetadataIndex.load(metadata_dir, num_rows=num_rows, fingerprint=fingerprint)
+    except ValueError:
+        return None
+
+
+def load_service(data_dir: str = "./data", **kwargs) -> SearchService:
+    """Loads the persisted index and the OpenAI query embedding model.
+
+    Args:
+        data_dir (str, optional): The directory the app loads its index from.
+            Defaults to "./data".
+        **kwargs: Passed to SearchService.
+
+    Returns:
+        SearchService: A service retrieving 10 nodes above a similarity of 0.25,
+            as the app does.
+    """
+    # pylint: disable=C0415
+    from llama_index.embeddings.openai import OpenAIEmbedding
+    from tldhuber.utils.embedding_cache import CachedEmbedding
+
+    index, metadata_dir = load_index(data_dir)
+    embed_model = CachedEmbedding(
+        OpenAIEmbedding(model="text-embedding-3-small"),
+        cache_path=os.path.join(data_dir, os.path.basename(EMBEDDING_CACHE_PATH)),
+    )
+    retriever = MatrixRetriever.from_index(index, embed_model=embed_model,
+                                           similarity_top_k=10, similarity_cutoff=0.25)
+    return SearchService(retriever, embed_model,
+                         metadata_index=load_metadata_index(metadata_dir, index), **kwargs)
+
+
+def main(argv: List[str] = None) -> None:
+    """Serves the search API. Needs OPENAI_API_KEY to embed queries."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args(argv)
+    service = load_service(args.data_dir, max_batch=args.max_batch,
+                           max_wait=args.max_wait_ms / 1000.0)
+    web.run_app(create_app(service), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
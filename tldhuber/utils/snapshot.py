@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file builds the prebuilt retrieval snapshot that the app loads at startup.
+
+A snapshot directory holds everything retrieval needs, in formats that are
+memory-mapped rather than parsed:
+1. vectors/ - the memory-mapped vector store export (see vector_store.py).
+2. bm25/ - the keyword index of the same nodes in row order, so the chat engine
+   can use hybrid retrieval (see bm25_index.py and retrievers.HybridRetriever).
+3. ivf/ - optionally, the approximate nearest neighbour index (see ann_index.py).
+4. quantized/ - optionally, int8 or binary codes of the vectors, which the app
+   scores instead of the full-precision vectors (see quantized_index.py).
+5. metadata/ - the metadata index of the vectors' rows, for filtering searches
+   by episode, guest or timestamp (see metadata_index.py).
+6. manifest.json - the format version, node count, dimension, components and
+   the options they were built with. Written last, so its presence marks a complete snapshot.
+
+Loading a snapshot opens a few small files and maps the rest, with no JSON index
+to parse and no index to build. Reading the manifest only needs the standard
+library, so the app can find a snapshot before importing llama_index. Build the
+snapshot once, then copy the directory to every replica (or bake it into the
+image) as data/snapshot.
+
+Usage:
+    python -m tldhuber.utils.snapshot --ivf
+
+Modules: os, json, time, shutil, argparse.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Optional
+
+SNAPSHOT_DIR = "./data/snapshot"
+MANIFEST_FILE = "manifest.json"
+FORMAT_VERSION = 1
+COMPONENT_DIRS = {"vectors": "vectors", "keyword": "bm25", "ivf": "ivf",
+                  "quantized": "quantized", "metadata": "metadata"}
+
+
+def is_snapshot(path: str) -> bool:
+    """Checks whether a complete snapshot has been written to a directory."""
+    return os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+
+def read_manifest(path: str) -> dict:
+    """Reads the manifest of a snapshot.
+
+    Raises:
+        ValueError: If the snapshot was written by an unsupported format version.
+    """
+    with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as file:
+        manifest = json.load(file)
+    if manifest["format_version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {manifest['format_version']} in {path}")
+    return manifest
+
+
+def snapshot_dirs(path: str) -> Dict[str, str]:
+    """Returns the directory of each component ("vectors", "keyword", "ivf",
+    "quantized" and "metadata") of a snapshot. Components that were not built have no meta.json
+    in their directory."""
+    return {component: os.path.join(path, subdir) for component, subdir in COMPONENT_DIRS.items()}
+
+
+def _build_indexes(store, dirs: Dict[str, str], *, ivf: bool, n_lists: Optional[int],
+                   quantize: Optional[str]) -> List[str]:
+    """Builds the indexes of a snapshot on its MmapVectorStore and returns their
+    component names."""
+    # pylint: disable=C0415
+    from tldhuber.utils.ann_index import IVFIndex
+    from tldhuber.utils.bm25_index import BM25Index
+    from tldhuber.utils.metadata_index import MetadataIndex
+    from tldhuber.utils.quantized_index import QuantizedIndex
+
+    components = ["keyword", "metadata"]
+    BM25Index.build(store.get_node(row) for row in range(store.num_nodes)).save(dirs["keyword"])
+    MetadataIndex.build(
+        store.get_node(row).metadata for row in range(store.num_nodes)
+    ).save(dirs["metadata"], store.fingerprint)
+    if ivf:
+        IVFIndex.build(store.embeddings, n_lists).save(dirs["ivf"], store.fingerprint)
+        components.append("ivf")
+    if quantize:
+        QuantizedIndex.build(store.embeddings, quantize).save(dirs["quantized"],
+                                                             store.fingerprint)
+        components.append("quantized")
+    return components
+
+
+def build_snapshot(index_dir: str = "./data", out_dir: str = SNAPSHOT_DIR, *,
+                   ivf: bool = False, n_lists: int = None, quantize: str = None) -> dict:
+    """Builds a snapshot from the app's vector index.
+
+    Args:
+        index_dir (str, optional): Either the JSON-persisted index written by
+            indexing.py, or its memory-mapped export. Defaults to "./data".
+        out_dir (str, optional): Defaults to SNAPSHOT_DIR.
+        ivf (bool, optional): Also build the approximate nearest neighbour index.
+            Defaults to False.
+        n_lists (int, optional): The number of IVF lists. Defaults to the square
+            root of the number of nodes.
+        quantize (str, optional): Also build quantized codes, "int8" or "binary".
+            Defaults to None.
+
+    Returns:
+        dict: The manifest of the snapshot.
+    """
+    # Imported here so that finding a snapshot does not import llama_index
+    # pylint: disable=C0415
+    from tldhuber.utils.vector_store import META_FILE, MmapVectorStore, export_persisted_index
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        # The snapshot is incomplete until the new manifest is written
+        os.remove(manifest_path)
+    dirs = snapshot_dirs(out_dir)
+    for directory in dirs.values():
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if os.path.exists(os.path.join(index_dir, META_FILE)):
+        shutil.copytree(index_dir, dirs["vectors"])
+    else:
+        export_persisted_index(index_dir, dirs["vectors"])
+    store = MmapVectorStore(dirs["vectors"])
+    components = ["vectors"] + _build_indexes(store, dirs, ivf=ivf, n_lists=n_lists,
+                                              quantize=quantize)
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "num_nodes": store.num_nodes,
+        "dim": int(store.embeddings.shape[1]),
+        "components": components,
+        "options": {"n_lists": n_lists, "quantize": quantize},
+    }
+    with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    return manifest
+
+
+def main(argv: List[str] = None) -> None:
+    """
+    Builds the snapshot in ./data/snapshot from ./data/mmap when the memory-mapped
+    export exists, and from the JSON index in ./data otherwise.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--index-dir", help="the JSON index or its memory-mapped export")
+    parser.add_argument("--out", default=SNAPSHOT_DIR)
+    parser.add_argument("--ivf", action="store_true", help="also build the IVF index")
+    parser.add_argument("--n-lists", type=int)
+    parser.add_argument("--quantize", choices=("int8", "binary"),
+                        help="also build quantized codes of the vectors")
+    args = parser.parse_args(argv)
+    index_dir = args.index_dir or (
+        "./data/mmap" if os.path.exists("./data/mmap/meta.json") else "./data"
+    )
+    manifest = build_snapshot(index_dir, args.out, ivf=args.ivf, n_lists=args.n_lists,
+                              quantize=args.quantize)
+    print(f"Saved a snapshot of {manifest['num_nodes']} nodes "
+          f"({', '.join(manifest['components'])}) to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file contains a benchmark of the app's import time and startup, measured on
+a snapshot of a synthetic corpus so that it needs no data, API key or network.
+
+Every repeat runs in a fresh interpreter, as a new app replica would, and times:
+1. import_streamlit - importing streamlit, which `streamlit run` has already done
+   before it runs the app.
+2. import_app - importing hello_huber in bare mode, which renders the page. This
+   is how long a replica takes to serve its first page.
+3. import_chat_stack - importing hello_huber.CHAT_MODULES, which a served app
+   does in the background after rendering the page.
+4. load_snapshot - load_data, then set_up_app_engines on the snapshot (see
+   snapshot.py).
+5. first_query - the first retrieval through the session's retriever.
+
+Results are written as JSON in the layout of retrieval_benchmark.py, so runs can
+be compared across commits in the same way.
+
+Usage:
+    python -m tldhuber.utils.startup_benchmark --out startup.json --compare baseline.json
+
+This file only imports the standard library at the top, so that measuring in a
+fresh interpreter is not skewed by the benchmark's own imports.
+
+Modules: os, sys, json, time, argparse, importlib, platform, subprocess, tempfile.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+QUERY = "How does morning sunlight affect sleep?"
+
+
+def set_up_app_engines(app, index) -> tuple:
+    """Builds the engines of a chat session the way the app does.
+
+    Args:
+        app (module): The imported hello_huber module.
+        index (VectorStoreIndex): The index returned by app.load_data.
+
+    Returns:
+        tuple[SessionRetriever, ContextChatEngine]: The session's retriever and the
+            chat engine built on it.
+    """
+    engine = app.set_up_engine(index, retriever_mode=app.default_retriever_mode(),
+                               keyword_index=app.load_keyword_index())
+    retriever = app.set_up_session_retriever(engine)
+    return retriever, app.set_up_chat_engine(retriever)
+
+
+def measure_startup(work_dir: str) -> Dict[str, float]:
+    """Times the startup stages in the current interpreter, which must not have
+    imported the app yet.
+
+    Args:
+        work_dir (str): A directory holding a snapshot in data/snapshot. The app is
+            imported from the current directory, then loads the snapshot from here.
+
+    Returns:
+        dict[str, float]: The seconds taken by each stage.
+    """
+    # pylint: disable=C0415
+    stages = {}
+    started = time.perf_counter()
+    importlib.import_module("streamlit")
+    stages["import_streamlit"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    app = importlib.import_module("tldhuber.hello_huber")
+    stages["import_app"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for name in app.CHAT_MODULES:
+        importlib.import_module(name)
+    stages["import_chat_stack"] = time.perf_counter() - started
+
+    from llama_index.core import Settings
+    from llama_index.core.embeddings import MockEmbedding
+    from tldhuber.utils.snapshot import read_manifest
+
+    os.chdir(work_dir)
+    dim = read_manifest(app.SNAPSHOT_DIR)["dim"]
+    started = time.perf_counter()
+    index = app.load_data()
+    # Queries are embedded locally instead of by the OpenAI model of load_data
+    Settings.embed_model = MockEmbedding(embed_dim=dim)
+    retriever, _ = set_up_app_engines(app, index)
+    stages["load_snapshot"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    retriever.retrieve(QUERY)
+    stages["first_query"] = time.perf_counter() - started
+    return stages
+
+
+def run_measurement(work_dir: str) -> Dict[str, float]:
+    """Runs measure_startup in a fresh interpreter and returns its stages."""
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "benchmark")
+    output = subprocess.run(
+        [sys.executable, "-m", "tldhuber.utils.startup_benchmark", "--measure", work_dir],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_benchmark(num_nodes: int = None, dim: int = 1536,  # pylint: disable=R0913
+                  repeats: int = 5, *, ivf: bool = False, seed: int = 0,
+                  work_dir: str = None) -> dict:
+    """Benchmarks startup on a snapshot of a synthetic corpus.
+
+    Args:
+        num_nodes (int, optional): The size of the corpus. Defaults to the size of
+            the real corpus.
+        dim (int, optional): The embedding dimension. Defaults to 1536.
+        repeats (int, optional): The number of fresh interpreters. Defaults to 5.
+        ivf (bool, optional): Include the IVF index in the snapshot. Defaults to False.
+        seed (int, optional): Seeds the corpus. Defaults to 0.
+        work_dir (str, optional): Where the snapshot is written. Defaults to a
+            temporary directory that is removed afterwards.
+
+    Returns:
+        dict: The environment, configuration and stage timings.
+    """
+    # pylint: disable=C0415
+    from tldhuber.utils.retrieval_benchmark import (BASE_CORPUS_CHUNKS, current_commit,
+                                                    summarize, write_synthetic_index)
+    from tldhuber.utils.snapshot import build_snapshot
+
+    num_nodes = num_nodes or BASE_CORPUS_CHUNKS
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        export_dir = os.path.join(tmp_dir, "mmap")
+        write_synthetic_index(export_dir, num_nodes, dim, seed)
+        build_snapshot(export_dir, os.path.join(tmp_dir, "data", "snapshot"), ivf=ivf)
+        runs = [run_measurement(tmp_dir) for _ in range(repeats)]
+    stages = {stage: summarize([run[stage] for run in runs]) for stage in runs[0]}
+    return {
+        "commit": current_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {"dim": dim, "repeats": repeats, "ivf": ivf, "seed": seed},
+        "results": [{"num_nodes": num_nodes, "stages": stages}],
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    """Runs the benchmark from the command line. Returns 1 if a stage regressed."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--nodes", type=int)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--ivf", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="startup_benchmark.json")
+    parser.add_argument("--compare", help="a previous results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--measure", metavar="WORK_DIR", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.measure:
+        print(json.dumps(measure_startup(args.measure)))
+        return 0
+
+    # pylint: disable=C0415
+    from tldhuber.utils.retrieval_benchmark import read_baseline, report_and_compare
+
+    baseline = read_baseline(args.compare)
+    report = run_benchmark(args.nodes, args.dim, args.repeats, ivf=args.ivf, seed=args.seed)
+    return report_and_compare(report, args.out, baseline, args.tolerance, precision=1)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
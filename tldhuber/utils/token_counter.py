@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file records the prompt and completion tokens of every LLM call in the
+metrics registry of metrics.py.
+
+LLMTokenCounter is a llama_index callback handler. It is kept out of metrics.py
+so that recording latencies does not import llama_index.
+
+Modules: llama_index.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from llama_index.core.callbacks import CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.callbacks.token_counting import TokenCounter, get_tokens_from_response
+
+from tldhuber.utils.metrics import LLM_TOKENS, REGISTRY, MetricsRegistry
+
+
+def llm_token_counts(token_counter: TokenCounter, payload: Dict[str, Any]) -> Tuple[int, int]:
+    """Returns the (prompt, completion) tokens of an LLM callback event.
+
+    The counts reported by the API are used when the raw response carries them
+    (they are missing for streamed responses), and are estimated with the
+    tokenizer otherwise.
+    """
+    if EventPayload.MESSAGES in payload:
+        response = payload.get(EventPayload.RESPONSE)
+    else:
+        response = payload.get(EventPayload.COMPLETION)
+    prompt_tokens, completion_tokens = 0, 0
+    if response is not None and response.raw is not None:
+        prompt_tokens, completion_tokens = get_tokens_from_response(response)
+    if not prompt_tokens:
+        if EventPayload.MESSAGES in payload:
+            prompt_tokens = token_counter.estimate_tokens_in_messages(
+                payload[EventPayload.MESSAGES]
+            )
+        else:
+            prompt_tokens = token_counter.get_string_tokens(
+                str(payload.get(EventPayload.PROMPT, ""))
+            )
+    if not completion_tokens and response is not None:
+        completion_tokens = token_counter.get_string_tokens(str(response))
+    return prompt_tokens, completion_tokens
+
+
+class LLMTokenCounter(BaseCallbackHandler):
+    """Callback handler that records the tokens of every LLM call in a registry.
+
+    Pass it in the callback_manager of the LLM, e.g.
+    OpenAI(callback_manager=CallbackManager([LLMTokenCounter()])).
+
+    Args:
+        registry (MetricsRegistry, optional): Defaults to REGISTRY.
+        tokenizer (Callable, optional): Used when the API reports no token counts.
+            Defaults to llama_index's tokenizer.
+    """
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None, tokenizer=None) -> None:
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.registry = registry or REGISTRY
+        self._token_counter = TokenCounter(tokenizer=tokenizer)
+
+    def on_event_start(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                       event_id: str = "", parent_id: str = "", **kwargs: Any) -> str:
+        return event_id
+
+    def on_event_end(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                     event_id: str = "", **kwargs: Any) -> None:
+        if event_type != CBEventType.LLM or not payload:
+            return
+        prompt_tokens, completion_tokens = llm_token_counts(self._token_counter, payload)
+        self.registry.observe(LLM_TOKENS, prompt_tokens, kind="prompt")
+        self.registry.observe(LLM_TOKENS, completion_tokens, kind="completion")
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(self, trace_id: Optional[str] = None,
+                  trace_map: Optional[Dict[str, List[str]]] = None) -> None:
+        pass
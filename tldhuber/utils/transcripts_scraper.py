@@ -19,75 +19,348 @@ information to JSON. It's designed to be run as a
 script, with example usage that fetches and saves
 video information from a specified channel.
 
+All requests go through a YouTubeClient, which keeps one pooled session, so
+connections are reused across pages and videos. Requests failing with HTTP 429
+or 5xx (or a dropped connection) are retried with exponential backoff,
+honouring Retry-After. When the client has a ScrapeState, it also:
+1. Sends conditional requests (If-None-Match / If-Modified-Since) for pages it
+   has seen, and reuses the stored page on HTTP 304 Not Modified.
+2. Remembers the playlist items, so refresh_playlist_items only pages through
+   the newest uploads until it reaches videos it already knows.
+3. Appends every fetched transcript to an on-disk log, so fetch_transcripts,
+   which fetches transcripts on a bounded pool of threads, never fetches a video
+   twice and an interrupted scrape resumes where it stopped.
+
 Authors: Mark Daniel, Amit Peled 
 Date: 2024-02-20
 """
 
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+YOUTUBE_API_URL = "https://www.googleapis.com/youtube/v3"
+SCRAPE_STATE_DIR = "./data/youtube_state"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ScrapeState:
+    """
+    On-disk state of a channel scrape, kept in a directory:
+    - responses.json: the ETag, Last-Modified and body of every cached API page,
+      and the known items of each playlist. Rewritten atomically by save().
+    - transcripts.jsonl: one {"video_id", "transcript"} record per fetched
+      video, appended as each transcript arrives. A torn last line (from an
+      interrupted write) is ignored.
+
+    Parameters:
+    - state_dir: The directory of the state. It is created if it does not exist.
+    """
+
+    def __init__(self, state_dir=SCRAPE_STATE_DIR):
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        self._responses_path = os.path.join(state_dir, "responses.json")
+        self._transcripts_path = os.path.join(state_dir, "transcripts.jsonl")
+        self._lock = threading.Lock()
+        self.responses, self.playlists = {}, {}
+        if os.path.exists(self._responses_path):
+            with open(self._responses_path, "r", encoding="utf-8") as file:
+                saved = json.load(file)
+            self.responses, self.playlists = saved["responses"], saved["playlists"]
+        self.transcripts = {}
+        if os.path.exists(self._transcripts_path):
+            with open(self._transcripts_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    self.transcripts[record["video_id"]] = record["transcript"]
+
+    def cached_response(self, key):
+        """Returns the cached {"etag", "last_modified", "body"} of a request, or None."""
+        with self._lock:
+            return self.responses.get(key)
+
+    def store_response(self, key, etag, last_modified, body):
+        """Caches the validators and body of a response. Call save() to persist them."""
+        with self._lock:
+            self.responses[key] = {"etag": etag, "last_modified": last_modified, "body": body}
+
+    def add_transcript(self, video_id, transcript):
+        """Records a fetched transcript, or None for a video without one, on disk."""
+        record = json.dumps({"video_id": video_id, "transcript": transcript})
+        with self._lock:
+            with open(self._transcripts_path, "a", encoding="utf-8") as file:
+                file.write(record + "\n")
+            self.transcripts[video_id] = transcript
+
+    def save(self):
+        """Writes the cached responses and playlist items, replacing the old file."""
+        with self._lock:
+            tmp_path = f"{self._responses_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump({"responses": self.responses, "playlists": self.playlists}, file)
+            os.replace(tmp_path, self._responses_path)
+
+
+class YouTubeClient:
+    """
+    Client for the YouTube Data API with a pooled, retrying session.
 
-def get_channel_upload_playlist_id_by_username(yt_data_api_key, username):
+    Parameters:
+    - yt_data_api_key: The YouTube Data API key, sent with every API request.
+    - base_url: The root of the API. Defaults to YOUTUBE_API_URL.
+    - state: A ScrapeState for conditional requests and resuming, or None.
+    - pool_size: The most connections kept open per host. Defaults to 8.
+    - retries: The most retries of a failing request. Defaults to 5.
+    - backoff_factor: Retries wait backoff_factor * 2 ** (retry - 1) seconds, or
+      as long as the server's Retry-After asks. Defaults to 0.5.
+    - timeout: The connect and read timeouts, in seconds. Defaults to (10, 60).
+    """
+
+    # pylint: disable=R0913
+    def __init__(self, yt_data_api_key, base_url=YOUTUBE_API_URL, state=None, *,
+                 pool_size=8, retries=5, backoff_factor=0.5, timeout=(10, 60)):
+        self.api_key = yt_data_api_key
+        self.base_url = base_url.rstrip("/")
+        self.state = state
+        self.timeout = timeout
+        self.stats = {"requests": 0, "not_modified": 0}
+        self._stats_lock = threading.Lock()
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUSES, allowed_methods=("GET",),
+                      respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get_json(self, url, params=None):
+        """
+        Fetches a JSON document, conditionally when the client has a state.
+
+        Parameters:
+        - url: An absolute URL, or a path under base_url such as "/channels".
+        - params: The query parameters. The API key is added to API requests.
+
+        Returns:
+        - The decoded JSON.
+
+        Raises:
+        - requests.HTTPError: If the response is an error, after any retries.
+        """
+        if url.startswith("/"):
+            url = f"{self.base_url}{url}"
+        params = dict(params or {})
+        # The cache key leaves out the API key, so that rotating it keeps the cache
+        key = requests.Request("GET", url, params=params).prepare().url
+        if url.startswith(self.base_url) and self.api_key:
+            params["key"] = self.api_key
+        cached = self.state.cached_response(key) if self.state is not None else None
+        headers = {}
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+        not_modified = response.status_code == 304 and cached is not None
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            self.stats["not_modified"] += not_modified
+        if not_modified:
+            return cached["body"]
+        response.raise_for_status()
+        body = response.json()
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if self.state is not None and (etag or last_modified):
+            self.state.store_response(key, etag, last_modified, body)
+        return body
+
+    def close(self):
+        """Closes the pooled connections."""
+        self.session.close()
+
+
+def get_channel_upload_playlist_id_by_username(yt_data_api_key, username, client=None):
     """
     Fetches the upload playlist ID for a given YouTube channel username.
     
     Parameters:
     - api_key: The YouTube Data API key.
     - username: The username of the YouTube channel.
+    - client: The YouTubeClient to use. Defaults to a new client.
     
     Returns:
     - The upload playlist ID as a string.
     """
-    base_url = "https://www.googleapis.com/youtube/v3/channels"
-    url=f"{base_url}?part=contentDetails&forUsername={username}&key={yt_data_api_key}"
-    response = requests.get(url, timeout=600)
-    data = response.json()
+    client = client or YouTubeClient(yt_data_api_key)
+    data = client.get_json("/channels", {"part": "contentDetails", "forUsername": username})
     if data['items']:
         return data["items"][0]["contentDetails"]["relatedPlaylists"]["uploads"]
     return None
 
-def get_channel_upload_playlist_id_by_channelid(yt_data_api_key, channel_id):
+def get_channel_upload_playlist_id_by_channelid(yt_data_api_key, channel_id, client=None):
     """
     Fetches the upload playlist ID for a given YouTube channel ID.
     
     Parameters:
     - api_key: The YouTube Data API key.
     - channel_id: The ID of the YouTube channel.
+    - client: The YouTubeClient to use. Defaults to a new client.
     
     Returns:
     - The upload playlist ID as a string.
     """
-    base_url = "https://www.googleapis.com/youtube/v3/channels"
-    url = f"{base_url}?part=contentDetails&id={channel_id}&key={yt_data_api_key}"
-    response = requests.get(url, timeout=600)
-    data = response.json()
+    client = client or YouTubeClient(yt_data_api_key)
+    data = client.get_json("/channels", {"part": "contentDetails", "id": channel_id})
     return data["items"][0]["contentDetails"]["relatedPlaylists"]["uploads"]
 
-def get_playlist_items(yt_data_api_key, playlist_id):
+def iter_playlist_pages(client, playlist_id):
+    """
+    Yields the items of each page of a YouTube playlist, following nextPageToken.
+
+    Parameters:
+    - client: The YouTubeClient to use.
+    - playlist_id: The ID of the playlist from which to fetch items.
+    """
+    params = {"part": "snippet,contentDetails", "maxResults": 50, "playlistId": playlist_id}
+    while True:
+        data = client.get_json("/playlistItems", params)
+        yield data["items"]
+        next_page_token = data.get("nextPageToken")
+        if not next_page_token:
+            break
+        params["pageToken"] = next_page_token
+
+def get_playlist_items(yt_data_api_key, playlist_id, client=None):
     """
     Retrieves all items in a given YouTube playlist.
     
     Parameters:
     - api_key: The YouTube Data API key.
     - playlist_id: The ID of the playlist from which to fetch items.
+    - client: The YouTubeClient to use. Defaults to a new client.
     
     Returns:
     - A list of items (videos) from the playlist.
     """
-    base_url = "https://www.googleapis.com/youtube/v3/playlistItems"
-    url = (
-        f"{base_url}?part=snippet,contentDetails"
-        f"&maxResults=50&playlistId={playlist_id}&key={yt_data_api_key}"
-    )
+    client = client or YouTubeClient(yt_data_api_key)
     items = []
-    while True:
-        response = requests.get(url,timeout=600)
-        data = response.json()
-        items.extend(data["items"])
-        next_page_token = data.get("nextPageToken")
-        if not next_page_token:
+    for page in iter_playlist_pages(client, playlist_id):
+        items.extend(page)
+    return items
+
+def video_id_of(item):
+    """Returns the video ID of a playlist item."""
+    return item["contentDetails"]["videoId"]
+
+def refresh_playlist_items(client, playlist_id):
+    """
+    Retrieves the items of a playlist ordered newest first, such as a channel's
+    uploads, reusing the items stored in the client's state. Pages are fetched
+    until one holds only known videos, and the known items follow the new ones.
+    Without a state, every page is fetched.
+
+    Parameters:
+    - client: The YouTubeClient to use.
+    - playlist_id: The ID of the playlist from which to fetch items.
+
+    Returns:
+    - A list of items (videos) from the playlist.
+    """
+    known = client.state.playlists.get(playlist_id, []) if client.state is not None else []
+    known_ids = {video_id_of(item) for item in known}
+    items = []
+    for page in iter_playlist_pages(client, playlist_id):
+        items.extend(item for item in page if video_id_of(item) not in known_ids)
+        if known_ids and all(video_id_of(item) in known_ids for item in page):
             break
-        url = f"{url}&pageToken={next_page_token}"
+    else:
+        # Every page was read, so videos missing from it have been removed
+        known = []
+    new_ids = {video_id_of(item) for item in items}
+    items.extend(item for item in known if video_id_of(item) not in new_ids)
+    if client.state is not None:
+        client.state.playlists[playlist_id] = items
+        client.state.save()
     return items
 
+def fetch_youtube_transcript(client, video_id, languages=("en",)):
+    """
+    Fetches the transcript of a video with youtube_transcript_api, through the
+    client's pooled session.
+
+    Parameters:
+    - client: The YouTubeClient to use.
+    - video_id: The ID of the video.
+    - languages: The transcript languages to look for, in order of preference.
+
+    Returns:
+    - The transcript segments ({"text", "start", "duration"}), or None if the
+      video has no transcript.
+
+    Raises:
+    - requests.RequestException: If the transcript could not be fetched for
+      another reason, e.g. rate limiting, so that it is retried later.
+    """
+    # pylint: disable=C0415
+    from youtube_transcript_api import (CouldNotRetrieveTranscript, NoTranscriptFound,
+                                        TranscriptsDisabled, VideoUnavailable)
+    # YouTubeTranscriptApi.list_transcripts does this with a new session per video
+    from youtube_transcript_api._transcripts import TranscriptListFetcher
+
+    try:
+        transcript_list = TranscriptListFetcher(client.session).fetch(video_id)
+        return transcript_list.find_transcript(languages).fetch()
+    except (NoTranscriptFound, TranscriptsDisabled, VideoUnavailable):
+        return None
+    except CouldNotRetrieveTranscript as error:
+        raise requests.RequestException(str(error)) from error
+
+def fetch_transcripts(client, video_ids, fetcher=fetch_youtube_transcript, max_workers=8):
+    """
+    Fetches the transcripts of videos on a pool of max_workers threads sharing the
+    client's connections. Transcripts already in the client's state are reused,
+    and every new transcript (or None, for a video without one) is recorded as
+    soon as it arrives. Videos whose fetch fails are skipped, and retried by the
+    next call.
+
+    Parameters:
+    - client: The YouTubeClient to use.
+    - video_ids: The IDs of the videos.
+    - fetcher: Fetches one transcript, given the client and a video ID, returning
+      None for videos without one. Defaults to fetch_youtube_transcript.
+    - max_workers: The most transcripts fetched at once. Defaults to 8.
+
+    Returns:
+    - A dict of the transcript of every video fetched now or before.
+    """
+    done = client.state.transcripts if client.state is not None else {}
+    transcripts = {video_id: done[video_id] for video_id in video_ids if video_id in done}
+    missing = [video_id for video_id in dict.fromkeys(video_ids) if video_id not in done]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetcher, client, video_id): video_id for video_id in missing}
+        for future in as_completed(futures):
+            video_id = futures[future]
+            try:
+                transcript = future.result()
+            except requests.RequestException as error:
+                print(f"Failed to fetch the transcript of {video_id}: {error}")
+                continue
+            if client.state is not None:
+                client.state.add_transcript(video_id, transcript)
+            transcripts[video_id] = transcript
+    return transcripts
+
 def save_video_information_to_json(video_information, file_path):
     """
     Saves the video information to a JSON file at the specified path.
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+This file converts the JSON-persisted VectorStoreIndex in `data/` into a compact
+binary layout that can be memory-mapped, and provides a read-only llama_index
+vector store on top of that layout.
+
+Loading the JSON index parses every embedding and every node into Python lists
+and dicts, once per process. The binary layout is instead mapped straight from
+disk, so startup does no parsing and every app worker shares the same physical
+pages through the OS page cache.
+
+Layout of an exported directory:
+1. embeddings.npy - contiguous (n_nodes, dim) float32 matrix, rows L2-normalized.
+2. nodes.bin - the serialized nodes (without embeddings), one JSON record per row.
+3. node_offsets.npy - (n_nodes + 1) uint64 byte offsets of each record in nodes.bin.
+4. meta.json - node count, dimension, format version, a fingerprint of the rows
+   and one of the node ids in row order. Written last, so its presence marks a
+   complete export.
+
+Indexes built on an export (ann_index, quantized_index, metadata_index) record
+its row count and fingerprint, and refuse to load against another export, whose
+rows may be in another order.
+
+Modules: os, json, mmap, hashlib, numpy, llama_index.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core import StorageContext, load_index_from_storage
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+FORMAT_VERSION = 1
+EMBEDDINGS_FILE = "embeddings.npy"
+NODES_FILE = "nodes.bin"
+OFFSETS_FILE = "node_offsets.npy"
+META_FILE = "meta.json"
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scales each row of a matrix to unit L2 norm, leaving all-zero rows as is.
+
+    Args:
+        matrix (np.ndarray): A 1-D vector or 2-D matrix of embeddings.
+
+    Returns:
+        np.ndarray: A float32 array of the same shape with unit-norm rows.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_rows(
+    scores: np.ndarray, top_k: int, similarity_cutoff: Optional[float] = None
+) -> np.ndarray:
+    """Selects the rows with the highest scores, best first.
+
+    Uses argpartition so that only the selected rows are sorted, which keeps the
+    selection linear in the number of rows.
+
+    Args:
+        scores (np.ndarray): A 1-D array with one similarity score per row.
+        top_k (int): The maximum number of rows to return.
+        similarity_cutoff (float, optional): When given, rows scoring below the
+            cutoff are dropped, matching SimilarityPostprocessor. Defaults to None.
+
+    Returns:
+        np.ndarray: The selected row numbers, ordered by descending score.
+    """
+    top_k = min(top_k, scores.shape[0])
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64)
+    rows = np.argpartition(-scores, top_k - 1)[:top_k]
+    if similarity_cutoff is not None:
+        rows = rows[scores[rows] >= similarity_cutoff]
+    return rows[np.argsort(-scores[rows], kind="stable")]
+
+
+def node_ids_fingerprint(node_ids: Iterable[str]) -> str:
+    """Returns the SHA-256 hex digest of a sequence of node ids, in order."""
+    digest = hashlib.sha256()
+    for node_id in node_ids:
+        digest.update(f"{node_id}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def export_rows(rows: Iterable[Tuple[Sequence[float], BaseNode]], num_nodes: int,
+                dim: int, out_dir: str) -> int:
+    """Writes (embedding, node) pairs in the memory-mapped layout, one row at a time.
+
+    Embeddings are L2-normalized so that cosine similarity becomes a plain dot
+    product. Nodes are stored without their embeddings.
+
+    Args:
+        rows (Iterable[tuple]): The (embedding, node) of each row, in row order.
+        num_nodes (int): The number of rows.
+        dim (int): The embedding dimension.
+        out_dir (str): The directory to write the exported files to.
+
+    Returns:
+        int: The number of exported nodes.
+    """
+    if num_nodes == 0:
+        raise ValueError("Cannot export an empty index.")
+    os.makedirs(out_dir, exist_ok=True)
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(out_dir, EMBEDDINGS_FILE),
+        mode="w+",
+        dtype=np.float32,
+        shape=(num_nodes, dim),
+    )
+    offsets = np.zeros(num_nodes + 1, dtype=np.uint64)
+    fingerprint = hashlib.sha256()
+    node_ids = []
+
+    with open(os.path.join(out_dir, NODES_FILE), "wb") as file:
+        for row, (embedding, node) in enumerate(rows):
+            embeddings[row] = normalize_rows(embedding)
+            node = node.copy()
+            node.embedding = None
+            record = json.dumps(doc_to_json(node)).encode("utf-8")
+            file.write(record)
+            offsets[row + 1] = offsets[row] + len(record)
+            fingerprint.update(record)
+            fingerprint.update(embeddings[row].tobytes())
+            node_ids.append(node.node_id)
+
+    embeddings.flush()
+    del embeddings
+    np.save(os.path.join(out_dir, OFFSETS_FILE), offsets)
+
+    meta = {"format_version": FORMAT_VERSION, "num_nodes": num_nodes, "dim": dim,
+            "fingerprint": fingerprint.hexdigest(),
+            "node_ids_fingerprint": node_ids_fingerprint(node_ids)}
+    with open(os.path.join(out_dir, META_FILE), "w", encoding="utf-8") as file:
+        json.dump(meta, file)
+
+    return num_nodes
+
+
+def read_fingerprint(persist_dir: str) -> Optional[str]:
+    """Returns the fingerprint of an export's rows, or None for exports written
+    before fingerprints were recorded."""
+    with open(os.path.join(persist_dir, META_FILE), "r", encoding="utf-8") as file:
+        return json.load(file).get("fingerprint")
+
+
+def check_built_on(meta: dict, num_rows: int, fingerprint: Optional[str],
+                   index_dir: str) -> None:
+    """Checks that an index derived from an export was built on the given rows.
+
+    Args:
+        meta (dict): The meta.json of the derived index, with its "num_rows" and,
+            if known, the "fingerprint" of the export it was built on.
+        num_rows (int): The number of rows of the export searched.
+        fingerprint (str): The fingerprint of that export, or None if unknown.
+        index_dir (str): The directory of the derived index, for the message.
+
+    Raises:
+        ValueError: If the row counts or the known fingerprints differ.
+    """
+    if meta["num_rows"] != num_rows:
+        raise ValueError(f"The index in {index_dir} has {meta['num_rows']} rows but the "
+                         f"vector index has {num_rows}; rebuild it.")
+    built_on = meta.get("fingerprint")
+    if built_on and fingerprint and built_on != fingerprint:
+        raise ValueError(f"The index in {index_dir} was built on another export of the "
+                         "vector index; rebuild it.")
+
+
+def export_index(index, out_dir: str) -> int:
+    """Writes the nodes and embeddings of a VectorStoreIndex in the memory-mapped layout.
+
+    Rows are written in the order of the index's node table, and embeddings are
+    L2-normalized so that cosine similarity becomes a plain dot product.
+
+    Args:
+        index (VectorStoreIndex): An index backed by a vector store that keeps
+            embeddings, such as the default SimpleVectorStore.
+        out_dir (str): The directory to write the exported files to.
+
+    Returns:
+        int: The number of exported nodes.
+    """
+    node_ids = list(index.index_struct.nodes_dict.values())
+    if not node_ids:
+        raise ValueError("Cannot export an empty index.")
+    rows = (
+        (index.vector_store.get(node_id), index.docstore.get_node(node_id))
+        for node_id in node_ids
+    )
+    dim = len(index.vector_store.get(node_ids[0]))
+    return export_rows(rows, len(node_ids), dim, out_dir)
+
+
+class MmapVectorStore(BasePydanticVectorStore):
+    """Read-only vector store over a directory written by `export_index`.
+
+    The embedding matrix and the node table are memory-mapped, and nodes are only
+    decoded when they are returned from a query. Use
+    `VectorStoreIndex.from_vector_store` to get an index for retrievers and chat
+    engines.
+    """
+
+    stores_text: bool = True
+    persist_dir: str
+
+    _embeddings: np.ndarray = PrivateAttr()
+    _offsets: np.ndarray = PrivateAttr()
+    _nodes_blob: mmap.mmap = PrivateAttr()
+    _fingerprint: Optional[str] = PrivateAttr(default=None)
+    _node_ids_fingerprint: Optional[str] = PrivateAttr(default=None)
+
+    def __init__(self, persist_dir: str, **kwargs: Any) -> None:
+        super().__init__(persist_dir=persist_dir, **kwargs)
+        with open(os.path.join(persist_dir, META_FILE), "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported vector store format {meta['format_version']} in {persist_dir}."
+            )
+
+        self._fingerprint = meta.get("fingerprint")
+        self._node_ids_fingerprint = meta.get("node_ids_fingerprint")
+        self._embeddings = np.load(os.path.join(persist_dir, EMBEDDINGS_FILE), mmap_mode="r")
+        self._offsets = np.load(os.path.join(persist_dir, OFFSETS_FILE), mmap_mode="r")
+        with open(os.path.join(persist_dir, NODES_FILE), "rb") as file:
+            self._nodes_blob = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @property
+    def client(self) -> None:
+        """This store has no underlying client."""
+        return None
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """The memory-mapped, row-normalized (n_nodes, dim) float32 matrix."""
+        return self._embeddings
+
+    @property
+    def num_nodes(self) -> int:
+        """The number of nodes in the store."""
+        return self._embeddings.shape[0]
+
+    @property
+    def fingerprint(self) -> Optional[str]:
+        """The fingerprint of the exported rows, or None for older exports."""
+        return self._fingerprint
+
+    @property
+    def node_ids_fingerprint(self) -> str:
+        """The fingerprint of the node ids in row order (see node_ids_fingerprint).
+        Older exports did not record it, so their nodes are decoded once."""
+        if self._node_ids_fingerprint is None:
+            self._node_ids_fingerprint = node_ids_fingerprint(
+                self.get_node(row).node_id for row in range(self.num_nodes)
+            )
+        return self._node_ids_fingerprint
+
+    def get_node(self, row: int) -> BaseNode:
+        """Decodes the node stored at the given row of the embedding matrix."""
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        return json_to_doc(json.loads(self._nodes_blob[start:end]))
+
+    def get_nodes_by_rows(self, rows) -> List[BaseNode]:
+        """Decodes the nodes stored at the given rows, in order."""
+        return [self.get_node(int(row)) for row in rows]
+
+    def add(self, nodes: List[BaseNode], **kwargs: Any) -> List[str]:
+        raise NotImplementedError("MmapVectorStore is read-only; re-export the index.")
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        raise NotImplementedError("MmapVectorStore is read-only; re-export the index.")
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """Scores every row against the query embedding and returns the top k nodes."""
+        if query.query_embedding is None:
+            raise ValueError("MmapVectorStore requires a query embedding.")
+        if query.filters is not None:
+            raise ValueError("MmapVectorStore does not support metadata filters.")
+
+        scores = self._embeddings @ normalize_rows(query.query_embedding)
+        rows = top_k_rows(scores, query.similarity_top_k)
+        nodes = self.get_nodes_by_rows(rows)
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=scores[rows].tolist(),
+            ids=[node.node_id for node in nodes],
+        )
+
+
+def index_signature(index) -> Tuple[int, Optional[str]]:
+    """Returns the number of rows of a VectorStoreIndex and, for an index over an
+    MmapVectorStore, the fingerprint of its export (None otherwise)."""
+    store = index.vector_store
+    if isinstance(store, MmapVectorStore):
+        return store.num_nodes, store.fingerprint
+    return len(index.index_struct.nodes_dict), None
+
+
+def export_persisted_index(persist_dir: str, out_dir: str) -> int:
+    """Loads the JSON-persisted index in persist_dir and exports it to out_dir."""
+    storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+    loaded_index = load_index_from_storage(storage_context)
+    return export_index(loaded_index, out_dir)
+
+
+def main():
+    """
+    Converts the JSON index in ./data, as written by indexing.main(), into the
+    memory-mapped layout in ./data/mmap that the app loads at startup.
+    """
+    num_nodes = export_persisted_index("./data", "./data/mmap")
+    print(f"Exported {num_nodes} nodes to ./data/mmap")
+
+
+if __name__ == "__main__":
+    main()